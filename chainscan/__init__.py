@@ -7,9 +7,9 @@ ChainScan
 """
 
 from .utils import iter_blocks, get_blockchain, iter_txs
-from .scan import BlockFilter
+from .scan import BlockFilter, ReorgEvent
 from .block import Block
 from .tx import Tx, TxInput, TxOutput, CoinbaseTxInput
 
 # avoid pyflakes "imported but unused" warnings:
-iter_blocks, get_blockchain, iter_txs, BlockFilter, Block, Tx, TxInput, TxOutput, CoinbaseTxInput
+iter_blocks, get_blockchain, iter_txs, BlockFilter, ReorgEvent, Block, Tx, TxInput, TxOutput, CoinbaseTxInput
@@ -6,7 +6,7 @@ This module is imported from `_block_c.pyx`.
 """
 
 from .misc import deserialize_varlen_integer
-from .tx import TxInBlock, deserialize_tx
+from .tx import TxInBlock, BlockContext, deserialize_tx
 
 ################################################################################
 # BLOCK TXS
@@ -22,11 +22,20 @@ class BlockTxsIterator:
     """
     
     def __init__(self, blob, num_txs, block, include_block_context = False, include_tx_blob = False):
+        """
+        :param include_block_context: generate `TxInBlock` objects instead of `Tx`
+            objects, referencing the block.  If 'light', they reference a
+            `BlockContext` of the block instead of the block itself.
+        """
         self.blob = blob
         self.block = block
         self.num_txs = num_txs
         self.include_block_context = include_block_context
         self.include_tx_blob = include_tx_blob
+        if include_block_context == 'light':
+            self._block_context = BlockContext.from_block(block)
+        else:
+            self._block_context = block
         # state
         self._offset = 0
         self._tx_idx = 0
@@ -45,7 +54,7 @@ class BlockTxsIterator:
     def _make_tx(self, blob, idx_in_block):
         tx = deserialize_tx(blob, include_blob = self.include_tx_blob)
         if self.include_block_context:
-            tx = TxInBlock(tx, self.block, index = idx_in_block)
+            tx = TxInBlock(tx, self._block_context, index = idx_in_block)
         return tx
     
     def __iter__(self):
@@ -95,11 +104,12 @@ class BlockTxs:
             include_block_context = include_block_context,
             **kwargs)
 
-    def iter_txs_in_block(self, **kwargs):
+    def iter_txs_in_block(self, light = False, **kwargs):
         """
         Same as `iter_txs`, but generates `TxInBlock` objects instead of `Tx` objects.
+        :param light: reference a `BlockContext` of the block, instead of the block
         """
-        return self.iter_txs(include_block_context = True, **kwargs)
+        return self.iter_txs(include_block_context = 'light' if light else True, **kwargs)
 
     def __repr__(self):
         return '<%s (%d txs)>' % (type(self).__name__, len(self))
@@ -18,5 +18,7 @@ cdef class Block:
         readonly bytesview blob
         public int32_t height
         readonly bytearray _block_hash
+        public object filepos
+        object __weakref__
 
 cpdef Block deserialize_block(bytesview buf, int32_t height, bint prefix_included = *)
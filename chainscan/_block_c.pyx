@@ -33,6 +33,7 @@ cdef class Block:
             bytesview nonce_bytes,
             bytesview blob,
             int32_t height = -1,
+            object filepos = None,
             ):
 
         self.version_bytes = version_bytes
@@ -44,8 +45,25 @@ cdef class Block:
         self.blob = blob
         self.height = height
         self._block_hash = doublehash(blob[:80])  # doublehash of the 80-byte header
+        self.filepos = filepos  # where the block is stored (a FilePos), if known
 
 
+    def detach(self):
+        """
+        Copy the data of the block out of the buffer it was read from.
+
+        A block references the data of the whole `blk*.dat` file it was read
+        from, so keeping a block keeps that data alive.  A detached block only
+        keeps a copy of its own data.
+        :note: txs already generated from the block are not detached.
+        """
+        self.blob = bytearray(self.blob)
+        self.version_bytes = self.blob[0 : 4]
+        self._prev_block_hash = self.blob[4 : 36]
+        self.merkle_root = self.blob[36 : 68]
+        self.difficulty_bytes = self.blob[72 : 76]
+        self.nonce_bytes = self.blob[76 : 80]
+
     # Block properties
 
     property rawsize:
@@ -109,9 +127,9 @@ cdef class Block:
     def __reduce__(self):
         return (
             # The function to call to create the object:
-            deserialize_block,
+            _unpickle_block,
             # Args to pass to the function:
-            ( bytearray(self.blob), self.height, False ),
+            ( bytearray(self.blob), self.height, self.filepos ),
         )
     
 
@@ -119,6 +137,11 @@ cdef class Block:
 # DESERIALIZATION
 ################################################################################
 
+def _unpickle_block(blob, height, filepos):
+    block = deserialize_block(blob, height, False)
+    block.filepos = filepos
+    return block
+
 @boundscheck(False)
 @wraparound(False)
 @nonecheck(False)
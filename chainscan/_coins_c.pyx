@@ -0,0 +1,277 @@
+"""
+(De)serialization of bitcoind's "coins" (spent or unspent tx outputs), as found in
+bitcoind's undo files (`rev*.dat`) and UTXO snapshots (`dumptxoutset`),
+implemented using Cython for speed.
+
+Coins are stored in bitcoind's compressed format (see bitcoind's `compressor.h`):
+amounts and scripts are compressed, and integers are serialized as VARINTs (which
+are not the same as the "varlen integers" used in blocks and txs).
+"""
+
+from cython cimport boundscheck, wraparound, nonecheck
+
+include "consts.pxi"
+
+from chainscan._common_c cimport uint8_t, uint32_t, uint64_t, bytesview, varlenint_pair
+from chainscan._common_c cimport deserialize_varlen_integer
+from chainscan._tx_c cimport TxOutput
+
+from chainscan.misc import Bunch
+
+
+################################################################################
+# VARINT
+################################################################################
+
+cdef struct varint_pair:
+    uint64_t value
+    uint32_t consumed
+
+@boundscheck(False)
+@wraparound(False)
+@nonecheck(False)
+cdef varint_pair _deserialize_varint(bytesview buf) nogil:
+    cdef varint_pair res
+    cdef uint8_t ch
+    res.value = 0
+    res.consumed = 0
+    while True:
+        ch = buf[res.consumed]
+        res.consumed += 1
+        res.value = (res.value << 7) | (ch & 0x7F)
+        if ch & 0x80:
+            res.value += 1
+        else:
+            return res
+
+cpdef tuple deserialize_varint(bytesview buf):
+    """
+    Deserialize a bitcoind VARINT (MSB base-128 encoding).
+    :return: a (value, consumed) pair
+    """
+    cdef varint_pair pair = _deserialize_varint(buf)
+    return ( pair.value, pair.consumed )
+
+cpdef bytes serialize_varint(uint64_t n):
+    """
+    The inverse of `deserialize_varint`.
+    """
+    cdef uint8_t tmp[10]
+    cdef int i = 0
+    while True:
+        tmp[i] = (n & 0x7F) | (0x80 if i else 0x00)
+        if n <= 0x7F:
+            break
+        n = (n >> 7) - 1
+        i += 1
+    return bytes([ tmp[j] for j in range(i, -1, -1) ])
+
+
+################################################################################
+# AMOUNT AND SCRIPT DECOMPRESSION
+################################################################################
+
+cpdef uint64_t decompress_amount(uint64_t x) nogil:
+    """
+    The inverse of bitcoind's `CompressAmount()`.
+    """
+    cdef uint64_t e, d, n
+    if x == 0:
+        return 0
+    x -= 1
+    e = x % 10
+    x //= 10
+    if e < 9:
+        d = (x % 9) + 1
+        x //= 9
+        n = x * 10 + d
+    else:
+        n = x + 1
+    while e:
+        n *= 10
+        e -= 1
+    return n
+
+cpdef uint64_t compress_amount(uint64_t n) nogil:
+    """
+    bitcoind's `CompressAmount()`.
+    """
+    cdef uint64_t e = 0, d
+    if n == 0:
+        return 0
+    while (n % 10) == 0 and e < 9:
+        n //= 10
+        e += 1
+    if e < 9:
+        d = n % 10
+        n //= 10
+        return 1 + (n * 9 + d - 1) * 10 + e
+    return 1 + (n - 1) * 10 + 9
+
+# number of bytes following nSize, for the special (templated) script types
+SPECIAL_SCRIPT_SIZES = ( 20, 20, 32, 32, 32, 32 )
+DEF NUM_SPECIAL_SCRIPTS = 6
+
+# secp256k1 field prime, for decompressing public keys
+SECP256K1_P = 2**256 - 2**32 - 977
+
+def decompress_pubkey(uint8_t prefix, bytes x_bytes):
+    """
+    Compute the uncompressed (65-byte) form of a compressed secp256k1 public key.
+    :param prefix: 2 or 3, the parity of y
+    """
+    p = SECP256K1_P
+    x = int.from_bytes(x_bytes, 'big')
+    y = pow((x * x * x + 7) % p, (p + 1) // 4, p)
+    if (y & 1) != (prefix & 1):
+        y = p - y
+    return b'\x04' + x_bytes + y.to_bytes(32, 'big')
+
+cpdef bytes decompress_script(uint64_t nsize, bytesview data):
+    """
+    The inverse of bitcoind's script compression.
+    :param nsize: the script-type/size code
+    :param data: the bytes following the code (exactly as many as the code indicates)
+    """
+    if nsize == 0:  # P2PKH
+        return b'\x76\xa9\x14' + bytes(data) + b'\x88\xac'
+    if nsize == 1:  # P2SH
+        return b'\xa9\x14' + bytes(data) + b'\x87'
+    if nsize == 2 or nsize == 3:  # P2PK, compressed pubkey
+        return b'\x21' + bytes([ nsize ]) + bytes(data) + b'\xac'
+    if nsize == 4 or nsize == 5:  # P2PK, uncompressed pubkey
+        return b'\x41' + decompress_pubkey(nsize - 2, bytes(data)) + b'\xac'
+    return bytes(data)
+
+cpdef bytes compress_script(bytes script):
+    """
+    bitcoind's script compression.
+    :note: uncompressed P2PK scripts are not compressed (this is allowed by the
+        format, and saves validating the pubkey).
+    :return: the script-type/size code (as a VARINT) followed by the data
+    """
+    cdef Py_ssize_t n = len(script)
+    if n == 25 and script[:3] == b'\x76\xa9\x14' and script[23:] == b'\x88\xac':  # P2PKH
+        return b'\x00' + script[3:23]
+    if n == 23 and script[:2] == b'\xa9\x14' and script[22] == 0x87:  # P2SH
+        return b'\x01' + script[2:22]
+    if n == 35 and script[0] == 0x21 and script[1] in (2, 3) and script[34] == 0xac:  # P2PK, compressed
+        return script[1:34]
+    return serialize_varint(n + NUM_SPECIAL_SCRIPTS) + script
+
+cdef uint64_t _get_compressed_script_size(uint64_t nsize):
+    if nsize < NUM_SPECIAL_SCRIPTS:
+        return SPECIAL_SCRIPT_SIZES[nsize]
+    return nsize - NUM_SPECIAL_SCRIPTS
+
+
+################################################################################
+# COINS
+################################################################################
+
+@boundscheck(False)
+@wraparound(False)
+@nonecheck(False)
+cpdef tuple deserialize_compressed_txout(bytesview buf):
+    """
+    Deserialize a tx output in bitcoind's compressed format (`TxOutCompression`).
+    :return: a (TxOutput, consumed) pair
+    """
+    cdef varint_pair pair
+    cdef uint64_t value
+    cdef uint64_t nsize
+    cdef uint64_t script_size
+    cdef uint32_t offset
+    pair = _deserialize_varint(buf)
+    value = decompress_amount(pair.value)
+    offset = pair.consumed
+    pair = _deserialize_varint(buf[offset:])
+    nsize = pair.value
+    offset += pair.consumed
+    script_size = _get_compressed_script_size(nsize)
+    cdef TxOutput txout = TxOutput(value, None)
+    txout.script = decompress_script(nsize, buf[offset : offset + script_size])
+    offset += script_size
+    return ( txout, offset )
+
+cpdef bytes serialize_compressed_txout(uint64_t value, bytes script):
+    """
+    The inverse of `deserialize_compressed_txout`.
+    """
+    return serialize_varint(compress_amount(value)) + compress_script(script)
+
+@boundscheck(False)
+@wraparound(False)
+@nonecheck(False)
+cpdef tuple deserialize_coin(bytesview buf):
+    """
+    Deserialize an unspent output, as stored in a UTXO snapshot (`Coin`).
+    :return: a (TxOutput, block_height, is_coinbase, consumed) tuple
+    """
+    cdef varint_pair pair = _deserialize_varint(buf)
+    cdef uint64_t code = pair.value
+    cdef uint32_t offset = pair.consumed
+    txout, consumed = deserialize_compressed_txout(buf[offset:])
+    offset += consumed
+    return ( txout, code >> 1, bool(code & 1), offset )
+
+cpdef bytes serialize_coin(uint64_t value, bytes script, uint64_t block_height, bint is_coinbase=False):
+    """
+    The inverse of `deserialize_coin`.
+    """
+    return serialize_varint(block_height * 2 + is_coinbase) + serialize_compressed_txout(value, script)
+
+@boundscheck(False)
+@wraparound(False)
+@nonecheck(False)
+cpdef tuple deserialize_undo_coin(bytesview buf):
+    """
+    Deserialize a spent output, as stored in undo data (`TxInUndoFormatter`).
+    :return: a (spending_info, consumed) pair, where spending_info is a Bunch,
+        like the ones set by TrackedSpendingTxIterator (with an extra `is_coinbase`
+        attribute).
+    """
+    cdef varint_pair pair = _deserialize_varint(buf)
+    cdef uint64_t code = pair.value
+    cdef uint32_t offset = pair.consumed
+    cdef uint64_t height = code >> 1
+    if height > 0:
+        # a dummy version field, kept for backward compatibility
+        offset += _deserialize_varint(buf[offset:]).consumed
+    txout, consumed = deserialize_compressed_txout(buf[offset:])
+    offset += consumed
+    spending_info = Bunch(
+        spent_output = txout,
+        block_height = height,
+        is_coinbase = bool(code & 1),
+    )
+    return ( spending_info, offset )
+
+@boundscheck(False)
+@wraparound(False)
+@nonecheck(False)
+cpdef list deserialize_block_undo(bytesview buf):
+    """
+    Deserialize a block's undo data (`CBlockUndo`).
+    :return: a list with an element per non-coinbase tx in the block, each a list
+        of spending_info objects, one per tx input.
+    """
+    cdef varlenint_pair pair = deserialize_varlen_integer(buf)
+    cdef uint32_t num_txs = pair.first
+    cdef uint32_t num_inputs
+    cdef uint32_t offset = pair.second
+    cdef list block_undo = []
+    cdef list tx_undo
+    while num_txs > 0:
+        num_txs -= 1
+        pair = deserialize_varlen_integer(buf[offset:])
+        num_inputs = pair.first
+        offset += pair.second
+        tx_undo = []
+        while num_inputs > 0:
+            num_inputs -= 1
+            spending_info, consumed = deserialize_undo_coin(buf[offset:])
+            tx_undo.append(spending_info)
+            offset += consumed
+        block_undo.append(tx_undo)
+    return block_undo
@@ -0,0 +1,254 @@
+"""
+Golomb-coded sets (GCS), as used by BIP158 compact block filters, implemented
+using Cython for speed.
+
+A GCS is a compact probabilistic set: items are hashed (using SipHash-2-4) to
+the range [0, N*M), and the sorted hashes are stored as Golomb-Rice coded
+deltas, with parameter P.  Testing for an item can yield false positives (at a
+rate of about 1/M), but no false negatives.
+"""
+
+from cython cimport boundscheck, wraparound, nonecheck
+from libcpp.vector cimport vector
+from libcpp.algorithm cimport sort
+
+from chainscan._common_c cimport uint8_t, uint32_t, uint64_t
+
+
+################################################################################
+# SipHash-2-4
+################################################################################
+
+cdef inline uint64_t _rotl(uint64_t x, int b) nogil:
+    return (x << b) | (x >> (64 - b))
+
+cdef inline uint64_t _load64(const uint8_t* p) nogil:
+    cdef uint64_t x = 0
+    cdef int i
+    for i in range(7, -1, -1):
+        x = (x << 8) | p[i]
+    return x
+
+@boundscheck(False)
+@wraparound(False)
+@nonecheck(False)
+cdef uint64_t _siphash24(uint64_t k0, uint64_t k1, const uint8_t* data, size_t size) nogil:
+    cdef:
+        uint64_t v0 = k0 ^ 0x736f6d6570736575ULL
+        uint64_t v1 = k1 ^ 0x646f72616e646f6dULL
+        uint64_t v2 = k0 ^ 0x6c7967656e657261ULL
+        uint64_t v3 = k1 ^ 0x7465646279746573ULL
+        uint64_t m
+        uint64_t b = (<uint64_t>size) << 56
+        size_t end = size - (size % 8)
+        size_t i
+        int r
+    i = 0
+    while i < end:
+        m = _load64(data + i)
+        v3 ^= m
+        for r in range(2):
+            v0 += v1; v1 = _rotl(v1, 13); v1 ^= v0; v0 = _rotl(v0, 32)
+            v2 += v3; v3 = _rotl(v3, 16); v3 ^= v2
+            v0 += v3; v3 = _rotl(v3, 21); v3 ^= v0
+            v2 += v1; v1 = _rotl(v1, 17); v1 ^= v2; v2 = _rotl(v2, 32)
+        v0 ^= m
+        i += 8
+    for i in range(size - end):
+        b |= (<uint64_t>data[end + i]) << (8 * i)
+    v3 ^= b
+    for r in range(2):
+        v0 += v1; v1 = _rotl(v1, 13); v1 ^= v0; v0 = _rotl(v0, 32)
+        v2 += v3; v3 = _rotl(v3, 16); v3 ^= v2
+        v0 += v3; v3 = _rotl(v3, 21); v3 ^= v0
+        v2 += v1; v1 = _rotl(v1, 17); v1 ^= v2; v2 = _rotl(v2, 32)
+    v0 ^= b
+    v2 ^= 0xff
+    for r in range(4):
+        v0 += v1; v1 = _rotl(v1, 13); v1 ^= v0; v0 = _rotl(v0, 32)
+        v2 += v3; v3 = _rotl(v3, 16); v3 ^= v2
+        v0 += v3; v3 = _rotl(v3, 21); v3 ^= v0
+        v2 += v1; v1 = _rotl(v1, 17); v1 ^= v2; v2 = _rotl(v2, 32)
+    return v0 ^ v1 ^ v2 ^ v3
+
+cpdef uint64_t siphash24(uint64_t k0, uint64_t k1, const uint8_t[::1] data):
+    """
+    SipHash-2-4 of `data`, with the 128-bit key (k0, k1).
+    """
+    return _siphash24(k0, k1, &data[0] if len(data) else NULL, len(data))
+
+cdef inline uint64_t _mulhi64(uint64_t a, uint64_t b) nogil:
+    # the high 64 bits of the 128-bit product
+    cdef:
+        uint64_t a_lo = a & 0xffffffffULL
+        uint64_t a_hi = a >> 32
+        uint64_t b_lo = b & 0xffffffffULL
+        uint64_t b_hi = b >> 32
+        uint64_t lo_lo = a_lo * b_lo
+        uint64_t hi_lo = a_hi * b_lo
+        uint64_t lo_hi = a_lo * b_hi
+        uint64_t hi_hi = a_hi * b_hi
+        uint64_t cross = (lo_lo >> 32) + (hi_lo & 0xffffffffULL) + lo_hi
+    return hi_hi + (hi_lo >> 32) + (cross >> 32)
+
+cdef vector[uint64_t] _hash_items(bytes key, items, uint64_t F) except *:
+    # hash the items to [0, F), sorted
+    cdef:
+        const uint8_t* key_ptr
+        uint64_t k0, k1
+        vector[uint64_t] hashes
+        const uint8_t[::1] item_view
+    if len(key) != 16:
+        raise ValueError('Key must be 16 bytes')
+    key_ptr = <const uint8_t*><const char*>key
+    k0 = _load64(key_ptr)
+    k1 = _load64(key_ptr + 8)
+    hashes.reserve(len(items))
+    for item in items:
+        item_view = item
+        hashes.push_back(_mulhi64(_siphash24(k0, k1, &item_view[0] if len(item_view) else NULL, len(item_view)), F))
+    sort(hashes.begin(), hashes.end())
+    return hashes
+
+
+################################################################################
+# Golomb-coded sets
+################################################################################
+
+cdef struct _BitWriter:
+    vector[uint8_t] data
+    uint8_t nbits  # bits used in the last byte
+
+cdef inline void _write_bit(_BitWriter* w, bint bit) nogil:
+    if w.nbits == 0:
+        w.data.push_back(0)
+    if bit:
+        w.data[w.data.size() - 1] = w.data[w.data.size() - 1] | (0x80 >> w.nbits)
+    w.nbits = (w.nbits + 1) % 8
+
+cdef struct _BitReader:
+    const uint8_t* data
+    size_t size
+    size_t pos  # in bits
+
+cdef inline int _read_bit(_BitReader* r) nogil:
+    # -1 at the end of the data
+    cdef int bit
+    if r.pos >= r.size * 8:
+        return -1
+    bit = (r.data[r.pos // 8] >> (7 - r.pos % 8)) & 1
+    r.pos += 1
+    return bit
+
+cdef inline bint _read_value(_BitReader* r, uint8_t P, uint64_t* value) nogil:
+    # read a Golomb-Rice coded value. returns False at the end of the data
+    cdef uint64_t q = 0
+    cdef uint64_t x = 0
+    cdef int bit
+    cdef int i
+    while True:
+        bit = _read_bit(r)
+        if bit < 0:
+            return False
+        if bit == 0:
+            break
+        q += 1
+    for i in range(P):
+        bit = _read_bit(r)
+        if bit < 0:
+            return False
+        x = (x << 1) | bit
+    value[0] = (q << P) | x
+    return True
+
+cdef bytes _serialize_compact_size(uint64_t n):
+    if n < 0xfd:
+        return bytes([n])
+    if n <= 0xffff:
+        return b'\xfd' + n.to_bytes(2, 'little')
+    if n <= 0xffffffff:
+        return b'\xfe' + n.to_bytes(4, 'little')
+    return b'\xff' + n.to_bytes(8, 'little')
+
+cpdef tuple deserialize_compact_size(const uint8_t[::1] buf):
+    """
+    :return: a (value, consumed) pair
+    """
+    cdef uint8_t v1 = buf[0]
+    cdef int size
+    if v1 < 0xfd:
+        return ( v1, 1 )
+    size = 2 if v1 == 0xfd else 4 if v1 == 0xfe else 8
+    return ( int.from_bytes(bytes(buf[1 : 1 + size]), 'little'), 1 + size )
+
+def build_gcs(items, bytes key, uint8_t P, uint64_t M):
+    """
+    Build a GCS of `items`.
+    :param items: a collection of distinct items (bytes-like)
+    :param key: the 16-byte SipHash key
+    :return: the serialized GCS: the number of items (as a CompactSize), followed
+        by the Golomb-Rice coded deltas of the sorted hashes
+    """
+    cdef:
+        uint64_t N = len(items)
+        vector[uint64_t] hashes = _hash_items(key, items, N * M)
+        _BitWriter w
+        uint64_t last = 0
+        uint64_t delta, q
+        size_t i
+        int j
+    w.nbits = 0
+    for i in range(hashes.size()):
+        delta = hashes[i] - last
+        last = hashes[i]
+        q = delta >> P
+        while q > 0:
+            _write_bit(&w, 1)
+            q -= 1
+        _write_bit(&w, 0)
+        for j in range(P - 1, -1, -1):
+            _write_bit(&w, (delta >> j) & 1)
+    return _serialize_compact_size(N) + (<bytes>(<char*>w.data.data())[:w.data.size()] if w.data.size() else b'')
+
+@boundscheck(False)
+@wraparound(False)
+@nonecheck(False)
+def gcs_match_any(const uint8_t[::1] gcs, bytes key, items, uint8_t P, uint64_t M):
+    """
+    Test whether any of `items` is (probably) in a GCS.
+    All the items are tested in a single pass over the GCS.
+    :param gcs: a serialized GCS, as returned by `build_gcs`
+    :param key: the key the GCS was built with
+    """
+    cdef:
+        uint64_t N
+        int consumed
+        vector[uint64_t] hashes
+        _BitReader r
+        uint64_t value = 0
+        uint64_t delta
+        size_t i = 0
+        bint found = False
+    N, consumed = deserialize_compact_size(gcs)
+    if N == 0 or len(items) == 0:
+        return False
+    hashes = _hash_items(key, items, N * M)
+    r.data = &gcs[consumed] if len(gcs) > consumed else NULL
+    r.size = len(gcs) - consumed
+    r.pos = 0
+    with nogil:
+        while N > 0:
+            if not _read_value(&r, P, &delta):
+                break
+            value += delta
+            N -= 1
+            while i < hashes.size() and hashes[i] < value:
+                i += 1
+            if i == hashes.size():
+                break
+            if hashes[i] == value:
+                found = True
+                break
+    return found
+
+################################################################################
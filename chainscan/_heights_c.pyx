@@ -0,0 +1,135 @@
+
+# distutils: extra_compile_args = ['-std=c++11']
+
+"""
+Definition of the HeightTable class, a compact mapping of block hashes to
+heights, implemented using Cython for speed.
+"""
+
+include "consts.pxi"
+
+from libcpp.unordered_map cimport unordered_map
+from cython.operator cimport dereference, preincrement
+
+from chainscan._common_c cimport int32_t, uint64_t
+
+import numpy as np
+
+
+################################################################################
+
+cdef inline uint64_t _get_key(bytes block_hash) except? 0:
+    # the first 8 bytes of the hash (which, unlike the last bytes, are not
+    # zeros due to proof-of-work)
+    if len(block_hash) < 8:
+        raise ValueError('Invalid block hash: %r' % block_hash)
+    return (<uint64_t*><char*>block_hash)[0]
+
+cdef class HeightTable:
+    """
+    A mapping of block hashes to heights, keyed by 64-bit hash prefixes, using
+    about 40 bytes per block (instead of ~200 for a dict of bytes).
+
+    Entries far below the highest height set can be pruned, keeping the size
+    of the table bounded.
+    """
+
+    cdef:
+        unordered_map[uint64_t, int32_t] _heights
+        readonly int32_t max_height
+        readonly int32_t prune_depth
+
+    def __init__(self, items = (), prune_depth = HEIGHT_TABLE_PRUNE_DEPTH):
+        """
+        :param items: initial (block_hash, height) pairs
+        :param prune_depth: prune entries this far below the max height (None to
+            never prune)
+        """
+        self.max_height = -1
+        self.prune_depth = prune_depth if prune_depth is not None else -1
+        for block_hash, height in items:
+            self[block_hash] = height
+
+    def get(self, bytes block_hash, default = None):
+        it = self._heights.find(_get_key(block_hash))
+        if it == self._heights.end():
+            return default
+        return dereference(it).second
+
+    def __getitem__(self, bytes block_hash):
+        height = self.get(block_hash)
+        if height is None:
+            raise KeyError(block_hash)
+        return height
+
+    def __setitem__(self, bytes block_hash, int32_t height):
+        self._heights[_get_key(block_hash)] = height
+        if height > self.max_height:
+            self.max_height = height
+        if self.prune_depth >= 0 and <int32_t>self._heights.size() > 2 * self.prune_depth + 100:
+            self.prune(self.max_height - self.prune_depth)
+
+    def __contains__(self, bytes block_hash):
+        return self._heights.count(_get_key(block_hash)) > 0
+
+    def __len__(self):
+        return self._heights.size()
+
+    def prune(self, int32_t min_height):
+        """
+        Remove the entries of heights lower than `min_height`.
+        :return: the number of entries removed
+        """
+        cdef size_t size = self._heights.size()
+        it = self._heights.begin()
+        while it != self._heights.end():
+            if dereference(it).second < min_height:
+                it = self._heights.erase(it)
+            else:
+                preincrement(it)
+        return size - self._heights.size()
+
+    def copy(self):
+        cdef HeightTable table = HeightTable(prune_depth = self.prune_depth if self.prune_depth >= 0 else None)
+        table._heights = self._heights
+        table.max_height = self.max_height
+        return table
+
+    # pickle support
+
+    def to_arrays(self):
+        """
+        :return: a (keys, heights) pair of numpy arrays
+        """
+        cdef size_t i = 0
+        keys = np.empty(self._heights.size(), dtype = np.uint64)
+        heights = np.empty(self._heights.size(), dtype = np.int32)
+        cdef uint64_t[:] keys_view = keys
+        cdef int32_t[:] heights_view = heights
+        it = self._heights.begin()
+        while it != self._heights.end():
+            keys_view[i] = dereference(it).first
+            heights_view[i] = dereference(it).second
+            i += 1
+            preincrement(it)
+        return keys, heights
+
+    def __reduce__(self):
+        keys, heights = self.to_arrays()
+        return ( _unpickle_height_table, ( keys, heights, self.max_height, self.prune_depth ) )
+
+    def __repr__(self):
+        return '<%s (%d blocks, max height %d)>' % ( type(self).__name__, len(self), self.max_height )
+
+def _unpickle_height_table(keys, heights, max_height, prune_depth):
+    cdef HeightTable table = HeightTable(prune_depth = prune_depth if prune_depth >= 0 else None)
+    cdef uint64_t[:] keys_view = keys
+    cdef int32_t[:] heights_view = heights
+    cdef size_t i
+    table._heights.reserve(len(keys))
+    for i in range(len(keys)):
+        table._heights[keys_view[i]] = heights_view[i]
+    table.max_height = max_height
+    return table
+
+################################################################################
@@ -8,15 +8,20 @@ Definition of the UtxoSet class, used for tracking spending.
 include "consts.pxi"
 
 from libc.stdlib cimport malloc, free
+from libc.stdint cimport UINT64_MAX
 from libcpp.pair cimport pair
 from libcpp.unordered_map cimport unordered_map
+from libcpp.vector cimport vector
 from cython cimport boundscheck, wraparound, nonecheck
 from cython.operator cimport dereference, preincrement
+from cpython.bytes cimport PyBytes_FromStringAndSize, PyBytes_AS_STRING
 
 from chainscan._common_c cimport uint8_t, int32_t, uint32_t, uint64_t, bytesview, btc_value
-from chainscan._common_c cimport bytes2uint64, bytes_to_hash_hex, copy_bytes_to_carray
+from chainscan._common_c cimport bytes_to_hash_hex
 from chainscan._block_c cimport Block
-from chainscan._tx_c cimport TxOutput
+from chainscan._tx_c cimport Tx, TxInput, TxOutput
+
+import numpy as np
 
 from chainscan.misc import Bunch
 
@@ -35,15 +40,16 @@ ctypedef uint64_t txid_key_t
 
 cdef extern from "_utxo.hpp" nogil:
 
+    cdef cppclass CScriptArena:
+        uint64_t total_size
+
     cdef cppclass CUtxOutputMinimal:
         uint64_t value
-        void set(btc_value value, uint32_t script_len, uint8_t *script)
 
     cdef cppclass CUtxOutputScript:
         btc_value value
-        uint32_t script_len
-        uint8_t *script
-        void set(btc_value value, uint32_t script_len, uint8_t *script)
+        uint32_t get_script_size()
+        void copy_script(uint8_t *dst, const CScriptArena &arena)
     
     cdef cppclass CUtxoSpendingInfo[CUtxOutput]:
         CUtxOutput *output
@@ -51,13 +57,34 @@ cdef extern from "_utxo.hpp" nogil:
         bint is_last
 
     cdef cppclass CUtxEntry[CUtxOutput]:
-        void set_output(osize_t oidx, btc_value value, uint32_t script_len, uint8_t *script)
+        void set_spent(osize_t oidx)
 
     cdef cppclass CUtxoSet[CUtxOutput]:
-        CUtxEntry[CUtxOutput]& add_tx(txid_key_t key, osize_t num_outputs, int32_t block_height) except +
-        bint spend_output(txid_key_t key, osize_t output_idx, CUtxoSpendingInfo[CUtxOutput]& spending_info)
-        void dealloc_output(txid_key_t key, CUtxOutput *output, bint is_last)
+        CScriptArena arena
+        CUtxEntry[CUtxOutput]& add_tx(const uint8_t *txid, osize_t num_outputs, int32_t block_height) except +
+        void set_output(CUtxEntry[CUtxOutput] &entry, osize_t oidx, btc_value value, uint32_t script_len, const uint8_t *script) except +
+        bint spend_output(const uint8_t *txid, osize_t output_idx, CUtxoSpendingInfo[CUtxOutput]& spending_info)
+        void dealloc_output(const uint8_t *txid, CUtxOutput *output, bint is_last)
+        bint restore_output(const uint8_t *txid, osize_t oidx, btc_value value, uint32_t script_len, const uint8_t *script, int32_t block_height) except +
+        uint64_t spend_outputs(uint64_t n, const uint8_t *txids, const uint32_t *output_idxs,
+                               uint8_t *found, uint64_t *values, int32_t *block_heights,
+                               uint64_t *script_offsets, vector[uint8_t] *scripts) except +
+        void add_outputs(uint64_t num_txs, const uint8_t *txids, const int32_t *block_heights, const uint32_t *num_outputs,
+                         const uint32_t *output_idxs, const btc_value *values,
+                         const uint64_t *script_offsets, const uint8_t *scripts) except +
+        void configure_keys(uint8_t key_size, bint check_collisions)
+        void begin_block() except +
+        void end_block() except +
         uint64_t size()
+        uint64_t overflow_size()
+        uint64_t table_memory_size()
+        uint64_t num_unspent_outputs()
+        void count_range(txid_key_t key_lo, txid_key_t key_hi, uint64_t &num_outputs, uint64_t &script_bytes)
+        uint64_t export_range(txid_key_t key_lo, txid_key_t key_hi,
+                              uint64_t *keys, uint32_t *checks, uint8_t *txids, uint32_t *output_idxs, uint64_t *values, int32_t *block_heights,
+                              uint64_t *script_offsets, uint8_t *scripts)
+        void summarize(btc_value dust_threshold, uint64_t &total, int32_t &max_height, uint64_t &num_dust)
+        void count_by_height(uint32_t bucket_size, uint64_t *counts, uint32_t num_buckets)
 
 
 ################################################################################
@@ -92,66 +119,120 @@ cdef fused CUtxoSetX:
 cdef class UtxoSet:
     """
     A data structure holding all the unspent tx outputs (UTXOs)
+
+    With `include_scripts=True`, output scripts are stored compressed: the
+    common templates (P2PKH, P2SH, P2WPKH) are reduced to their 20-byte hash,
+    and all scripts are kept in a shared arena, rather than being allocated
+    one by one.
+
+    UTXOs are keyed by a prefix of the txid, of `key_size` bytes.  Keys are
+    stored packed (in a table of `key_size`-byte keys), so smaller keys take
+    less memory (see `table_size`), but with no collision checking, a tx whose
+    key collides with the key of another tx in the set silently replaces it.
+    With `check_collisions=True`, 4 more txid bytes are stored with each entry
+    (at no extra memory cost), and colliding txs are moved to an overflow
+    table, keyed by the full txid.
     """
     
     cdef _Set1 _data1
     cdef _Set2 _data2
     cdef void *_dataptr
     cdef readonly bint include_scripts
+    cdef readonly uint8_t key_size
+    cdef readonly bint check_collisions
     
-    def __init__(self, include_scripts = False):
+    def __init__(self, include_scripts = False, key_size = None, check_collisions = False):
+        """
+        :param include_scripts: also store the scripts of the outputs
+        :param key_size: number of txid bytes to use as key (1 to 8). Defaults
+            to TXID_PREFIX_SIZE.
+        :param check_collisions: detect txs whose keys collide, and keep them apart
+        """
+        if key_size is None:
+            key_size = TXID_PREFIX_SIZE
+        if not 1 <= key_size <= 8:
+            raise ValueError('key_size must be between 1 and 8: %r' % (key_size,))
         self.include_scripts = include_scripts
+        self.key_size = key_size
+        self.check_collisions = check_collisions
         if include_scripts:
             self._dataptr = &(self._data2)
+            (<_Set2*>self._dataptr).configure_keys(key_size, check_collisions)
         else:
             self._dataptr = &(self._data1)
+            (<_Set1*>self._dataptr).configure_keys(key_size, check_collisions)
     
-    @boundscheck(False)
-    @wraparound(False)
-    @nonecheck(False)
     def add_from_tx(self, tx):
         """
         Given a Tx, add its outputs as UTXOs.
         """
-        
-        cdef txid_key_t key = self._get_tx_key(tx)
-        cdef list outputs = tx.outputs
-        cdef osize_t num_outputs = len(outputs)
-        cdef osize_t oidx
-        cdef btc_value value
-        cdef bytes script
-        cdef uint32_t script_len
-        cdef uint8_t *scriptptr
-        cdef int block_height
-        cdef _Entry1 *entry1
-        cdef _Entry2 *entry2
-
         # use block.height if tx includes block-context (i.e. tx is a TxInBlock).
         # else, use block_height=-1
         block = getattr(tx, 'block', None)
         block_height = block.height if block is not None else -1
+        self.add(tx.txid, tx.outputs, block_height)
 
-        if self.include_scripts:
-            entry2 = &(<_Set2*>self._dataptr).add_tx(key, num_outputs, block_height)
+    @boundscheck(False)
+    @wraparound(False)
+    @nonecheck(False)
+    def add(self, bytes txid, list outputs, int block_height = -1, output_idxs = None):
+        """
+        Add the outputs of a tx as UTXOs.
+        :param txid: the (full, 32-byte) txid
+        :param outputs: a list of TxOutputs (or any objects with `value` and `script`)
+        :param block_height: the height of the block including the tx (-1 if unknown)
+        :param output_idxs: the indexes of `outputs` in the tx, if only some of the
+            tx's outputs are unspent (e.g. when loading a UTXO snapshot). The
+            missing outputs are considered spent.
+        """
+        if len(txid) != 32:
+            raise ValueError('txid must be 32 bytes long, got %d' % len(txid))
+        cdef const uint8_t *txidptr = <const uint8_t*><char*>txid
+        cdef osize_t num_given = len(outputs)
+        cdef osize_t num_outputs
+        cdef osize_t i, oidx
+        cdef btc_value value
+        cdef bytes script
+        cdef _Entry1 *entry1 = NULL
+        cdef _Entry2 *entry2 = NULL
+        cdef bytearray is_given
 
-            for oidx in range(num_outputs):
-                o = outputs[oidx]
-                value = o.value
-                script = o.script
-                script_len = len(script)
-                scriptptr = copy_bytes_to_carray(script, script_len)
-                if scriptptr == NULL:
-                    raise MemoryError()
-                entry2.set_output(oidx, value, script_len, scriptptr)
+        if output_idxs is None:
+            num_outputs = num_given
+        else:
+            if len(output_idxs) != num_given:
+                raise ValueError('outputs and output_idxs must have the same length')
+            num_outputs = max(output_idxs) + 1 if num_given > 0 else 0
+        if num_outputs == 0:
+            return
 
+        if self.include_scripts:
+            entry2 = &(<_Set2*>self._dataptr).add_tx(txidptr, num_outputs, block_height)
         else:
-            entry1 = &(<_Set1*>self._dataptr).add_tx(key, num_outputs, block_height)
+            entry1 = &(<_Set1*>self._dataptr).add_tx(txidptr, num_outputs, block_height)
 
+        for i in range(num_given):
+            o = outputs[i]
+            oidx = output_idxs[i] if output_idxs is not None else i
+            value = o.value
+            if self.include_scripts:
+                script = o.script
+                # the script is copied (compressed) into the set's arena
+                (<_Set2*>self._dataptr).set_output(entry2[0], oidx, value, len(script), <const uint8_t*><char*>script)
+            else:
+                (<_Set1*>self._dataptr).set_output(entry1[0], oidx, value, 0, NULL)
+
+        if num_outputs != num_given:
+            is_given = bytearray(num_outputs)
+            for oidx in output_idxs:
+                is_given[oidx] = 1
             for oidx in range(num_outputs):
-                o = outputs[oidx]
-                value = o.value
-                entry1.set_output(oidx, value, 0, NULL)
-        
+                if not is_given[oidx]:
+                    if self.include_scripts:
+                        entry2.set_spent(oidx)
+                    else:
+                        entry1.set_spent(oidx)
+
     @boundscheck(False)
     @wraparound(False)
     @nonecheck(False)
@@ -161,43 +242,157 @@ cdef class UtxoSet:
         :return: a Bunch object representing spending_info
         :raise: KeyError if not found or already spent
         """
-        cdef txid_key_t key = self._get_tx_key_from_txid(spent_txid)
+        if spent_txid.shape[0] != 32:
+            raise ValueError('txid must be 32 bytes long, got %d' % spent_txid.shape[0])
+        cdef const uint8_t *txidptr = &(spent_txid[0])
         cdef _SInfo1 sinfo1
         cdef _SInfo2 sinfo2
         cdef bint found
 
         if self.include_scripts:
-            found = (<_Set2*>self._dataptr).spend_output(key, spent_output_idx, sinfo2)
+            found = (<_Set2*>self._dataptr).spend_output(txidptr, spent_output_idx, sinfo2)
             if not found:
                 raise KeyError('Tx not found in UtxoSet: %s' % bytes_to_hash_hex(spent_txid))
-            txoutput = _spending_info2_to_txoutput(sinfo2)
+            txoutput = _spending_info2_to_txoutput(sinfo2, (<_Set2*>self._dataptr).arena)
             # need to deallocate the output, whose ownership was passed to us
-            (<_Set2*>self._dataptr).dealloc_output(key, sinfo2.output, sinfo2.is_last)
+            (<_Set2*>self._dataptr).dealloc_output(txidptr, sinfo2.output, sinfo2.is_last)
         else:
-            found = (<_Set1*>self._dataptr).spend_output(key, spent_output_idx, sinfo1)
+            found = (<_Set1*>self._dataptr).spend_output(txidptr, spent_output_idx, sinfo1)
             if not found:
                 raise KeyError('Tx not found in UtxoSet: %s' % bytes_to_hash_hex(spent_txid))
             txoutput = _spending_info1_to_txoutput(sinfo1)
             # need to deallocate the output, whose ownership was passed to us
-            (<_Set1*>self._dataptr).dealloc_output(key, sinfo1.output, sinfo1.is_last)
+            (<_Set1*>self._dataptr).dealloc_output(txidptr, sinfo1.output, sinfo1.is_last)
         
         return txoutput
 
+    def restore(self, bytes txid, osize_t output_idx, output, int block_height = -1):
+        """
+        Re-add a spent UTXO (the inverse of `spend()`), e.g. when undoing a block.
+        :param output: the spent TxOutput (or any object with `value` and `script`),
+            e.g. `spending_info.spent_output`
+        :param block_height: the height of the block including the tx (-1 if unknown),
+            e.g. `spending_info.block_height`
+        :raise: KeyError if the output is unspent
+        """
+        if len(txid) != 32:
+            raise ValueError('txid must be 32 bytes long, got %d' % len(txid))
+        cdef const uint8_t *txidptr = <const uint8_t*><char*>txid
+        cdef btc_value value = output.value
+        cdef bytes script
+        cdef bint restored
+        if self.include_scripts:
+            script = bytes(output.script) if output.script is not None else b''
+            restored = (<_Set2*>self._dataptr).restore_output(
+                txidptr, output_idx, value, len(script), <const uint8_t*><char*>script, block_height)
+        else:
+            restored = (<_Set1*>self._dataptr).restore_output(txidptr, output_idx, value, 0, NULL, block_height)
+        if not restored:
+            raise KeyError('Output is unspent: %s:%d' % (bytes_to_hash_hex(bytearray(txid)), output_idx))
+
     @boundscheck(False)
     @wraparound(False)
     @nonecheck(False)
-    cdef txid_key_t _get_tx_key_from_txid(self, bytesview txid):
-        # this implementation assumes TXID_PREFIX_SIZE=8 !
-        return bytes2uint64(txid, <uint8_t>TXID_PREFIX_SIZE)
-    
+    def spend_batch(self, const uint8_t[::1] txids, const uint32_t[::1] output_idxs):
+        """
+        Find and remove many UTXOs at once (the batch version of `spend()`).
+        :param txids: the (full, 32-byte) txids of the UTXOs, concatenated
+        :param output_idxs: a uint32 array of the indexes of the UTXOs in their txs
+        :return: a Bunch with arrays `found` (0 for UTXOs which are not found, which
+            are skipped), `value` and `block_height`, and, if `include_scripts`,
+            `script_offset` and `script_data` (the script of the i-th UTXO is
+            `script_data[script_offset[i]:script_offset[i+1]]`)
+        """
+        cdef uint64_t n = output_idxs.shape[0]
+        if <uint64_t>txids.shape[0] != 32 * n:
+            raise ValueError('txids must be 32*%d bytes long, got %d' % (n, txids.shape[0]))
+        cdef uint8_t[::1] found = np.zeros(n, dtype = np.uint8)
+        cdef uint64_t[::1] values = np.zeros(n, dtype = np.uint64)
+        cdef int32_t[::1] block_heights = np.empty(n, dtype = np.int32)
+        cdef uint64_t[::1] script_offsets = np.zeros(n + 1 if self.include_scripts else 0, dtype = np.uint64)
+        cdef vector[uint8_t] scripts
+        if n > 0:
+            if self.include_scripts:
+                (<_Set2*>self._dataptr).spend_outputs(
+                    n, &txids[0], &output_idxs[0], &found[0], &values[0], &block_heights[0], &script_offsets[0], &scripts)
+            else:
+                (<_Set1*>self._dataptr).spend_outputs(
+                    n, &txids[0], &output_idxs[0], &found[0], &values[0], &block_heights[0], NULL, NULL)
+        return Bunch(
+            found = found.base,
+            value = values.base,
+            block_height = block_heights.base,
+            script_offset = script_offsets.base if self.include_scripts else None,
+            script_data = PyBytes_FromStringAndSize(<char*>scripts.data(), scripts.size()) if self.include_scripts else None,
+        )
+
     @boundscheck(False)
     @wraparound(False)
     @nonecheck(False)
-    cdef txid_key_t _get_tx_key(self, tx):
-        # HACK: due to that cython bug, we need to convert the bytes to a writable buffer
-        cdef bytearray txid_buf = bytearray(tx.txid)  # TBD avoid the bytearray copying...
-        return self._get_tx_key_from_txid(txid_buf)
-    
+    def add_batch(self, const uint8_t[::1] txids, const int32_t[::1] block_heights, const uint32_t[::1] num_outputs,
+                  const uint32_t[::1] output_idxs, const uint64_t[::1] values,
+                  const uint64_t[::1] script_offsets = None, const uint8_t[::1] script_data = None):
+        """
+        Add the outputs of many txs at once (the batch version of `add()`).
+        :param txids: the (full, 32-byte) txids of the txs, concatenated
+        :param block_heights: an int32 array, the heights of the blocks including the txs
+        :param num_outputs: a uint32 array, the number of outputs given for each tx
+        :param output_idxs: a uint32 array of the indexes of the outputs in their
+            txs (the outputs of the i-th tx are the next `num_outputs[i]` ones).
+            The missing outputs are considered spent.
+        :param values: a uint64 array of the values of the outputs
+        :param script_offsets, script_data: the scripts of the outputs (required
+            if `include_scripts`), like the ones returned by `spend_batch()`
+        """
+        cdef uint64_t num_txs = num_outputs.shape[0]
+        cdef uint64_t total = 0
+        cdef uint64_t i
+        cdef uint8_t empty = 0
+        cdef const uint8_t *script_data_ptr = &empty
+        if <uint64_t>txids.shape[0] != 32 * num_txs or <uint64_t>block_heights.shape[0] != num_txs:
+            raise ValueError('txids, block_heights and num_outputs must have the same number of txs')
+        for i in range(num_txs):
+            total += num_outputs[i]
+        if <uint64_t>output_idxs.shape[0] != total or <uint64_t>values.shape[0] != total:
+            raise ValueError('output_idxs and values must have sum(num_outputs)=%d elements' % total)
+        if num_txs == 0:
+            return
+        if self.include_scripts:
+            if script_offsets is None or script_data is None:
+                raise ValueError('scripts are required (include_scripts=True)')
+            if <uint64_t>script_offsets.shape[0] != total + 1 or script_offsets[total] > <uint64_t>script_data.shape[0]:
+                raise ValueError('script_offsets must have sum(num_outputs)+1 elements, within script_data')
+            if script_data.shape[0] > 0:
+                script_data_ptr = &script_data[0]
+            (<_Set2*>self._dataptr).add_outputs(
+                num_txs, &txids[0], &block_heights[0], &num_outputs[0], &output_idxs[0], &values[0],
+                &script_offsets[0], script_data_ptr)
+        else:
+            (<_Set1*>self._dataptr).add_outputs(
+                num_txs, &txids[0], &block_heights[0], &num_outputs[0], &output_idxs[0], &values[0], NULL, NULL)
+
+    def begin_block(self):
+        """
+        Indicate that the txs added from now on, until `end_block()` is called,
+        are all from the same block.
+        UTXOs created and spent within the block are kept in a small block-local
+        table, and are never added to the (big) global set.
+        Calling `begin_block()` again implicitly ends the previous block.
+        """
+        if self.include_scripts:
+            (<_Set2*>self._dataptr).begin_block()
+        else:
+            (<_Set1*>self._dataptr).begin_block()
+
+    def end_block(self):
+        """
+        Move the UTXOs which survived the current block to the global set.
+        """
+        if self.include_scripts:
+            (<_Set2*>self._dataptr).end_block()
+        else:
+            (<_Set1*>self._dataptr).end_block()
+
     def __repr__(self):
         return '<%s (%s txs)>' % (type(self).__name__, len(self))
 
@@ -207,6 +402,150 @@ cdef class UtxoSet:
         else:
             return (<_Set1*>self._dataptr).size()
     
+    # Bulk introspection.
+    # These iterate over the underlying C++ data structures, without creating
+    # python objects per UTXO.
+
+    def get_num_unspent_outputs(self):
+        """
+        :return: the number of UTXOs (as opposed to `len()`, which is the number
+            of txs with UTXOs)
+        """
+        if self.include_scripts:
+            return (<_Set2*>self._dataptr).num_unspent_outputs()
+        else:
+            return (<_Set1*>self._dataptr).num_unspent_outputs()
+
+    def to_arrays(self):
+        """
+        Export all UTXOs to numpy arrays.
+        :return: a Bunch with (same-length) arrays `key` (the txid key), `output_idx`,
+            `value` and `block_height` (-1 if unknown), one element per UTXO, in
+            no particular order.
+        """
+        res = self._export(0, UINT64_MAX, False)
+        del res.check, res.txid, res.script_offset, res.script_data
+        return res
+
+    def _export(self, txid_key_t key_lo, txid_key_t key_hi, bint include_scripts, bint include_txids = False):
+        """
+        Export the UTXOs whose keys are in the range [key_lo, key_hi] to numpy arrays.
+        Like `to_arrays()`, with the extra arrays `check` (the 4 txid bytes following
+        the key), if `include_txids`, `txid` (an array of shape (n,32), of the full
+        txids where known, else of the zero-padded key and check bytes), and, if
+        `include_scripts`, `script_offset` and `script_data` (the script of the
+        i-th UTXO is `script_data[script_offset[i]:script_offset[i+1]]`).
+        """
+        cdef uint64_t n, script_bytes
+        if self.include_scripts:
+            (<_Set2*>self._dataptr).count_range(key_lo, key_hi, n, script_bytes)
+        else:
+            (<_Set1*>self._dataptr).count_range(key_lo, key_hi, n, script_bytes)
+        include_scripts = include_scripts and self.include_scripts
+        cdef uint64_t[::1] keys = np.empty(n, dtype = np.uint64)
+        cdef uint32_t[::1] checks = np.empty(n, dtype = np.uint32)
+        cdef uint8_t[:, ::1] txids = np.zeros(( n if include_txids else 0, 32 ), dtype = np.uint8)
+        cdef uint8_t *txids_ptr = &txids[0, 0] if include_txids and n > 0 else NULL
+        cdef uint32_t[::1] output_idxs = np.empty(n, dtype = np.uint32)
+        cdef uint64_t[::1] values = np.empty(n, dtype = np.uint64)
+        cdef int32_t[::1] block_heights = np.empty(n, dtype = np.int32)
+        cdef uint64_t[::1] script_offsets = np.zeros(n + 1 if include_scripts else 0, dtype = np.uint64)
+        cdef uint8_t[::1] script_data = np.empty(script_bytes + 1 if include_scripts else 0, dtype = np.uint8)
+        cdef uint64_t *script_offsets_ptr = &script_offsets[0] if include_scripts else NULL
+        cdef uint8_t *script_data_ptr = &script_data[0] if include_scripts else NULL
+        if n > 0:
+            if self.include_scripts:
+                (<_Set2*>self._dataptr).export_range(
+                    key_lo, key_hi, &keys[0], &checks[0], txids_ptr, &output_idxs[0], &values[0], &block_heights[0],
+                    script_offsets_ptr, script_data_ptr)
+            else:
+                (<_Set1*>self._dataptr).export_range(
+                    key_lo, key_hi, &keys[0], &checks[0], txids_ptr, &output_idxs[0], &values[0], &block_heights[0],
+                    NULL, NULL)
+        return Bunch(
+            key = keys.base,
+            check = checks.base,
+            txid = np.asarray(txids) if include_txids else None,
+            output_idx = output_idxs.base,
+            value = values.base,
+            block_height = block_heights.base,
+            script_offset = script_offsets.base if include_scripts else None,
+            script_data = script_data.base[:script_bytes] if include_scripts else None,
+        )
+
+    def get_total_value(self):
+        """
+        :return: the total value of all UTXOs, in satoshis
+        """
+        return self._summarize(0).total
+
+    def count_dust(self, threshold = DUST_THRESHOLD):
+        """
+        :return: the number of UTXOs whose value is less than `threshold` satoshis
+        """
+        return self._summarize(threshold).num_dust
+
+    def count_by_height(self, bucket_size = 1):
+        """
+        Count UTXOs by the height of the block they were created in.
+        UTXOs of unknown height are not counted.
+        :return: an array of counts, where the i-th element is the number of
+            UTXOs created in heights `[i*bucket_size, (i+1)*bucket_size)`.
+        """
+        if bucket_size < 1:
+            raise ValueError('bucket_size must be positive: %r' % (bucket_size,))
+        cdef int32_t max_height = self._summarize(0).max_height
+        cdef uint32_t num_buckets = max_height // bucket_size + 1 if max_height >= 0 else 0
+        cdef uint64_t[::1] counts = np.zeros(num_buckets, dtype = np.uint64)
+        if num_buckets > 0:
+            if self.include_scripts:
+                (<_Set2*>self._dataptr).count_by_height(bucket_size, &counts[0], num_buckets)
+            else:
+                (<_Set1*>self._dataptr).count_by_height(bucket_size, &counts[0], num_buckets)
+        return counts.base
+
+    def _summarize(self, btc_value dust_threshold):
+        cdef uint64_t total
+        cdef int32_t max_height
+        cdef uint64_t num_dust
+        if self.include_scripts:
+            (<_Set2*>self._dataptr).summarize(dust_threshold, total, max_height, num_dust)
+        else:
+            (<_Set1*>self._dataptr).summarize(dust_threshold, total, max_height, num_dust)
+        return Bunch(total = total, max_height = max_height, num_dust = num_dust)
+
+    property num_collisions:
+        """
+        Number of txs currently in the overflow table, due to key collisions
+        (always 0 unless `check_collisions=True`).
+        """
+        def __get__(self):
+            if self.include_scripts:
+                return (<_Set2*>self._dataptr).overflow_size()
+            else:
+                return (<_Set1*>self._dataptr).overflow_size()
+
+    property table_size:
+        """
+        Number of bytes currently allocated for the table of txs (their keys, and
+        per-tx data), not including their outputs and scripts.
+        """
+        def __get__(self):
+            if self.include_scripts:
+                return (<_Set2*>self._dataptr).table_memory_size()
+            else:
+                return (<_Set1*>self._dataptr).table_memory_size()
+
+    property scripts_size:
+        """
+        Number of bytes currently allocated for storing scripts.
+        """
+        def __get__(self):
+            if self.include_scripts:
+                return (<_Set2*>self._dataptr).arena.total_size
+            else:
+                return 0
+    
 
     # pickle support
     # TBD: when the set is big, the temporary pickleable state created by __getstate__ can
@@ -214,10 +553,9 @@ cdef class UtxoSet:
 
     # TBD: not currently supported    
     def __getstate__(self):
-        return ( self.include_scripts, )
+        return ( self.include_scripts, self.key_size, self.check_collisions )
     def __setstate__(self, state):
-        include_scripts, = state
-        self.__init__(include_scripts)
+        self.__init__(*state)
 
 #    def __getstate__(self):
 #        if self.include_scripts:
@@ -264,21 +602,149 @@ cdef _spending_info1_to_txoutput(_SInfo1 &spending_info):
 @boundscheck(False)
 @wraparound(False)
 @nonecheck(False)
-cdef _spending_info2_to_txoutput(_SInfo2& spending_info):
+cdef _spending_info2_to_txoutput(_SInfo2& spending_info, const CScriptArena &arena):
     cdef _Output2 *output = spending_info.output
-    cdef bytesview scriptview
-    cdef uint8_t *oscript = output.script
-    if oscript != NULL:
-        if output.script_len > 0:
-            scriptview = <uint8_t[ : output.script_len : 1 ]>oscript  # this doesn't work if script_len=0...
-        else:
-            scriptview = bytearray(b'')
-    else:
-        scriptview = None
-    txoutput = TxOutput(output.value, scriptview)
+    cdef uint32_t script_size = output.get_script_size()
+    cdef bytes script = PyBytes_FromStringAndSize(NULL, script_size)
+    # decompress the script directly into the (new, not yet shared) bytes object
+    output.copy_script(<uint8_t*>PyBytes_AS_STRING(script), arena)
+    cdef TxOutput txoutput = TxOutput(output.value, None)
+    txoutput.script = script
     return Bunch(
         spent_output = txoutput,
         block_height = spending_info.block_height,
     )
 
 ################################################################################
+# BATCHES -- packing the updates of a whole block into flat arrays (for
+# `UtxoSet.spend_batch()` and `UtxoSet.add_batch()`, e.g. of the workers of a
+# ShardedUtxoSet), and setting the spending_info of the inputs from the results.
+
+@boundscheck(False)
+@wraparound(False)
+def pack_block_updates(list txs, bint include_scripts):
+    """
+    Resolve the spends of outputs created within a block, and pack the other
+    spends of the block, and the outputs which survive it, into flat arrays.
+    The inputs spending outputs created within the block get their `spending_info`
+    set.
+    :param txs: the txs of the block (Txs or TxInBlocks), in order
+    :return: a Bunch with the spends (`spend_txids`, `spend_output_idxs`, and
+        `spend_inputs`, the TxInputs they are for), and the adds (`txids`,
+        `block_heights`, `num_outputs`, `output_idxs`, `output_values`, and, if
+        `include_scripts`, `script_offsets` and `script_data`), in the format of
+        `UtxoSet.spend_batch()` and `UtxoSet.add_batch()`
+    """
+    cdef Py_ssize_t num_txs = len(txs)
+    cdef Py_ssize_t total_outputs = 0
+    cdef Py_ssize_t i, k, oidx, first
+    cdef Tx tx, spent_tx
+    cdef TxInput txin
+    cdef TxOutput txout, spent_output
+    cdef list tx_objs = [ t if type(t) is Tx else t.tx for t in txs ]
+    cdef int32_t[::1] block_heights = np.empty(num_txs, dtype = np.int32)
+    cdef uint32_t[::1] first_output = np.empty(num_txs + 1, dtype = np.uint32)
+    for i in range(num_txs):
+        tx = tx_objs[i]
+        block = getattr(txs[i], 'block', None)
+        block_heights[i] = block.height if block is not None else -1
+        first_output[i] = total_outputs
+        total_outputs += len(tx.outputs)
+    first_output[num_txs] = total_outputs
+
+    # spends, resolving the outputs of the block locally
+    cdef uint8_t[::1] is_spent = np.zeros(total_outputs, dtype = np.uint8)
+    cdef dict block_txs = {}  # txid -> index in txs
+    cdef bytearray spend_txids = bytearray()
+    cdef list spend_output_idxs = []
+    cdef list spend_inputs = []
+    for i in range(num_txs):
+        tx = tx_objs[i]
+        for x in tx.inputs:
+            if type(x) is not TxInput:
+                continue  # coinbase
+            txin = x
+            oidx = txin.spent_output_idx
+            k = block_txs.get(bytes(txin._spent_txid), -1)
+            if k >= 0 and oidx < first_output[k + 1] - first_output[k] and not is_spent[first_output[k] + oidx]:
+                is_spent[first_output[k] + oidx] = 1
+                spent_tx = tx_objs[k]
+                spent_output = spent_tx.outputs[oidx]
+                txout = TxOutput(spent_output.value, None)
+                if include_scripts:
+                    txout.script = spent_output.script
+                txin.spending_info = Bunch(spent_output = txout, block_height = block_heights[k])
+            else:
+                spend_txids += txin._spent_txid
+                spend_output_idxs.append(oidx)
+                spend_inputs.append(txin)
+        block_txs[bytes(tx._txid)] = i
+
+    # adds: the outputs which survive the block
+    cdef bytearray txids = bytearray()
+    cdef list add_block_heights = []
+    cdef list num_outputs = []
+    cdef uint32_t[::1] output_idxs = np.empty(total_outputs, dtype = np.uint32)
+    cdef uint64_t[::1] values = np.empty(total_outputs, dtype = np.uint64)
+    cdef uint64_t[::1] script_offsets = np.zeros(total_outputs + 1 if include_scripts else 0, dtype = np.uint64)
+    cdef list scripts = []
+    cdef Py_ssize_t n = 0
+    for i in range(num_txs):
+        tx = tx_objs[i]
+        first = n
+        for oidx in range(first_output[i + 1] - first_output[i]):
+            if is_spent[first_output[i] + oidx]:
+                continue
+            txout = tx.outputs[oidx]
+            output_idxs[n] = oidx
+            values[n] = txout.value
+            if include_scripts:
+                scripts.append(txout.script)
+                script_offsets[n + 1] = script_offsets[n] + len(txout.script)
+            n += 1
+        if n > first:
+            txids += tx._txid
+            add_block_heights.append(block_heights[i])
+            num_outputs.append(n - first)
+
+    return Bunch(
+        spend_txids = bytes(spend_txids),
+        spend_output_idxs = np.array(spend_output_idxs, dtype = np.uint32),
+        spend_inputs = spend_inputs,
+        txids = bytes(txids),
+        block_heights = np.array(add_block_heights, dtype = np.int32),
+        num_outputs = np.array(num_outputs, dtype = np.uint32),
+        output_idxs = output_idxs.base[:n],
+        output_values = values.base[:n],
+        script_offsets = script_offsets.base[:n + 1] if include_scripts else None,
+        script_data = b''.join(scripts) if include_scripts else None,
+    )
+
+@boundscheck(False)
+@wraparound(False)
+def set_spending_infos(list txins, const uint32_t[::1] idxs, spent):
+    """
+    Set the `spending_info` of TxInputs, from the results of `UtxoSet.spend_batch()`.
+    :param txins: the TxInputs
+    :param idxs: the index in `txins` of the input of each spend
+    :param spent: the Bunch returned by `UtxoSet.spend_batch()`
+    :raise: KeyError if an output spent was not found
+    """
+    cdef const uint8_t[::1] found = spent.found
+    cdef const uint64_t[::1] values = spent.value
+    cdef const int32_t[::1] block_heights = spent.block_height
+    cdef const uint64_t[::1] script_offsets = spent.script_offset
+    cdef bytes script_data = spent.script_data
+    cdef Py_ssize_t j
+    cdef TxInput txin
+    cdef TxOutput txout
+    for j in range(idxs.shape[0]):
+        txin = txins[idxs[j]]
+        if not found[j]:
+            raise KeyError('Tx not found in UtxoSet: %s' % bytes_to_hash_hex(txin._spent_txid))
+        txout = TxOutput(values[j], None)
+        if script_data is not None:
+            txout.script = script_data[script_offsets[j] : script_offsets[j + 1]]
+        txin.spending_info = Bunch(spent_output = txout, block_height = block_heights[j])
+
+################################################################################
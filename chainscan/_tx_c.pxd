@@ -40,6 +40,7 @@ cdef class Tx:
         readonly bytearray _txid
         readonly uint32_t rawsize
         readonly bytesview blob
+        object __weakref__
 
 
 # deserialization functions
@@ -55,6 +55,14 @@ cdef class TxInput:
         self.sequence = sequence
         self.spending_info = spending_info
 
+    def detach(self):
+        """
+        Copy the data of the input out of the buffer it was deserialized from
+        (see `Tx.detach`).
+        """
+        self._spent_txid = bytearray(self._spent_txid)
+        self.script = bytearray(self.script)
+
     property is_coinbase:
         def __get__(self):
             return False
@@ -122,6 +130,13 @@ cdef class CoinbaseTxInput:
         self.script = script
         self.sequence = sequence
         
+    def detach(self):
+        """
+        Copy the data of the input out of the buffer it was deserialized from
+        (see `Tx.detach`).
+        """
+        self.script = bytearray(self.script)
+
     property is_coinbase:
         def __get__(self):
             return True
@@ -205,6 +220,20 @@ cdef class Tx:
         def __get__(self):
             return self.inputs[0].is_coinbase
 
+    def detach(self):
+        """
+        Copy the data of the tx out of the buffer it was deserialized from.
+
+        A tx references the data of the whole `blk*.dat` file it was read
+        from (its fields are memoryviews into the file's data), so keeping a tx
+        keeps that data alive.  A detached tx only keeps copies of its own data.
+        """
+        self.version_bytes = bytearray(self.version_bytes)
+        if self.blob is not None:
+            self.blob = bytearray(self.blob)
+        for txin in self.inputs:
+            txin.detach()
+
     def get_total_output_value(self):
         cdef TxOutput o
         return sum( o.value for o in self.outputs )
@@ -1,7 +1,11 @@
 
 #include <stdint.h>
+#include <limits.h>
 #include <malloc.h>
+#include <string.h>
 #include <cstddef>
+#include <new>
+#include <vector>
 #include <unordered_map>
 #include <iostream>
 
@@ -17,6 +21,182 @@ typedef uint64_t btc_value;
 // 0xffffffffffffffff = max(uint64_t)
 #define OUTPUT_SPENT_MARKER 0xffffffffffffffff
 
+////////////////////////////////////////////////////////////////////////////////
+// SCRIPT ARENA -- shared storage for (compressed) output scripts.
+// Scripts are bump-allocated from big chunks, instead of being malloc'ed one by
+// one.  Each chunk counts the scripts still alive in it, and is freed (or reused)
+// once all of them have been released.
+
+#define SCRIPT_ARENA_CHUNK_SIZE (1 << 20)
+#define SCRIPT_ARENA_NO_CHUNK 0xffffffff
+
+class CScriptArena {
+
+public:
+
+    struct Chunk {
+        uint8_t *data;
+        uint32_t size;
+        uint32_t used;
+        uint32_t live;
+    };
+
+    vector<Chunk> chunks;
+    vector<uint32_t> free_chunk_ids;
+    uint32_t cur_chunk_id;
+    uint64_t total_size;
+
+public:
+
+    CScriptArena() : cur_chunk_id(SCRIPT_ARENA_NO_CHUNK), total_size(0) {}
+
+    ~CScriptArena() {
+        for (size_t i = 0; i < this->chunks.size(); ++i) {
+            if (this->chunks[i].data != NULL) {
+                free(this->chunks[i].data);
+            }
+        }
+    }
+
+    uint8_t* alloc(uint32_t size, uint32_t &chunk_id, uint32_t &offset) {
+        // allocate from the current chunk, if there's room
+        if (this->cur_chunk_id != SCRIPT_ARENA_NO_CHUNK) {
+            Chunk &cur = this->chunks[this->cur_chunk_id];
+            if (cur.size - cur.used >= size) {
+                return this->_alloc_from(this->cur_chunk_id, size, chunk_id, offset);
+            }
+        }
+        // need a new chunk. very big scripts get a dedicated chunk of their own.
+        uint32_t new_id = this->_new_chunk(size > SCRIPT_ARENA_CHUNK_SIZE ? size : SCRIPT_ARENA_CHUNK_SIZE);
+        if (size <= SCRIPT_ARENA_CHUNK_SIZE) {
+            // the previous current chunk can be freed if nothing lives in it
+            uint32_t prev_id = this->cur_chunk_id;
+            this->cur_chunk_id = new_id;
+            if (prev_id != SCRIPT_ARENA_NO_CHUNK && this->chunks[prev_id].live == 0) {
+                this->_free_chunk(prev_id);
+            }
+        }
+        return this->_alloc_from(new_id, size, chunk_id, offset);
+    }
+
+    inline uint8_t* get(uint32_t chunk_id, uint32_t offset) const {
+        return this->chunks[chunk_id].data + offset;
+    }
+
+    void release(uint32_t chunk_id) {
+        Chunk &chunk = this->chunks[chunk_id];
+        chunk.live--;
+        if (chunk.live == 0) {
+            if (chunk_id == this->cur_chunk_id) {
+                // nothing alive in the current chunk. start over.
+                chunk.used = 0;
+            } else {
+                this->_free_chunk(chunk_id);
+            }
+        }
+    }
+
+    uint8_t* _alloc_from(uint32_t id, uint32_t size, uint32_t &chunk_id, uint32_t &offset) {
+        Chunk &chunk = this->chunks[id];
+        chunk_id = id;
+        offset = chunk.used;
+        chunk.used += size;
+        chunk.live++;
+        return chunk.data + offset;
+    }
+
+    uint32_t _new_chunk(uint32_t size) {
+        Chunk chunk;
+        chunk.data = (uint8_t*)malloc(size);
+        if (chunk.data == NULL) {
+            throw bad_alloc();
+        }
+        chunk.size = size;
+        chunk.used = 0;
+        chunk.live = 0;
+        this->total_size += size;
+        if (!this->free_chunk_ids.empty()) {
+            uint32_t id = this->free_chunk_ids.back();
+            this->free_chunk_ids.pop_back();
+            this->chunks[id] = chunk;
+            return id;
+        }
+        this->chunks.push_back(chunk);
+        return this->chunks.size() - 1;
+    }
+
+    void _free_chunk(uint32_t id) {
+        Chunk &chunk = this->chunks[id];
+        this->total_size -= chunk.size;
+        free(chunk.data);
+        chunk.data = NULL;
+        chunk.size = chunk.used = chunk.live = 0;
+        this->free_chunk_ids.push_back(id);
+    }
+
+};
+
+
+////////////////////////////////////////////////////////////////////////////////
+// SCRIPT COMPRESSION -- the common script templates are stored as a type and
+// a 20-byte hash (in the style of bitcoind's compressed scripts).
+
+#define SCRIPT_TYPE_RAW    0
+#define SCRIPT_TYPE_P2PKH  1  // OP_DUP OP_HASH160 <20> OP_EQUALVERIFY OP_CHECKSIG
+#define SCRIPT_TYPE_P2SH   2  // OP_HASH160 <20> OP_EQUAL
+#define SCRIPT_TYPE_P2WPKH 3  // OP_0 <20>
+
+#define SCRIPT_HASH_SIZE 20
+
+inline uint8_t get_script_type(uint32_t script_len, const uint8_t *script) {
+    if (script_len == 25 && script[0] == 0x76 && script[1] == 0xa9 && script[2] == 0x14
+            && script[23] == 0x88 && script[24] == 0xac) {
+        return SCRIPT_TYPE_P2PKH;
+    }
+    if (script_len == 23 && script[0] == 0xa9 && script[1] == 0x14 && script[22] == 0x87) {
+        return SCRIPT_TYPE_P2SH;
+    }
+    if (script_len == 22 && script[0] == 0x00 && script[1] == 0x14) {
+        return SCRIPT_TYPE_P2WPKH;
+    }
+    return SCRIPT_TYPE_RAW;
+}
+
+// offset of the hash within the (uncompressed) script
+inline uint32_t get_script_hash_offset(uint8_t script_type) {
+    switch (script_type) {
+        case SCRIPT_TYPE_P2PKH: return 3;
+        case SCRIPT_TYPE_P2SH: return 2;
+        case SCRIPT_TYPE_P2WPKH: return 2;
+        default: return 0;
+    }
+}
+
+inline uint32_t get_script_size(uint8_t script_type, uint32_t stored_len) {
+    switch (script_type) {
+        case SCRIPT_TYPE_P2PKH: return 25;
+        case SCRIPT_TYPE_P2SH: return 23;
+        case SCRIPT_TYPE_P2WPKH: return 22;
+        default: return stored_len;
+    }
+}
+
+inline void decompress_script(uint8_t script_type, uint32_t stored_len, const uint8_t *stored, uint8_t *dst) {
+    switch (script_type) {
+        case SCRIPT_TYPE_P2PKH:
+            dst[0] = 0x76; dst[1] = 0xa9; dst[2] = 0x14; dst[23] = 0x88; dst[24] = 0xac;
+            break;
+        case SCRIPT_TYPE_P2SH:
+            dst[0] = 0xa9; dst[1] = 0x14; dst[22] = 0x87;
+            break;
+        case SCRIPT_TYPE_P2WPKH:
+            dst[0] = 0x00; dst[1] = 0x14;
+            break;
+    }
+    memcpy(dst + get_script_hash_offset(script_type), stored, stored_len);
+}
+
+
 ////////////////////////////////////////////////////////////////////////////////
 // UTX OUTPUT -- The per-output data stored in a CUtxEntry
 
@@ -31,7 +211,7 @@ public:
     inline CUtxOutputBase() : value(0) {}
     inline CUtxOutputBase(btc_value value) : value(value) {}
 
-    inline void dealloc() { this->value = OUTPUT_SPENT_MARKER; }
+    inline void dealloc(CScriptArena &) { this->value = OUTPUT_SPENT_MARKER; }
 
 };
 
@@ -40,9 +220,8 @@ class CUtxOutputMinimal : public CUtxOutputBase {
 public:
 
     inline CUtxOutputMinimal() {}
-    inline CUtxOutputMinimal(btc_value value, uint32_t, uint8_t *) : CUtxOutputBase(value) {}
         
-    inline void set(btc_value value, uint32_t, uint8_t *) {
+    inline void set(btc_value value, uint32_t, const uint8_t *, CScriptArena &) {
         this->value = value;
     }
     
@@ -52,35 +231,69 @@ class CUtxOutputScript : public CUtxOutputBase {
 
 public:
         
-    uint32_t script_len;
-    uint8_t *script;
+    // The script is stored compressed, in the arena.  Using chunk_id+offset (rather
+    // than a pointer), the whole struct takes the same 24 bytes it takes with a
+    // malloc'ed script pointer.
+    uint32_t script_chunk_id;
+    uint32_t script_offset;
+    uint32_t script_len;  // number of bytes stored in the arena
+    uint8_t script_type;
 
 public:
 
-    inline CUtxOutputScript() { this->set(0, 0, NULL); }
+    inline CUtxOutputScript() : script_chunk_id(SCRIPT_ARENA_NO_CHUNK), script_offset(0), script_len(0), script_type(SCRIPT_TYPE_RAW) {}
     
-    inline CUtxOutputScript(btc_value value, uint32_t script_len, uint8_t *script) {
-        this->set(value, script_len, script);
-    }
-
-    inline void set(btc_value value, uint32_t script_len, uint8_t *script) {
+    inline void set(btc_value value, uint32_t script_len, const uint8_t *script, CScriptArena &arena) {
         this->value = value;
+        this->script_type = get_script_type(script_len, script);
+        if (this->script_type != SCRIPT_TYPE_RAW) {
+            script += get_script_hash_offset(this->script_type);
+            script_len = SCRIPT_HASH_SIZE;
+        }
         this->script_len = script_len;
-        // Note: we use the given pointer, no copying.
-        this->script = script;
+        if (script_len > 0) {
+            // Note: we copy the script into the arena.
+            uint8_t *dst = arena.alloc(script_len, this->script_chunk_id, this->script_offset);
+            memcpy(dst, script, script_len);
+        } else {
+            this->script_chunk_id = SCRIPT_ARENA_NO_CHUNK;
+        }
     }
     
-    inline void dealloc() {
-        CUtxOutputBase::dealloc();
-        if (this->script != NULL) {
-            free(this->script);
-            this->script = NULL;
+    inline uint32_t get_script_size() const {
+        return ::get_script_size(this->script_type, this->script_len);
+    }
+
+    inline void copy_script(uint8_t *dst, const CScriptArena &arena) const {
+        const uint8_t *stored = NULL;
+        if (this->script_chunk_id != SCRIPT_ARENA_NO_CHUNK) {
+            stored = arena.get(this->script_chunk_id, this->script_offset);
+        }
+        decompress_script(this->script_type, this->script_len, stored, dst);
+    }
+
+    inline void dealloc(CScriptArena &arena) {
+        CUtxOutputBase::dealloc(arena);
+        if (this->script_chunk_id != SCRIPT_ARENA_NO_CHUNK) {
+            arena.release(this->script_chunk_id);
+            this->script_chunk_id = SCRIPT_ARENA_NO_CHUNK;
         }
     }
         
 };
 
 
+// Script access, for any output type (CUtxOutputMinimal has no scripts)
+
+inline uint32_t get_output_script_size(const CUtxOutputMinimal &) { return 0; }
+inline uint32_t get_output_script_size(const CUtxOutputScript &output) { return output.get_script_size(); }
+
+inline void copy_output_script(const CUtxOutputMinimal &, uint8_t *, const CScriptArena &) {}
+inline void copy_output_script(const CUtxOutputScript &output, uint8_t *dst, const CScriptArena &arena) {
+    output.copy_script(dst, arena);
+}
+
+
 ////////////////////////////////////////////////////////////////////////////////
 // SPENDING INFO: per-output data about spending (including data from CUtxEntry
 // and the relevant CUtxOutput)
@@ -115,10 +328,13 @@ public:
     osize_t num_outputs;
     osize_t num_unspent;
     int32_t block_height;
+    // more txid bytes (following the key), used for detecting key collisions.
+    // (this field takes no extra memory, it fits in the struct's padding)
+    uint32_t txid_check;
     
 public:
 
-    CUtxEntry() : outputs(NULL), num_outputs(0), num_unspent(0), block_height(0) {}
+    CUtxEntry() : outputs(NULL), num_outputs(0), num_unspent(0), block_height(0), txid_check(0) {}
     
     void _init(osize_t num_outputs, int32_t block_height) {
         this->block_height = block_height;
@@ -127,8 +343,16 @@ public:
         this->outputs = new CUtxOutput[num_outputs];
     }
     
-    void set_output(osize_t oidx, btc_value value, uint32_t script_len, uint8_t *script) {
-        this->outputs[oidx].set(value, script_len, script);
+    void set_output(osize_t oidx, btc_value value, uint32_t script_len, const uint8_t *script, CScriptArena &arena) {
+        this->outputs[oidx].set(value, script_len, script, arena);
+    }
+
+    void set_spent(osize_t oidx) {
+        // mark an output (which has not been set) as spent
+        if (this->outputs[oidx].value != OUTPUT_SPENT_MARKER) {
+            this->outputs[oidx].value = OUTPUT_SPENT_MARKER;
+            this->num_unspent--;
+        }
     }
 
     void spend(CSpendingInfo &spending_info, osize_t idx) {
@@ -144,12 +368,14 @@ public:
         spending_info.is_last = (this->num_unspent == 0);
     }
 
-    void dealloc(bool deep) {
+    void dealloc(bool deep, CScriptArena &arena) {
         // Note: it is safe to call dealloc() multiple times.
         if (this->outputs != NULL) {
             if (deep) {
                 for (osize_t i = 0; i < this->num_outputs; ++i) {
-                    this->outputs[i].dealloc();
+                    if (this->outputs[i].value != OUTPUT_SPENT_MARKER) {
+                        this->outputs[i].dealloc(arena);
+                    }
                 }
             }
             delete[] this->outputs;
@@ -161,8 +387,212 @@ public:
 };
 
 
+////////////////////////////////////////////////////////////////////////////////
+// TXIDS -- full txids, used as keys of the block-local table
+
+#define TXID_SIZE 32
+
+struct CTxid {
+    uint8_t bytes[TXID_SIZE];
+    CTxid(const uint8_t *txid) { memcpy(this->bytes, txid, TXID_SIZE); }
+    CTxid(const uint8_t *txid, uint8_t prefix_size) {
+        // only the txid prefix is kept (the rest is zeroed)
+        memcpy(this->bytes, txid, prefix_size);
+        memset(this->bytes + prefix_size, 0, TXID_SIZE - prefix_size);
+    }
+    bool operator==(const CTxid &other) const { return memcmp(this->bytes, other.bytes, TXID_SIZE) == 0; }
+};
+
+struct CTxidHash {
+    size_t operator()(const CTxid &txid) const {
+        // txids are already uniformly distributed
+        uint64_t h;
+        memcpy(&h, txid.bytes, sizeof(h));
+        return h;
+    }
+};
+
+inline txid_key_t make_txid_key(const uint8_t *txid, uint8_t key_size) {
+    txid_key_t key = 0;
+    for (uint8_t i = 0; i < key_size; ++i) {
+        key |= ((txid_key_t)txid[i]) << (8 * i);
+    }
+    return key;
+}
+
+inline uint32_t make_txid_check(const uint8_t *txid, uint8_t key_size) {
+    uint32_t check;
+    memcpy(&check, txid + key_size, sizeof(check));
+    return check;
+}
+
+
+////////////////////////////////////////////////////////////////////////////////
+// PACKED-KEY MAP -- the global map of the UTXO set.
+// An open-addressing hash table (linear probing), whose keys are stored packed,
+// key_size bytes each, in an array of their own.  A slot takes sizeof(E) +
+// key_size bytes, so a smaller key_size takes less memory (a std::unordered_map
+// node takes a pointer, a full 8-byte key, and malloc overhead, plus a bucket).
+// A slot is free iff its entry's `outputs` is NULL.  Entries are moved when the
+// table grows, or when an entry is erased, so pointers to entries are only valid
+// until the next insert/erase.
+
+#define PACKED_MAP_MIN_CAPACITY 16
+
+template <typename E>
+class CPackedKeyMap {
+
+public:
+
+    E *entries;
+    uint8_t *keys;
+    uint64_t capacity;  // a power of 2
+    uint8_t capacity_bits;
+    uint64_t num_used;
+    uint8_t key_size;
+
+public:
+
+    CPackedKeyMap() : entries(NULL), keys(NULL), capacity(0), capacity_bits(0), num_used(0), key_size(sizeof(txid_key_t)) {}
+
+    ~CPackedKeyMap() {
+        free(this->entries);
+        free(this->keys);
+    }
+
+    void set_key_size(uint8_t key_size) {
+        // (only before anything is inserted)
+        this->key_size = key_size;
+    }
+
+    inline uint64_t size() const { return this->num_used; }
+
+    inline uint64_t memory_size() const { return this->capacity * (sizeof(E) + this->key_size); }
+
+    inline bool is_used(uint64_t i) const { return this->entries[i].outputs != NULL; }
+
+    inline txid_key_t get_key(uint64_t i) const {
+        return make_txid_key(this->keys + i * this->key_size, this->key_size);
+    }
+
+    inline uint64_t _home(txid_key_t key) const {
+        // fibonacci hashing (keys with few bytes are not uniform in the high bits)
+        return (key * 0x9E3779B97F4A7C15ULL) >> (64 - this->capacity_bits);
+    }
+
+    E* find(txid_key_t key) {
+        if (this->num_used == 0) {
+            return NULL;
+        }
+        uint64_t mask = this->capacity - 1;
+        for (uint64_t i = this->_home(key); this->is_used(i); i = (i + 1) & mask) {
+            if (this->get_key(i) == key) {
+                return &(this->entries[i]);
+            }
+        }
+        return NULL;
+    }
+
+    E* insert(txid_key_t key) {
+        // the key must not be in the map. the caller must set the new entry's
+        // `outputs` before the map is accessed again.
+        if ((this->num_used + 1) * 5 > this->capacity * 4) {
+            this->_grow();
+        }
+        uint64_t i = this->_place(key);
+        this->num_used++;
+        return &(this->entries[i]);
+    }
+
+    void erase(E *entry) {
+        // backward-shift deletion (no tombstones): entries following the freed
+        // slot are moved back into it, if it's between them and their home slot
+        uint64_t mask = this->capacity - 1;
+        uint64_t i = entry - this->entries;
+        for (uint64_t j = (i + 1) & mask; this->is_used(j); j = (j + 1) & mask) {
+            uint64_t home = this->_home(this->get_key(j));
+            if (((j - home) & mask) >= ((j - i) & mask)) {
+                this->entries[i] = this->entries[j];
+                memcpy(this->keys + i * this->key_size, this->keys + j * this->key_size, this->key_size);
+                i = j;
+            }
+        }
+        this->entries[i] = E();
+        this->num_used--;
+    }
+
+    template <typename F>
+    void for_each(F &f) {
+        // calls f(key, entry) for each entry
+        for (uint64_t i = 0; i < this->capacity; ++i) {
+            if (this->is_used(i)) {
+                f(this->get_key(i), this->entries[i]);
+            }
+        }
+    }
+
+    uint64_t _place(txid_key_t key) {
+        uint64_t mask = this->capacity - 1;
+        uint64_t i = this->_home(key);
+        while (this->is_used(i)) {
+            i = (i + 1) & mask;
+        }
+        uint8_t *dst = this->keys + i * this->key_size;
+        for (uint8_t b = 0; b < this->key_size; ++b) {
+            dst[b] = (uint8_t)(key >> (8 * b));
+        }
+        return i;
+    }
+
+    void _grow() {
+        E *old_entries = this->entries;
+        uint8_t *old_keys = this->keys;
+        uint64_t old_capacity = this->capacity;
+        uint64_t capacity = old_capacity ? 2 * old_capacity : PACKED_MAP_MIN_CAPACITY;
+        // calloc: all slots free (outputs=NULL)
+        E *entries = (E*)calloc(capacity, sizeof(E));
+        uint8_t *keys = (uint8_t*)malloc(capacity * this->key_size);
+        if (entries == NULL || keys == NULL) {
+            free(entries);
+            free(keys);
+            throw bad_alloc();
+        }
+        this->entries = entries;
+        this->keys = keys;
+        this->capacity = capacity;
+        this->capacity_bits = 0;
+        while (((uint64_t)1 << this->capacity_bits) < capacity) {
+            this->capacity_bits++;
+        }
+        for (uint64_t i = 0; i < old_capacity; ++i) {
+            if (old_entries[i].outputs != NULL) {
+                txid_key_t key = make_txid_key(old_keys + i * this->key_size, this->key_size);
+                this->entries[this->_place(key)] = old_entries[i];
+            }
+        }
+        free(old_entries);
+        free(old_keys);
+    }
+
+};
+
+
 ////////////////////////////////////////////////////////////////////////////////
 // UTXO SET
+//
+// Between begin_block() and end_block(), new entries are added to a small
+// block-local table, instead of to the (big) global map.  Outputs spent within
+// the same block are resolved against the local table, and never touch the
+// global map.  The entries which survive the block are moved to the global map
+// when it ends.
+//
+// The global map (a CPackedKeyMap) is keyed by a prefix of the txid, of key_size
+// bytes.  If
+// check_collisions is set, a few more txid bytes are stored in each entry, for
+// detecting key collisions.  A tx whose key collides with a different tx is
+// stored in an overflow table, keyed by the full txid.
+// If check_collisions is not set, a tx whose key collides overwrites the
+// existing entry.
 
 template <typename CUtxOutput>
 class CUtxoSet {
@@ -172,56 +602,463 @@ public:
     typedef CUtxOutput COutput;
     typedef CUtxEntry<CUtxOutput> E;
     typedef typename E::CSpendingInfo CSpendingInfo;
-    typedef unordered_map<txid_key_t, E> Map;
-    typedef typename unordered_map<txid_key_t, E>::iterator MapIter;
+    typedef CPackedKeyMap<E> Map;
+    typedef unordered_map<CTxid, E, CTxidHash> LocalMap;
+    typedef typename unordered_map<CTxid, E, CTxidHash>::iterator LocalMapIter;
     
 public:
 
     Map _data;
+    LocalMap _block_data;
+    LocalMap _overflow;
+    bool in_block;
+    uint8_t key_size;
+    bool check_collisions;
+    CScriptArena arena;
 
 public:
 
+    CUtxoSet() : in_block(false), key_size(sizeof(txid_key_t)), check_collisions(false) {}
+
+    struct _Deallocator {
+        CScriptArena *arena;
+        inline void operator()(txid_key_t, E &entry) { entry.dealloc(true, *(this->arena)); }
+    };
+
     ~CUtxoSet() {
-        for (MapIter it = this->_data.begin(); it != this->_data.end(); ++it) {
-            it->second.dealloc(true);
+        _Deallocator f = { &(this->arena) };
+        this->_data.for_each(f);
+        for (LocalMapIter it = this->_block_data.begin(); it != this->_block_data.end(); ++it) {
+            it->second.dealloc(true, this->arena);
+        }
+        this->_block_data.clear();
+        for (LocalMapIter it = this->_overflow.begin(); it != this->_overflow.end(); ++it) {
+            it->second.dealloc(true, this->arena);
+        }
+        this->_overflow.clear();
+    }
+
+    void configure_keys(uint8_t key_size, bool check_collisions) {
+        this->key_size = key_size;
+        this->check_collisions = check_collisions;
+        this->_data.set_key_size(key_size);
+    }
+
+    inline txid_key_t make_key(const uint8_t *txid) {
+        return make_txid_key(txid, this->key_size);
+    }
+
+    inline CTxid make_partial_txid(const uint8_t *txid) {
+        // the txid bytes known for entries of the global map: the key and check
+        // bytes (the rest is zeroed)
+        return CTxid(txid, this->key_size + sizeof(uint32_t));
+    }
+
+    inline uint32_t make_check(const uint8_t *txid) {
+        return this->check_collisions ? make_txid_check(txid, this->key_size) : 0;
+    }
+
+    void begin_block() {
+        this->flush_block();
+        this->in_block = true;
+    }
+
+    void end_block() {
+        this->flush_block();
+        this->in_block = false;
+    }
+
+    void flush_block() {
+        // move the entries which survived the block to the global map
+        for (LocalMapIter it = this->_block_data.begin(); it != this->_block_data.end(); ++it) {
+            E &entry = this->_add_global(it->first.bytes);
+            uint32_t check = entry.txid_check;
+            entry = it->second;
+            entry.txid_check = check;
+        }
+        this->_block_data.clear();
+    }
+
+    E& add_tx(const uint8_t *txid, osize_t num_outputs, int32_t block_height) {
+        E *new_utxentry;
+        if (this->in_block) {
+            new_utxentry = &(this->_block_data.operator[](CTxid(txid)));
+            // a tx appearing twice in a block (impossible in a valid block):
+            new_utxentry->dealloc(true, this->arena);
+        } else {
+            new_utxentry = &(this->_add_global(txid));
         }
-        this->_data.clear();
+        new_utxentry->_init(num_outputs, block_height);
+        return *new_utxentry;
     }
 
-    E& add_tx(txid_key_t key, osize_t num_outputs, int32_t block_height) {
-        E &new_utxentry = this->_data.operator[](key);
-        new_utxentry._init(num_outputs, block_height);
-        return new_utxentry;
+    E& _add_global(const uint8_t *txid) {
+        uint32_t check = this->make_check(txid);
+        txid_key_t key = this->make_key(txid);
+        E *new_utxentry = this->_data.find(key);
+        if (new_utxentry == NULL) {
+            new_utxentry = this->_data.insert(key);
+        } else if (new_utxentry->txid_check != check) {
+            // key collision with a different tx. use the overflow table instead.
+            new_utxentry = &(this->_overflow.operator[](CTxid(txid)));
+        }
+        // if the entry already exists (a duplicate txid), it is overwritten:
+        new_utxentry->dealloc(true, this->arena);
+        new_utxentry->txid_check = check;
+        return *new_utxentry;
+    }
+
+    void set_output(E &entry, osize_t oidx, btc_value value, uint32_t script_len, const uint8_t *script) {
+        entry.set_output(oidx, value, script_len, script, this->arena);
     }
     
-    bool spend_output(txid_key_t key, osize_t output_idx, CSpendingInfo& spending_info) {
-        MapIter map_iter = this->_data.find(key);
-        MapIter end_iter = this->_data.end();
-        if (map_iter == end_iter) {
+    bool spend_output(const uint8_t *txid, osize_t output_idx, CSpendingInfo& spending_info) {
+        E *entry = this->_find(txid);
+        if (entry == NULL) {
             return false;
         }
-        this->_spend_utxo(map_iter, spending_info, output_idx);  // modifies spending_info inplace
+        if (output_idx >= entry->num_outputs || entry->outputs[output_idx].value == OUTPUT_SPENT_MARKER) {
+            // no such output, or already spent
+            return false;
+        }
+        entry->spend(spending_info, output_idx);  // modifies spending_info inplace
         return true;
     }
 
-    void _spend_utxo(MapIter map_iter, CSpendingInfo &spending_info, osize_t output_idx) {
-        map_iter->second.spend(spending_info, output_idx);
+    E* _find(const uint8_t *txid) {
+        if (!this->_block_data.empty()) {
+            LocalMapIter local_iter = this->_block_data.find(CTxid(txid));
+            if (local_iter != this->_block_data.end()) {
+                return &(local_iter->second);
+            }
+        }
+        E *entry = this->_data.find(this->make_key(txid));
+        if (entry != NULL && entry->txid_check == this->make_check(txid)) {
+            return entry;
+        }
+        if (!this->_overflow.empty()) {
+            LocalMapIter overflow_iter = this->_find_overflow(txid);
+            if (overflow_iter != this->_overflow.end()) {
+                return &(overflow_iter->second);
+            }
+        }
+        return NULL;
+    }
+
+    LocalMapIter _find_overflow(const uint8_t *txid) {
+        // the overflow table is keyed by full txids.  A tx added with a partial
+        // txid (the zero-padded key and check bytes, e.g. from a UTXO snapshot
+        // dumped by export_range()) can only be found by its partial txid.
+        LocalMapIter overflow_iter = this->_overflow.find(CTxid(txid));
+        if (overflow_iter == this->_overflow.end()) {
+            CTxid partial_txid = this->make_partial_txid(txid);
+            if (memcmp(partial_txid.bytes, txid, TXID_SIZE) != 0) {
+                overflow_iter = this->_overflow.find(partial_txid);
+            }
+        }
+        return overflow_iter;
     }
 
-    void dealloc_output(txid_key_t key, CUtxOutput *output, bool is_last) {
+    void dealloc_output(const uint8_t *txid, CUtxOutput *output, bool is_last) {
         // need to deallocate the output, whose ownership was passed to us
-        output->dealloc();
+        output->dealloc(this->arena);
         if (is_last) {
             // last output has now been spent. discard entry
             // TBD: avoid the double-lookup (in spend_output(), then in dealloc_output())
-            MapIter map_iter = this->_data.find(key);
-            map_iter->second.dealloc(false);
-            this->_data.erase(map_iter);
+            this->_discard(txid);
         }
     }
-    
+
+    bool restore_output(const uint8_t *txid, osize_t oidx, btc_value value, uint32_t script_len, const uint8_t *script, int32_t block_height) {
+        // the inverse of spending an output (e.g. when undoing a block).
+        // returns false if the output is already unspent.
+        E *entry = this->_find(txid);
+        if (entry == NULL) {
+            // all outputs of the tx were spent, and the entry was discarded. the
+            // other outputs are marked as spent (more are added if restored later)
+            entry = &(this->add_tx(txid, oidx + 1, block_height));
+            for (osize_t i = 0; i < oidx; ++i) {
+                entry->set_spent(i);
+            }
+        } else if (oidx >= entry->num_outputs) {
+            // an entry re-added by a previous restore, with fewer outputs. grow it
+            CUtxOutput *outputs = new CUtxOutput[oidx + 1];
+            for (osize_t i = 0; i < entry->num_outputs; ++i) {
+                outputs[i] = entry->outputs[i];  // (the arena data is not copied)
+            }
+            for (osize_t i = entry->num_outputs; i < oidx; ++i) {
+                outputs[i].value = OUTPUT_SPENT_MARKER;
+            }
+            delete[] entry->outputs;
+            entry->outputs = outputs;
+            entry->num_outputs = oidx + 1;
+            entry->num_unspent++;
+        } else if (entry->outputs[oidx].value != OUTPUT_SPENT_MARKER) {
+            return false;
+        } else {
+            entry->num_unspent++;
+        }
+        entry->set_output(oidx, value, script_len, script, this->arena);
+        return true;
+    }
+
+    void _discard(const uint8_t *txid) {
+        if (!this->_block_data.empty()) {
+            LocalMapIter local_iter = this->_block_data.find(CTxid(txid));
+            if (local_iter != this->_block_data.end()) {
+                local_iter->second.dealloc(false, this->arena);
+                this->_block_data.erase(local_iter);
+                return;
+            }
+        }
+        E *entry = this->_data.find(this->make_key(txid));
+        if (entry != NULL && entry->txid_check == this->make_check(txid)) {
+            entry->dealloc(false, this->arena);
+            this->_data.erase(entry);
+            return;
+        }
+        LocalMapIter overflow_iter = this->_find_overflow(txid);
+        overflow_iter->second.dealloc(false, this->arena);
+        this->_overflow.erase(overflow_iter);
+    }
+
+    // Batch updates: many spends (or adds) in a single call, from flat arrays
+
+    uint64_t spend_outputs(uint64_t n, const uint8_t *txids, const uint32_t *output_idxs,
+                           uint8_t *found, uint64_t *values, int32_t *block_heights,
+                           uint64_t *script_offsets, vector<uint8_t> *scripts) {
+        // spend the outputs (txids are n concatenated 32-byte txids).  outputs
+        // which are not found are skipped (and found[i] is set to 0).  scripts are
+        // only collected if `scripts` is not NULL: the script of the i-th output
+        // is then scripts[script_offsets[i]:script_offsets[i+1]].
+        // returns the number of outputs found.
+        uint64_t num_found = 0;
+        CSpendingInfo spending_info;
+        if (scripts != NULL) {
+            script_offsets[0] = 0;
+        }
+        for (uint64_t i = 0; i < n; ++i) {
+            const uint8_t *txid = txids + i * TXID_SIZE;
+            found[i] = this->spend_output(txid, output_idxs[i], spending_info);
+            if (found[i]) {
+                values[i] = spending_info.output->value;
+                block_heights[i] = spending_info.block_height;
+                if (scripts != NULL) {
+                    uint32_t script_size = get_output_script_size(*spending_info.output);
+                    if (script_size > 0) {
+                        uint64_t offset = scripts->size();
+                        scripts->resize(offset + script_size);
+                        copy_output_script(*spending_info.output, scripts->data() + offset, this->arena);
+                    }
+                }
+                this->dealloc_output(txid, spending_info.output, spending_info.is_last);
+                num_found++;
+            } else {
+                values[i] = 0;
+                block_heights[i] = -1;
+            }
+            if (scripts != NULL) {
+                script_offsets[i + 1] = scripts->size();
+            }
+        }
+        return num_found;
+    }
+
+    void add_outputs(uint64_t num_txs, const uint8_t *txids, const int32_t *block_heights, const uint32_t *num_outputs,
+                     const uint32_t *output_idxs, const btc_value *values,
+                     const uint64_t *script_offsets, const uint8_t *scripts) {
+        // add the outputs of num_txs txs (txids are concatenated 32-byte txids).
+        // the outputs of the i-th tx are the next num_outputs[i] elements of
+        // output_idxs and values (and, if scripts is not NULL, of script_offsets).
+        // the other outputs of the tx are considered spent.
+        uint64_t j = 0;
+        for (uint64_t i = 0; i < num_txs; ++i) {
+            uint64_t end = j + num_outputs[i];
+            if (end == j) {
+                continue;
+            }
+            osize_t tx_num_outputs = 0;
+            for (uint64_t k = j; k < end; ++k) {
+                if (output_idxs[k] >= tx_num_outputs) {
+                    tx_num_outputs = output_idxs[k] + 1;
+                }
+            }
+            E &entry = this->add_tx(txids + i * TXID_SIZE, tx_num_outputs, block_heights[i]);
+            for (osize_t oidx = 0; oidx < tx_num_outputs; ++oidx) {
+                entry.outputs[oidx].value = OUTPUT_SPENT_MARKER;
+            }
+            entry.num_unspent = num_outputs[i];
+            for (; j < end; ++j) {
+                if (scripts != NULL) {
+                    entry.set_output(output_idxs[j], values[j], script_offsets[j + 1] - script_offsets[j], scripts + script_offsets[j], this->arena);
+                } else {
+                    entry.set_output(output_idxs[j], values[j], 0, NULL, this->arena);
+                }
+            }
+        }
+    }
+
     uint64_t size() {
-        return this->_data.size();
+        return this->_data.size() + this->_block_data.size() + this->_overflow.size();
+    }
+
+    uint64_t overflow_size() {
+        return this->_overflow.size();
+    }
+
+    uint64_t table_memory_size() {
+        return this->_data.memory_size();
+    }
+
+    // Bulk introspection: iterating over all the unspent outputs in the set (or
+    // only over the ones whose keys are in the range [key_lo, key_hi]), calling
+    // f(key, txid_check, txid, block_height, output_idx, output) for each.
+    // txid is the full txid, or NULL for the entries of the global map (of which
+    // only the key and txid_check are known).
+
+    template <typename F>
+    struct _RangeVisitor {
+        CUtxoSet *utxoset; F *f; txid_key_t key_lo; txid_key_t key_hi;
+        inline void operator()(txid_key_t key, const E &entry) {
+            if (key >= this->key_lo && key <= this->key_hi) {
+                this->utxoset->_visit_entry(key, entry.txid_check, NULL, entry, *(this->f));
+            }
+        }
+    };
+
+    template <typename F>
+    void for_each_utxo(F &f, txid_key_t key_lo = 0, txid_key_t key_hi = UINT64_MAX) {
+        _RangeVisitor<F> visitor = { this, &f, key_lo, key_hi };
+        this->_data.for_each(visitor);
+        for (LocalMapIter it = this->_block_data.begin(); it != this->_block_data.end(); ++it) {
+            this->_visit_local_entry(it->first.bytes, it->second, f, key_lo, key_hi);
+        }
+        for (LocalMapIter it = this->_overflow.begin(); it != this->_overflow.end(); ++it) {
+            this->_visit_local_entry(it->first.bytes, it->second, f, key_lo, key_hi);
+        }
+    }
+
+    template <typename F>
+    inline void _visit_local_entry(const uint8_t *txid, const E &entry, F &f, txid_key_t key_lo, txid_key_t key_hi) {
+        txid_key_t key = this->make_key(txid);
+        if (key >= key_lo && key <= key_hi) {
+            this->_visit_entry(key, this->make_check(txid), txid, entry, f);
+        }
+    }
+
+    template <typename F>
+    inline void _visit_entry(txid_key_t key, uint32_t check, const uint8_t *txid, const E &entry, F &f) {
+        for (osize_t i = 0; i < entry.num_outputs; ++i) {
+            const CUtxOutput &output = entry.outputs[i];
+            if (output.value != OUTPUT_SPENT_MARKER) {
+                f(key, check, txid, entry.block_height, i, output);
+            }
+        }
+    }
+
+    struct _Counter {
+        uint64_t count;
+        uint64_t script_bytes;
+        _Counter() : count(0), script_bytes(0) {}
+        inline void operator()(txid_key_t, uint32_t, const uint8_t *, int32_t, osize_t, const CUtxOutput &output) {
+            this->count++;
+            this->script_bytes += get_output_script_size(output);
+        }
+    };
+
+    struct _Exporter {
+        uint64_t *keys; uint32_t *checks; uint8_t *txids; uint32_t *output_idxs; uint64_t *values; int32_t *block_heights;
+        uint64_t *script_offsets; uint8_t *scripts; const CScriptArena *arena; uint8_t key_size;
+        uint64_t i;
+        uint64_t script_offset;
+        inline void operator()(txid_key_t key, uint32_t check, const uint8_t *txid, int32_t block_height, osize_t oidx, const CUtxOutput &output) {
+            this->keys[this->i] = key;
+            if (this->checks != NULL) this->checks[this->i] = check;
+            if (this->txids != NULL) {
+                uint8_t *dst = this->txids + this->i * TXID_SIZE;
+                if (txid != NULL) {
+                    memcpy(dst, txid, TXID_SIZE);
+                } else {
+                    // only the key and check bytes are known. zero-padded.
+                    memset(dst, 0, TXID_SIZE);
+                    for (uint8_t b = 0; b < this->key_size; ++b) {
+                        dst[b] = (uint8_t)(key >> (8 * b));
+                    }
+                    memcpy(dst + this->key_size, &check, sizeof(check));
+                }
+            }
+            this->output_idxs[this->i] = oidx;
+            this->values[this->i] = output.value;
+            this->block_heights[this->i] = block_height;
+            if (this->scripts != NULL) {
+                this->script_offsets[this->i] = this->script_offset;
+                copy_output_script(output, this->scripts + this->script_offset, *(this->arena));
+                this->script_offset += get_output_script_size(output);
+                this->script_offsets[this->i + 1] = this->script_offset;
+            }
+            this->i++;
+        }
+    };
+
+    struct _Summer {
+        uint64_t total;
+        int32_t max_height;
+        uint64_t num_dust;
+        btc_value dust_threshold;
+        _Summer(btc_value dust_threshold) : total(0), max_height(-1), num_dust(0), dust_threshold(dust_threshold) {}
+        inline void operator()(txid_key_t, uint32_t, const uint8_t *, int32_t block_height, osize_t, const CUtxOutput &output) {
+            this->total += output.value;
+            if (block_height > this->max_height) this->max_height = block_height;
+            if (output.value < this->dust_threshold) this->num_dust++;
+        }
+    };
+
+    struct _HeightCounter {
+        uint64_t *counts; uint32_t bucket_size; uint32_t num_buckets;
+        inline void operator()(txid_key_t, uint32_t, const uint8_t *, int32_t block_height, osize_t, const CUtxOutput &) {
+            if (block_height < 0) return;  // unknown height
+            uint32_t bucket = block_height / this->bucket_size;
+            if (bucket < this->num_buckets) this->counts[bucket]++;
+        }
+    };
+
+    uint64_t num_unspent_outputs() {
+        _Counter f;
+        this->for_each_utxo(f);
+        return f.count;
+    }
+
+    void count_range(txid_key_t key_lo, txid_key_t key_hi, uint64_t &num_outputs, uint64_t &script_bytes) {
+        _Counter f;
+        this->for_each_utxo(f, key_lo, key_hi);
+        num_outputs = f.count;
+        script_bytes = f.script_bytes;
+    }
+
+    // checks, txids, script_offsets and scripts are optional (can be NULL).
+    // txids needs room for TXID_SIZE bytes per output (the txids of global map
+    // entries are partial, see make_partial_txid()).
+    // script_offsets needs room for num_outputs+1 elements.
+    uint64_t export_range(txid_key_t key_lo, txid_key_t key_hi,
+            uint64_t *keys, uint32_t *checks, uint8_t *txids, uint32_t *output_idxs, uint64_t *values, int32_t *block_heights,
+            uint64_t *script_offsets, uint8_t *scripts) {
+        _Exporter f = { keys, checks, txids, output_idxs, values, block_heights, script_offsets, scripts, &(this->arena), this->key_size, 0, 0 };
+        if (script_offsets != NULL) script_offsets[0] = 0;
+        this->for_each_utxo(f, key_lo, key_hi);
+        return f.i;
+    }
+
+    void summarize(btc_value dust_threshold, uint64_t &total, int32_t &max_height, uint64_t &num_dust) {
+        _Summer f(dust_threshold);
+        this->for_each_utxo(f);
+        total = f.total;
+        max_height = f.max_height;
+        num_dust = f.num_dust;
+    }
+
+    void count_by_height(uint32_t bucket_size, uint64_t *counts, uint32_t num_buckets) {
+        _HeightCounter f = { counts, bucket_size, num_buckets };
+        this->for_each_utxo(f);
     }
 
 };
@@ -0,0 +1,198 @@
+"""
+asyncio-native iteration over blocks and txs.
+
+The iterators of this package do blocking file reads (and CPU-bound
+decoding), so iterating over them directly in a coroutine blocks the event
+loop.  `aiter_blocks()` and `aiter_txs()` run the underlying iterators on an
+executor, reading ahead (a bounded number of) batches of elements::
+
+    async for tx in aiter_txs(tail = True):
+        await handle(tx)
+
+With `tail=True`, they keep waiting for new data (like `utils.tailable`), but
+the waiting is done using asyncio (no thread is blocked while waiting).
+Waiting can be cut short using `notify()`, e.g. when notified of a new block by
+bitcoind (`-blocknotify`).
+
+Any number of coroutines can each iterate over their own async iterator
+concurrently.  They share the executor: no thread is dedicated to a consumer.
+"""
+
+import asyncio
+import itertools
+
+from .utils import iter_blocks, iter_txs
+
+
+################################################################################
+
+_END = object()
+
+class AsyncIterator:
+    """
+    An async-iterator-wrapper of a (blocking) iterator, which calls it on an
+    executor.
+
+    Elements are read in batches, by a background task, which reads up to
+    `read_ahead` batches ahead of the consumer.  Only a single call to the
+    underlying iterator is made at a time.
+    """
+
+    DEFAULT_BATCH_SIZE = 100
+    DEFAULT_READ_AHEAD = 4
+
+    def __init__(self, iterator, tail = False, timeout = None, polling_interval = 5,
+                 batch_size = None, read_ahead = None, executor = None):
+        """
+        :param iterator: the underlying iterator. With `tail=True`, it needs to be
+            "refreshable" (see `utils.tailable`)
+        :param tail: keep waiting for new data, when the underlying iterator is exhausted
+        :param timeout: with `tail=True`, stop after waiting this many seconds for
+            new data (None to wait forever)
+        :param polling_interval: with `tail=True`, how often to check for new data (in seconds)
+        :param batch_size: number of elements read in each call on the executor
+        :param read_ahead: max number of batches read, but not consumed yet
+        :param executor: a `concurrent.futures.Executor` (None for the loop's
+            default executor)
+        """
+        self.iter = iterator
+        self.tail = tail
+        if timeout is None:
+            timeout = float('Inf')
+        self.timeout = timeout
+        self.polling_interval = polling_interval
+        self.batch_size = batch_size if batch_size is not None else self.DEFAULT_BATCH_SIZE
+        self.read_ahead = read_ahead if read_ahead is not None else self.DEFAULT_READ_AHEAD
+        self.executor = executor
+
+        # state
+        self._batch = iter(())  # the batch being consumed
+        self._queue = None  # of batches (created on first use, in the loop)
+        self._producer = None  # the task filling _queue
+        self._wakeup = None  # an asyncio.Event, set to stop waiting for new data
+        self._is_stopped = False
+        self._is_done = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            try:
+                return self._batch.__next__()
+            except StopIteration:
+                pass
+            if self._is_done:
+                raise StopAsyncIteration
+            if self._queue is None:
+                self._start()
+            batch = await self._queue.get()
+            if batch is _END:
+                self._is_done = True
+                raise StopAsyncIteration
+            if isinstance(batch, BaseException):
+                self._is_done = True
+                raise batch
+            self._batch = iter(batch)
+
+    def _start(self):
+        self._queue = asyncio.Queue(maxsize = self.read_ahead)
+        self._wakeup = asyncio.Event()
+        self._producer = asyncio.ensure_future(self._produce())
+
+    async def _produce(self):
+        loop = asyncio.get_running_loop()
+        queue = self._queue
+        wait_start_time = loop.time()
+        try:
+            while not self._is_stopped:
+                # (cleared before reading, so notifications made while reading are not missed)
+                self._wakeup.clear()
+                batch = await loop.run_in_executor(self.executor, self._read_batch)
+                if batch:
+                    await queue.put(batch)
+                    wait_start_time = loop.time()
+                    continue
+                # no more available data. check timeout, then wait+retry
+                if not self.tail:
+                    break
+                remaining_time = self.timeout - (loop.time() - wait_start_time)
+                if remaining_time <= 0:
+                    # timed out, waited long enough
+                    break
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout = min(self.polling_interval, remaining_time))
+                except asyncio.TimeoutError:
+                    pass
+        except Exception as e:
+            await queue.put(e)
+        await queue.put(_END)
+
+    def _read_batch(self):
+        # (runs on the executor)
+        return list(itertools.islice(self.iter, self.batch_size))
+
+    def notify(self):
+        """
+        Check for new data now, instead of waiting for the polling interval to
+        pass (with `tail=True`).
+        """
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def stop(self):
+        """
+        Signal the iterator to stop waiting for more data.  Elements already
+        read are still generated.
+        """
+        self._is_stopped = True
+        self.notify()
+
+    async def aclose(self):
+        """
+        Stop reading, and discard the elements already read.
+        """
+        self.stop()
+        if self._producer is not None:
+            self._producer.cancel()
+            try:
+                await self._producer
+            except asyncio.CancelledError:
+                pass
+        self._batch = iter(())
+        self._is_done = True
+
+    def __repr__(self):
+        return '<%s of %r>' % ( type(self).__name__, self.iter )
+
+
+################################################################################
+
+def aiter_blocks(block_iter = None, tail = False, timeout = None, polling_interval = 5,
+                 batch_size = None, read_ahead = None, executor = None, **kwargs):
+    """
+    The async version of `iter_blocks()`.
+    :param tail, timeout, polling_interval, batch_size, read_ahead, executor: see AsyncIterator
+    :param kwargs: extra kwargs for `iter_blocks()`
+    :return: an AsyncIterator
+    """
+    return AsyncIterator(
+        iter_blocks(block_iter = block_iter, **kwargs), tail = tail, timeout = timeout, polling_interval = polling_interval,
+        batch_size = batch_size, read_ahead = read_ahead, executor = executor)
+
+def aiter_txs(tx_iter = None, tail = False, timeout = None, polling_interval = 5,
+              batch_size = None, read_ahead = None, executor = None, **kwargs):
+    """
+    The async version of `iter_txs()`.
+    :param tx_iter: a TxIterator (if None, one is created by `iter_txs()`)
+    :param tail, timeout, polling_interval, batch_size, read_ahead, executor: see AsyncIterator
+    :param kwargs: extra kwargs for `iter_txs()` (ignored unless tx_iter is None)
+    :return: an AsyncIterator
+    """
+    if tx_iter is None:
+        tx_iter = iter_txs(**kwargs)
+    return AsyncIterator(
+        tx_iter, tail = tail, timeout = timeout, polling_interval = polling_interval,
+        batch_size = batch_size, read_ahead = read_ahead, executor = executor)
+
+################################################################################
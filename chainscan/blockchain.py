@@ -2,10 +2,18 @@
 The BlockChain data structure and tools for populating it.
 """
 
+import os
+import json
+import datetime
 from collections import OrderedDict
+import numpy as np
 
-from .misc import bytes_to_hash_hex
-from .scan import LongestChainBlockIterator
+from .misc import bytes_to_hash_hex, FilePos, Bunch
+from .scan import LongestChainBlockIterator, BlockFilter, ReorgEvent, read_block, get_block_ref
+from .block import deserialize_block
+
+from .loggers import get_logger
+logger = get_logger('blockchain', 'info')
 
 
 ################################################################################
@@ -17,14 +25,15 @@ class BlockInfo:
     Block metadata.
     """
     
-    __slots__ = [ 'block_hash', 'height', 'timestamp', 'num_txs', 'rawsize' ]
+    __slots__ = [ 'block_hash', 'height', 'timestamp', 'num_txs', 'rawsize', 'filepos' ]
     
-    def __init__(self, block_hash, height, timestamp, num_txs, rawsize):
+    def __init__(self, block_hash, height, timestamp, num_txs, rawsize, filepos = None):
         self.block_hash = block_hash
         self.height = height
         self.timestamp = timestamp
         self.num_txs = num_txs
         self.rawsize = rawsize
+        self.filepos = filepos
         
     @classmethod
     def from_block(cls, block):
@@ -39,7 +48,11 @@ class BlockInfo:
         
     @property
     def block_hash_hex(self):
-        return bytes_to_hash_hex(self.block_hash)
+        return bytes_to_hash_hex(bytearray(self.block_hash))
+
+    @property
+    def timestamp_epoch(self):
+        return int(self.timestamp.timestamp())
 
     def __repr__(self):
         return '<%s #%d %s>' % ( type(self).__name__, self.height, self.block_hash_hex )
@@ -50,16 +63,66 @@ class BlockChain:
     efficient lookup by block hash and height.
     
     This data structure includes the longest chain only, no forks.
+
+    Block data is stored in columns (numpy arrays, one row per block), and
+    BlockInfos are created on access.  Lookup by hash uses a sorted index of
+    hash prefixes (blocks appended since the index was last built are kept in a
+    small dict, until it is rebuilt).
+
+    A BlockChain can be saved to a directory, and loaded from it.  Loading maps
+    the files to memory, so it is instant.  Saving to the directory it was loaded
+    from only appends the new blocks.
+
+    The locations of the blocks (in the `blk*.dat` files) are also stored, if
+    known, so blocks can be read directly (see `get_block()`).
     """
+
+    # name -> ( dtype, row shape )
+    COLUMNS = OrderedDict([
+        ( 'hashes', ( np.uint8, (32,) ) ),
+        ( 'timestamps', ( np.uint32, () ) ),
+        ( 'num_txs', ( np.uint32, () ) ),
+        ( 'rawsizes', ( np.uint32, () ) ),
+        ( 'file_idxs', ( np.uint32, () ) ),  # index into _filenames
+        ( 'offsets', ( np.uint64, () ) ),  # where the block starts in the file (its magic)
+    ])
+    INITIAL_CAPACITY = 1024
+    MIN_PENDING_INDEX_SIZE = 4096
+    BLOCK_CACHE_SIZE = 64
+    FORMAT_VERSION = 1
     
     def __init__(self, blocks = None):
         
-        # An OrderedDict from block_hash to BlockInfo.
-        # The height is reflected in the ordering of the items.
-        self._blocks = OrderedDict()
-        
-        # Used for lookup by height (OrderedDict does not support random-access)
-        self._height_to_hash = dict()
+        self._size = 0
+        self._columns = {
+            name: np.empty((0,) + shape, dtype = dtype)
+            for name, ( dtype, shape ) in self.COLUMNS.items()
+        }
+
+        # The hash index: the prefixes of the hashes of the first `_num_indexed`
+        # blocks, sorted, along with their heights.
+        self._index_prefixes = np.empty(0, dtype = np.uint64)
+        self._index_heights = np.empty(0, dtype = np.uint32)
+        self._num_indexed = 0
+        # blocks not indexed yet: block_hash -> height
+        self._pending = {}
+
+        # the running max of the timestamps, computed on demand (of the first
+        # `_max_timestamps_size` blocks)
+        self._max_timestamps = np.empty(0, dtype = np.uint32)
+        self._max_timestamps_size = 0
+
+        # block locations: the blk*.dat files referenced
+        self._filenames = []
+        self._filename_idxs = {}  # filename -> index in _filenames
+
+        # recently read blocks: block_hash -> Block
+        self._block_cache = OrderedDict()
+
+        # for saving incrementally: the directory last saved to (or loaded from),
+        # and the number of blocks which are the same in memory and on disk
+        self._dirname = None
+        self._num_unchanged = 0
 
         if blocks:
             self.extend(blocks)
@@ -68,7 +131,7 @@ class BlockChain:
     
     def append(self, block):
         """
-        :param block: a BlockInfo
+        :param block: a BlockInfo (or a Block)
         """
         next_height = block.height
         next_hash = block.block_hash
@@ -77,11 +140,30 @@ class BlockChain:
         if next_height != last_height + 1:
             raise ValueError('Expected block with height %s, got %s' % (last_height + 1, next_height))
         # verify hash
-        if next_hash in self._blocks:
+        if self.contains_hash(next_hash):
             raise ValueError('Block hash already in BlockChain: %s' % block.block_hash_hex)
+        # verify it follows the last block (only Blocks reference their prev block)
+        prev_block_hash = getattr(block, 'prev_block_hash', None)
+        if prev_block_hash is not None and last_height >= 0 and \
+                bytes(prev_block_hash) != self._columns['hashes'][last_height].tobytes():
+            raise ValueError('Block does not follow the last block of the BlockChain: %s' % block.block_hash_hex)
         # add to data structure
-        self._blocks[next_hash] = block
-        self._height_to_hash[next_height] = block.block_hash
+        self._reserve(next_height + 1)
+        columns = self._columns
+        columns['hashes'][next_height] = np.frombuffer(next_hash, dtype = np.uint8)
+        columns['timestamps'][next_height] = block.timestamp_epoch
+        columns['num_txs'][next_height] = block.num_txs
+        columns['rawsizes'][next_height] = block.rawsize
+        filepos = block.filepos
+        if filepos is not None:
+            columns['file_idxs'][next_height] = self._get_file_idx(filepos.filename)
+            columns['offsets'][next_height] = filepos.offset
+        else:
+            columns['file_idxs'][next_height] = NO_FILE
+        self._size += 1
+        self._pending[bytes(next_hash)] = next_height
+        if len(self._pending) > max(self.MIN_PENDING_INDEX_SIZE, self._size // 8):
+            self._build_index()
 
     def extend(self, blocks):
         """
@@ -91,36 +173,86 @@ class BlockChain:
             self.append(block)
 
     def clear(self):
-        self._blocks.clear()
-        self._height_to_hash.clear()
+        self.__init__()
         
     def pop(self):
         """
         Remove the most recent block from the chain.
         """
-        block = self._blocks.pop()
-        del self._height_to_hash[block.height]
+        block = self.last_block
+        if block is None:
+            raise KeyError('pop from an empty BlockChain')
+        self._size -= 1
+        self._num_unchanged = min(self._num_unchanged, self._size)
+        self._max_timestamps_size = min(self._max_timestamps_size, self._size)
+        if self._pending.pop(block.block_hash, None) is None:
+            # it is in the index
+            keep = self._index_heights != block.height
+            self._index_prefixes = self._index_prefixes[keep]
+            self._index_heights = self._index_heights[keep]
+            self._num_indexed -= 1
         return block
 
+    def _reserve(self, size):
+        # make sure the columns are writable, and can hold `size` blocks
+        columns = self._columns
+        capacity = len(columns['hashes'])
+        is_writable = columns['hashes'].flags.writeable and not isinstance(columns['hashes'], np.memmap)
+        if capacity >= size and is_writable:
+            return
+        capacity = max(size, 2 * capacity, self.INITIAL_CAPACITY)
+        for name, ( dtype, shape ) in self.COLUMNS.items():
+            column = np.empty((capacity,) + shape, dtype = dtype)
+            column[:self._size] = columns[name][:self._size]
+            columns[name] = column
+
+    def _build_index(self):
+        # index all blocks (the pending ones included)
+        prefixes = self._get_prefixes(0, self._size)
+        order = np.argsort(prefixes, kind = 'stable')
+        self._index_prefixes = prefixes[order]
+        self._index_heights = order.astype(np.uint32)
+        self._num_indexed = self._size
+        self._pending = {}
+
+    def _get_prefixes(self, start, stop):
+        return np.ascontiguousarray(self._columns['hashes'][start:stop, :8]).view('<u8').reshape(-1)
+
+    def _find_height(self, block_hash):
+        height = self._pending.get(block_hash)
+        if height is not None:
+            return height
+        if len(block_hash) != 32:
+            return None
+        prefix = int.from_bytes(block_hash[:8], 'little')
+        lo = np.searchsorted(self._index_prefixes, prefix, 'left')
+        hi = np.searchsorted(self._index_prefixes, prefix, 'right')
+        hashes = self._columns['hashes']
+        for i in range(lo, hi):
+            height = int(self._index_heights[i])
+            if hashes[height].tobytes() == block_hash:
+                return height
+        return None
+
     # Iterating and other list operations
     
     def __len__(self):
-        return len(self._blocks)
+        return self._size
 
     def __iter__(self):
-        return iter(self._blocks.values())
+        return ( self._get_block_info(height) for height in range(self._size) )
 
     def __reversed__(self):
-        return reversed(self._blocks.values())
+        return ( self._get_block_info(height) for height in reversed(range(self._size)) )
     
     def __contains__(self, block):
-        self.contains_block(block)
+        return self.contains_block(block)
     
     def contains_block(self, block):
         return self.contains_hash(block.block_hash)
     
     def contains_hash(self, block_hash):
-        return block_hash in self._blocks
+        return self._find_height(bytes(block_hash)) is not None
     
     def __getitem__(self, i):
         if isinstance(i, bytes):
@@ -150,13 +282,282 @@ class BlockChain:
             return None
 
     def get_by_height(self, height):
-        return self.get_by_hash(self._height_to_hash[height])
+        if not 0 <= height < self._size:
+            raise KeyError(height)
+        return self._get_block_info(height)
     
     def get_by_hash(self, block_hash):
-        return self._blocks[block_hash]
+        height = self._find_height(bytes(block_hash))
+        if height is None:
+            raise KeyError(block_hash)
+        return self._get_block_info(height)
+
+    def _get_block_info(self, height):
+        columns = self._columns
+        return BlockInfo(
+            block_hash = columns['hashes'][height].tobytes(),
+            height = height,
+            timestamp = datetime.datetime.fromtimestamp(int(columns['timestamps'][height])),
+            num_txs = int(columns['num_txs'][height]),
+            rawsize = int(columns['rawsizes'][height]),
+            filepos = self._get_filepos(height),
+        )
+
+    def _get_file_idx(self, filename):
+        file_idx = self._filename_idxs.get(filename)
+        if file_idx is None:
+            file_idx = len(self._filenames)
+            self._filenames.append(filename)
+            self._filename_idxs[filename] = file_idx
+        return file_idx
+
+    def _get_filepos(self, height):
+        file_idx = int(self._columns['file_idxs'][height])
+        if file_idx == NO_FILE:
+            return None
+        return FilePos(self._filenames[file_idx], int(self._columns['offsets'][height]))
+
+    # Reading blocks
+
+    def get_block(self, height_or_hash):
+        """
+        Read a block (only its own data) from the `blk*.dat` file it is in.
+        Recently read blocks are cached.
+        :param height_or_hash: the block's height, or hash (bytes)
+        :return: a Block
+        """
+        return self.get_blocks([ height_or_hash ])[0]
+
+    def get_blocks(self, heights_or_hashes):
+        """
+        Same as `get_block()`, for several blocks.  The blocks are read in the
+        order they are stored, not in the order requested.
+        :return: a list of Blocks, in the order requested
+        """
+        heights = [ self._to_height(x) for x in heights_or_hashes ]
+        cache = self._block_cache
+        res = {}
+        to_read = []
+        for height in set(heights):
+            block_hash = self._columns['hashes'][height].tobytes()
+            block = cache.get(block_hash)
+            if block is not None:
+                cache.move_to_end(block_hash)
+                res[height] = block
+            else:
+                filepos = self._get_filepos(height)
+                if filepos is None:
+                    raise ValueError('Location of block #%d is unknown' % height)
+                to_read.append(( filepos.filename, filepos.offset, height, block_hash ))
+        for filename, offset, height, block_hash in sorted(to_read):
+            block = _read_block(filename, offset, int(self._columns['rawsizes'][height]), height)
+            res[height] = block
+            cache[block_hash] = block
+            if len(cache) > self.BLOCK_CACHE_SIZE:
+                cache.popitem(last = False)
+        return [ res[height] for height in heights ]
+
+    def _to_height(self, height_or_hash):
+        if isinstance(height_or_hash, (bytes, bytearray)):
+            height = self._find_height(bytes(height_or_hash))
+            if height is None:
+                raise KeyError(height_or_hash)
+            return height
+        height = int(height_or_hash)
+        if not 0 <= height < self._size:
+            raise KeyError(height)
+        return height
+
+    @property
+    def timestamps(self):
+        """
+        The block timestamps (epoch seconds), as an array indexed by height.
+        """
+        return self._columns['timestamps'][:self._size]
+
+    @property
+    def rawsizes(self):
+        """
+        The raw block sizes (in bytes), as an array indexed by height.
+        """
+        return self._columns['rawsizes'][:self._size]
+
+    # Lookup by time
+
+    @property
+    def max_timestamps(self):
+        """
+        The running max of the block timestamps (epoch seconds), as an array
+        indexed by height.  Unlike block timestamps, it is monotonic.
+        """
+        n = self._max_timestamps_size
+        size = self._size
+        if n < size:
+            if len(self._max_timestamps) < size:
+                max_timestamps = np.empty(len(self._columns['timestamps']), dtype = np.uint32)
+                max_timestamps[:n] = self._max_timestamps[:n]
+                self._max_timestamps = max_timestamps
+            tail = self._max_timestamps[n:size]
+            np.maximum.accumulate(self._columns['timestamps'][n:size], out = tail)
+            if n > 0:
+                np.maximum(tail, self._max_timestamps[n - 1], out = tail)
+            self._max_timestamps_size = size
+        return self._max_timestamps[:size]
+
+    def height_at_or_after(self, t):
+        """
+        Find the first block with a timestamp of `t` or later.
+        :param t: a datetime, or epoch seconds.  Can also be an array of epoch
+            seconds, in which case an array of heights is returned.
+        :return: the height of the block, or `len(self)` if there is no such block.
+        :note: Block timestamps are not monotonic: blocks following the block found
+            can have earlier timestamps.
+        """
+        heights = np.searchsorted(self.max_timestamps, _to_epoch(t), 'left')
+        return int(heights) if np.ndim(heights) == 0 else heights
+
+    def height_range(self, start_time = None, stop_time = None):
+        """
+        :return: a range of the heights of the blocks from the first with a
+            timestamp of `start_time` or later (inclusive), to the first with
+            a timestamp of `stop_time` or later (exclusive).
+        """
+        start = self.height_at_or_after(start_time) if start_time is not None else 0
+        stop = self.height_at_or_after(stop_time) if stop_time is not None else len(self)
+        return range(start, max(start, stop))
+
+    def get_block_filter(self, start_block_time = None, stop_block_time = None):
+        """
+        :return: a BlockFilter including the same blocks as
+            `BlockFilter(start_block_time = ..., stop_block_time = ...)`, but by
+            height, so the blocks before the start can be skipped without checking
+            their timestamps.
+        """
+        heights = self.height_range(start_block_time, stop_block_time)
+        return BlockFilter(
+            start_block_height = heights.start,
+            stop_block_height = heights.stop if stop_block_time is not None else None,
+        )
+
+    # Persistence
+
+    def save(self, dirname):
+        """
+        Save to a directory (created if missing).
+        If already saved to (or loaded from) `dirname`, only the blocks added
+        since are written.
+        """
+        os.makedirs(dirname, exist_ok = True)
+        if self._pending:
+            self._build_index()
+        num_unchanged = self._num_unchanged if dirname == self._dirname else 0
+        for name, ( dtype, shape ) in self.COLUMNS.items():
+            row_size = np.dtype(dtype).itemsize * int(np.prod(shape))
+            filename = os.path.join(dirname, '%s.bin' % name)
+            if num_unchanged > 0 and os.path.isfile(filename) and os.path.getsize(filename) == num_unchanged * row_size:
+                # only appending. (the file might be memory-mapped, by this
+                # BlockChain or by others, which is safe as long as the mapped
+                # part is not modified)
+                with open(filename, 'ab') as f:
+                    f.write(self._columns[name][num_unchanged:self._size].tobytes())
+            else:
+                # rows are removed or replaced (e.g. after `pop()`).  rewritten
+                # into a new file, rather than truncating a file which might be
+                # memory-mapped (accessing a truncated mapping crashes)
+                _write_file(filename, self._columns[name][:self._size])
+        # the index is rewritten, into new files (it might be memory-mapped)
+        for name, arr in [ ( 'index_prefixes', self._index_prefixes ), ( 'index_heights', self._index_heights ) ]:
+            _write_file(os.path.join(dirname, '%s.bin' % name), arr)
+        # the metadata file is written last
+        meta = dict(
+            version = self.FORMAT_VERSION,
+            size = self._size,
+            num_indexed = self._num_indexed,
+            filenames = self._filenames,
+        )
+        filename = os.path.join(dirname, 'meta.json')
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(filename + '.tmp', filename)
+        self._dirname = dirname
+        self._num_unchanged = self._size
+
+    @classmethod
+    def load(cls, dirname):
+        """
+        Load a BlockChain saved using `save()`.  The files are memory-mapped, and
+        are only read when accessed.
+        """
+        with open(os.path.join(dirname, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != cls.FORMAT_VERSION:
+            raise ValueError('Unsupported BlockChain format version: %s' % meta['version'])
+        size = meta['size']
+        num_indexed = meta['num_indexed']
+        blockchain = cls()
+        for name, ( dtype, shape ) in cls.COLUMNS.items():
+            blockchain._columns[name] = _memmap(os.path.join(dirname, '%s.bin' % name), dtype, (size,) + shape)
+        blockchain._size = size
+        blockchain._index_prefixes = _memmap(os.path.join(dirname, 'index_prefixes.bin'), np.uint64, (num_indexed,))
+        blockchain._index_heights = _memmap(os.path.join(dirname, 'index_heights.bin'), np.uint32, (num_indexed,))
+        blockchain._num_indexed = num_indexed
+        blockchain._filenames = meta['filenames']
+        blockchain._filename_idxs = { filename: i for i, filename in enumerate(blockchain._filenames) }
+        blockchain._pending = {
+            blockchain._columns['hashes'][height].tobytes(): height
+            for height in range(num_indexed, size)
+        }
+        blockchain._dirname = dirname
+        blockchain._num_unchanged = size
+        return blockchain
+
+    # pickle support -- the unused capacity is not included
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_columns'] = { name: np.array(column[:self._size]) for name, column in self._columns.items() }
+        state['_index_prefixes'] = np.array(self._index_prefixes)
+        state['_index_heights'] = np.array(self._index_heights)
+        state['_block_cache'] = OrderedDict()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
 
     def __repr__(self):
-        return '<%s %d blocks, last from %s>' % ( type(self).__name__, len(self), self.last_block.timestamp )
+        last_block = self.last_block
+        return '<%s %d blocks, last from %s>' % ( type(self).__name__, len(self), last_block.timestamp if last_block is not None else None )
+
+# the file index of blocks of unknown location
+NO_FILE = 2**32 - 1
+
+def _read_block(filename, offset, rawsize, height):
+    # the block's data follows its magic and size fields
+    blob = bytearray(rawsize)
+    with open(filename, 'rb') as f:
+        if os.preadv(f.fileno(), [ blob ], offset + 8) != rawsize:
+            raise ValueError('Truncated block at %s, offset %s' % (filename, offset))
+    block = deserialize_block(blob, height, False)
+    block.filepos = FilePos(filename, offset)
+    return block
+
+def _write_file(filename, arr):
+    # write to a new file, and replace the old one (whose memory mappings keep
+    # referring to the old data)
+    with open(filename + '.tmp', 'wb') as f:
+        f.write(arr.tobytes())
+    os.replace(filename + '.tmp', filename)
+
+def _to_epoch(t):
+    if isinstance(t, datetime.datetime):
+        return int(t.timestamp())
+    return t
+
+def _memmap(filename, dtype, shape):
+    if shape[0] == 0:
+        # can't map an empty file
+        return np.empty(shape, dtype = dtype)
+    return np.memmap(filename, dtype = dtype, mode = 'r', shape = shape)
 
 
 ################################################################################
@@ -178,6 +579,11 @@ class BlockChainIterator:
 
     BlockInfo = BlockInfo
     BlockIterator = LongestChainBlockIterator
+
+    # when resuming from a non-empty BlockChain, the blk files are read from the
+    # position of the first stored of its last RESUME_WINDOW blocks (bitcoind
+    # stores blocks in the order they are downloaded, up to 1024 blocks ahead)
+    RESUME_WINDOW = 1024
     
 
     def __init__(self, blockchain = None, block_iter = None, **kwargs):
@@ -185,19 +591,91 @@ class BlockChainIterator:
         :param blockchain: a BlockChain
         :param block_iter: a LongestChainBlockIterator
         :param kwargs: extra kwargs for LongestChainBlockIterator (ignored unless block_iter is None)
+        :note: If `blockchain` is not empty (e.g. loaded using `BlockChain.load()`),
+            and no `block_filter` is specified, iteration starts from the block
+            following its last block.  The blk files are then read from the
+            stored positions of its last blocks (if known), rather than from
+            the first file.
         """
+        if blockchain is None:
+            blockchain = BlockChain()
         if block_iter is None:
+            resume_state = None
+            if len(blockchain) > 0 and kwargs.get('block_filter') is None:
+                resume_state = self._get_resume_state(blockchain)
+                if resume_state is None:
+                    # the blocks' positions are unknown. scan all files
+                    kwargs['block_filter'] = BlockFilter(start_block_height = blockchain.height + 1)
             block_iter = self.BlockIterator(**kwargs)
+            if resume_state is not None:
+                block_iter.set_checkpoint_state(resume_state)
         self.block_iter = block_iter
-        if blockchain is None:
-            blockchain = BlockChain()
         self.blockchain = blockchain
 
+    def _get_resume_state(self, blockchain):
+        """
+        The state of a LongestChainBlockIterator (see `get_checkpoint_state()`)
+        which generates the blocks following the last block of `blockchain`,
+        reading the blk files from the stored positions of its last blocks.
+        :return: None if the positions are unknown, or the last block is not
+            stored where expected (e.g. the files changed)
+        """
+        last_block = blockchain.last_block
+        heights = range(max(0, last_block.height + 1 - self.RESUME_WINDOW), last_block.height + 1)
+        fileposes = [ blockchain._get_filepos(height) for height in heights ]
+        if None in fileposes:
+            return None
+        try:
+            block = read_block(last_block.filepos, last_block.height)
+        except (OSError, ValueError):
+            block = None
+        if block is None or bytes(block.block_hash) != last_block.block_hash:
+            logger.warning('block #%d not found at %s. scanning all files', last_block.height, last_block.filepos)
+            return None
+        start = min(fileposes, key = lambda filepos: ( filepos.filename, filepos.offset ))
+        return Bunch(
+            root_block = get_block_ref(block),
+            blocks = [],
+            last_block_hash = block.block_hash,
+            block_filter = None,
+            best_tip_hash = block.block_hash,
+            block_iter = Bunch(
+                height_by_hash = { blockchain._columns['hashes'][height].tobytes(): height for height in heights },
+                orphans = {},
+                ready_blocks = [],
+                rawfile_block_iter = Bunch(
+                    filename = start.filename,
+                    offset = start.offset,
+                    raw_data_iter = start.filename,
+                ),
+            ),
+        )
+
+    @property
+    def generate_unsafe_tail(self):
+        return getattr(self.block_iter, 'generate_unsafe_tail', False)
+
     def __next__(self):
         block = next(self.block_iter)
-        block_info = BlockInfo.from_block(block)
-        self.blockchain.append(block_info)
+        if type(block) is ReorgEvent:
+            # (with generate_unsafe_tail=True) the disconnected blocks are the last ones appended
+            for _ in block.disconnected_blocks:
+                self.blockchain.pop()
+            return block
+        self.blockchain.append(block)
         return block
+
+    # checkpoint support -- see the `checkpoint` module
+
+    def get_checkpoint_state(self):
+        return ( self.blockchain, self.block_iter.get_checkpoint_state() )
+
+    def set_checkpoint_state(self, state):
+        blockchain, block_iter_state = state
+        # the BlockChain is updated in place
+        self.blockchain.clear()
+        self.blockchain.extend(blockchain)
+        self.block_iter.set_checkpoint_state(block_iter_state)
         
     def __iter__(self):
         return self
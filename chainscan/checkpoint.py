@@ -0,0 +1,188 @@
+"""
+Periodic checkpointing of the state of iterators, for resuming long scans.
+
+Pickling an iterator (the iterators in this package are picklable) includes
+the data it currently holds, e.g. the whole `blk*.dat` file being read.  A
+checkpoint, on the other hand, only includes *positions*: the file and offset
+reached, the positions of the blocks held by the longest-chain logic, and the
+index of the next tx in the current block.  Resuming reads those blocks (and the
+current file) back.  Optionally, the UtxoSet of a tracked scan is included too,
+as a UTXO snapshot (see the `snapshot` module).
+
+E.g., a scan which can be stopped and resumed::
+
+    checkpointer = Checkpointer('scan.ckpt', every_blocks = 1000, every_seconds = 600)
+    tx_iter = iter_txs(track_spending = True)
+    checkpointer.restore(tx_iter)  # no-op if no checkpoint was saved yet
+    for tx in checkpointer.iter(tx_iter):
+        process(tx)
+
+Checkpoints are written atomically: a checkpoint is either fully written, or
+the previous one is kept.
+"""
+
+import os
+import time
+import pickle
+
+from .misc import Bunch
+from .track import TrackedSpendingTxIterator
+from ._track_c import UtxoSet
+from .snapshot import dump_utxo_snapshot, load_utxo_snapshot
+
+from .loggers import get_logger
+logger = get_logger('checkpoint', 'info')
+
+
+################################################################################
+
+CHECKPOINT_VERSION = 1
+
+class Checkpointer:
+    """
+    Saves the state of an iterator every N blocks and/or every N seconds, and
+    restores it.
+
+    Supports all the iterators in this package, from RawFileBlockIterator up
+    to TxIterator and its subclasses.
+
+    :note: Checkpointing the UtxoSet is not supported for ShardedUtxoSets.
+    """
+
+    def __init__(self, filename, every_blocks = None, every_seconds = None, include_utxoset = True):
+        """
+        :param filename: the checkpoint file
+        :param every_blocks: save a checkpoint every this many blocks
+        :param every_seconds: save a checkpoint every this many seconds
+        :param include_utxoset: when checkpointing a TrackedSpendingTxIterator,
+            also save its UtxoSet (without which the scan cannot be resumed)
+        """
+        self.filename = filename
+        self.every_blocks = every_blocks
+        self.every_seconds = every_seconds
+        self.include_utxoset = include_utxoset
+
+        # state
+        self._num_blocks = 0  # blocks since last checkpoint
+        self._last_time = time.monotonic()
+        self._last_block = None
+        self._utxo_filename = None  # the UTXO snapshot of the last checkpoint
+
+    def iter(self, iterator):
+        """
+        Generate the elements of `iterator`, saving checkpoints as needed.
+        A checkpoint is saved only after the consumer is done with the element
+        last generated (when the next one is requested).
+        """
+        for x in iterator:
+            yield x
+            self.maybe_save(iterator)
+
+    def maybe_save(self, iterator):
+        """
+        Save a checkpoint, if it is time to.
+        :return: True if saved
+        """
+        if hasattr(iterator, '_block'):
+            # tx iterators keep the current block
+            block = iterator._block
+            if block is not self._last_block:
+                self._last_block = block
+                self._num_blocks += 1
+        else:
+            # block iterators generate a new block every time
+            self._num_blocks += 1
+        if self.every_blocks is not None and self._num_blocks >= self.every_blocks:
+            self.save(iterator)
+            return True
+        if self.every_seconds is not None and time.monotonic() - self._last_time >= self.every_seconds:
+            self.save(iterator)
+            return True
+        return False
+
+    def save(self, iterator):
+        """
+        Save a checkpoint of the current state of `iterator`.
+        """
+        utxoset = self._get_utxoset(iterator)
+        state = Bunch(
+            version = CHECKPOINT_VERSION,
+            iter_state = iterator.get_checkpoint_state(),
+            utxo_filename = None,
+        )
+        old_utxo_filename = self._utxo_filename
+        if old_utxo_filename is None and os.path.exists(self.filename):
+            old_utxo_filename = self._load_state().utxo_filename
+        if utxoset is not None:
+            # written (atomically) before the checkpoint referencing it
+            state.utxo_filename = '%s.utxo.%d' % (self.filename, time.time_ns())
+            block = getattr(iterator, '_block', None)
+            base_block_hash = block.block_hash if block is not None else bytes(32)
+            _write_atomically(state.utxo_filename, lambda fn: dump_utxo_snapshot(utxoset, fn, base_block_hash))
+        _write_atomically(self.filename, lambda fn: _pickle_to_file(state, fn))
+        if old_utxo_filename is not None and os.path.exists(old_utxo_filename):
+            os.remove(old_utxo_filename)
+        self._utxo_filename = state.utxo_filename
+        self._num_blocks = 0
+        self._last_time = time.monotonic()
+        logger.info('checkpoint saved: %s' % self.filename)
+
+    def restore(self, iterator):
+        """
+        Restore the state of `iterator` from the checkpoint.
+        `iterator` should be a new iterator, created with the same arguments as the
+        one checkpointed.
+        :return: True if restored, False if there is no checkpoint
+        """
+        if not os.path.exists(self.filename):
+            return False
+        state = self._load_state()
+        utxoset = self._get_utxoset(iterator)
+        if utxoset is not None:
+            if state.utxo_filename is None:
+                raise ValueError('Checkpoint does not include a UtxoSet')
+            if len(utxoset) > 0:
+                raise ValueError('Can only restore into an empty UtxoSet')
+            load_utxo_snapshot(state.utxo_filename, utxoset = utxoset)
+        iterator.set_checkpoint_state(state.iter_state)
+        self._last_block = getattr(iterator, '_block', None)
+        self._utxo_filename = state.utxo_filename
+        logger.info('checkpoint restored: %s' % self.filename)
+        return True
+
+    def _get_utxoset(self, iterator):
+        if not self.include_utxoset or not isinstance(iterator, TrackedSpendingTxIterator):
+            return None
+        utxoset = iterator.tracker.utxoset
+        if not isinstance(utxoset, UtxoSet):
+            raise TypeError('Checkpointing is not supported for %s' % type(utxoset).__name__)
+        return utxoset
+
+    def _load_state(self):
+        with open(self.filename, 'rb') as f:
+            state = pickle.load(f)
+        if state.version != CHECKPOINT_VERSION:
+            raise ValueError('Unsupported checkpoint version: %s' % state.version)
+        return state
+
+    def __repr__(self):
+        return '<%s %s>' % ( type(self).__name__, self.filename )
+
+
+################################################################################
+
+def _pickle_to_file(obj, filename):
+    with open(filename, 'wb') as f:
+        pickle.dump(obj, f, protocol = pickle.HIGHEST_PROTOCOL)
+
+def _write_atomically(filename, write_func):
+    """
+    Write a file using `write_func(tmp_filename)`, then atomically rename it.
+    """
+    tmp_filename = filename + '.tmp'
+    write_func(tmp_filename)
+    with open(tmp_filename, 'rb+') as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+
+################################################################################
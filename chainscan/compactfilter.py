@@ -0,0 +1,268 @@
+"""
+BIP158-style compact block filters, built locally, for finding the blocks
+relevant to a watch-list of scripts without decoding the whole chain.
+
+The "basic" filter of a block is a Golomb-coded set (see the `_gcs_c` module)
+of the scripts of the block's outputs, and of the outputs spent by its inputs.
+Filters are built during a scan which resolves spent outputs, i.e. a
+TrackedSpendingTxIterator (whose UtxoSet includes scripts) or an
+UndoSpendingTxIterator, and are appended to a single sidecar file::
+
+    compact_filters = CompactFilters('filters.dat')
+    for tx in iter_txs(track_scripts = True, compact_filters = compact_filters):
+        ...
+    compact_filters.close()
+
+Rescanning for a new watch-list then only tests the filters, and reads (and
+decodes) the blocks which match::
+
+    compact_filters = CompactFilters('filters.dat')
+    for block in FilteredBlockIterator(compact_filters, scripts):
+        for tx in block.iter_txs():
+            ...
+
+:note: Like all GCS, filters have false positives (about 1 in 784931 per script
+    per block), but no false negatives.
+"""
+
+import os
+import struct
+
+from .defs import OP_RETURN
+from .misc import FilePos
+from .scan import read_block
+from ._gcs_c import build_gcs, gcs_match_any
+
+from .loggers import get_logger
+logger = get_logger('compactfilter', 'info')
+
+
+################################################################################
+
+# BIP158 basic filter parameters
+BASIC_FILTER_P = 19
+BASIC_FILTER_M = 784931
+
+def get_filter_key(block_hash):
+    """
+    :return: the SipHash key of the filter of a block: the first 16 bytes of its hash
+    """
+    return bytes(block_hash[:16])
+
+def get_basic_filter_items(txs):
+    """
+    :return: the set of the items of a block's basic filter: the scripts of the
+        outputs of `txs`, and of the outputs they spend (excluding empty and
+        OP_RETURN scripts)
+    :note: the inputs must be resolved (have `spending_info` set)
+    """
+    items = set()
+    for tx in txs:
+        for txout in tx.outputs:
+            _add_script(items, txout.script)
+        if tx.is_coinbase:
+            continue
+        for txin in tx.inputs:
+            if txin.spending_info is None:
+                raise ValueError('Spent output is not resolved, of tx %s' % tx.txid_hex)
+            script = txin.spending_info.spent_output.script
+            if script is None:
+                raise ValueError('Script of spent output is unknown (use a UtxoSet with include_scripts=True)')
+            _add_script(items, script)
+    return items
+
+def _add_script(items, script):
+    if len(script) > 0 and script[0] != OP_RETURN:
+        items.add(bytes(script))
+
+
+################################################################################
+# Filters file
+
+class CompactFilters:
+    """
+    A file of the compact filters of blocks, in the order added (i.e., height order).
+
+    Each record holds the block's hash, height and position (in its `blk*.dat`
+    file), followed by its serialized filter.  The headers of the records are
+    read when the file is opened.
+    """
+
+    # block_hash, height, block offset, filename size, filter size
+    RECORD_HEADER = struct.Struct('<32siQHI')
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._records = {}  # block_hash -> ( height, FilePos of the block, offset of the filter, filter size )
+        self._hash_by_height = {}
+        self._load()
+        self._file = open(filename, 'ab')
+
+        # the block being added
+        self._cur_block = None
+        self._cur_items = set()
+        self._cur_num_txs = 0
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, block_hash):
+        return block_hash in self._records
+
+    @property
+    def height(self):
+        """
+        The height of the last block added (-1 if none).
+        """
+        return max(self._hash_by_height, default = -1)
+
+    ###################
+    # Building
+
+    def add_tx(self, tx, block):
+        """
+        Add the filter items of a tx.  The filter of a block is written after all
+        of its txs are added.
+        :param block: the block the tx is in. Its `filepos` must be set.
+        :note: txs of blocks already added are ignored.
+        """
+        if block is not self._cur_block:
+            self._end_block()
+            if block.block_hash in self._records:
+                return
+            self._cur_block = block
+        self._cur_items |= get_basic_filter_items([ tx ])
+        self._cur_num_txs += 1
+
+    def _end_block(self):
+        block = self._cur_block
+        if block is not None and self._cur_num_txs == block.num_txs:
+            self.add_block(block, self._cur_items)
+        self._cur_block = None
+        self._cur_items = set()
+        self._cur_num_txs = 0
+
+    def add_block(self, block, items):
+        """
+        Build the filter of a block, and append it to the file.
+        :param items: the filter's items, e.g. as returned by `get_basic_filter_items`
+        """
+        if block.filepos is None:
+            raise ValueError('Location of block is unknown: %s' % block.block_hash_hex)
+        block_hash = bytes(block.block_hash)
+        gcs = build_gcs(items, get_filter_key(block_hash), BASIC_FILTER_P, BASIC_FILTER_M)
+        filename = block.filepos.filename.encode()
+        header = self.RECORD_HEADER.pack(block_hash, block.height, block.filepos.offset, len(filename), len(gcs))
+        offset = self._file.tell()
+        self._file.write(header + filename + gcs)
+        self._add_record(block_hash, block.height, block.filepos, offset + len(header) + len(filename), len(gcs))
+
+    def _add_record(self, block_hash, height, filepos, gcs_offset, gcs_size):
+        self._records[block_hash] = ( height, filepos, gcs_offset, gcs_size )
+        self._hash_by_height[height] = block_hash  # the last one added wins (e.g. after a reorg)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        """
+        Write the filter of the block being added (if all its txs were added),
+        and close the file.
+        """
+        self._end_block()
+        self._file.close()
+
+    def _load(self):
+        if not os.path.exists(self.filename):
+            return
+        header_size = self.RECORD_HEADER.size
+        with open(self.filename, 'rb') as f:
+            offset = 0
+            while True:
+                header = f.read(header_size)
+                if len(header) < header_size:
+                    break
+                block_hash, height, block_offset, filename_size, gcs_size = self.RECORD_HEADER.unpack(header)
+                filename = f.read(filename_size).decode()
+                gcs_offset = offset + header_size + filename_size
+                if os.fstat(f.fileno()).st_size < gcs_offset + gcs_size:
+                    break  # a partially written record
+                self._add_record(block_hash, height, FilePos(filename, block_offset), gcs_offset, gcs_size)
+                offset = gcs_offset + gcs_size
+                f.seek(offset)
+        if offset < os.path.getsize(self.filename):
+            logger.warning('truncating a partially written record: %s' % self.filename)
+            os.truncate(self.filename, offset)
+
+    ###################
+    # Matching
+
+    def get_filter(self, block_hash):
+        """
+        :return: the serialized filter (a GCS) of a block
+        :raise: KeyError if the block has no filter
+        """
+        _, _, gcs_offset, gcs_size = self._records[bytes(block_hash)]
+        self._file.flush()
+        with open(self.filename, 'rb') as f:
+            return os.pread(f.fileno(), gcs_size, gcs_offset)
+
+    def match_any(self, block_hash, scripts):
+        """
+        :return: True if any of `scripts` is (probably) an output script or a spent
+            output script in the block
+        """
+        return gcs_match_any(self.get_filter(block_hash), get_filter_key(block_hash), scripts, BASIC_FILTER_P, BASIC_FILTER_M)
+
+    def iter_matching(self, scripts, start_height = 0, stop_height = None):
+        """
+        Generate the blocks whose filters match any of `scripts`, in height order,
+        as ( height, block_hash, filepos ) tuples.
+        """
+        scripts = [ bytes(script) for script in scripts ]
+        if stop_height is None:
+            stop_height = self.height + 1
+        self._file.flush()
+        with open(self.filename, 'rb') as f:
+            fd = f.fileno()
+            for height in range(start_height, stop_height):
+                block_hash = self._hash_by_height.get(height)
+                if block_hash is None:
+                    continue
+                _, filepos, gcs_offset, gcs_size = self._records[block_hash]
+                gcs = os.pread(fd, gcs_size, gcs_offset)
+                if gcs_match_any(gcs, get_filter_key(block_hash), scripts, BASIC_FILTER_P, BASIC_FILTER_M):
+                    yield height, block_hash, filepos
+
+    def __repr__(self):
+        return '<%s %s (%d blocks)>' % ( type(self).__name__, self.filename, len(self) )
+
+
+################################################################################
+# Filtered iteration
+
+class FilteredBlockIterator:
+    """
+    Iterates over the blocks whose compact filters match any of a list of
+    scripts, in height order.  Only matching blocks are read from the `blk*.dat`
+    files.
+
+    Element type is `Block`.
+    """
+
+    def __init__(self, compact_filters, scripts, start_height = 0, stop_height = None):
+        """
+        :param compact_filters: a CompactFilters
+        :param scripts: the scripts to watch
+        """
+        self.compact_filters = compact_filters
+        self._matches = compact_filters.iter_matching(scripts, start_height = start_height, stop_height = stop_height)
+
+    def __next__(self):
+        height, block_hash, filepos = next(self._matches)
+        return read_block(filepos, height)
+
+    def __iter__(self):
+        return self
+
+################################################################################
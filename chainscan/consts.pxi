@@ -22,6 +22,12 @@ DEF COINBASE_SPENT_OUTPUT_INDEX = 0xFFFFFFFF
 
 DEF SATOSHIS_IN_ONE = 100000000
 
+DEF DUST_THRESHOLD = 546
+"""
+Outputs worth less than this many satoshis are considered "dust" (this is the
+dust threshold of P2PKH outputs, under the default relay policy of bitcoind).
+"""
+
 
 ################################################################################
 # Other
@@ -35,11 +41,20 @@ This value of 6 is selected in accordance with the best practice of waiting for
 6 confirmations to consider a transaction "safe".
 """
 
+DEF HEIGHT_TABLE_PRUNE_DEPTH = 10000
+"""
+Heights of blocks this far below the highest block seen are dropped from the
+TopologicalBlockIterator's table of block heights.  Blocks are stored in the
+`blk*.dat` files at most ~1000 blocks away from their prev blocks, so a child
+never appears after its prev block's height is dropped.
+"""
+
 DEF TXID_PREFIX_SIZE = 8
 """
 Txid-prefixes of size TXID_PREFIX_SIZE are still unique. Can use them instead
 of the full txid, to save memory (e.g. as dict keys, DB index, etc.).
 As of Dec 2016, prefix=7 is also fine. Still, we use 8 to be safe.
+This is the default key size of UtxoSet (see `UtxoSet(key_size=...)`).
 """
 
 
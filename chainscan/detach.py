@@ -0,0 +1,71 @@
+"""
+Bounding the memory retained by long-lived Blocks and Txs.
+
+Blocks and txs reference the data of the whole `blk*.dat` file they were read
+from (their fields are memoryviews into it), so keeping even a single tx from
+each file keeps the data of all of those files alive.  There are two ways to
+avoid that:
+
+- Detaching specific objects, on demand, using `tx.detach()` or `block.detach()`,
+  which copy out the object's own data.
+- Using `auto_detach=True` (with TxIterator and the block iterators), which
+  detaches the objects still alive (i.e., referenced elsewhere) when the scan
+  moves on to the next file::
+
+    for tx in iter_txs(auto_detach = True):
+        ...
+
+With either, memory used is proportional to what is kept, not to the number of
+files read.
+"""
+
+import weakref
+
+
+################################################################################
+
+class Detacher:
+    """
+    Keeps (weak) references to the objects generated from the current `blk*.dat`
+    file, and detaches the ones still alive when moving on to the next file.
+    """
+
+    def __init__(self):
+        self._filename = None
+        self._refs = []
+
+    def add(self, obj, filename):
+        """
+        :param obj: a Block or a Tx (or any object with a `detach()` method,
+            supporting weak references)
+        :param filename: the `blk*.dat` file `obj` was read from
+        """
+        if filename != self._filename:
+            self.detach_all()
+            self._filename = filename
+        self._refs.append(weakref.ref(obj))
+
+    def detach_all(self):
+        """
+        Detach all objects still alive.
+        """
+        num_detached = 0
+        for ref in self._refs:
+            obj = ref()
+            if obj is not None:
+                obj.detach()
+                num_detached += 1
+        self._refs = []
+        return num_detached
+
+    # pickle support -- weak references are not included
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_refs'] = []
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+################################################################################
@@ -0,0 +1,131 @@
+"""
+Computing aggregates over the chain in parallel, map-reduce style.
+
+The longest chain is partitioned into contiguous height ranges (of roughly the
+same amount of data), using the block locations stored in a BlockChain.  Each
+range is mapped by a worker process, which reads its blocks directly from the
+`blk*.dat` files, and the results are combined using a reducer::
+
+    from collections import Counter
+    from operator import add
+
+    def count_versions(blocks):
+        return Counter( tx.version for block in blocks for tx in block.txs )
+
+    print(chain_map_reduce(count_versions, add, workers = 8))
+
+:note: `map_fn` is pickled to the workers, so it must be a module-level function
+    (not a lambda or a closure).
+"""
+
+import multiprocessing
+from functools import reduce
+
+import numpy as np
+
+from .blockchain import _read_block
+from .utils import get_blockchain
+
+from .loggers import get_logger
+logger = get_logger('mapreduce', 'info')
+
+
+################################################################################
+# Partitioning
+
+# number of ranges per worker, for balancing the load
+RANGES_PER_WORKER = 4
+
+def split_heights(blockchain, num_ranges, heights = None):
+    """
+    Partition a range of heights into contiguous sub-ranges, of roughly the same
+    amount of raw block data.
+    :param blockchain: a BlockChain
+    :param heights: a range of heights (default: all blocks)
+    :return: a list of ranges (at most `num_ranges`, none of them empty)
+    """
+    if heights is None:
+        heights = range(len(blockchain))
+    if len(heights) == 0:
+        return []
+    sizes = np.cumsum(blockchain.rawsizes[heights.start:heights.stop], dtype = np.uint64)
+    targets = np.arange(1, num_ranges, dtype = np.float64) * (float(sizes[-1]) / num_ranges)
+    bounds = np.searchsorted(sizes, targets, 'right') + heights.start
+    bounds = sorted(set([ heights.start ] + [ int(b) for b in bounds ] + [ heights.stop ]))
+    return [ range(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) ]
+
+def _get_locations(blockchain, heights):
+    # :return: a list of ( filename, offset, rawsize, height ), of the blocks in `heights`
+    locations = []
+    for height in heights:
+        info = blockchain.get_by_height(height)
+        if info.filepos is None:
+            raise ValueError('Location of block #%d is unknown' % height)
+        locations.append(( info.filepos.filename, info.filepos.offset, info.rawsize, height ))
+    return locations
+
+
+################################################################################
+# Map-reduce
+
+def _iter_range_blocks(locations):
+    for filename, offset, rawsize, height in locations:
+        yield _read_block(filename, offset, rawsize, height)
+
+def _map_range(args):
+    map_fn, locations = args
+    return map_fn(_iter_range_blocks(locations))
+
+def chain_map_reduce(
+        map_fn,
+        reduce_fn,
+        workers = None,
+        initial = None,
+        heights = None,
+        blockchain = None,
+        num_ranges = None,
+        pool = None,
+        **kwargs):
+    """
+    Map each range of blocks of the longest chain (in a process pool), and reduce
+    the results.
+    :param map_fn: a picklable function, taking an iterator of the Blocks of a
+        range (in order), and returning a partial result
+    :param reduce_fn: a function combining two results (called in this process,
+        with the results of the ranges in height order)
+    :param workers: number of worker processes (default: the number of CPUs)
+    :param initial: if not None, the partial results are reduced onto it
+    :param heights: a range of heights to include (default: all blocks)
+    :param blockchain: the BlockChain, providing the block locations. If None,
+        `get_blockchain(**kwargs)` is used (pass `dirname` to persist it)
+    :param num_ranges: number of ranges to split into (default: RANGES_PER_WORKER
+        per worker)
+    :param pool: a `multiprocessing.Pool` to use
+    :return: the reduced result (`initial`, if there are no blocks)
+    """
+    if blockchain is None:
+        blockchain = get_blockchain(**kwargs)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if num_ranges is None:
+        num_ranges = workers * RANGES_PER_WORKER
+    ranges = split_heights(blockchain, num_ranges, heights)
+    if not ranges:
+        return initial
+    logger.info('mapping %d ranges of blocks, with %d workers', len(ranges), workers)
+    tasks = ( ( map_fn, _get_locations(blockchain, r) ) for r in ranges )
+
+    own_pool = pool is None
+    if own_pool:
+        pool = multiprocessing.Pool(workers)
+    try:
+        results = pool.imap(_map_range, tasks)
+        if initial is not None:
+            return reduce(reduce_fn, results, initial)
+        return reduce(reduce_fn, results)
+    finally:
+        if own_pool:
+            pool.terminate()
+            pool.join()
+
+################################################################################
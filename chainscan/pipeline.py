@@ -0,0 +1,359 @@
+"""
+Running many independent analyses in a single pass over the chain.
+
+Each analysis is a Plugin, which is fed the blocks (and txs) of the longest
+chain.  A Pipeline drives a single block iteration, decodes the txs (and tracks
+spending) once, as needed by the union of the plugins, and fans each block and
+tx out to all plugins::
+
+    class FeeStats(Plugin):
+        needs = { NEEDS_SPENDING }
+        def begin(self):
+            self.total_fees = 0
+        def process_tx(self, tx):
+            if not tx.is_coinbase:
+                self.total_fees += tx.get_fee_paid()
+        def result(self):
+            return self.total_fees
+
+    class CoinbaseTags(Plugin):
+        needs = { NEEDS_TXS }
+        def begin(self):
+            self.num_tags = 0
+        def process_tx(self, tx):
+            if tx.is_coinbase and b'/' in tx.inputs[0].script:
+                self.num_tags += 1
+        def result(self):
+            return self.num_tags
+
+    total_fees, num_tags = Pipeline([ FeeStats(), CoinbaseTags() ]).run()
+
+Plugins which only need blocks (and txs, but not tracked spending) can run in
+worker processes (`Pipeline.add(plugin, in_worker = True)`).  They are then
+pickled to the worker, fed the blocks there, and their results are pickled
+back.
+"""
+
+import multiprocessing
+from collections import deque
+
+from .scan import LongestChainBlockIterator, ReorgEvent
+from .track import TrackedSpendingTxIterator, TxSpendingTracker, UtxoSet
+
+from .loggers import get_logger
+logger = get_logger('pipeline', 'info')
+
+
+################################################################################
+# Plugins
+
+# the data a plugin can need
+NEEDS_TXS = 'txs'  # process_tx() is called
+NEEDS_BLOCK_CONTEXT = 'block_context'  # txs are TxInBlocks (implies NEEDS_TXS)
+NEEDS_SPENDING = 'spending'  # the `spending_info` of tx inputs is set (implies NEEDS_TXS)
+NEEDS_SCRIPTS = 'scripts'  # the spent outputs include scripts (implies NEEDS_SPENDING)
+
+class Plugin:
+    """
+    The base class of pipeline plug-ins.  Subclasses override some of the
+    `begin`, `process_block`, `process_tx`, `process_reorg`, `end` and `result`
+    methods, and declare the data they need in `needs`.
+    """
+
+    # a set of NEEDS_* values
+    needs = frozenset()
+
+    def begin(self):
+        """
+        Called before the first block.
+        """
+        pass
+
+    def process_block(self, block):
+        """
+        Called for each block, before its txs.
+        """
+        pass
+
+    def process_tx(self, tx):
+        """
+        Called for each tx (only if NEEDS_TXS, or any other NEEDS_* is in `needs`).
+        """
+        pass
+
+    def process_reorg(self, event):
+        """
+        Called with a ReorgEvent (only with `generate_unsafe_tail=True`).
+        """
+        pass
+
+    def end(self):
+        """
+        Called after the last block.
+        """
+        pass
+
+    def result(self):
+        """
+        :return: the result of the plugin, returned by `Pipeline.run()`
+        """
+        return None
+
+    def __repr__(self):
+        return '<%s>' % type(self).__name__
+
+def get_needs(plugins):
+    """
+    :return: the union of the needs of `plugins`, including the implied ones
+    """
+    needs = set()
+    for plugin in plugins:
+        needs |= set(plugin.needs)
+    if NEEDS_SCRIPTS in needs:
+        needs.add(NEEDS_SPENDING)
+    if needs:
+        needs.add(NEEDS_TXS)
+    return needs
+
+def _collect_block(tracker, ahead):
+    block, txs = ahead.popleft()
+    tracker.collect_block()
+    return block, txs
+
+def _feed_block(plugins, tx_plugins, block, txs):
+    for plugin in plugins:
+        plugin.process_block(block)
+    if txs is not None:
+        for tx in txs:
+            for plugin in tx_plugins:
+                plugin.process_tx(tx)
+
+
+################################################################################
+# Worker processes
+
+class _PluginWorker:
+    """
+    Runs a plugin in a worker process.  Blocks are sent to it in batches.
+    """
+
+    BATCH_SIZE = 16
+
+    def __init__(self, plugin):
+        if NEEDS_SPENDING in get_needs([ plugin ]):
+            raise ValueError('Plugins which need tracked spending cannot run in a worker: %r' % plugin)
+        self.plugin = plugin
+        self._batch = []
+        parent_conn, child_conn = multiprocessing.Pipe()
+        self._worker = multiprocessing.Process(target = _plugin_worker, args = (child_conn, plugin), daemon = True)
+        self._worker.start()
+        child_conn.close()
+        self._conn = parent_conn
+
+    def add_block(self, block):
+        self._batch.append(block)
+        if len(self._batch) >= self.BATCH_SIZE:
+            self._flush()
+
+    def add_reorg(self, event):
+        self._batch.append(event)
+        self._flush()
+
+    def _flush(self):
+        if self._batch:
+            self._send(( 'blocks', self._batch ))
+            self._batch = []
+
+    def finish(self):
+        """
+        :return: the plugin's result
+        :raise: the exception raised by the plugin in the worker
+        """
+        self._flush()
+        self._send(( 'end', ))
+        res = self._recv()
+        self._worker.join()
+        self._conn.close()
+        if isinstance(res, Exception):
+            raise res
+        return res
+
+    def _send(self, msg):
+        # the worker only sends before 'end' if the plugin failed (and it then
+        # exits), so raising its error rather than failing to send to it
+        if self._conn.poll():
+            raise self._recv()
+        try:
+            self._conn.send(msg)
+        except ( BrokenPipeError, ConnectionResetError ):
+            if self._conn.poll():
+                raise self._recv()
+            raise self._get_exit_error()
+
+    def _recv(self):
+        try:
+            return self._conn.recv()
+        except EOFError:
+            self._worker.join()
+            raise self._get_exit_error() from None
+
+    def _get_exit_error(self):
+        return RuntimeError('Worker process exited (exit code %s): %r' % ( self._worker.exitcode, self.plugin ))
+
+    def close(self):
+        if self._worker.is_alive():
+            self._worker.terminate()
+            self._worker.join()
+        self._conn.close()
+
+def _plugin_worker(conn, plugin):
+    include_block_context = NEEDS_BLOCK_CONTEXT in get_needs([ plugin ])
+    needs_txs = NEEDS_TXS in get_needs([ plugin ])
+    try:
+        plugin.begin()
+        while True:
+            msg = conn.recv()
+            if msg[0] == 'end':
+                plugin.end()
+                conn.send(plugin.result())
+                return
+            for block in msg[1]:
+                if type(block) is ReorgEvent:
+                    plugin.process_reorg(block)
+                    continue
+                txs = block.txs.iter_txs(include_block_context = include_block_context) if needs_txs else None
+                _feed_block([ plugin ], [ plugin ], block, txs)
+    except Exception as e:
+        logger.exception('plugin failed in worker: %r', plugin)
+        try:
+            conn.send(e)
+        except Exception:
+            # (e.g. an unpicklable exception)
+            conn.send(RuntimeError('Plugin failed in worker: %r' % e))
+
+
+################################################################################
+# Pipeline
+
+class Pipeline:
+    """
+    Feeds the blocks (and txs) of a single pass over the longest chain to
+    multiple plugins.
+    """
+
+    def __init__(self, plugins = (), block_iter = None, tracker = None, **kwargs):
+        """
+        :param plugins: Plugins, to run in this process (see `add()`)
+        :param block_iter: a LongestChainBlockIterator
+        :param tracker: a TxSpendingTracker, used if any plugin needs tracked spending
+        :param kwargs: extra kwargs for LongestChainBlockIterator (ignored unless block_iter is None)
+        """
+        if block_iter is None:
+            block_iter = LongestChainBlockIterator(**kwargs)
+        self.block_iter = block_iter
+        self.tracker = tracker
+        self._plugins = []  # ( plugin, in_worker ) pairs
+        for plugin in plugins:
+            self.add(plugin)
+
+    def add(self, plugin, in_worker = False):
+        """
+        :param in_worker: run the plugin in a worker process
+        """
+        self._plugins.append(( plugin, in_worker ))
+        return plugin
+
+    @property
+    def plugins(self):
+        return [ plugin for plugin, _ in self._plugins ]
+
+    @property
+    def needs(self):
+        """
+        The data decoded in this process: the union of the needs of the plugins
+        running in this process.
+        """
+        return get_needs( plugin for plugin, in_worker in self._plugins if not in_worker )
+
+    def run(self):
+        """
+        Iterate over the blocks, feeding them to the plugins.
+        :return: a list of the results of the plugins, in the order added
+        :raise: ValueError if the tracker given cannot undo blocks, with
+            `generate_unsafe_tail=True` (see `TxSpendingTracker.check_can_undo()`)
+        """
+        needs = self.needs
+        local_plugins = [ plugin for plugin, in_worker in self._plugins if not in_worker ]
+        tx_plugins = [ plugin for plugin in local_plugins if get_needs([ plugin ]) ]
+        include_block_context = NEEDS_BLOCK_CONTEXT in needs
+        generate_unsafe_tail = getattr(self.block_iter, 'generate_unsafe_tail', False)
+        # (the tracker tracks the txs, so it is not used if no plugin needs txs)
+        tracker = self.tracker if NEEDS_TXS in needs else None
+        if tracker is None and NEEDS_SPENDING in needs:
+            undo_depth = TrackedSpendingTxIterator.DEFAULT_UNDO_DEPTH if generate_unsafe_tail else 0
+            tracker = TxSpendingTracker(utxoset = UtxoSet(include_scripts = NEEDS_SCRIPTS in needs), undo_depth = undo_depth)
+            self.tracker = tracker
+        elif tracker is not None and generate_unsafe_tail:
+            # (failing before the first block, rather than at the first reorg)
+            tracker.check_can_undo()
+
+        workers = {}
+        try:
+            for plugin, in_worker in self._plugins:
+                if in_worker:
+                    workers[id(plugin)] = _PluginWorker(plugin)
+                else:
+                    plugin.begin()
+
+            # with a sharded tracker, blocks are submitted to the shards ahead of
+            # being fed to the plugins: ( block, txs ), oldest first
+            ahead = deque()
+            for block in self.block_iter:
+                if type(block) is ReorgEvent:
+                    while ahead:
+                        _feed_block(local_plugins, tx_plugins, *_collect_block(tracker, ahead))
+                    if tracker is not None:
+                        tracker.undo_reorg(block)
+                    for plugin in local_plugins:
+                        plugin.process_reorg(block)
+                    for worker in workers.values():
+                        worker.add_reorg(block)
+                    continue
+                for worker in workers.values():
+                    worker.add_block(block)
+                txs = None
+                if NEEDS_TXS in needs:
+                    txs = block.txs.iter_txs(include_block_context = include_block_context)
+                    if tracker is not None:
+                        if tracker.is_sharded:
+                            txs = list(txs)
+                            tracker.submit_block_txs(txs)
+                            ahead.append(( block, txs ))
+                            if len(ahead) >= tracker.PIPELINE_DEPTH:
+                                _feed_block(local_plugins, tx_plugins, *_collect_block(tracker, ahead))
+                            continue
+                        # (this also ends the previous block)
+                        tracker.begin_block(block)
+                        txs = tracker.process_txs_gen(txs)
+                _feed_block(local_plugins, tx_plugins, block, txs)
+            while ahead:
+                _feed_block(local_plugins, tx_plugins, *_collect_block(tracker, ahead))
+            if tracker is not None:
+                tracker.end_block()
+
+            results = []
+            for plugin, in_worker in self._plugins:
+                if in_worker:
+                    results.append(workers.pop(id(plugin)).finish())
+                else:
+                    plugin.end()
+                    results.append(plugin.result())
+            return results
+        finally:
+            for worker in workers.values():
+                worker.close()
+
+    def __repr__(self):
+        return '<%s (%d plugins)>' % ( type(self).__name__, len(self._plugins) )
+
+################################################################################
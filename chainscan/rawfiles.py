@@ -72,6 +72,16 @@ class RawFilesIterator:
         self._prev_file = next(self._iter)
         return self._prev_file
 
+    # checkpoint support -- see the `checkpoint` module
+
+    def get_checkpoint_state(self):
+        return self._prev_file
+
+    def set_checkpoint_state(self, state):
+        # continue with the files following the file last generated
+        self._prev_file = state
+        self._init()
+
     def __next__(self):
         try:
             return self._raw_next()
@@ -148,6 +158,12 @@ class RawDataIterator:
         buf = np.fromfile(raw_file, dtype = np.uint8)
         return buf
     
+    def get_checkpoint_state(self):
+        return self.raw_files_iter.get_checkpoint_state()
+
+    def set_checkpoint_state(self, state):
+        self.raw_files_iter.set_checkpoint_state(state)
+
     def __iter__(self):
         return self
 
@@ -155,6 +171,25 @@ class RawDataIterator:
     def refresh(self):
         return self.raw_files_iter.refresh
 
+def read_raw_block(filename, offset):
+    """
+    Read the raw data of a single block stored in a `blk*.dat` file, without
+    reading the rest of the file.
+    :param offset: the offset of the block in the file (where its magic starts)
+    :return: a (writable) buffer with the block's data, starting with the magic
+        and size fields (i.e. in the format expected by `deserialize_block`).
+    """
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        header = np.fromfile(f, dtype = np.uint8, count = 8)
+        if len(header) < 8:
+            raise ValueError('No block at %s, offset %s' % (filename, offset))
+        size = int(header[4:8].view('<u4')[0])
+        data = np.fromfile(f, dtype = np.uint8, count = size)
+        if len(data) < size:
+            raise ValueError('Truncated block at %s, offset %s' % (filename, offset))
+    return np.concatenate([ header, data ])
+
 ################################################################################
 
 def _make_progressbar(iterable, **kwargs):
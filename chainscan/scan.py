@@ -6,10 +6,13 @@ the blockchain.
 from collections import deque
 from sortedcontainers import SortedList
 
-from .defs import GENESIS_PREV_BLOCK_HASH, HEIGHT_SAFETY_MARGIN
-from .misc import hash_hex_to_bytes, FilePos, Bunch
-from .rawfiles import RawDataIterator
+from .defs import GENESIS_PREV_BLOCK_HASH, HEIGHT_SAFETY_MARGIN, HEIGHT_TABLE_PRUNE_DEPTH
+from .misc import hash_hex_to_bytes, bytes_to_hash_hex, deserialize_varlen_integer, FilePos, Bunch
+from .rawfiles import RawDataIterator, read_raw_block
 from .block import StoredBlock, deserialize_block
+from ._heights_c import HeightTable
+from .summary import FileSummaryBuilder, StubBlock, can_skip_file
+from .detach import Detacher
 
 from .loggers import logger
 
@@ -148,27 +151,43 @@ class RawFileBlockIterator:
     :note: This iterator is resumable and refreshable.
     """
 
-    def __init__(self, raw_data_iter = None, **kwargs):
+    def __init__(self, raw_data_iter = None, summaries = None, skip_file = None, auto_detach = False, **kwargs):
         """
         :param raw_data_iter: a RawDataIterator
+        :param summaries: a FileSummaries, of files which can be skipped
+        :param skip_file: a function, which given the FileSummary of a file, returns
+            True if the file can be skipped (in which case StubBlocks are generated
+            instead of its blocks)
+        :param auto_detach: detach the blocks still alive when moving on to the
+            next file (see the `detach` module)
         :param kwargs: extra kwargs for RawDataIterator (ignored unless raw_data_iter is None)
         """
         if raw_data_iter is None:
             raw_data_iter = RawDataIterator(**kwargs)
         self.raw_data_iter = raw_data_iter
+        self.summaries = summaries
+        self.skip_file = skip_file
+        self._detacher = Detacher() if auto_detach else None
         
         # state
         self._cur_blob = b''
         self._cur_offset = 0
         self._cur_filename = None
+        self._cur_stubs = deque()  # the StubBlocks of the current file, if skipped
+        self.num_skipped_files = 0
 
     def __next__(self):
         
+        if self._cur_stubs:
+            return self._next_stub()
+
         if self._cur_offset >= len(self._cur_blob):
             # we're done with this blob. read the next one. 
             #if self._cur_blob is not None:
             #    assert self._cur_offset == len(self._cur_blob), (self._cur_offset, len(self._cur_blob))
             self._read_next_blob()  # raises StopIteration if no more files
+            if self._cur_stubs:
+                return self._next_stub()
     
         block_offset = self._cur_offset
         block = deserialize_block(self._cur_blob[block_offset : ], -1)
@@ -185,23 +204,71 @@ class RawFileBlockIterator:
                 raise StopIteration
             
         self._cur_offset += 8 + block.rawsize
+        filepos = FilePos(self._cur_filename, block_offset)
+        # the block also remembers where it is stored, after it is detached from the StoredBlock
+        block.filepos = filepos
+        if self._detacher is not None:
+            self._detacher.add(block, self._cur_filename)
         return StoredBlock(
             block = block,
-            filepos = FilePos(self._cur_filename, block_offset),
+            filepos = filepos,
         )
 
     def _read_next_blob(self):
-        data = self.raw_data_iter.__next__()  # raises StopIteration if no more files . # easier to profile with x.__next__() instead of next(x)...
-        self._cur_blob = data.blob
-        self._cur_filename = data.filename
+        if self.skip_file is None:
+            data = self.raw_data_iter.__next__()  # raises StopIteration if no more files . # easier to profile with x.__next__() instead of next(x)...
+            self._cur_blob = data.blob
+            self._cur_filename = data.filename
+            self._cur_offset = 0
+            return
+        filename = self.raw_data_iter.raw_files_iter.__next__()  # raises StopIteration if no more files
+        self._cur_filename = filename
         self._cur_offset = 0
+        summary = self.summaries.get(filename)
+        if summary is not None and self.skip_file(summary):
+            logger.debug('skipping file: %s', filename)
+            self._cur_blob = b''
+            self._cur_stubs = deque(summary.get_stub_blocks())
+            self.num_skipped_files += 1
+        else:
+            self._cur_blob = self.raw_data_iter.get_data(filename).blob
+
+    def _next_stub(self):
+        stub = self._cur_stubs.popleft()
+        self._cur_offset = stub.filepos.offset + 8 + stub.rawsize
+        return StoredBlock(
+            block = stub,
+            filepos = stub.filepos,
+        )
 
     def _reread_blob(self):
         if self._cur_filename is not None:
             # note: not updating self._cur_filename and self._cur_offset, because
             # we need to keep reading from the same offset in the same file.
+            if self._detacher is not None:
+                # the blocks read so far reference the old data
+                self._detacher.detach_all()
             self._cur_blob = self.raw_data_iter.get_data(self._cur_filename).blob
 
+    # checkpoint support -- see the `checkpoint` module
+
+    def get_checkpoint_state(self):
+        return Bunch(
+            filename = self._cur_filename,
+            offset = self._cur_offset,
+            raw_data_iter = self.raw_data_iter.get_checkpoint_state(),
+        )
+
+    def set_checkpoint_state(self, state):
+        self.raw_data_iter.set_checkpoint_state(state.raw_data_iter)
+        self._cur_filename = state.filename
+        self._cur_offset = state.offset
+        self._cur_stubs = deque()
+        if state.filename is not None:
+            self._cur_blob = self.raw_data_iter.get_data(state.filename).blob
+        else:
+            self._cur_blob = b''
+
     def __iter__(self):
         return self
 
@@ -223,18 +290,34 @@ class TopologicalBlockIterator:
     :note: This iterator is resumable and refreshable.
     """
 
-    def __init__(self, rawfile_block_iter = None, **kwargs):
+    def __init__(self, rawfile_block_iter = None, summaries = None, skip_file = None,
+                 height_prune_depth = HEIGHT_TABLE_PRUNE_DEPTH, orphans_as_positions = False, **kwargs):
         """
         :param rawfile_block_iter: a RawFileBlockIterator
+        :param summaries: a FileSummaries, to add summaries of the files read to
+            (and to skip files using, see `skip_file`)
+        :param skip_file: see RawFileBlockIterator (ignored unless rawfile_block_iter is None)
+        :param height_prune_depth: forget the heights of blocks this far below the
+            highest block seen (None to keep all).  Orphan blocks still waiting for
+            their prev block after the chain advanced this far are dropped too
+            (their prev block is most likely pruned, e.g. a late stale-fork block)
+        :param orphans_as_positions: keep only the positions of orphan blocks
+            (blocks appearing before their prev block), and re-read them when
+            their prev block appears, instead of keeping the blocks
         :param kwargs: extra kwargs for RawFileBlockIterator (ignored unless rawfile_block_iter is None)
         """
         if rawfile_block_iter is None:
-            rawfile_block_iter = RawFileBlockIterator(**kwargs)
+            rawfile_block_iter = RawFileBlockIterator(summaries = summaries, skip_file = skip_file, **kwargs)
         self.rawfile_block_iter = rawfile_block_iter
+        self._summary_builder = FileSummaryBuilder(summaries) if summaries is not None else None
+        self.orphans_as_positions = orphans_as_positions
 
         # state
-        self._height_by_hash = { GENESIS_PREV_BLOCK_HASH: -1 }  # genesis is 0, so its prev is -1
-        self._orphans = {}  # block_hash -> a list of orphan blocks waiting for it to appear
+        self._height_by_hash = HeightTable([ ( GENESIS_PREV_BLOCK_HASH, -1 ) ],  # genesis is 0, so its prev is -1
+                                           prune_depth = height_prune_depth)
+        self._orphans = {}  # block_hash -> a list of orphan blocks (or _OrphanPositions) waiting for it to appear
+        self._orphan_heights = {}  # block_hash -> the max height seen when its first orphan appeared
+        self._next_orphan_sweep = 0  # the max height at which stale orphans are dropped next
         self._ready_blocks = deque()  # blocks which can be released on next call to __next__()
 
     def __next__(self):
@@ -246,7 +329,12 @@ class TopologicalBlockIterator:
 
     def _read_another_block(self):
         # note: block.height is not set by RawFileBlockIterator
-        block = self.rawfile_block_iter.__next__().block  # easier to profile with x.__next__() instead of next(x)...
+        stored_block = self.rawfile_block_iter.__next__()  # easier to profile with x.__next__() instead of next(x)...
+        block = stored_block.block
+        if self._summary_builder is not None and type(block) is not StubBlock:
+            if self._summary_builder.add_block(block, stored_block.filepos):
+                # started reading a new file
+                self._summary_builder.summarize_completed(self._height_by_hash)
         #logger.debug('prev-block-reference: %s -> %s', block.block_hash_hex, block.prev_block_hash_hex) # commented out because hex() takes time...
         # handle new block either as "ready" or "orphan":
         height_by_hash = self._height_by_hash
@@ -254,11 +342,16 @@ class TopologicalBlockIterator:
         prev_height = height_by_hash.get(prev_block_hash)
         if prev_height is None:
             # prev not found. orphan.
+            if self.orphans_as_positions and type(block) is not StubBlock:
+                block = _OrphanPosition(block.block_hash, stored_block.filepos)
             self._orphans.setdefault(prev_block_hash, []).append(block)
+            self._orphan_heights.setdefault(prev_block_hash, height_by_hash.max_height)
             return False
         else:
             # prev found. block is "ready".
             self._disorphanate_block(block, prev_height + 1)
+            if height_by_hash.max_height >= self._next_orphan_sweep:
+                self._drop_stale_orphans()
             return True
 
     def _get_next_block_to_release(self):
@@ -269,8 +362,11 @@ class TopologicalBlockIterator:
         
     def _disorphanate_children_of(self, block):
         children = self._orphans.pop(block.block_hash, ())
+        self._orphan_heights.pop(block.block_hash, None)
         child_height = block.height + 1
         for child_block in children:
+            if type(child_block) is _OrphanPosition:
+                child_block = read_block(child_block.filepos)
             self._disorphanate_block(child_block, child_height)
             
     def _disorphanate_block(self, child_block, height):
@@ -280,9 +376,89 @@ class TopologicalBlockIterator:
         # no longer orphan. it is ready for releasing:
         self._ready_blocks.append(child_block)  # appendright
 
+    def _drop_stale_orphans(self):
+        """
+        Drop the orphans which have been waiting for their prev block since the
+        chain was `prune_depth` blocks lower.  Their prev block is either pruned
+        from the height table, or never appears, so they would never be released.
+        """
+        prune_depth = self._height_by_hash.prune_depth
+        if prune_depth < 0:
+            self._next_orphan_sweep = 2**31
+            return
+        max_height = self._height_by_hash.max_height
+        min_height = max_height - prune_depth
+        stale = [ prev_block_hash for prev_block_hash, height in self._orphan_heights.items() if height < min_height ]
+        for prev_block_hash in stale:
+            del self._orphan_heights[prev_block_hash]
+            blocks = self._orphans.pop(prev_block_hash)
+            logger.info('dropping %d orphan blocks whose prev block is missing: %s', len(blocks), bytes_to_hash_hex(bytearray(prev_block_hash)))
+        self._next_orphan_sweep = max_height + max(1, prune_depth // 2)
+
+    # checkpoint support -- see the `checkpoint` module
+
+    def get_checkpoint_state(self):
+        # blocks are referenced by their positions
+        return Bunch(
+            height_by_hash = self._height_by_hash,
+            orphans = {
+                prev_block_hash: [ _get_orphan_ref(block) for block in blocks ]
+                for prev_block_hash, blocks in self._orphans.items()
+            },
+            orphan_heights = dict(self._orphan_heights),
+            ready_blocks = [ get_block_ref(block) for block in self._ready_blocks ],
+            rawfile_block_iter = self.rawfile_block_iter.get_checkpoint_state(),
+        )
+
+    def set_checkpoint_state(self, state):
+        self.rawfile_block_iter.set_checkpoint_state(state.rawfile_block_iter)
+        if self._summary_builder is not None:
+            # resuming mid-file
+            self._summary_builder.reset()
+        height_by_hash = state.height_by_hash
+        if isinstance(height_by_hash, HeightTable):
+            height_by_hash = height_by_hash.copy()
+        else:
+            # an older checkpoint
+            height_by_hash = HeightTable(height_by_hash.items(), prune_depth = self._height_by_hash.prune_depth)
+        self._height_by_hash = height_by_hash
+        self._orphans = {
+            prev_block_hash: [ self._read_orphan_ref(ref) for ref in refs ]
+            for prev_block_hash, refs in state.orphans.items()
+        }
+        # (older checkpoints have no orphan heights. their orphans are as old as the checkpoint)
+        orphan_heights = state.get('orphan_heights', {})
+        self._orphan_heights = {
+            prev_block_hash: orphan_heights.get(prev_block_hash, height_by_hash.max_height)
+            for prev_block_hash in self._orphans
+        }
+        self._next_orphan_sweep = 0
+        self._ready_blocks = deque( read_block_ref(ref) for ref in state.ready_blocks )
+
+    def _read_orphan_ref(self, ref):
+        block = read_block_ref(ref)
+        if self.orphans_as_positions:
+            return _OrphanPosition(block.block_hash, block.filepos)
+        return block
+
     def __iter__(self):
         return self
 
+class _OrphanPosition:
+    """
+    An orphan block, kept by its position only.
+    """
+    __slots__ = [ 'block_hash', 'filepos' ]
+
+    def __init__(self, block_hash, filepos):
+        self.block_hash = block_hash
+        self.filepos = filepos
+
+def _get_orphan_ref(block):
+    if type(block) is _OrphanPosition:
+        return ( block.filepos.filename, block.filepos.offset, -1 )
+    return get_block_ref(block)
+
 
 ################################################################################
 # Longest chain
@@ -300,28 +476,48 @@ class LongestChainBlockIterator:
     The height of the first block (genesis) is 0, and its `prev_block_hash` is all zeros.
 
     Element type is `Block`.
+
+    With `generate_unsafe_tail=True`, blocks are generated as soon as they
+    extend the best (highest) chain seen, without waiting for the chain to lead
+    by `height_safety_margin` blocks.  When a competing fork takes the lead, a
+    `ReorgEvent` is generated, listing the blocks disconnected (which the
+    consumer should roll back), followed by the blocks of the new best chain::
+
+        for x in LongestChainBlockIterator(generate_unsafe_tail = True):
+            if isinstance(x, ReorgEvent):
+                for block in x.disconnected_blocks:
+                    undo(block)
+            else:
+                do(x)
+
+    The guarantees above then hold for the sequence of blocks, with the
+    disconnected blocks removed.
     
     :note: This iterator is resumable and refreshable.
     """
 
-    # TBD: an option to generate_unsafe_tail
-    
-    
     DEFAULT_HEIGHT_SAFETY_MARGIN = HEIGHT_SAFETY_MARGIN
     _DUMMY_PRE_GENESIS_BLOCK = Bunch(height = -1, block_hash = GENESIS_PREV_BLOCK_HASH)
 
 
-    def __init__(self, block_iter = None, height_safety_margin = None, block_filter = None, **kwargs):
+    def __init__(self, block_iter = None, height_safety_margin = None, block_filter = None, summaries = None,
+                 generate_unsafe_tail = False, **kwargs):
         """
         :param block_iter: a TopologicalBlockIterator
         :param height_safety_margin:
             how much longer should a fork be than a competing fork before we
             can safely conclude it is the eventual "winner" fork.
         :param block_filter: a BlockFilter, indicating blocks to start/stop at.
+        :param generate_unsafe_tail: also generate the blocks not yet deemed safe,
+            and ReorgEvents when they are disconnected (see class's docstring)
+        :param summaries: a FileSummaries. Files all of whose blocks are excluded
+            by `block_filter` are skipped (not read), if summarized.  Files read
+            are summarized.  (ignored unless block_iter is None)
         :param kwargs: extra kwargs for TopologicalBlockIterator (ignored unless block_iter is None)
         """
         if block_iter is None:
-            block_iter = TopologicalBlockIterator(**kwargs)
+            skip_file = self._can_skip_file if summaries is not None else None
+            block_iter = TopologicalBlockIterator(summaries = summaries, skip_file = skip_file, **kwargs)
         self.block_iter = block_iter
         if height_safety_margin is None:
             height_safety_margin = self.DEFAULT_HEIGHT_SAFETY_MARGIN
@@ -329,6 +525,7 @@ class LongestChainBlockIterator:
         if block_filter is not None:
             block_filter = _WorkingBlockFilter(block_filter)
         self.block_filter = block_filter
+        self.generate_unsafe_tail = generate_unsafe_tail
         
         # state
         root_block = self._DUMMY_PRE_GENESIS_BLOCK
@@ -337,17 +534,119 @@ class LongestChainBlockIterator:
         self._blocks_by_hash = { root_block.block_hash: root_block }  # block_hash -> block
         self._block_children = { root_block.block_hash: []}  # block_hash -> list of child blocks
         self._leaf_heights = SortedList([ root_block.height ])  # block heights, of the leaf blocks only
+        # unsafe-tail state:
+        self._best_tip = root_block  # the first block seen at the highest height
+        self._unsafe_tail = []  # the route from _root_block to _best_tip, as _TailEntries
+        self._num_tail_processed = 0  # number of _unsafe_tail entries generated (or excluded)
+        self._reorg_events = deque()  # ReorgEvents to generate
 
     def __next__(self):
+        if self.generate_unsafe_tail:
+            return self._next_unsafe()
         while True:
             block = self._get_next_block_to_release()
             if block is not None:
                 self._root_block = block
                 if self._check_block(block):
+                    if type(block) is StubBlock:
+                        # in a skipped file, but included after all. read it
+                        block = read_block(block.filepos, block.height)
                     return block
             # no next block in pending blocks. need to read more data
             self._read_another_block()
 
+    def _next_unsafe(self):
+        tail = self._unsafe_tail
+        while True:
+            if self._reorg_events:
+                return self._reorg_events.popleft()
+            # generate the blocks added to the tail
+            while self._num_tail_processed < len(tail):
+                entry = tail[self._num_tail_processed]
+                self._num_tail_processed += 1
+                if entry.is_included:
+                    if type(entry.block) is StubBlock:
+                        entry.block = read_block(entry.block.filepos, entry.block.height)
+                    return entry.block
+            if self._sync_unsafe_tail():
+                continue
+            # the tail is in sync. (its first block is the next one to be deemed safe)
+            block = self._get_next_block_to_release()
+            if block is not None:
+                self._root_block = block
+                entry = tail.pop(0)
+                self._num_tail_processed -= 1
+                assert entry.block.block_hash == block.block_hash, (entry.block, block)
+                if self.block_filter is not None:
+                    self.block_filter.is_started, self.block_filter.is_ended = entry.filter_state
+                    if self.block_filter.is_ended:
+                        raise StopIteration
+                continue
+            self._read_another_block()
+
+    def _sync_unsafe_tail(self):
+        """
+        Update `_unsafe_tail` to be the route to `_best_tip`.  Blocks no longer in
+        the route are disconnected (generating a ReorgEvent).
+        :return: True if changed
+        """
+        tail = self._unsafe_tail
+        best_tip = self._best_tip
+        if tail and tail[-1].block.block_hash == best_tip.block_hash:
+            return False
+        root_block = self._root_block
+        if best_tip.height <= root_block.height:
+            return False
+        # find the route from the root to the best tip
+        route = []
+        blocks_by_hash = self._blocks_by_hash
+        root_block_hash = root_block.block_hash
+        block = best_tip
+        while block.block_hash != root_block_hash:
+            route.append(block)
+            block = blocks_by_hash[block.prev_block_hash]
+        route.reverse()
+        # disconnect the blocks which diverge from it
+        num_common = 0
+        while num_common < len(tail) and tail[num_common].block.block_hash == route[num_common].block_hash:
+            num_common += 1
+        if num_common < len(tail):
+            disconnected_blocks = [
+                entry.block for entry in reversed(tail[num_common : self._num_tail_processed])
+                if entry.is_included
+            ]
+            if disconnected_blocks:
+                fork_block = tail[num_common - 1].block if num_common > 0 else root_block
+                logger.info('reorg: %d blocks disconnected, forking from #%s', len(disconnected_blocks), fork_block.height)
+                self._reorg_events.append(ReorgEvent(fork_block, disconnected_blocks))
+            del tail[num_common:]
+            self._num_tail_processed = min(self._num_tail_processed, num_common)
+        # connect the new blocks
+        if self.block_filter is not None:
+            filter_state = tail[-1].filter_state if tail else ( self.block_filter.is_started, self.block_filter.is_ended )
+        else:
+            filter_state = None
+        for block in route[num_common:]:
+            is_included, filter_state = self._check_tail_block(block, filter_state)
+            tail.append(_TailEntry(block, is_included, filter_state))
+        return True
+
+    def _check_tail_block(self, block, filter_state):
+        """
+        Same as `_check_block`, for a block in the unsafe tail, given the state
+        of `block_filter` following the previous block in the tail.
+        :return: a ( should_include, filter_state following `block` ) pair
+        """
+        if self.block_filter is None:
+            return True, None
+        working_filter = _WorkingBlockFilter(self.block_filter.filter)
+        working_filter.is_started, working_filter.is_ended = filter_state
+        try:
+            is_included = working_filter.check_block(block)
+        except StopIteration:
+            is_included = False
+        return is_included, ( working_filter.is_started, working_filter.is_ended )
+
     def _get_next_block_to_release(self):
 
         if not self._check_heights_gap():
@@ -445,7 +744,11 @@ class LongestChainBlockIterator:
                 assert prev_block.height + 1 == block_height, (prev_block.height, block_height)
         except KeyError:
             # already neglected
-            logger.info('block ignored (must be from a fork already deemed inferior): %s', block.block_hash_hex)
+            if block_height <= self._root_block.height:
+                # (e.g. re-read when resuming, see BlockChainIterator)
+                logger.debug('block ignored (already released, or from a fork already deemed inferior): %s', block.block_hash_hex)
+            else:
+                logger.info('block ignored (must be from a fork already deemed inferior): %s', block.block_hash_hex)
             return
         
         # update data structures with new block
@@ -460,6 +763,78 @@ class LongestChainBlockIterator:
             # prev is not longer a leaf. need to remove it from leaf_heights
             leaf_heights.remove(block_height - 1)
         leaf_heights.add(block_height)
+        if block_height > self._best_tip.height:
+            self._best_tip = block
+
+    # checkpoint support -- see the `checkpoint` module
+
+    def get_checkpoint_state(self):
+        # blocks are referenced by their positions. the block tree is rebuilt
+        # from the blocks' prev_block_hash.
+        root_block = self._root_block
+        root_hash = root_block.block_hash
+        block_filter = self.block_filter
+        return Bunch(
+            root_block = get_block_ref(root_block) if root_block is not self._DUMMY_PRE_GENESIS_BLOCK else None,
+            blocks = [ get_block_ref(block) for block_hash, block in self._blocks_by_hash.items() if block_hash != root_hash ],
+            last_block_hash = self._last_block.block_hash,
+            block_filter = ( block_filter.is_started, block_filter.is_ended ) if block_filter is not None else None,
+            best_tip_hash = self._best_tip.block_hash,
+            unsafe_tail = [
+                ( get_block_ref(entry.block), entry.is_included, entry.filter_state )
+                for entry in self._unsafe_tail
+            ],
+            num_tail_processed = self._num_tail_processed,
+            reorg_events = [
+                ( self._get_fork_block_ref(event.fork_block), [ get_block_ref(block) for block in event.disconnected_blocks ] )
+                for event in self._reorg_events
+            ],
+            block_iter = self.block_iter.get_checkpoint_state(),
+        )
+
+    def _get_fork_block_ref(self, block):
+        return get_block_ref(block) if block is not self._DUMMY_PRE_GENESIS_BLOCK else None
+
+    def set_checkpoint_state(self, state):
+        self.block_iter.set_checkpoint_state(state.block_iter)
+        if state.root_block is not None:
+            root_block = read_block_ref(state.root_block)
+        else:
+            root_block = self._DUMMY_PRE_GENESIS_BLOCK
+        self._root_block = root_block
+        self._blocks_by_hash = { root_block.block_hash: root_block }
+        self._block_children = { root_block.block_hash: [] }
+        # blocks are in topological order (in the order they were added)
+        for ref in state.blocks:
+            block = read_block_ref(ref)
+            self._blocks_by_hash[block.block_hash] = block
+            self._block_children[block.block_hash] = []
+            self._block_children[block.prev_block_hash].append(block)
+        self._leaf_heights = SortedList(
+            block.height
+            for block_hash, block in self._blocks_by_hash.items()
+            if not self._block_children[block_hash]
+        )
+        self._last_block = self._blocks_by_hash[state.last_block_hash]
+        if state.block_filter is not None:
+            self.block_filter.is_started, self.block_filter.is_ended = state.block_filter
+        # unsafe-tail state (missing in older checkpoints)
+        self._best_tip = self._blocks_by_hash[state.get('best_tip_hash', state.last_block_hash)]
+        self._unsafe_tail = [
+            _TailEntry(read_block_ref(ref), is_included, filter_state)
+            for ref, is_included, filter_state in state.get('unsafe_tail', [])
+        ]
+        self._num_tail_processed = state.get('num_tail_processed', 0)
+        self._reorg_events = deque(
+            ReorgEvent(read_block_ref(fork_ref) if fork_ref is not None else self._DUMMY_PRE_GENESIS_BLOCK,
+                       [ read_block_ref(ref) for ref in refs ])
+            for fork_ref, refs in state.get('reorg_events', [])
+        )
+
+    def _can_skip_file(self, summary):
+        if self.block_filter is None:
+            return False
+        return can_skip_file(summary, self.block_filter.filter)
 
     def _check_block(self, block):
         """
@@ -475,6 +850,41 @@ class LongestChainBlockIterator:
     def __repr__(self):
         return '<%s at block #%r>' % ( type(self).__name__, self._root_block.height )
 
+class _TailEntry:
+    """
+    A block in the unsafe tail of a LongestChainBlockIterator.
+    """
+    __slots__ = [ 'block', 'is_included', 'filter_state' ]
+
+    def __init__(self, block, is_included, filter_state):
+        self.block = block
+        self.is_included = is_included  # by the block_filter
+        self.filter_state = filter_state  # of the block_filter, following this block
+
+class ReorgEvent:
+    """
+    Generated by a LongestChainBlockIterator with `generate_unsafe_tail=True`,
+    when blocks it generated are no longer in the best chain.
+    """
+    __slots__ = [ 'fork_block', 'disconnected_blocks' ]
+
+    def __init__(self, fork_block, disconnected_blocks):
+        """
+        :param fork_block: the last block common to the old and new chains
+        :param disconnected_blocks: the blocks generated which are no longer in
+            the chain, tip first (i.e. in the order they should be rolled back)
+        """
+        self.fork_block = fork_block
+        self.disconnected_blocks = disconnected_blocks
+
+    @property
+    def depth(self):
+        return len(self.disconnected_blocks)
+
+    def __repr__(self):
+        return '<%s: %d blocks disconnected, forking from #%s>' % (
+            type(self).__name__, self.depth, self.fork_block.height)
+
 
 ################################################################################
 # Transactions
@@ -488,48 +898,154 @@ class TxIterator:
         for block in LongestChainBlockIterator():
             yield from block.iter_txs()
             
-    Element type is `Tx` (or `TxInBlock`, if `include_block_context=True`.
+    Element type is `Tx` (or `TxInBlock`, if `include_block_context=True`, or
+    `include_block_context='light'`, in which case its `block` is a `BlockContext`).
+
+    With `generate_unsafe_tail=True` (see LongestChainBlockIterator), ReorgEvents
+    are generated as well, between the txs of the blocks.
     
     :note: This iterator is resumable and refreshable.
     """
     
-    def __init__(self, include_block_context = False, include_tx_blob = False, block_iter = None, **kwargs):
+    def __init__(self, include_block_context = False, include_tx_blob = False, block_iter = None,
+                 txindex = None, script_index = None, spent_by_index = None, auto_detach = False, **kwargs):
         """
         :param block_iter: a LongestChainBlockIterator
+        :param txindex: a TxIndex, to add the txs generated to
+        :param script_index: a ScriptIndex, to add the outputs of the txs generated to
+        :param spent_by_index: a SpentByIndex, to add the inputs of the txs generated to
+        :param auto_detach: detach the txs (and blocks) still alive when moving on
+            to the next file (see the `detach` module)
         :param kwargs: extra kwargs for LongestChainBlockIterator (ignored unless block_iter is None)
         """
         if block_iter is None:
-            block_iter = LongestChainBlockIterator(**kwargs)
+            block_iter = LongestChainBlockIterator(auto_detach = auto_detach, **kwargs)
         self.block_iter = block_iter
         self.include_block_context = include_block_context
         self.include_tx_blob = include_tx_blob
+        self.txindex = txindex
+        self.script_index = script_index
+        self.spent_by_index = spent_by_index
+        self._indexes = [ index for index in ( txindex, script_index, spent_by_index ) if index is not None ]
+        self._detacher = Detacher() if auto_detach else None
         
         # state
         self._block_txs = iter(())  # iterator over an empty sequence
+        self._block = None  # the current block
+        self._tx_idx = 0  # number of txs generated from the current block
+        self._tx_offset = 0  # offset of the next tx in the current block (maintained if indexing)
+        self._reorg_event = None  # a ReorgEvent to generate
 
     def __next__(self):
         while True:
             try:
                 # return the next tx in this block:
                 tx = self._block_txs.__next__()  # easier to profile with x.__next__() instead of next(x)...
+                self._tx_idx += 1
+                if self._detacher is not None:
+                    self._detacher.add(getattr(tx, 'tx', tx), getattr(self._block.filepos, 'filename', None))
+                if self._indexes:
+                    for index in self._indexes:
+                        index.add_tx(tx, self._block, self._tx_offset)
+                    self._tx_offset += tx.rawsize
                 return tx
             except StopIteration:
                 # done with this block
                 pass
             # proceed to next block:
             self._block_txs = self._get_iter_of_next_block()
+            if self._reorg_event is not None:
+                event = self._reorg_event
+                self._reorg_event = None
+                return event
 
     def _get_iter_of_next_block(self):
-        txs = self.block_iter.__next__().txs  # easier to profile with x.__next__() instead of next(x)...
+        block = self.block_iter.__next__()  # easier to profile with x.__next__() instead of next(x)...
+        if type(block) is ReorgEvent:
+            self._on_reorg(block)
+            self._reorg_event = block
+            return iter(())
+        self._block = block
+        self._tx_idx = 0
+        self._tx_offset = _get_first_tx_offset(block)
+        return self._get_iter_of_block(block)
+
+    def _on_reorg(self, event):
+        """
+        Called when blocks whose txs were generated are disconnected (with
+        `generate_unsafe_tail=True`).  Subclasses can override (calling this
+        method), to undo the effects of the txs.
+        :note: the indexes (`txindex` etc.) forget the disconnected blocks, so the
+            blocks replacing them are indexed, but their entries already flushed
+            remain (see `SortedRunsIndex.undo_reorg()`)
+        """
+        for index in self._indexes:
+            index.undo_reorg(event)
+
+    def _get_iter_of_block(self, block):
+        txs = block.txs
         if self.include_block_context:
-            return txs.iter_txs_in_block(include_tx_blob = self.include_tx_blob)
+            return txs.iter_txs(include_block_context = self.include_block_context, include_tx_blob = self.include_tx_blob)
         else:
             return txs.iter_txs(include_tx_blob = self.include_tx_blob)
 
     def __iter__(self):
         return self
 
+    # checkpoint support -- see the `checkpoint` module
+
+    def get_checkpoint_state(self):
+        return Bunch(
+            block = get_block_ref(self._block) if self._block is not None else None,
+            tx_idx = self._tx_idx,
+            block_iter = self.block_iter.get_checkpoint_state(),
+        )
+
+    def set_checkpoint_state(self, state):
+        self.block_iter.set_checkpoint_state(state.block_iter)
+        if state.block is None:
+            self._block = None
+            self._block_txs = iter(())
+        else:
+            self._block = read_block_ref(state.block)
+            self._block_txs = self._get_iter_of_block(self._block)
+            # skip the txs already generated
+            self._tx_offset = _get_first_tx_offset(self._block)
+            for _ in range(state.tx_idx):
+                self._tx_offset += self._block_txs.__next__().rawsize
+        self._tx_idx = state.tx_idx
+
     def __repr__(self):
         return '<%s at %r>' % ( type(self).__name__, self.block_iter )
 
+def _get_first_tx_offset(block):
+    # the txs follow the 80-byte header and the number of txs
+    _, consumed = deserialize_varlen_integer(block._txs_blob)
+    return 80 + consumed
+
+################################################################################
+# Reading blocks by position
+
+def read_block(filepos, height = -1):
+    """
+    Read a single block, given its position.
+    :param filepos: a FilePos (e.g. a `Block.filepos`)
+    """
+    block = deserialize_block(read_raw_block(filepos.filename, filepos.offset), height)
+    block.filepos = filepos
+    return block
+
+def get_block_ref(block):
+    """
+    :return: a compact (picklable) reference to a block, to be read using `read_block_ref`
+    """
+    filepos = block.filepos
+    if filepos is None:
+        raise ValueError('Location of block is unknown: %s' % block.block_hash_hex)
+    return ( filepos.filename, filepos.offset, block.height )
+
+def read_block_ref(ref):
+    filename, offset, height = ref
+    return read_block(FilePos(filename, offset), height)
+
 ################################################################################
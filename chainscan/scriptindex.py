@@ -0,0 +1,81 @@
+"""
+An on-disk index of tx outputs by their scripts, for finding all the outputs
+paying to a script (e.g. an address), without scanning the chain.
+
+The index is built during a normal tx scan, by passing it to TxIterator::
+
+    with ScriptIndex('scriptindex') as script_index:
+        for tx in iter_txs(script_index = script_index):
+            ...
+
+    for posting in ScriptIndex('scriptindex').get_postings(script):
+        print(posting['height'], posting['value'])
+
+Like TxIndex, the index is stored as immutable sorted runs (see
+`txindex.SortedRunsIndex`), so memory used for building it is bounded by the
+buffer size, and it can be extended as new blocks arrive.
+"""
+
+import hashlib
+import numpy as np
+
+from .txindex import SortedRunsIndex, LOCATION_DTYPE, read_tx
+
+
+################################################################################
+
+# an output paying to a script: the location of its tx, and the output itself
+POSTING_DTYPE = np.dtype(LOCATION_DTYPE.descr + [
+    ( 'output_idx', '<u4' ),
+    ( 'value', '<u8' ),
+])
+
+def get_script_key(script):
+    """
+    :return: the key of a script in the index: a 64-bit hash of it
+    """
+    return int.from_bytes(hashlib.sha256(script).digest()[:8], 'little')
+
+
+class ScriptIndex(SortedRunsIndex):
+    """
+    An index mapping output scripts to the outputs paying to them ("postings").
+
+    Scripts are keyed by a 64-bit hash, so (very rarely) postings of another
+    script with the same hash can be included.  `get_txs()` verifies the scripts.
+    """
+
+    ENTRY_DTYPE = POSTING_DTYPE
+
+    def _get_entries(self, tx, location):
+        return [
+            ( get_script_key(txout.script), location + ( output_idx, txout.value ) )
+            for output_idx, txout in enumerate(tx.outputs)
+        ]
+
+    def get_postings(self, script):
+        """
+        :return: a structured array (of POSTING_DTYPE) of the outputs paying to
+            `script`, in height order.  The location of the tx of a posting is
+            given by `get_location(posting)`.
+        """
+        return self._lookup(get_script_key(script))
+
+    def get_txs(self, script):
+        """
+        Generate ( tx, output_idx ) pairs of the outputs paying to `script`, in
+        height order.  The txs are read from the `blk*.dat` files.
+        """
+        for posting in self.get_postings(script):
+            tx = read_tx(self.get_location(posting))
+            output_idx = int(posting['output_idx'])
+            if tx.outputs[output_idx].script == script:
+                yield tx, output_idx
+
+    def get_total_received(self, script):
+        """
+        :return: the total value of the outputs paying to `script`
+        """
+        return int(self.get_postings(script)['value'].sum())
+
+################################################################################
@@ -0,0 +1,433 @@
+"""
+A local server, streaming the blocks of the longest chain to many clients.
+
+A single ChainServer scans the `blk*.dat` files (resolving the longest chain
+once), and streams the raw blocks to any number of ChainClients (e.g. in other
+processes on the same host), over a Unix socket::
+
+    # in the server process:
+    with ChainServer('/tmp/chainscan.sock') as server:
+        server.wait()
+
+    # in a client process:
+    client = ChainClient('/tmp/chainscan.sock', start_height = 800000)
+    for block in client.iter_blocks():
+        ...
+
+Each client connects with the height to start from (its resume cursor), and
+receives the blocks from that height on, including new blocks as they arrive.
+With `generate_unsafe_tail=True` (see LongestChainBlockIterator), blocks are
+sent as soon as they arrive, and clients are sent reorg frames when blocks
+they received are disconnected (generating ReorgEvents).
+
+A resuming client also sends the hashes of the last blocks it received (its
+"locator", most recent first).  If its last block is no longer on the
+server's chain (e.g. it was disconnected by a reorg while the client was
+away, or the server was restarted), the server first sends a reorg frame, of
+the most recent block of the locator which still is.
+
+Framing: the request is a REQUEST (start height, number of locator hashes),
+followed by the hashes.  Each frame is a FRAME_HEADER (frame type, height, payload size),
+followed by the payload.  The payload of a FRAME_BLOCK is the block's raw data
+(without the magic and size prefix).  The height of a FRAME_REORG is the height
+of the fork block (the client drops the blocks above it), and it has no
+payload.
+"""
+
+import os
+import socket
+import socketserver
+import struct
+import threading
+from collections import deque
+
+from .misc import Bunch, FilePos
+from .scan import LongestChainBlockIterator, ReorgEvent, read_block
+from .block import deserialize_block
+from .rawfiles import read_raw_block
+from .utils import tailable
+
+from .loggers import get_logger
+logger = get_logger('server', 'info')
+
+
+################################################################################
+# Framing
+
+# the start height, and the number of locator hashes following it, sent by the
+# client when connecting
+REQUEST = struct.Struct('<iI')
+MAX_LOCATOR_SIZE = 1000
+
+# frame type, height, payload size
+FRAME_HEADER = struct.Struct('<BiI')
+FRAME_BLOCK = 1
+FRAME_REORG = 2
+
+def _pack_frame(frame_type, height, payload = b''):
+    return FRAME_HEADER.pack(frame_type, height, len(payload)) + payload
+
+def _recv_exactly(f, size):
+    # :return: None at EOF
+    data = f.read(size)
+    if len(data) < size:
+        return None
+    return data
+
+
+################################################################################
+# Server
+
+class ChainServer:
+    """
+    Scans the longest chain (in a background thread), and streams its blocks
+    to clients connecting to a Unix socket.
+
+    Recent blocks are sent from memory.  Older blocks (for clients starting far
+    behind) are read from the `blk*.dat` files, by their positions.
+    """
+
+    # number of most recent blocks kept in memory
+    NUM_RECENT_BLOCKS = 16
+    # max number of blocks sent to a client per wake-up
+    SEND_BATCH_SIZE = 64
+
+    def __init__(self, socket_path, block_iter = None, polling_interval = 5, **kwargs):
+        """
+        :param socket_path: the path of the Unix socket to listen on
+        :param block_iter: a LongestChainBlockIterator
+        :param polling_interval: how often to check for new blocks, after reaching
+            the end of the data (in seconds)
+        :param kwargs: extra kwargs for LongestChainBlockIterator (ignored unless block_iter is None)
+        """
+        if block_iter is None:
+            block_iter = LongestChainBlockIterator(**kwargs)
+        self.socket_path = socket_path
+        self.block_iter = block_iter
+        self._tail_iter = tailable(block_iter, polling_interval = polling_interval)
+
+        # state, guarded by _cond
+        self._cond = threading.Condition()
+        self._base_height = None  # height of the first block
+        self._positions = []  # FilePos of each block, from _base_height
+        self._recent = deque(maxlen = self.NUM_RECENT_BLOCKS)  # the most recent blocks
+        self._fork_heights = []  # of all reorgs, in order
+        self._is_stopped = False
+        self._error = None
+
+        self._scan_thread = None
+        self._server = None
+        self._server_thread = None
+
+    @property
+    def height(self):
+        """
+        The height of the last block scanned (-1 if none).
+        """
+        with self._cond:
+            return self._get_height()
+
+    def _get_height(self):
+        if self._base_height is None:
+            return -1
+        return self._base_height + len(self._positions) - 1
+
+    ###################
+    # Running
+
+    def start(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self._server = _UnixServer(self.socket_path, _ClientHandler)
+        self._server.chain_server = self
+        self._server_thread = threading.Thread(target = self._server.serve_forever, daemon = True)
+        self._server_thread.start()
+        self._scan_thread = threading.Thread(target = self._scan, daemon = True)
+        self._scan_thread.start()
+        logger.info('serving on %s', self.socket_path)
+
+    def wait(self, timeout = None):
+        """
+        Wait for the server to stop (e.g. by `stop()` from another thread, or on a scan error).
+        """
+        self._scan_thread.join(timeout)
+        if self._error is not None:
+            raise self._error
+
+    def stop(self):
+        self._tail_iter.stop()
+        with self._cond:
+            self._is_stopped = True
+            self._cond.notify_all()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self._scan_thread is not None:
+            self._scan_thread.join()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    ###################
+    # Scanning
+
+    def _scan(self):
+        try:
+            for x in self._tail_iter:
+                with self._cond:
+                    if type(x) is ReorgEvent:
+                        self._on_reorg(x)
+                    else:
+                        self._add_block(x)
+                    self._cond.notify_all()
+        except Exception as e:
+            logger.exception('scan failed')
+            self._error = e
+        with self._cond:
+            self._is_stopped = True
+            self._cond.notify_all()
+
+    def _add_block(self, block):
+        if self._base_height is None:
+            self._base_height = block.height
+        assert block.height == self._get_height() + 1, (block.height, self._get_height())
+        self._positions.append(block.filepos)
+        self._recent.append(block)
+
+    def _on_reorg(self, event):
+        for _ in event.disconnected_blocks:
+            self._positions.pop()
+            if self._recent:
+                self._recent.pop()
+        self._fork_heights.append(event.fork_block.height)
+
+    ###################
+    # Serving
+
+    def _get_blocks(self, start_height, max_blocks):
+        """
+        :return: the blocks (or their FilePos) from `start_height` on (called with
+            the lock held)
+        """
+        stop_height = min(self._get_height() + 1, start_height + max_blocks)
+        recent_start_height = self._get_height() + 1 - len(self._recent)
+        return [
+            self._recent[height - recent_start_height] if height >= recent_start_height
+            else self._positions[height - self._base_height]
+            for height in range(start_height, stop_height)
+        ]
+
+    def _get_block_hash(self, height):
+        """
+        :return: the hash of the block at `height` (called with the lock held)
+        """
+        recent_start_height = self._get_height() + 1 - len(self._recent)
+        if height >= recent_start_height:
+            return self._recent[height - recent_start_height].block_hash
+        return read_block(self._positions[height - self._base_height], height).block_hash
+
+    def _find_fork_height(self, start_height, locator):
+        """
+        :param locator: the hashes of the blocks a client received last, from height
+            `start_height - 1` down
+        :return: the height of the most recent block of `locator` which is on the
+            chain, or None if the client's last block is (or if none can be checked)
+            (called with the lock held, when the chain reaches `start_height - 1`)
+        """
+        fork_height = None
+        for i, block_hash in enumerate(locator):
+            height = start_height - 1 - i
+            if height < self._base_height:
+                break
+            if self._get_block_hash(height) == block_hash:
+                return height if i > 0 else None
+            fork_height = height - 1
+        return fork_height
+
+    def _serve_client(self, wfile, start_height, locator = ()):
+        """
+        :param locator: see `_find_fork_height()`
+        """
+        cond = self._cond
+        with cond:
+            num_reorgs_seen = len(self._fork_heights)
+        cursor = start_height  # the next height to send
+        while True:
+            frames = []
+            with cond:
+                while True:
+                    if self._is_stopped:
+                        return
+                    new_fork_heights = self._fork_heights[num_reorgs_seen:]
+                    if new_fork_heights or ( self._base_height is not None and cursor <= self._get_height() ):
+                        break
+                    cond.wait()
+                num_reorgs_seen = len(self._fork_heights)
+                if locator and cursor <= self._get_height():
+                    # the client's blocks can be checked, against the current chain
+                    # (reorgs since the client connected included)
+                    fork_height = self._find_fork_height(cursor, locator)
+                    locator = None
+                    new_fork_heights = []
+                    if fork_height is not None:
+                        logger.info('client resuming from a block no longer on the chain, forking from #%d', fork_height)
+                        frames.append(_pack_frame(FRAME_REORG, fork_height))
+                        cursor = fork_height + 1
+                if new_fork_heights:
+                    fork_height = min(new_fork_heights)
+                    if cursor > fork_height + 1:
+                        frames.append(_pack_frame(FRAME_REORG, fork_height))
+                        cursor = fork_height + 1
+                        # (the client drops the blocks the locator refers to)
+                        locator = None
+                if self._base_height is not None:
+                    cursor = max(cursor, self._base_height)
+                    blocks = self._get_blocks(cursor, self.SEND_BATCH_SIZE)
+                else:
+                    blocks = []
+            # (reading from files and sending, without holding the lock)
+            for block in blocks:
+                if type(block) is FilePos:
+                    data = memoryview(read_raw_block(block.filename, block.offset))[8:]
+                else:
+                    data = block.blob
+                frames.append(FRAME_HEADER.pack(FRAME_BLOCK, cursor, len(data)))
+                frames.append(data)
+                cursor += 1
+            for frame in frames:
+                wfile.write(frame)
+            wfile.flush()
+
+    def __repr__(self):
+        return '<%s %s at block #%d>' % ( type(self).__name__, self.socket_path, self.height )
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class _ClientHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        request = _recv_exactly(self.rfile, REQUEST.size)
+        if request is None:
+            return
+        start_height, locator_size = REQUEST.unpack(request)
+        if locator_size > MAX_LOCATOR_SIZE:
+            logger.warning('invalid request, locator too large: %d', locator_size)
+            return
+        data = _recv_exactly(self.rfile, locator_size * 32) if locator_size else b''
+        if data is None:
+            return
+        locator = [ data[i : i + 32] for i in range(0, len(data), 32) ]
+        logger.info('client connected, starting at #%d', start_height)
+        try:
+            self.server.chain_server._serve_client(self.wfile, start_height, locator)
+        except (BrokenPipeError, ConnectionResetError):
+            logger.info('client disconnected')
+
+
+################################################################################
+# Client
+
+class ChainClient:
+    """
+    Receives blocks from a ChainServer.
+
+    The client keeps its resume cursor (`height`), so iterating again (e.g.
+    after the connection is lost) continues from the block following the last
+    block received.  If that block was disconnected in the meantime, a
+    ReorgEvent is generated first.
+    """
+
+    def __init__(self, socket_path, start_height = 0, reorg_depth = 100):
+        """
+        :param start_height: the height of the first block to receive
+        :param reorg_depth: number of most recent blocks kept, for including in
+            ReorgEvents
+        """
+        self.socket_path = socket_path
+        self.height = start_height - 1  # of the last block received
+        self._recent = deque(maxlen = reorg_depth)
+        self._sock = None
+
+    def iter_blocks(self):
+        """
+        Generate the blocks received (and ReorgEvents, if the server generates
+        an unsafe tail), until the server closes the connection.
+
+        Element type is `Block` (without a `filepos`).
+        """
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._sock.connect(self.socket_path)
+            locator = self._get_locator()
+            self._sock.sendall(REQUEST.pack(self.height + 1, len(locator)) + b''.join(locator))
+            with self._sock.makefile('rb') as rfile:
+                while True:
+                    header = _recv_exactly(rfile, FRAME_HEADER.size)
+                    if header is None:
+                        return
+                    frame_type, height, size = FRAME_HEADER.unpack(header)
+                    payload = _recv_exactly(rfile, size) if size else b''
+                    if payload is None:
+                        return
+                    if frame_type == FRAME_BLOCK:
+                        block = deserialize_block(bytearray(payload), height, False)
+                        self.height = height
+                        self._recent.append(block)
+                        yield block
+                    elif frame_type == FRAME_REORG:
+                        yield self._make_reorg_event(height)
+                    else:
+                        raise ValueError('Unknown frame type: %r' % frame_type)
+        finally:
+            self.close()
+
+    def iter_txs(self, include_block_context = False):
+        """
+        Generate the txs of the blocks received (and ReorgEvents).
+        """
+        for block in self.iter_blocks():
+            if type(block) is ReorgEvent:
+                yield block
+            else:
+                yield from block.txs.iter_txs(include_block_context = include_block_context)
+
+    def _get_locator(self):
+        # the hashes of the recent blocks, from the last block received down
+        locator = []
+        height = self.height
+        for block in reversed(self._recent):
+            if block.height != height or len(locator) >= MAX_LOCATOR_SIZE:
+                break
+            locator.append(bytes(block.block_hash))
+            height -= 1
+        return locator
+
+    def _make_reorg_event(self, fork_height):
+        disconnected_blocks = []
+        while self._recent and self._recent[-1].height > fork_height:
+            disconnected_blocks.append(self._recent.pop())
+        if self._recent and self._recent[-1].height == fork_height:
+            fork_block = self._recent[-1]
+        else:
+            # no longer kept
+            fork_block = Bunch(height = fork_height)
+        self.height = fork_height
+        return ReorgEvent(fork_block, disconnected_blocks)
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def __repr__(self):
+        return '<%s %s at block #%d>' % ( type(self).__name__, self.socket_path, self.height )
+
+################################################################################
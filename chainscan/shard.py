@@ -0,0 +1,267 @@
+"""
+A UtxoSet partitioned across worker processes.
+
+A single UtxoSet is bound to a single core (and to a single process's memory).
+A ShardedUtxoSet partitions the UTXOs by txid across N worker processes, each
+holding a UtxoSet of its own.  Adds and spends are sent to the workers in
+batches (typically, a batch per block), packed into a few flat buffers, and all
+workers process their parts of a batch in parallel, using the batch methods of
+UtxoSet (`spend_batch()` and `add_batch()`).  The tracker keeps a few blocks in
+flight, rather than waiting for each block to be applied before reading the next.
+
+Use it via TxSpendingTracker::
+
+    tracker = TxSpendingTracker(num_shards = 4)
+    for tx in TrackedSpendingTxIterator(tracker = tracker):
+        ...
+    tracker.utxoset.close()
+"""
+
+import multiprocessing
+import queue
+import threading
+import numpy as np
+
+from collections import deque
+
+from ._track_c import UtxoSet, set_spending_infos
+
+from .loggers import get_logger
+logger = get_logger('shard', 'info')
+
+
+################################################################################
+# Splitting batches
+
+def _take_txids(txids, idxs):
+    return np.frombuffer(txids, dtype = np.uint8).reshape(-1, 32)[idxs].tobytes()
+
+def _get_txid_shards(txids, num_shards):
+    # the last byte of each txid (see ShardedUtxoSet.get_shard())
+    return np.frombuffer(txids, dtype = np.uint8)[31::32] % num_shards
+
+def _split_batch(batch, num_shards):
+    """
+    Split a batch (as returned by `pack_block_updates()`) by shard.
+    :return: a list of ( spend_idxs, spends, adds ), one per shard, where
+        spend_idxs are the indexes (in `batch.spend_inputs`) of the shard's
+        spends, and spends and adds are the args of `UtxoSet.spend_batch()` and
+        `UtxoSet.add_batch()`
+    """
+    spend_shards = _get_txid_shards(batch.spend_txids, num_shards)
+    tx_shards = _get_txid_shards(batch.txids, num_shards)
+    output_shards = np.repeat(tx_shards, batch.num_outputs)
+    if batch.script_offsets is not None:
+        script_sizes = np.diff(batch.script_offsets).astype(np.int64)
+        script_data = np.frombuffer(batch.script_data, dtype = np.uint8)
+        script_data_shards = np.repeat(output_shards, script_sizes)
+    res = []
+    for shard in range(num_shards):
+        spend_idxs = np.flatnonzero(spend_shards == shard).astype(np.uint32)
+        spends = ( _take_txids(batch.spend_txids, spend_idxs), batch.spend_output_idxs[spend_idxs] )
+        tx_idxs = np.flatnonzero(tx_shards == shard)
+        output_mask = output_shards == shard
+        adds = (
+            _take_txids(batch.txids, tx_idxs),
+            batch.block_heights[tx_idxs],
+            batch.num_outputs[tx_idxs],
+            batch.output_idxs[output_mask],
+            batch.output_values[output_mask],
+        )
+        if batch.script_offsets is not None:
+            script_offsets = np.zeros(len(adds[3]) + 1, dtype = np.uint64)
+            np.cumsum(script_sizes[output_mask], out = script_offsets[1:])
+            adds += ( script_offsets, script_data[script_data_shards == shard].tobytes() )
+        res.append(( spend_idxs, spends, adds ))
+    return res
+
+
+################################################################################
+# Workers
+
+def _shard_worker(conn, utxoset_kwargs):
+    utxoset = UtxoSet(**utxoset_kwargs)
+    # requests are received by a separate thread, so the parent can send the next
+    # batches while the worker sends the reply to this one (and neither blocks
+    # the other, when batches are bigger than the pipe's buffer)
+    requests = queue.Queue()
+    threading.Thread(target = _receive_requests, args = (conn, requests), daemon = True).start()
+    while True:
+        msg = requests.get()
+        cmd = msg[0]
+        if cmd == 'close':
+            conn.close()
+            return
+        try:
+            if cmd == 'update':
+                res = _apply_update(utxoset, msg[1], msg[2])
+            elif cmd == 'stats':
+                res = ( len(utxoset), utxoset.get_num_unspent_outputs(), utxoset.get_total_value() )
+            else:
+                raise ValueError('Unknown command: %r' % (cmd,))
+        except Exception as e:
+            # errors are passed to the parent, which re-raises them
+            res = e
+        conn.send(res)
+
+def _receive_requests(conn, requests):
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            msg = ( 'close', )
+        requests.put(msg)
+        if msg[0] == 'close':
+            return
+
+def _apply_update(utxoset, spends, adds):
+    # spends first: spends never refer to outputs added in the same batch
+    res = utxoset.spend_batch(*spends)
+    utxoset.add_batch(*adds)
+    return res
+
+
+################################################################################
+# ShardedUtxoSet
+
+class ShardedUtxoSet:
+    """
+    A UtxoSet-like object, whose UTXOs are partitioned by txid across worker
+    processes.
+
+    Unlike UtxoSet, it is updated in batches (see `update()`), and not one tx at
+    a time.  Batches can be pipelined: `submit()` sends a batch to the workers,
+    and returns without waiting for them, so the next batches can be prepared
+    (and submitted) while they apply it.
+
+    :note: The worker processes are terminated when `close()` is called (or at
+        exit, as they are daemonic).
+    """
+
+    def __init__(self, num_shards, **utxoset_kwargs):
+        """
+        :param num_shards: number of worker processes
+        :param utxoset_kwargs: kwargs for the UtxoSet of each worker
+        """
+        if num_shards < 1:
+            raise ValueError('num_shards must be positive: %r' % (num_shards,))
+        self.num_shards = num_shards
+        self.include_scripts = utxoset_kwargs.get('include_scripts', False)
+        self._conns = []
+        self._workers = []
+        self._pending = deque()  # ( spend_inputs, spend_idxs of each shard ), of the batches submitted
+        for _ in range(num_shards):
+            parent_conn, child_conn = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target = _shard_worker, args = (child_conn, utxoset_kwargs), daemon = True)
+            worker.start()
+            child_conn.close()
+            self._conns.append(parent_conn)
+            self._workers.append(worker)
+
+    def get_shard(self, txid):
+        # the last txid byte is used (the first bytes make the keys of the
+        # UtxoSets, and are better left unconstrained)
+        return txid[-1] % self.num_shards
+
+    def submit(self, batch):
+        """
+        Send a batch of spends and adds to the workers, without waiting for them
+        to apply it.  Batches are applied in the order they are submitted (so a
+        batch can spend outputs added by previous ones), and the results must be
+        collected (see `collect()`) in the same order.
+        :param batch: a batch, as returned by `pack_block_updates()`
+        :note: spends are applied before adds, so a batch cannot spend outputs
+            it adds.
+        """
+        shard_idxs = []
+        for conn, ( spend_idxs, spends, adds ) in zip(self._conns, _split_batch(batch, self.num_shards)):
+            conn.send(( 'update', spends, adds ))
+            shard_idxs.append(spend_idxs)
+        self._pending.append(( batch.spend_inputs, shard_idxs ))
+
+    def collect(self):
+        """
+        Wait for the oldest batch submitted to be applied, and set the
+        `spending_info` of its inputs.
+        :raise: KeyError if one of them spends an output which is not in the set
+        """
+        spend_inputs, shard_idxs = self._pending.popleft()
+        # all shards work in parallel
+        replies = self._recv_all()
+        for spend_idxs, spent in zip(shard_idxs, replies):
+            set_spending_infos(spend_inputs, spend_idxs, spent)
+
+    def flush(self):
+        """
+        Collect all the batches submitted.
+        """
+        while self._pending:
+            self.collect()
+
+    def update(self, batch):
+        """
+        Apply a batch of spends and adds (see `submit()`), and wait for it.
+        """
+        self.submit(batch)
+        self.flush()
+
+    @property
+    def num_pending(self):
+        """
+        The number of batches submitted, and not yet collected.
+        """
+        return len(self._pending)
+
+    def _get_stats(self):
+        self.flush()
+        for conn in self._conns:
+            conn.send(( 'stats', ))
+        return self._recv_all()
+
+    def _recv_all(self):
+        # a reply from each shard. errors are re-raised (once all replies are
+        # received, so the next replies are received in order)
+        replies = [ conn.recv() for conn in self._conns ]
+        for reply in replies:
+            if isinstance(reply, Exception):
+                raise reply
+        return replies
+
+    def __len__(self):
+        return sum( stats[0] for stats in self._get_stats() )
+
+    def get_num_unspent_outputs(self):
+        return sum( stats[1] for stats in self._get_stats() )
+
+    def get_total_value(self):
+        return sum( stats[2] for stats in self._get_stats() )
+
+    def begin_block(self):
+        # block-local spends are resolved by the tracker, before updating
+        pass
+
+    def end_block(self):
+        pass
+
+    def close(self):
+        for conn, worker in zip(self._conns, self._workers):
+            try:
+                conn.send(( 'close', ))
+            except (BrokenPipeError, OSError):
+                pass
+            worker.join()
+            conn.close()
+        self._conns = []
+        self._workers = []
+        self._pending.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __repr__(self):
+        return '<%s (%d shards)>' % (type(self).__name__, self.num_shards)
+
+################################################################################
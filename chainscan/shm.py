@@ -0,0 +1,228 @@
+"""
+Passing blocks to worker processes through shared memory.
+
+Pickling a Block copies its data (and unpickling copies it again).  Instead, a
+SharedBlockRing holds the raw data of blocks in a `multiprocessing.shared_memory`
+segment, used as a ring buffer, and only small BlockHandles (segment name,
+offset, length, height) are passed to the workers, which deserialize the blocks
+in place (without copying), using `read_block_handle()`.
+
+`shm_map()` does it all, with a process pool::
+
+    def count_outputs(block):
+        return sum( len(tx.outputs) for tx in block.txs )
+
+    for num_outputs in shm_map(count_outputs, iter_blocks(), processes = 8):
+        ...
+
+:note: A block read from a handle is only valid until the handle is released
+    (its space in the ring is then reused).  To keep it (or any of its txs),
+    use `block.detach()`.
+"""
+
+import multiprocessing
+from collections import deque, namedtuple
+from multiprocessing import shared_memory
+
+from .block import deserialize_block
+
+
+################################################################################
+# Ring
+
+# segment name -> SharedMemory, of the segments created or attached by this process
+_attached_segments = {}
+
+BlockHandle = namedtuple('BlockHandle', [ 'segment', 'offset', 'length', 'height' ])
+
+class SharedBlockRing:
+    """
+    A shared-memory ring buffer of raw block data.
+
+    Space is allocated in order, and must be released in the same order (i.e.,
+    the oldest handle is released first).
+    """
+
+    DEFAULT_SIZE = 256 * 2**20
+
+    def __init__(self, size = None):
+        """
+        :param size: the size of the shared memory segment, in bytes. Must be large
+            enough for the largest block.
+        """
+        if size is None:
+            size = self.DEFAULT_SIZE
+        self.size = size
+        self._shm = shared_memory.SharedMemory(create = True, size = size)
+        _attached_segments[self._shm.name] = self._shm
+        self._allocated = deque()  # ( offset, length ), oldest first
+        self._head = 0  # where the next block is written
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    def __len__(self):
+        """
+        The number of blocks held.
+        """
+        return len(self._allocated)
+
+    def put(self, block):
+        """
+        Copy a block's data into the ring.
+        :return: a BlockHandle, or None if there is no room for the block (i.e. older
+            handles need to be released first)
+        :raise: ValueError if the block is larger than the ring
+        """
+        data = block.blob
+        length = len(data)
+        if length > self.size:
+            raise ValueError('Block is larger than the ring (%d > %d bytes): %s' % ( length, self.size, block.block_hash_hex ))
+        offset = self._allocate(length)
+        if offset is None:
+            return None
+        self._shm.buf[offset : offset + length] = data
+        self._allocated.append(( offset, length ))
+        self._head = offset + length
+        return BlockHandle(self.name, offset, length, block.height)
+
+    def _allocate(self, length):
+        if not self._allocated:
+            return 0
+        tail = self._allocated[0][0]
+        head = self._head
+        if head > tail:
+            # the used space is [tail, head). try after it, then from the start
+            if length <= self.size - head:
+                return head
+            if length < tail:
+                return 0
+        elif length < tail - head:
+            # the used space wraps around. the free space is [head, tail)
+            return head
+        return None
+
+    def release(self, handle):
+        """
+        Release the space of the oldest handle.
+        """
+        offset, length = self._allocated.popleft()
+        if ( offset, length ) != ( handle.offset, handle.length ):
+            self._allocated.appendleft(( offset, length ))
+            raise ValueError('Handles must be released in order: %r' % ( handle, ))
+        if not self._allocated:
+            self._head = 0
+
+    def close(self):
+        """
+        Free the shared memory segment.
+        """
+        self._allocated.clear()
+        _attached_segments.pop(self._shm.name, None)
+        self._shm.close()
+        self._shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __repr__(self):
+        return '<%s %s (%d blocks)>' % ( type(self).__name__, self.name, len(self) )
+
+
+################################################################################
+# Reading handles
+
+
+def read_block_handle(handle):
+    """
+    Deserialize a block from a SharedBlockRing (in any process), without copying
+    its data.
+    :param handle: a BlockHandle
+    """
+    shm = _attached_segments.get(handle.segment)
+    if shm is None:
+        # a new ring. first detach from the rings closed since (e.g. by previous
+        # `shm_map()` calls on the same pool)
+        _detach_unlinked()
+        shm = _attach(handle.segment)
+        _attached_segments[handle.segment] = shm
+    buf = shm.buf[handle.offset : handle.offset + handle.length]
+    return deserialize_block(buf, handle.height, False)
+
+def _attach(name):
+    # (worker processes share the resource tracker of the process which created
+    # the segment, which unlinks it)
+    return shared_memory.SharedMemory(name = name)
+
+def _detach_unlinked():
+    """
+    Close the cached segments which were unlinked (i.e. their ring was closed),
+    so their memory can be freed.
+    """
+    for name, shm in list(_attached_segments.items()):
+        try:
+            _attach(name).close()
+            continue
+        except FileNotFoundError:
+            pass
+        try:
+            shm.close()
+        except BufferError:
+            # a block read from it is still referenced. retried on the next new ring
+            continue
+        del _attached_segments[name]
+
+
+################################################################################
+# Process pool
+
+def _call_with_block(fn, handle):
+    return fn(read_block_handle(handle))
+
+def shm_map(fn, blocks, processes = None, ring_size = None, pool = None):
+    """
+    Apply `fn` to each block, in a process pool, passing the blocks through a
+    SharedBlockRing.
+    :param fn: a picklable function, taking a Block
+    :param blocks: an iterable of blocks (e.g. a LongestChainBlockIterator)
+    :param processes: number of worker processes (ignored if `pool` is given)
+    :param ring_size: the size of the SharedBlockRing
+    :param pool: a `multiprocessing.Pool` to use. It can be used for several calls
+        (the workers detach from the rings of previous calls).
+    :return: a generator of the results, in order
+    """
+    own_pool = pool is None
+    pending = deque()  # ( handle, AsyncResult ), oldest first
+    # (the ring is created before the pool, so the workers share the resource
+    # tracker which created it)
+    with SharedBlockRing(ring_size) as ring:
+        if own_pool:
+            pool = multiprocessing.Pool(processes)
+        try:
+            for block in blocks:
+                while True:
+                    handle = ring.put(block)
+                    if handle is not None:
+                        break
+                    # no room in the ring. wait for the oldest block
+                    yield _pop_result(ring, pending)
+                pending.append(( handle, pool.apply_async(_call_with_block, ( fn, handle )) ))
+            while pending:
+                yield _pop_result(ring, pending)
+        finally:
+            if own_pool:
+                pool.terminate()
+                pool.join()
+
+def _pop_result(ring, pending):
+    handle, async_result = pending.popleft()
+    try:
+        return async_result.get()
+    finally:
+        ring.release(handle)
+
+################################################################################
@@ -0,0 +1,286 @@
+"""
+Loading and dumping UtxoSets in the format of bitcoind's UTXO snapshots (the
+files written by bitcoind's `dumptxoutset` RPC).
+
+Loading a snapshot of the UTXO set at some block, and tracking spending from the
+following block onward, avoids replaying the whole chain from genesis::
+
+    utxoset, meta = load_utxo_snapshot('utxo.dat', blockchain = get_blockchain(), include_scripts = True)
+    tracker = TxSpendingTracker(utxoset = utxoset)
+    block_filter = BlockFilter(start_block_height = meta.block_height + 1)
+    for tx in tracker.process_block_txs_gen(iter_txs(block_filter = block_filter)):
+        ...
+
+Both the current format (version 2, starting with the `utxo\\xff` magic) and the
+legacy format (bitcoind versions prior to 28.0, with no magic) are supported.
+
+:note: A UtxoSet does not keep full txids, only a prefix of `key_size` (+4 check)
+    bytes (except for txs in its overflow table), so snapshots written by
+    `dump_utxo_snapshot` contain truncated (zero-padded) txids.  They can be
+    loaded by `load_utxo_snapshot` (the loaded UtxoSet is equivalent to the
+    dumped one), but not by bitcoind.
+:note: The height of the snapshot's base block is not stored in the snapshot.
+    It is taken from the caller (e.g. the position of the iterator when dumping),
+    or looked up in a BlockChain.
+"""
+
+import struct
+import numpy as np
+
+from .misc import Bunch, deserialize_varlen_integer
+from ._track_c import UtxoSet
+from ._coins_c import deserialize_coin, serialize_coin
+
+from .loggers import get_logger
+logger = get_logger('snapshot', 'info')
+
+
+################################################################################
+# Format
+
+SNAPSHOT_MAGIC = b'utxo\xff'
+SNAPSHOT_VERSION = 2
+
+NETWORK_MAGICS = {
+    'main': bytes.fromhex('f9beb4d9'),
+    'test': bytes.fromhex('0b110907'),
+    'testnet4': bytes.fromhex('1c163f28'),
+    'signet': bytes.fromhex('0a03cf40'),
+    'regtest': bytes.fromhex('fabfb5da'),
+}
+
+# an upper bound on the size of a serialized coin (with its vout), which is
+# guaranteed to be buffered when reading the next coin
+MAX_COIN_SIZE = 2**16
+READ_CHUNK_SIZE = 2**24
+
+# the number of UTXOs dumped per pass (each pass exports a range of keys of the
+# set to temporary arrays)
+DUMP_UTXOS_PER_PASS = 2**22
+
+
+################################################################################
+# Loading
+
+def load_utxo_snapshot(filename, utxoset = None, block_height = None, blockchain = None, **utxoset_kwargs):
+    """
+    Load a UTXO snapshot into a UtxoSet.
+    :param utxoset: the UtxoSet to add the UTXOs to. If None, a new one is created,
+        using `utxoset_kwargs`.
+    :param block_height: the height of the snapshot's base block, if known
+    :param blockchain: a BlockChain, for looking up the height of the base block
+        (if `block_height` is not given)
+    :return: a (utxoset, metadata) pair. metadata is a Bunch with `version` (0 for
+        the legacy format), `network_magic`, `network` (None if unknown),
+        `base_block_hash`, `coins_count` and `block_height` (None if unknown).
+    :raise: KeyError if the base block is not in `blockchain`
+    """
+    if utxoset is None:
+        utxoset = UtxoSet(**utxoset_kwargs)
+    with open(filename, 'rb') as f:
+        reader = _SnapshotReader(f)
+        meta = _read_header(reader)
+        logger.info('loading %d UTXOs from snapshot of block %s' % (meta.coins_count, meta.base_block_hash[::-1].hex()))
+        if meta.version == 0:
+            _load_legacy_coins(reader, meta.coins_count, utxoset)
+        else:
+            _load_coins(reader, meta.coins_count, utxoset)
+    if block_height is None and blockchain is not None:
+        block_height = blockchain.get_by_hash(meta.base_block_hash).height
+    meta.block_height = block_height
+    return utxoset, meta
+
+def _read_header(reader):
+    reader.ensure(64)
+    if reader.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC:
+        version, = struct.unpack('<H', reader.read(2))
+        if version != SNAPSHOT_VERSION:
+            raise ValueError('Unsupported snapshot version: %s' % version)
+        network_magic = reader.read(4)
+    else:
+        # legacy format: no magic, no version, no network
+        reader.pos = 0
+        version = 0
+        network_magic = None
+    base_block_hash = reader.read(32)
+    coins_count, = struct.unpack('<Q', reader.read(8))
+    network = None
+    for name, magic in NETWORK_MAGICS.items():
+        if magic == network_magic:
+            network = name
+    return Bunch(
+        version = version,
+        network_magic = network_magic,
+        network = network,
+        base_block_hash = base_block_hash,
+        coins_count = coins_count,
+    )
+
+def _load_coins(reader, coins_count, utxoset):
+    # coins are grouped by txid: txid, num_coins, then (vout, coin) per coin
+    num_read = 0
+    while num_read < coins_count:
+        reader.ensure(MAX_COIN_SIZE)
+        txid = reader.read(32)
+        num_coins = reader.read_compact_size()
+        outputs = []
+        output_idxs = []
+        for _ in range(num_coins):
+            reader.ensure(MAX_COIN_SIZE)
+            output_idxs.append(reader.read_compact_size())
+            txout, height, _, consumed = deserialize_coin(reader.view())
+            reader.advance(consumed)
+            outputs.append(txout)
+        num_read += num_coins
+        if num_coins > 0:
+            utxoset.add(txid, outputs, height, output_idxs)
+
+def _load_legacy_coins(reader, coins_count, utxoset):
+    # coins are ordered by outpoint: txid, vout, coin per coin.
+    # consecutive coins of the same tx are grouped and added together
+    cur_txid = None
+    outputs = []
+    output_idxs = []
+    for _ in range(coins_count):
+        reader.ensure(MAX_COIN_SIZE)
+        txid = reader.read(32)
+        vout, = struct.unpack('<I', reader.read(4))
+        txout, height, _, consumed = deserialize_coin(reader.view())
+        reader.advance(consumed)
+        if txid != cur_txid:
+            if outputs:
+                utxoset.add(cur_txid, outputs, cur_height, output_idxs)
+            cur_txid, cur_height = txid, height
+            outputs = []
+            output_idxs = []
+        outputs.append(txout)
+        output_idxs.append(vout)
+    if outputs:
+        utxoset.add(cur_txid, outputs, cur_height, output_idxs)
+
+class _SnapshotReader:
+    """
+    Reads a snapshot file in big chunks, keeping at least `ensure()`-ed bytes
+    buffered, so coins can be deserialized directly from the buffer.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.buf = bytearray()
+        self.pos = 0
+        self.end = 0
+        self.eof = False
+
+    def ensure(self, n):
+        if self.end - self.pos >= n or self.eof:
+            return
+        data = self.f.read(max(n, READ_CHUNK_SIZE))
+        self.eof = len(data) < max(n, READ_CHUNK_SIZE)
+        # at EOF, zero-padded, so a truncated coin is never deserialized past the buffer
+        self.buf = self.buf[self.pos : self.end] + data + (bytes(MAX_COIN_SIZE) if self.eof else b'')
+        self.end = len(self.buf) - (MAX_COIN_SIZE if self.eof else 0)
+        self.pos = 0
+
+    def view(self):
+        return memoryview(self.buf)[self.pos:]
+
+    def advance(self, n):
+        self.pos += n
+        if self.pos > self.end:
+            raise ValueError('Truncated snapshot file')
+
+    def read(self, n):
+        data = bytes(self.buf[self.pos : self.pos + n])
+        self.advance(n)
+        return data
+
+    def read_compact_size(self):
+        value, consumed = deserialize_varlen_integer(self.view())
+        self.advance(consumed)
+        return value
+
+
+################################################################################
+# Dumping
+
+def dump_utxo_snapshot(utxoset, filename, base_block_hash, network_magic = NETWORK_MAGICS['main']):
+    """
+    Write the UTXOs in a UtxoSet to a file, in the format of bitcoind's UTXO
+    snapshots (version 2).
+    :param base_block_hash: the hash of the block the UtxoSet is up-to-date with
+    :return: the number of UTXOs written
+    :note: Txids are truncated (see module docstring). UTXOs of unknown height are
+        written with height 0. Scripts are written only if the UtxoSet includes
+        them (else, empty scripts are written).
+    """
+    if len(base_block_hash) != 32:
+        raise ValueError('base_block_hash must be 32 bytes long')
+    coins_count = utxoset.get_num_unspent_outputs()
+    logger.info('dumping %d UTXOs' % coins_count)
+    with open(filename, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(struct.pack('<H', SNAPSHOT_VERSION))
+        f.write(network_magic)
+        f.write(base_block_hash)
+        f.write(struct.pack('<Q', coins_count))
+        num_written = 0
+        for key_lo, key_hi in _get_key_ranges(utxoset.key_size, coins_count):
+            num_written += _dump_key_range(utxoset, f, key_lo, key_hi)
+    assert num_written == coins_count, (num_written, coins_count)
+    return num_written
+
+def _get_key_ranges(key_size, num_utxos):
+    # keys are uniformly distributed, so equal-width ranges hold similar numbers of UTXOs
+    num_passes = max(1, -(-num_utxos // DUMP_UTXOS_PER_PASS))
+    max_key = 2 ** (8 * key_size) - 1
+    bounds = [ max_key * i // num_passes for i in range(num_passes + 1) ]
+    for i in range(num_passes):
+        yield bounds[i] + (i > 0), bounds[i + 1]
+
+def _dump_key_range(utxoset, f, key_lo, key_hi):
+    arrays = utxoset._export(key_lo, key_hi, True, True)
+    order = np.lexsort((arrays.output_idx, arrays.check, arrays.key))
+    txids = arrays.txid[order]
+    # a new tx starts wherever the txid changes
+    is_new_tx = np.ones(len(order), dtype = bool)
+    is_new_tx[1:] = (txids[1:] != txids[:-1]).any(axis = 1)
+    is_new_tx = is_new_tx.tolist()
+    output_idxs = arrays.output_idx[order].tolist()
+    values = arrays.value[order].tolist()
+    block_heights = np.maximum(arrays.block_height[order], 0).tolist()
+    if arrays.script_data is not None:
+        script_data = arrays.script_data
+        script_starts = arrays.script_offset[:-1][order].tolist()
+        script_ends = arrays.script_offset[1:][order].tolist()
+    out = []
+    n = len(order)
+    i = 0
+    while i < n:
+        # a group of the UTXOs of a tx
+        j = i + 1
+        while j < n and not is_new_tx[j]:
+            j += 1
+        out.append(txids[i].tobytes())
+        out.append(_serialize_compact_size(j - i))
+        for idx in range(i, j):
+            if arrays.script_data is not None:
+                script = script_data[script_starts[idx] : script_ends[idx]].tobytes()
+            else:
+                script = b''
+            out.append(_serialize_compact_size(output_idxs[idx]))
+            out.append(serialize_coin(values[idx], script, block_heights[idx]))
+        i = j
+    f.write(b''.join(out))
+    return n
+
+def _serialize_compact_size(n):
+    if n < 0xfd:
+        return struct.pack('<B', n)
+    elif n <= 0xffff:
+        return b'\xfd' + struct.pack('<H', n)
+    elif n <= 0xffffffff:
+        return b'\xfe' + struct.pack('<I', n)
+    else:
+        return b'\xff' + struct.pack('<Q', n)
+
+################################################################################
@@ -0,0 +1,89 @@
+"""
+An on-disk index of the inputs spending each output ("spent-by" links), for
+walking the tx graph forward, without scanning the chain.
+
+`TxInput.spent_txid` and `TxInput.spent_output_idx` link a tx to the outputs it
+spends (backward).  This index links an output to the input spending it
+(forward).  The index is built during a normal tx scan, by passing it to
+TxIterator (or to any of its subclasses, e.g. a TrackedSpendingTxIterator)::
+
+    with SpentByIndex('spentbyindex') as spent_by_index:
+        for tx in iter_txs(spent_by_index = spent_by_index):
+            ...
+
+Along with a TxIndex, both directions are point lookups::
+
+    txindex = TxIndex('txindex')
+    spent_by_index = SpentByIndex('spentbyindex')
+    tx = txindex.get_tx(txid)
+    prev_tx = txindex.get_tx(tx.inputs[0].spent_txid)  # backward
+    next_tx, input_idx = spent_by_index.get_spending_tx(txid, 0)  # forward
+
+Like TxIndex, the index is stored as immutable sorted runs (see
+`txindex.SortedRunsIndex`).
+"""
+
+import numpy as np
+
+from .misc import hash_hex_to_bytes
+from .txindex import SortedRunsIndex, LOCATION_DTYPE, get_txid_prefix, read_tx
+
+
+################################################################################
+
+# an input spending an output: the location of the spending tx, the output
+# spent (its txid is the key), and the input
+SPENT_BY_DTYPE = np.dtype(LOCATION_DTYPE.descr + [
+    ( 'spent_output_idx', '<u4' ),
+    ( 'input_idx', '<u4' ),
+])
+
+
+class SpentByIndex(SortedRunsIndex):
+    """
+    An index mapping outputs (txid, output_idx) to the inputs spending them.
+    """
+
+    ENTRY_DTYPE = SPENT_BY_DTYPE
+
+    def _get_entries(self, tx, location):
+        if tx.is_coinbase:
+            return []
+        return [
+            ( get_txid_prefix(txin.spent_txid), location + ( txin.spent_output_idx, input_idx ) )
+            for input_idx, txin in enumerate(tx.inputs)
+        ]
+
+    def get_spenders(self, txid, output_idx = None):
+        """
+        :return: a structured array (of SPENT_BY_DTYPE) of the inputs spending the
+            outputs of the tx whose txid prefix matches `txid`'s (only output
+            `output_idx`, if specified), in height order.  The location of the
+            spending tx is given by `get_location(entry)`.
+        """
+        if isinstance(txid, str):
+            txid = hash_hex_to_bytes(txid)
+        entries = self._lookup(get_txid_prefix(txid))
+        if output_idx is not None:
+            entries = entries[entries['spent_output_idx'] == output_idx]
+        return entries
+
+    def get_spending_tx(self, txid, output_idx):
+        """
+        Read the tx spending an output from the `blk*.dat` file it is in.
+        :return: a ( tx, input_idx ) pair, or None if the output is unspent (as of
+            the last block indexed)
+        """
+        if isinstance(txid, str):
+            txid = hash_hex_to_bytes(txid)
+        for entry in self.get_spenders(txid, output_idx):
+            tx = read_tx(self.get_location(entry))
+            input_idx = int(entry['input_idx'])
+            if tx.inputs[input_idx].spent_txid == txid:
+                return tx, input_idx
+        return None
+
+    def is_spent(self, txid, output_idx):
+        return self.get_spending_tx(txid, output_idx) is not None
+
+################################################################################
@@ -0,0 +1,278 @@
+"""
+Per-file summaries of `blk*.dat` files, for skipping whole files when scanning
+a range of blocks.
+
+A summary of a file lists the blocks stored in it (their hashes, prev hashes,
+timestamps, heights and positions), and is written the first time the file is
+scanned.  On the following scans, a file all of whose blocks are outside the
+range of a BlockFilter is not read at all: its blocks are replaced by "stub
+blocks", made from the summary.  Stub blocks include everything needed for
+resolving the chain (hash, prev hash), so the longest chain is determined the
+same way, with or without skipping::
+
+    summaries = FileSummaries('summaries')
+    block_filter = BlockFilter(start_block_height = 800000)
+    for block in LongestChainBlockIterator(block_filter = block_filter, summaries = summaries):
+        ...
+
+:note: Skipping is only an optimization: if a stub block turns out to be
+    included by the BlockFilter, the actual block is read (alone).
+"""
+
+import os
+import datetime
+import numpy as np
+
+from .misc import bytes_to_hash_hex, FilePos
+
+from .loggers import get_logger
+logger = get_logger('summary', 'info')
+
+
+################################################################################
+
+SUMMARY_BLOCK_DTYPE = np.dtype([
+    ( 'block_hash', 'u1', (32,) ),
+    ( 'prev_block_hash', 'u1', (32,) ),
+    ( 'timestamp', '<u4' ),
+    ( 'height', '<i4' ),  # -1 if unresolved (i.e. an orphan, when the file was summarized)
+    ( 'offset', '<u8' ),  # where the block starts in the file (its magic)
+    ( 'rawsize', '<u4' ),
+])
+
+
+class FileSummary:
+    """
+    The summary of a single `blk*.dat` file.
+    """
+
+    def __init__(self, filename, file_size, blocks):
+        """
+        :param file_size: the size of the file when summarized
+        :param blocks: an array of SUMMARY_BLOCK_DTYPE, in storage order
+        """
+        self.filename = filename
+        self.file_size = file_size
+        self.blocks = blocks
+
+    @property
+    def num_blocks(self):
+        return len(self.blocks)
+
+    @property
+    def min_timestamp(self):
+        return int(self.blocks['timestamp'].min())
+
+    @property
+    def max_timestamp(self):
+        return int(self.blocks['timestamp'].max())
+
+    @property
+    def min_height(self):
+        heights = self.blocks['height']
+        heights = heights[heights >= 0]
+        return int(heights.min()) if len(heights) else -1
+
+    @property
+    def max_height(self):
+        return int(self.blocks['height'].max())
+
+    def contains_hash(self, block_hash):
+        return bool((self.blocks['block_hash'] == np.frombuffer(block_hash, dtype = np.uint8)).all(axis = 1).any())
+
+    def get_stub_blocks(self):
+        """
+        :return: a list of StubBlocks, of the blocks in the file, in storage order
+        """
+        blocks = self.blocks
+        return [
+            StubBlock(
+                block_hash = blocks['block_hash'][i].tobytes(),
+                prev_block_hash = blocks['prev_block_hash'][i].tobytes(),
+                timestamp_epoch = int(blocks['timestamp'][i]),
+                rawsize = int(blocks['rawsize'][i]),
+                filepos = FilePos(self.filename, int(blocks['offset'][i])),
+            )
+            for i in range(len(blocks))
+        ]
+
+    def __repr__(self):
+        return '<%s %s (%d blocks, #%d-#%d)>' % (
+            type(self).__name__, os.path.basename(self.filename), self.num_blocks, self.min_height, self.max_height)
+
+
+class FileSummaries:
+    """
+    A directory of FileSummaries, one file per `blk*.dat` file.
+    """
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        os.makedirs(dirname, exist_ok = True)
+        self._cache = {}  # filename -> FileSummary (or None if missing)
+
+    def get(self, filename):
+        """
+        :return: the summary of a `blk*.dat` file, or None if it was not summarized
+            (or was modified since)
+        """
+        if filename not in self._cache:
+            self._cache[filename] = self._load(filename)
+        summary = self._cache[filename]
+        if summary is not None and os.path.getsize(filename) != summary.file_size:
+            return None
+        return summary
+
+    def add(self, filename, blocks):
+        """
+        Summarize a `blk*.dat` file.
+        :param blocks: an array of SUMMARY_BLOCK_DTYPE
+        """
+        summary = FileSummary(filename, os.path.getsize(filename), blocks)
+        summary_filename = self._get_summary_filename(filename)
+        with open(summary_filename + '.tmp', 'wb') as f:
+            np.savez(f, blocks = blocks, file_size = summary.file_size)
+        os.replace(summary_filename + '.tmp', summary_filename)
+        self._cache[filename] = summary
+        logger.debug('summarized: %r' % summary)
+        return summary
+
+    def _load(self, filename):
+        summary_filename = self._get_summary_filename(filename)
+        if not os.path.exists(summary_filename):
+            return None
+        with np.load(summary_filename) as data:
+            return FileSummary(filename, int(data['file_size']), data['blocks'])
+
+    def _get_summary_filename(self, filename):
+        return os.path.join(self.dirname, os.path.basename(filename) + '.summary.npz')
+
+    # pickle support -- the cache is not included
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_cache'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def __repr__(self):
+        return '<%s %s>' % ( type(self).__name__, self.dirname )
+
+
+class FileSummaryBuilder:
+    """
+    Collects the blocks of the files being scanned, and summarizes each file
+    once the heights of its blocks are resolved.
+    """
+
+    # files with blocks still unresolved this many files later are summarized anyway
+    MAX_PENDING_FILES = 2
+
+    def __init__(self, summaries):
+        self.summaries = summaries
+        self._pending = {}  # filename -> list of block records (or None, if not collected from its start)
+        self._cur_filename = None
+
+    def add_block(self, block, filepos):
+        """
+        :return: True if the block is the first of a new file
+        """
+        filename = filepos.filename
+        is_new_file = filename != self._cur_filename
+        if is_new_file:
+            # blocks of a file are all read before the next file
+            self._cur_filename = filename
+            self._pending[filename] = [] if filepos.offset == 0 else None
+        records = self._pending[filename]
+        if records is not None:
+            records.append(( block.block_hash, block.prev_block_hash, block.timestamp_epoch, filepos.offset, block.rawsize ))
+        return is_new_file
+
+    def summarize_completed(self, height_by_hash):
+        """
+        Summarize the files completely read (all but the current), whose
+        block heights are resolved.
+        """
+        completed = [ filename for filename in self._pending if filename != self._cur_filename ]
+        for i, filename in enumerate(completed):
+            records = self._pending[filename]
+            if not records:
+                del self._pending[filename]
+                continue
+            heights = [ height_by_hash.get(record[0], -1) for record in records ]
+            is_old = len(completed) - i > self.MAX_PENDING_FILES
+            if -1 in heights and not is_old:
+                continue
+            blocks = np.zeros(len(records), dtype = SUMMARY_BLOCK_DTYPE)
+            for j, ( block_hash, prev_block_hash, timestamp, offset, rawsize ) in enumerate(records):
+                blocks[j] = ( np.frombuffer(block_hash, dtype = np.uint8), np.frombuffer(prev_block_hash, dtype = np.uint8),
+                              timestamp, heights[j], offset, rawsize )
+            self.summaries.add(filename, blocks)
+            del self._pending[filename]
+
+    def reset(self):
+        # e.g. after restoring from a checkpoint, mid-file
+        self._pending = {}
+        self._cur_filename = None
+
+
+################################################################################
+# Stub blocks
+
+class StubBlock:
+    """
+    A stand-in for a block in a skipped file.  It has the attributes needed for
+    resolving the chain and applying BlockFilters, but no txs.
+    """
+
+    __slots__ = [ 'block_hash', 'prev_block_hash', 'timestamp_epoch', 'rawsize', 'filepos', 'height' ]
+
+    def __init__(self, block_hash, prev_block_hash, timestamp_epoch, rawsize, filepos, height = -1):
+        self.block_hash = block_hash
+        self.prev_block_hash = prev_block_hash
+        self.timestamp_epoch = timestamp_epoch
+        self.rawsize = rawsize
+        self.filepos = filepos
+        self.height = height
+
+    @property
+    def timestamp(self):
+        return datetime.datetime.fromtimestamp(self.timestamp_epoch)
+
+    @property
+    def block_hash_hex(self):
+        return bytes_to_hash_hex(bytearray(self.block_hash))
+
+    def __repr__(self):
+        return '<%s #%d %s>' % ( type(self).__name__, self.height, self.block_hash_hex )
+
+
+def can_skip_file(summary, block_filter):
+    """
+    :return: True if all the blocks in a summarized file are excluded by a
+        BlockFilter (before its start, or after its stop)
+    """
+    if block_filter is None or block_filter.block_hash is not None:
+        return False
+    if block_filter.block_height is not None and summary.max_height >= 0:
+        start, stop = block_filter.block_height
+        if start is not None and summary.max_height < start:
+            return True
+        if stop is not None and summary.min_height >= stop:
+            return True
+    if block_filter.block_time is not None:
+        start, stop = [ _to_epoch(t) for t in block_filter.block_time ]
+        if start is not None and summary.max_timestamp < start:
+            return True
+        if stop is not None and summary.min_timestamp >= stop:
+            return True
+    return False
+
+def _to_epoch(t):
+    if isinstance(t, datetime.datetime):
+        return t.timestamp()
+    return t
+
+################################################################################
@@ -2,8 +2,11 @@
 Tools for scanning while tracking refs from inputs to the outputs they spend.
 """
 
-from .scan import TxIterator
-from ._track_c import UtxoSet
+from collections import deque
+
+from .scan import TxIterator, ReorgEvent, _get_first_tx_offset
+from .shard import ShardedUtxoSet
+from ._track_c import UtxoSet, pack_block_updates
 
 
 ################################################################################
@@ -18,27 +21,191 @@ class TxSpendingTracker:
     
         track = TxSpendingTracker()
         for block in iter_blocks():
-            for tx in track(block.txs):
+            for tx in track.process_block_txs_gen(block.txs):
                 for txinput in txinput:
                     print(txinput.spent_output)
             if len(track.utxoset) > N:
                 do_something(track.utxoset)
+    
+    Processing txs block by block (using `process_block_txs_gen`, or `begin_block`)
+    lets the UtxoSet resolve outputs created and spent within the same block
+    locally, which is faster.
+
+    With `num_shards`, the UTXOs are held by a ShardedUtxoSet, i.e. partitioned
+    across worker processes.  It is updated a block at a time, so txs should be
+    processed block by block (processing a single tx costs a round-trip to the
+    workers).  To keep the workers busy, blocks can be pipelined, using
+    `submit_block_txs()` and `collect_block()`.
+
+    With `undo_depth`, the changes made by the last blocks processed are kept,
+    so they can be undone (e.g. when blocks are disconnected by a reorg, see
+    `LongestChainBlockIterator(generate_unsafe_tail=True)`), using `undo_block()`.
         
     """
     
-    def __init__(self, utxoset = None):
+    # with a ShardedUtxoSet, the number of blocks kept in flight by the iterators
+    # (see `submit_block_txs()`)
+    PIPELINE_DEPTH = 4
+
+    def __init__(self, utxoset = None, num_shards = None, undo_depth = 0):
+        """
+        :param utxoset: a UtxoSet (or a ShardedUtxoSet)
+        :param num_shards: if set, and utxoset is None, use a ShardedUtxoSet with
+            this many worker processes
+        :param undo_depth: number of most recent blocks which can be undone
+            (not supported with a ShardedUtxoSet)
+        :raise: ValueError if `undo_depth` is set with a ShardedUtxoSet
+        """
         if utxoset is None:
-            utxoset = UtxoSet()
+            if num_shards is not None:
+                utxoset = ShardedUtxoSet(num_shards)
+            else:
+                utxoset = UtxoSet()
         self.utxoset = utxoset
+        self.is_sharded = isinstance(utxoset, ShardedUtxoSet)
+        if undo_depth and self.is_sharded:
+            raise ValueError('undo_depth is not supported with a ShardedUtxoSet')
+        self.undo_depth = undo_depth
+        # the changes made by each block: ( block_hash, txs created, outputs spent )
+        self._undo_journal = deque(maxlen = undo_depth) if undo_depth else None
         
     def process_tx(self, tx):
-        _track_tx_spending(tx, self.utxoset)
+        if self.is_sharded:
+            self.process_block_txs([ tx ])
+        else:
+            _track_tx_spending(tx, self.utxoset)
+            if self._undo_journal is not None:
+                self._journal_tx(tx)
+
+    def _journal_tx(self, tx):
+        if not self._undo_journal:
+            # a tx processed outside of a block
+            self._undo_journal.append(( None, [], [] ))
+        _, created, spent = self._undo_journal[-1]
+        created.append(( bytes(tx.txid), len(tx.outputs) ))
+        for txin in tx.inputs:
+            if not txin.is_coinbase:
+                spent.append(( bytes(txin._spent_txid), txin.spent_output_idx, txin.spending_info ))
         
     def process_txs_gen(self, tx_iter):
         for tx in tx_iter:
             self.process_tx(tx)
             yield tx
         
+    def process_block_txs_gen(self, tx_iter):
+        """
+        Same as `process_txs_gen`, for txs which all belong to the same block.
+        """
+        if self.is_sharded:
+            txs = list(tx_iter)
+            self.process_block_txs(txs)
+            yield from txs
+            return
+        self.begin_block()
+        yield from self.process_txs_gen(tx_iter)
+        self.end_block()
+
+    def process_block_txs(self, txs):
+        """
+        Process a list of txs which all belong to the same block.
+        """
+        if self.is_sharded:
+            self.submit_block_txs(txs)
+            self.utxoset.flush()
+            return
+        self.begin_block()
+        for tx in txs:
+            self.process_tx(tx)
+        self.end_block()
+
+    def submit_block_txs(self, txs):
+        """
+        Start processing a list of txs which all belong to the same block, without
+        waiting for the workers of the ShardedUtxoSet.  The `spending_info` of
+        the inputs is set once `collect_block()` returns.
+        Blocks are collected in the order they are submitted.  A block can spend
+        outputs of the blocks submitted before it (the workers apply the blocks
+        in order).
+        :raise: ValueError if the UtxoSet is not a ShardedUtxoSet
+        """
+        if not self.is_sharded:
+            raise ValueError('Submitting blocks requires a ShardedUtxoSet')
+        self.utxoset.submit(pack_block_updates(txs, self.utxoset.include_scripts))
+
+    def collect_block(self):
+        """
+        Wait for the oldest block submitted (see `submit_block_txs()`).
+        :raise: KeyError if one of its inputs spends an output which is not in the set
+        """
+        self.utxoset.collect()
+
+    @property
+    def num_pending_blocks(self):
+        """
+        The number of blocks submitted, and not yet collected.
+        """
+        return self.utxoset.num_pending if self.is_sharded else 0
+
+    def begin_block(self, block = None):
+        """
+        :param block: the block whose txs are processed next (used for verifying
+            the blocks undone match the ones processed)
+        """
+        self.utxoset.begin_block()
+        if self._undo_journal is not None:
+            self._undo_journal.append(( bytes(block.block_hash) if block is not None else None, [], [] ))
+
+    def end_block(self):
+        self.utxoset.end_block()
+
+    def undo_block(self, block = None):
+        """
+        Undo the changes made by the last block processed: remove the outputs it
+        created, and restore the outputs it spent.
+        :param block: if set, verify it is the last block processed
+        :raise: ValueError if there is no block to undo (more than `undo_depth`
+            blocks were undone)
+        """
+        if not self._undo_journal:
+            raise ValueError('No block to undo (undo_depth=%s)' % self.undo_depth)
+        block_hash, created, spent = self._undo_journal[-1]
+        if block is not None and block_hash is not None and block_hash != block.block_hash:
+            raise ValueError('Block to undo is not the last block processed: %s' % block.block_hash_hex)
+        self._undo_journal.pop()
+        utxoset = self.utxoset
+        utxoset.end_block()
+        # restore spent outputs (including outputs created by the block, which are
+        # removed below)
+        for txid, output_idx, spending_info in reversed(spent):
+            utxoset.restore(txid, output_idx, spending_info.spent_output, spending_info.block_height)
+        # remove the outputs created
+        for txid, num_outputs in created:
+            txid = bytearray(txid)
+            for output_idx in range(num_outputs):
+                try:
+                    utxoset.spend(txid, output_idx)
+                except KeyError:
+                    # e.g. an OP_RETURN output
+                    pass
+
+    def undo_reorg(self, event):
+        """
+        Undo the blocks disconnected by a ReorgEvent.
+        """
+        for block in event.disconnected_blocks:
+            self.undo_block(block)
+
+    def check_can_undo(self):
+        """
+        Check that blocks can be undone, e.g. before following the unsafe tail of
+        the chain (see `LongestChainBlockIterator(generate_unsafe_tail=True)`).
+        :raise: ValueError if the tracker is sharded, or has no `undo_depth`
+        """
+        if self.is_sharded:
+            raise ValueError('Undoing blocks (e.g. with generate_unsafe_tail=True) is not supported with a ShardedUtxoSet')
+        if not self.undo_depth:
+            raise ValueError('Undoing blocks (e.g. with generate_unsafe_tail=True) requires a tracker with an undo_depth')
+        
     def __call__(self, tx_iter):
         """
         For convenience (see class's docstring).
@@ -56,29 +223,101 @@ class TrackedSpendingTxIterator(TxIterator):
 
     :note: to track, requires maintaining a very big data structure of unspent tx outputs, thus
         this iterator can consume a lot of RAM (>6GB).
+
+    :note: With `generate_unsafe_tail=True`, the tracking of blocks disconnected
+        by a reorg is undone (the tracker must have an `undo_depth`).
     
     :note: This iterator is resumable and refreshable.
     """
+
+    # the undo_depth of the tracker created, with generate_unsafe_tail=True
+    DEFAULT_UNDO_DEPTH = 100
     
-    def __init__(self, tracker = None, utxoset = None, *args, **kwargs):
+    def __init__(self, tracker = None, utxoset = None, compact_filters = None, *args, **kwargs):
         """
         :param tracker: a TxSpendingTracker
         :param utxoset: a UtxoSet
+        :param compact_filters: a CompactFilters, to add the filters of the blocks to
+            (the UtxoSet must include scripts)
         :param args, kwargs: extra args to pass to `TxInput.__init__`
+        :raise: ValueError if the tracker cannot undo blocks, with
+            `generate_unsafe_tail=True` (see `TxSpendingTracker.check_can_undo()`)
         """
         super().__init__(*args, **kwargs)
+        generate_unsafe_tail = getattr(self.block_iter, 'generate_unsafe_tail', False)
         if tracker is None:
-            tracker = TxSpendingTracker(utxoset = utxoset)
+            undo_depth = self.DEFAULT_UNDO_DEPTH if generate_unsafe_tail else 0
+            tracker = TxSpendingTracker(utxoset = utxoset, undo_depth = undo_depth)
+        elif generate_unsafe_tail:
+            tracker.check_can_undo()
         self.tracker = tracker
+        self.compact_filters = compact_filters
+        self._blocks_ahead = deque()  # ( block, txs ), read and submitted to the shards, if sharded
         
     def __next__(self):
         tx = super().__next__()
-        return self._track(tx)
+        if type(tx) is ReorgEvent:
+            return tx
+        if not self.tracker.is_sharded:
+            # (if sharded, already tracked, with the rest of its block)
+            self._track(tx)
+        if self.compact_filters is not None:
+            self.compact_filters.add_tx(tx, self._block)
+        return tx
     
     def _track(self, tx):
         self.tracker.process_tx(tx)
         return tx
 
+    def _on_reorg(self, event):
+        super()._on_reorg(event)
+        self.tracker.undo_reorg(event)
+
+    def _get_iter_of_next_block(self):
+        if self.tracker.is_sharded:
+            return self._get_iter_of_next_block_sharded()
+        txs = super()._get_iter_of_next_block()
+        if self._reorg_event is not None:
+            return txs
+        # txs from a new block. (this also ends the previous block)
+        self.tracker.begin_block(self._block)
+        return txs
+
+    def _get_iter_of_next_block_sharded(self):
+        # blocks are read (and submitted to the shards) ahead, so the shards apply
+        # the next blocks while the txs of this one are generated
+        ahead = self._blocks_ahead
+        while len(ahead) < self.tracker.PIPELINE_DEPTH:
+            try:
+                block = self.block_iter.__next__()
+            except StopIteration:
+                if not ahead:
+                    raise
+                break
+            if type(block) is ReorgEvent:
+                # not reading past it
+                ahead.append(( block, None ))
+                break
+            txs = list(self._get_iter_of_block(block))
+            self.tracker.submit_block_txs(txs)
+            ahead.append(( block, txs ))
+        block, txs = ahead.popleft()
+        if type(block) is ReorgEvent:
+            self._on_reorg(block)
+            self._reorg_event = block
+            return iter(())
+        self.tracker.collect_block()
+        self._block = block
+        self._tx_idx = 0
+        self._tx_offset = _get_first_tx_offset(block)
+        return iter(txs)
+
+    def get_checkpoint_state(self):
+        if self.tracker.is_sharded:
+            # the blocks read ahead are already tracked
+            raise TypeError('Checkpointing is not supported with a ShardedUtxoSet')
+        return super().get_checkpoint_state()
+
 
 def _track_tx_spending(tx, utxoset):
     """
@@ -5,6 +5,10 @@ Many of the classes and functions importable from this module are defined
 and implemented using Cython, for speed.  See `_tx_c.pyx`.
 """
 
+import datetime
+
+from .misc import bytes_to_hash_hex
+
 # Make some names importable from this module:
 from ._tx_c import Tx, TxOutput, TxInput, CoinbaseTxInput
 from ._tx_c import deserialize_tx, deserialize_tx_input, deserialize_tx_output
@@ -25,7 +29,8 @@ class TxInBlock:
         anywhere a `Tx` is needed.
     :note: This class keeps a reference to a `Block` object, so can potentially
         prevent it from being deallocated, which can cause memory consumption
-        to blow up.
+        to blow up.  To avoid that, use a `BlockContext` instead of the block
+        (`include_block_context='light'`).
     """
     
     __slots__ = [ 'tx', 'block', 'index' ]
@@ -34,7 +39,7 @@ class TxInBlock:
     def __init__(self, tx, block, index):
         """
         :param tx: a `Tx`.
-        :param block: a `Block`.
+        :param block: a `Block` (or a `BlockContext`).
         :param index: the index of the tx in the block.
         """
         self.tx = tx
@@ -54,4 +59,49 @@ class TxInBlock:
     def __dir__(self):
         return super().__dir__() + dir(self.tx)
 
+class BlockContext:
+    """
+    A small, immutable stand-in for a `Block`, in a `TxInBlock`: the block's
+    height, hash and timestamp, without its data.
+
+    Unlike a `Block`, which references the data of the whole `blk*.dat` file it
+    was read from, keeping a BlockContext costs a few dozens of bytes.
+    """
+
+    __slots__ = [ 'height', 'block_hash', 'timestamp_epoch' ]
+
+    def __init__(self, height, block_hash, timestamp_epoch):
+        object.__setattr__(self, 'height', height)
+        object.__setattr__(self, 'block_hash', bytes(block_hash))
+        object.__setattr__(self, 'timestamp_epoch', timestamp_epoch)
+
+    @classmethod
+    def from_block(cls, block):
+        return cls(block.height, block.block_hash, block.timestamp_epoch)
+
+    @property
+    def timestamp(self):
+        return datetime.datetime.fromtimestamp(self.timestamp_epoch)
+
+    @property
+    def block_hash_hex(self):
+        return bytes_to_hash_hex(bytearray(self.block_hash))
+
+    def __setattr__(self, attr, value):
+        raise AttributeError('%s is immutable' % type(self).__name__)
+
+    def __eq__(self, other):
+        if not isinstance(other, BlockContext):
+            return NotImplemented
+        return ( self.height, self.block_hash ) == ( other.height, other.block_hash )
+
+    def __hash__(self):
+        return hash(self.block_hash)
+
+    def __repr__(self):
+        return '<%s #%d %s>' % ( type(self).__name__, self.height, self.block_hash_hex )
+
+    def __reduce__(self):
+        return ( BlockContext, ( self.height, self.block_hash, self.timestamp_epoch ) )
+
 ################################################################################
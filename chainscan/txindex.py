@@ -0,0 +1,475 @@
+"""
+An on-disk index of the locations of txs, for fetching specific txs without
+scanning the chain.
+
+The index is built during a normal tx scan, by passing it to TxIterator::
+
+    with TxIndex('txindex') as txindex:
+        for tx in iter_txs(txindex = txindex):
+            ...
+
+    tx = TxIndex('txindex').get_tx(txid)
+
+A tx is located using a prefix of its txid (the txid itself is verified when the
+tx is read).  The index is stored as a set of immutable sorted "runs", each
+made of a file of keys (which lookups binary-search) and a file of entries.
+New entries are buffered in memory and written as a new run when flushed.  When
+there are too many runs, they are merged into one.
+
+Buffered entries are written by `close()` (or on exiting a `with` block).  As a
+safety net, an index which is garbage-collected or still open at interpreter
+exit is flushed too, but `close()` should not be relied upon implicitly: an
+index dropped by an exception can be flushed at an arbitrary point.
+
+Building an existing index further (e.g. after bitcoind downloaded more blocks)
+is done by scanning from the block following the last block indexed::
+
+    txindex = TxIndex('txindex')
+    block_filter = BlockFilter(start_block_height = txindex.height + 1)
+    for tx in iter_txs(txindex = txindex, block_filter = block_filter):
+        ...
+"""
+
+import os
+import json
+import atexit
+import weakref
+import numpy as np
+
+from .misc import Bunch, hash_hex_to_bytes
+from .tx import deserialize_tx
+
+from .loggers import get_logger
+logger = get_logger('txindex', 'info')
+
+
+################################################################################
+
+# the location of a tx
+LOCATION_DTYPE = np.dtype([
+    ( 'file_idx', '<u4' ),  # index into the index's list of filenames
+    ( 'tx_size', '<u4' ),
+    ( 'block_offset', '<u8' ),  # where the block starts in the file (its magic)
+    ( 'tx_offset', '<u4' ),  # where the tx starts in the block (after the magic and size)
+    ( 'height', '<i4' ),
+])
+
+# the index of the height in entries (ENTRY_DTYPEs start with the LOCATION_DTYPE fields)
+HEIGHT_FIELD_IDX = LOCATION_DTYPE.names.index('height')
+
+# the size of the magic and size fields preceding a block in a `blk*.dat` file
+BLOCK_PREFIX_SIZE = 8
+
+def get_txid_prefix(txid):
+    return int.from_bytes(txid[:8], 'little')
+
+# the indexes which may have buffered entries, flushed at exit
+_open_indexes = weakref.WeakSet()
+
+@atexit.register
+def _flush_open_indexes():
+    for index in list(_open_indexes):
+        index._flush_if_buffered()
+
+
+################################################################################
+# Sorted runs
+
+class SortedRunsIndex:
+    """
+    A base class for on-disk indexes of txs, built during a tx scan, and stored
+    as immutable runs of entries sorted by (uint64) keys.
+
+    Within a key, entries are kept in the order they were added (i.e., in height
+    order).
+
+    Subclasses define ENTRY_DTYPE (which includes the LOCATION_DTYPE fields), and
+    `_get_entries()`.
+    """
+
+    ENTRY_DTYPE = None
+    FORMAT_VERSION = 1
+    FLUSH_SIZE = 2**20
+    MAX_RUNS = 16
+    MERGE_CHUNK_SIZE = 2**22
+
+    def __init__(self, dirname, flush_size = None, max_runs = None):
+        """
+        :param dirname: the directory the index is stored in (created if missing)
+        :param flush_size: the number of entries to buffer before writing a new run
+        :param max_runs: the number of runs above which runs are merged
+        """
+        self.dirname = dirname
+        self.flush_size = flush_size if flush_size is not None else self.FLUSH_SIZE
+        self.max_runs = max_runs if max_runs is not None else self.MAX_RUNS
+        os.makedirs(dirname, exist_ok = True)
+
+        # stored state
+        self._filenames = []  # the blk*.dat files referenced by entries
+        self._run_ids = []
+        self._stored_height = -1  # the max height in the runs
+        self._next_run_id = 0
+        self._load_meta()
+        self._filename_idxs = { filename: i for i, filename in enumerate(self._filenames) }
+        self._runs = [ self._open_run(run_id) for run_id in self._run_ids ]
+
+        # buffered entries
+        self._buf = {}  # key -> list of entries, in the order added
+        self._buf_size = 0
+        self._buf_height = -1
+        self._cur_block = None  # the block txs are being added from
+        self._cur_entries = []  # ( key, entry ) pairs of _cur_block, buffered once it is complete
+        self._cur_num_txs = 0
+        self._auto_flush = True  # (unpickled copies are never flushed implicitly)
+        _open_indexes.add(self)
+
+    @property
+    def height(self):
+        """
+        The height of the last block indexed (-1 if none).
+        """
+        return max(self._stored_height, self._buf_height)
+
+    def __len__(self):
+        return sum( len(keys) for keys, _ in self._runs ) + self._buf_size + len(self._cur_entries)
+
+    ###################
+    # Building
+
+    def add_tx(self, tx, block, tx_offset):
+        """
+        Add the entries of a tx.
+        :param block: the block the tx is in. Its `filepos` must be set.
+        :param tx_offset: the offset of the tx in the block's data
+        :note: txs of blocks already indexed are ignored.
+        :note: A block's entries are only buffered (and flushed) once all its txs
+            are added, so the blocks in the index (up to `height`) are complete.
+            The entries of a block left incomplete (e.g. the index is closed
+            mid-block) are dropped.
+        """
+        height = block.height
+        if block is not self._cur_block:
+            self._cur_block = None
+            self._cur_entries = []
+            self._cur_num_txs = 0
+            if height <= self.height:
+                return
+            if block.filepos is None:
+                raise ValueError('Location of block is unknown: %s' % block.block_hash_hex)
+            self._cur_block = block
+        filepos = block.filepos
+        location = ( self._get_file_idx(filepos.filename), tx.rawsize, filepos.offset, tx_offset, height )
+        self._cur_entries.extend(self._get_entries(tx, location))
+        self._cur_num_txs += 1
+        if self._cur_num_txs == block.num_txs:
+            self._end_block()
+
+    def undo_reorg(self, event):
+        """
+        Forget the blocks disconnected by a ReorgEvent (with
+        `generate_unsafe_tail=True`), so that the blocks replacing them are added.
+        :note: Only buffered entries are removed.  The entries of disconnected
+            blocks which were already flushed remain in the runs, so lookups can
+            return stale entries (e.g. `TxIndex.get_locations()` can return the
+            location of a tx in a disconnected block as well).
+        """
+        fork_height = event.fork_block.height
+        self._cur_block = None
+        self._cur_entries = []
+        self._cur_num_txs = 0
+        if self._buf_height > fork_height:
+            buf = {}
+            for key, entries in self._buf.items():
+                entries = [ entry for entry in entries if entry[HEIGHT_FIELD_IDX] <= fork_height ]
+                if entries:
+                    buf[key] = entries
+            self._buf = buf
+            self._buf_size = sum( len(entries) for entries in buf.values() )
+            self._buf_height = fork_height
+        if self._stored_height > fork_height:
+            self._stored_height = fork_height
+            # (so the disconnected blocks are not skipped after a restart)
+            self._save_meta()
+
+    def _end_block(self):
+        # the current block is complete. buffer its entries
+        buf = self._buf
+        for key, entry in self._cur_entries:
+            buf.setdefault(key, []).append(entry)
+        self._buf_size += len(self._cur_entries)
+        self._buf_height = max(self._buf_height, self._cur_block.height)
+        self._cur_block = None
+        self._cur_entries = []
+        self._cur_num_txs = 0
+        if self._buf_size >= self.flush_size:
+            self.flush()
+
+    def _get_entries(self, tx, location):
+        """
+        :param location: the tx's location, a tuple of the LOCATION_DTYPE fields
+        :return: an iterable of ( key, entry ) pairs, where entry is a tuple of
+            the ENTRY_DTYPE fields
+        """
+        raise NotImplementedError
+
+    def _get_file_idx(self, filename):
+        file_idx = self._filename_idxs.get(filename)
+        if file_idx is None:
+            file_idx = len(self._filenames)
+            self._filenames.append(filename)
+            self._filename_idxs[filename] = file_idx
+        return file_idx
+
+    def flush(self):
+        """
+        Write the buffered entries (of complete blocks) as a new run.
+        """
+        if self._buf:
+            keys = sorted(self._buf)
+            entries = np.array([ entry for key in keys for entry in self._buf[key] ], dtype = self.ENTRY_DTYPE)
+            keys = np.repeat(np.array(keys, dtype = np.uint64), [ len(self._buf[key]) for key in keys ])
+            run_id = self._write_run([ ( keys, entries ) ])
+            self._run_ids.append(run_id)
+            self._runs.append(self._open_run(run_id))
+            self._stored_height = self.height
+            self._buf = {}
+            self._buf_size = 0
+            self._buf_height = -1
+        old_run_ids = []
+        if len(self._run_ids) > self.max_runs:
+            old_run_ids = self._merge_runs()
+        self._save_meta()
+        # removed only after the metadata no longer references them
+        for run_id in old_run_ids:
+            for filename in self._get_run_filenames(run_id):
+                os.remove(filename)
+
+    def close(self):
+        """
+        Flush the buffered entries.
+        :note: Entries added after the last flush are only written when the index
+            is flushed or closed, so an index being built must be closed (or used
+            in a `with` block).  If it is closed mid-block, that block is not
+            indexed (see `add_tx()`), and is indexed whole when resuming from
+            `height + 1`.
+        """
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _flush_if_buffered(self):
+        if self._auto_flush and self._buf:
+            logger.warning('%r was not closed. flushing %d buffered entries' % ( self, self._buf_size ))
+            self.flush()
+
+    def __del__(self):
+        # (not set if __init__ failed)
+        if getattr(self, '_buf', None):
+            self._flush_if_buffered()
+
+    def _merge_runs(self):
+        """
+        Merge all runs into one, in bounded memory: the key space is split into
+        ranges, each holding about MERGE_CHUNK_SIZE entries (keys are hashes, so
+        roughly uniform), and the runs' slices of each range are merged and
+        written in turn.
+        """
+        logger.debug('merging %d runs' % len(self._runs))
+        num_chunks = max(1, -(-len(self) // self.MERGE_CHUNK_SIZE))
+        bounds = [ 2**64 * i // num_chunks for i in range(num_chunks) ]
+        def gen_chunks():
+            for i in range(num_chunks):
+                keys = []
+                entries = []
+                for run_keys, run_entries in self._runs:
+                    lo = np.searchsorted(run_keys, np.uint64(bounds[i]), 'left')
+                    hi = np.searchsorted(run_keys, np.uint64(bounds[i + 1]), 'left') if i + 1 < num_chunks else len(run_keys)
+                    keys.append(run_keys[lo:hi])
+                    entries.append(run_entries[lo:hi])
+                # runs are in height order, so a stable sort keeps the entries of a key in height order
+                keys = np.concatenate(keys)
+                entries = np.concatenate(entries)
+                order = np.argsort(keys, kind = 'stable')
+                yield keys[order], entries[order]
+        run_id = self._write_run(gen_chunks())
+        old_run_ids = self._run_ids
+        self._run_ids = [ run_id ]
+        self._runs = [ self._open_run(run_id) ]
+        return old_run_ids
+
+    ###################
+    # Lookup
+
+    def _lookup(self, key):
+        """
+        :return: an array of the entries of `key`, in the order they were added
+        """
+        res = []
+        for keys, entries in self._runs:
+            lo = np.searchsorted(keys, np.uint64(key), 'left')
+            hi = np.searchsorted(keys, np.uint64(key), 'right')
+            res.append(entries[lo:hi])
+        res.append(np.array(self._buf.get(key, []), dtype = self.ENTRY_DTYPE))
+        # (the current block's, at most one block)
+        res.append(np.array([ entry for cur_key, entry in self._cur_entries if cur_key == key ], dtype = self.ENTRY_DTYPE))
+        return np.concatenate(res)
+
+    def get_location(self, entry):
+        """
+        :return: the location of the tx of an entry, as a Bunch with `filename`,
+            `block_offset`, `tx_offset`, `tx_size` and `height` (which can be read
+            using `read_tx()`)
+        """
+        return Bunch(
+            filename = self._filenames[int(entry['file_idx'])],
+            block_offset = int(entry['block_offset']),
+            tx_offset = int(entry['tx_offset']),
+            tx_size = int(entry['tx_size']),
+            height = int(entry['height']),
+        )
+
+    ###################
+    # Storage
+
+    def _get_run_filenames(self, run_id):
+        base = os.path.join(self.dirname, 'run-%06d' % run_id)
+        return base + '.keys', base + '.entries'
+
+    def _write_run(self, chunks):
+        """
+        :param chunks: an iterable of ( keys, entries ) pairs, of consecutive
+            parts of the run
+        """
+        run_id = self._next_run_id
+        self._next_run_id += 1
+        keys_filename, entries_filename = self._get_run_filenames(run_id)
+        with open(keys_filename, 'wb') as keys_file, open(entries_filename, 'wb') as entries_file:
+            for keys, entries in chunks:
+                keys_file.write(keys.tobytes())
+                entries_file.write(entries.tobytes())
+            for f in [ keys_file, entries_file ]:
+                f.flush()
+                os.fsync(f.fileno())
+        return run_id
+
+    def _open_run(self, run_id):
+        keys_filename, entries_filename = self._get_run_filenames(run_id)
+        return (
+            np.memmap(keys_filename, dtype = np.uint64, mode = 'r'),
+            np.memmap(entries_filename, dtype = self.ENTRY_DTYPE, mode = 'r'),
+        )
+
+    def _get_meta_filename(self):
+        return os.path.join(self.dirname, 'meta.json')
+
+    def _load_meta(self):
+        filename = self._get_meta_filename()
+        if not os.path.exists(filename):
+            return
+        with open(filename) as f:
+            meta = json.load(f)
+        if meta['version'] != self.FORMAT_VERSION:
+            raise ValueError('Unsupported %s format version: %s' % (type(self).__name__, meta['version']))
+        self._filenames = meta['filenames']
+        self._run_ids = meta['run_ids']
+        self._stored_height = meta['height']
+        self._next_run_id = meta['next_run_id']
+
+    def _save_meta(self):
+        meta = dict(
+            version = self.FORMAT_VERSION,
+            filenames = self._filenames,
+            run_ids = self._run_ids,
+            height = self._stored_height,
+            next_run_id = self._next_run_id,
+        )
+        filename = self._get_meta_filename()
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(filename + '.tmp', filename)
+
+    # pickle support -- memory-mapped runs are reopened
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_runs']
+        state['_cur_block'] = None
+        state['_cur_entries'] = []
+        state['_cur_num_txs'] = 0
+        state['_auto_flush'] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._runs = [ self._open_run(run_id) for run_id in self._run_ids ]
+
+    def __repr__(self):
+        return '<%s %s (%d runs, up to block #%d)>' % ( type(self).__name__, self.dirname, len(self._runs), self.height )
+
+
+################################################################################
+# TxIndex
+
+class TxIndex(SortedRunsIndex):
+    """
+    An index mapping txids to the locations of the txs in `blk*.dat` files.
+    """
+
+    ENTRY_DTYPE = LOCATION_DTYPE
+
+    def _get_entries(self, tx, location):
+        return [ ( get_txid_prefix(tx.txid), location ) ]
+
+    def get_locations(self, txid):
+        """
+        :return: the locations of the txs whose txid prefix matches `txid`'s
+            (see `get_location()`).
+        :note: Normally, there is at most one match.  More than one means
+            either a prefix collision, or a tx appearing more than once in the
+            chain (there are two such coinbase txs).
+        """
+        if isinstance(txid, str):
+            txid = hash_hex_to_bytes(txid)
+        return [ self.get_location(entry) for entry in self._lookup(get_txid_prefix(txid)) ]
+
+    def get_tx(self, txid):
+        """
+        Read a tx from the `blk*.dat` file it is in.
+        :param txid: the txid, as bytes or as a hex string
+        :return: a `Tx`
+        :raise: KeyError if the tx is not in the index
+        """
+        if isinstance(txid, str):
+            txid = hash_hex_to_bytes(txid)
+        for location in self.get_locations(txid):
+            tx = read_tx(location)
+            if tx.txid == txid:
+                return tx
+        raise KeyError(txid)
+
+    def __contains__(self, txid):
+        try:
+            self.get_tx(txid)
+        except KeyError:
+            return False
+        return True
+
+
+################################################################################
+
+def read_tx(location):
+    """
+    Read a single tx, given its location (e.g. as returned by `TxIndex.get_locations()`),
+    without reading the rest of its block.
+    """
+    with open(location.filename, 'rb') as f:
+        blob = os.pread(f.fileno(), location.tx_size, location.block_offset + BLOCK_PREFIX_SIZE + location.tx_offset)
+    if len(blob) < location.tx_size:
+        raise ValueError('Truncated tx at %s, offset %s' % (location.filename, location.block_offset))
+    return deserialize_tx(bytearray(blob))
+
+################################################################################
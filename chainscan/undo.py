@@ -0,0 +1,230 @@
+"""
+Tools for resolving spent outputs using bitcoind's undo files (`rev*.dat`).
+
+For each block it connects, bitcoind stores the outputs spent by the block's txs
+("undo data") in `rev*.dat` files, next to the `blk*.dat` files.  Reading the undo
+data of a block resolves the outputs spent by its txs, with no need to track
+spending (and maintain the huge UtxoSet).
+
+The undo data of a block stored in `blkNNNNN.dat` is stored in `revNNNNN.dat`, but
+not necessarily in the same order.  Each undo record ends with a checksum, which
+depends on the hash of the previous block (see bitcoind's `UndoWriteToDisk`), so
+records are matched to blocks using it.
+"""
+
+import os
+import pickle
+from collections import OrderedDict
+import numpy as np
+
+from .defs import MAGIC, MAGIC_ABORT
+from .misc import FilePos, bytes2uint32, doublehash, deserialize_varlen_integer
+from .scan import TxIterator, ReorgEvent
+from ._coins_c import deserialize_block_undo
+
+from .loggers import get_logger
+logger = get_logger('undo', 'info')
+
+
+################################################################################
+# Locating undo data
+
+class UndoIndex:
+    """
+    Locates the undo data of blocks in the `rev*.dat` files, and reads it.
+
+    Undo files are indexed lazily: the records in an undo file are parsed the
+    first time undo data of a block from the corresponding `blk*.dat` file is
+    requested.  Records are matched to blocks (using their checksums) as blocks
+    are requested.  The block-to-undo-position mapping built this way can be
+    saved, and loaded in later runs.
+
+    :note: Blocks must have their `filepos` set (i.e. be generated by the block
+        iterators in this package, which set it).
+    """
+
+    RAW_FILE_PREFIX = 'blk'
+    UNDO_FILE_PREFIX = 'rev'
+    MAX_CACHED_FILES = 2
+
+    def __init__(self):
+        self._positions = {}  # block_hash -> FilePos of the undo record
+        self._unmatched = {}  # undo_filename -> { num_txs: [ (offset, size), ... ] }
+        self._parsed_sizes = {}  # undo_filename -> offset up to which records were parsed
+        self._blobs = OrderedDict()  # undo_filename -> blob (a small cache of file data)
+
+    def get_block_undo(self, block):
+        """
+        :return: the block's undo data: a list with an element per non-coinbase tx
+            in the block, each a list of the spending_info objects of its inputs.
+        :raise: KeyError if not found
+        """
+        if block.num_txs <= 1:
+            # no inputs to resolve (also, bitcoind writes no undo data for genesis)
+            return []
+        filepos = self.locate(block)
+        blob = self._get_blob(filepos.filename)
+        size = bytes2uint32(blob[filepos.offset + 4 : ], 4)
+        data = blob[filepos.offset + 8 : filepos.offset + 8 + size]
+        return deserialize_block_undo(data)
+
+    def locate(self, block):
+        """
+        :return: a FilePos of the undo record of the block.
+        :raise: KeyError if not found
+        """
+        block_hash = block.block_hash
+        filepos = self._positions.get(block_hash)
+        if filepos is None:
+            if block.filepos is None:
+                raise KeyError('Location of block is unknown: %s' % block.block_hash_hex)
+            undo_filename = self.get_undo_filename(block.filepos.filename)
+            filepos = self._match(block, undo_filename)
+            if filepos is None:
+                # maybe the file has grown since we parsed it
+                self._parse_file(undo_filename, reread = True)
+                filepos = self._match(block, undo_filename)
+            if filepos is None:
+                raise KeyError('Undo data not found for block: %s' % block.block_hash_hex)
+            self._positions[block_hash] = filepos
+        return filepos
+
+    @classmethod
+    def get_undo_filename(cls, raw_filename):
+        dirname, basename = os.path.split(raw_filename)
+        assert basename.startswith(cls.RAW_FILE_PREFIX), raw_filename
+        return os.path.join(dirname, cls.UNDO_FILE_PREFIX + basename[len(cls.RAW_FILE_PREFIX):])
+
+    def _match(self, block, undo_filename):
+        if undo_filename not in self._unmatched:
+            self._parse_file(undo_filename)
+        candidates = self._unmatched[undo_filename].get(block.num_txs - 1, [])
+        blob = self._get_blob(undo_filename)
+        # the checksum is of the hash of the block's parent, followed by the data
+        prev_block_hash = bytearray(block.prev_block_hash)
+        for i, (offset, size) in enumerate(candidates):
+            data = blob[offset + 8 : offset + 8 + size]
+            checksum = bytes(blob[offset + 8 + size : offset + 8 + size + 32])
+            if doublehash(prev_block_hash + bytearray(data)) == checksum:
+                del candidates[i]
+                return FilePos(undo_filename, offset)
+        return None
+
+    def _parse_file(self, undo_filename, reread = False):
+        """
+        Parse the records in the file, and add them to the unmatched records.
+        """
+        blob = self._get_blob(undo_filename, reread = reread)
+        unmatched = self._unmatched.setdefault(undo_filename, {})
+        offset = self._parsed_sizes.get(undo_filename, 0)
+        while offset + 8 <= len(blob):
+            magic = bytes2uint32(blob[offset : ], 4)
+            if magic == MAGIC_ABORT:
+                # past last record
+                break
+            assert magic == MAGIC, ( 'Invalid MAGIC. Data corrupted?', undo_filename, offset, magic )
+            size = bytes2uint32(blob[offset + 4 : ], 4)
+            if offset + 8 + size + 32 > len(blob):
+                # record not fully written yet
+                break
+            num_txs, _ = deserialize_varlen_integer(blob[offset + 8 : ])
+            unmatched.setdefault(num_txs, []).append(( offset, size ))
+            offset += 8 + size + 32
+        self._parsed_sizes[undo_filename] = offset
+        logger.debug('parsed undo file %s (up to offset %s)', undo_filename, offset)
+
+    def _get_blob(self, undo_filename, reread = False):
+        blobs = self._blobs
+        blob = None if reread else blobs.get(undo_filename)
+        if blob is None:
+            logger.debug('reading: %s', undo_filename)
+            # a writable buffer (see RawDataIterator)
+            blob = np.fromfile(undo_filename, dtype = np.uint8)
+            blobs[undo_filename] = blob
+            while len(blobs) > self.MAX_CACHED_FILES:
+                blobs.popitem(last = False)
+        blobs.move_to_end(undo_filename)
+        return blob
+
+    # persistence
+
+    def save(self, filename):
+        """
+        Save the block-to-undo-position mapping (and unmatched records), so it can
+        be loaded in later runs, with no need to re-index.
+        """
+        with open(filename, 'wb') as f:
+            pickle.dump(self, f)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+
+    # pickle support -- the cached file data is not included
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_blobs'] = OrderedDict()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def __repr__(self):
+        return '<%s (%d blocks located)>' % ( type(self).__name__, len(self._positions) )
+
+
+################################################################################
+# TxIterator with spending resolved from undo data
+
+class UndoSpendingTxIterator(TxIterator):
+    """
+    A TxIterator which resolves references from a TxInput to the TxOutput it spends,
+    using bitcoind's undo files.
+
+    Same as TrackedSpendingTxIterator, but instead of tracking spending (which
+    requires maintaining a very big data structure of unspent outputs in RAM), it
+    reads the outputs spent by each block from bitcoind's `rev*.dat` files.
+
+    Element type is `Tx`.
+
+    :note: This iterator is resumable and refreshable.
+    """
+
+    def __init__(self, undo_index = None, compact_filters = None, *args, **kwargs):
+        """
+        :param undo_index: an UndoIndex
+        :param compact_filters: a CompactFilters, to add the filters of the blocks to
+        :param args, kwargs: extra args to pass to `TxIterator.__init__`
+        """
+        super().__init__(*args, **kwargs)
+        if undo_index is None:
+            undo_index = UndoIndex()
+        self.undo_index = undo_index
+        self.compact_filters = compact_filters
+
+        # state
+        self._block_undo = []
+
+    def __next__(self):
+        tx = super().__next__()
+        if type(tx) is ReorgEvent:
+            return tx
+        tx_idx = self._tx_idx - 1  # the index of tx in its block
+        if tx_idx > 0:
+            # not the coinbase tx
+            for txin, spending_info in zip(tx.inputs, self._block_undo[tx_idx - 1]):
+                txin.spending_info = spending_info
+        if self.compact_filters is not None:
+            self.compact_filters.add_tx(tx, self._block)
+        return tx
+
+    def _get_iter_of_block(self, block):
+        block_undo = self.undo_index.get_block_undo(block)
+        if len(block_undo) != block.num_txs - 1:
+            raise ValueError('Undo data does not match block %s' % block.block_hash_hex)
+        self._block_undo = block_undo
+        return super()._get_iter_of_block(block)
+
+################################################################################
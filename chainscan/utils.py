@@ -2,12 +2,14 @@
 Miscellaneous convenience functions for iterating over blocks, txs, etc.
 """
 
+import os
 import time
 import threading
 
 from .scan import LongestChainBlockIterator, TxIterator
 from .track import TrackedSpendingTxIterator, UtxoSet
-from .blockchain import BlockChainIterator
+from .undo import UndoSpendingTxIterator
+from .blockchain import BlockChain, BlockChainIterator
 
 
 ################################################################################
@@ -25,17 +27,26 @@ def iter_blocks(block_iter = None, **kwargs):
         block_iter = LongestChainBlockIterator(**kwargs)
     return block_iter
 
-def get_blockchain(blockchain_iter = None, **kwargs):
+def get_blockchain(blockchain_iter = None, dirname = None, **kwargs):
     """
     :param blockchain_iter: a BlockChainIterator
+    :param dirname: a directory to persist the BlockChain in. If it was saved
+        there before, it is loaded, extended with the blocks following its last
+        block (reading the blk files from where its last blocks are stored), and
+        saved back (only the new blocks are written).
     :param kwargs: extra kwargs for BlockChainIterator (ignored unless blockchain_iter is None)
     :return: a BlockChain
     """
     if blockchain_iter is None:
+        if dirname is not None and os.path.exists(os.path.join(dirname, 'meta.json')):
+            kwargs['blockchain'] = BlockChain.load(dirname)
         blockchain_iter = BlockChainIterator(**kwargs)
     # blockchain_iter builds the block chain as we iterate over it
     for _ in blockchain_iter: pass
-    return blockchain_iter.blockchain
+    blockchain = blockchain_iter.blockchain
+    if dirname is not None:
+        blockchain.save(dirname)
+    return blockchain
 
 
 ################################################################################
@@ -46,6 +57,8 @@ def iter_txs(
         track_scripts = False,
         tracker = None,
         utxoset = None,
+        use_undo_files = False,
+        undo_index = None,
         block_iter = None,
         blockchain = None,
         block_kwargs = {},
@@ -61,6 +74,10 @@ def iter_txs(
     :param track_scripts: when resolving spent_output, also include its script. track_scripts=True
         implies track_spending=True. (ignored unless utxoset is None)
     :param tracker, utxoset: ignored unless track_spending=True
+    :param use_undo_files: resolve spent_output for each TxInput (like track_spending=True) by
+        reading bitcoind's undo files, instead of tracking (will use UndoSpendingTxIterator).
+        Requires much less RAM than tracking.
+    :param undo_index: ignored unless use_undo_files=True
     :param block_iter: a LongestChainBlockIterator
     :param blockchain: a BlockChain object to populate on the fly
     :param block_kwargs: extra kwargs for the block_iter (LongestChainBlockIterator or BlockChainIterator)
@@ -84,7 +101,10 @@ def iter_txs(
     if track_scripts:
         # track_scripts=True implies track_spending=True
         track_spending = True
-    if track_spending:
+    if use_undo_files:
+        tx_iter_cls = UndoSpendingTxIterator
+        tx_kwargs.update(undo_index = undo_index)
+    elif track_spending:
         if utxoset is None:
             utxoset = UtxoSet(include_scripts = track_scripts)
         tx_iter_cls = TrackedSpendingTxIterator
@@ -142,6 +162,14 @@ class tailable:
         Signal the iterator to stop waiting for more data
         """
         self._stop_event.set()
+
+    # checkpoint support -- see the `checkpoint` module
+
+    def get_checkpoint_state(self):
+        return self.iter.get_checkpoint_state()
+
+    def set_checkpoint_state(self, state):
+        self.iter.set_checkpoint_state(state)
     
 
 ################################################################################
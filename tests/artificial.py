@@ -3,18 +3,21 @@ Code for generating artificial block data in the format of a blk.dat file,
 which includes forks. Used for testing.
 """
 
+import os
 import datetime
 
 from chainscan.block import deserialize_block
+from chainscan.tx import deserialize_tx
+from chainscan.misc import doublehash
 
-from chainscan.defs import MAGIC
+from chainscan.defs import MAGIC, COINBASE_SPENT_TXID, COINBASE_SPENT_OUTPUT_INDEX, GENESIS_PREV_BLOCK_HASH, SATOSHIS_IN_ONE
 MAGIC = MAGIC.to_bytes(4, 'little')
 
 FORKED_NONCE = 0xffffffff
 
 block_counter = 0
 
-def make_block(height, prev_block_hash, nonce = None):
+def make_block(height, prev_block_hash, nonce = None, txs = ()):
     global block_counter
     block_counter += 1
     #blob = b''
@@ -26,7 +29,7 @@ def make_block(height, prev_block_hash, nonce = None):
     if nonce is None:
         nonce = height
     nonce = to_bytes(nonce, 4)
-    num_txs = to_bytes(0, 1)  # if num_txs>0xfc, need to properly format a varlen int
+    num_txs = to_varlen(len(txs))
 
     blob = \
         version + \
@@ -36,11 +39,47 @@ def make_block(height, prev_block_hash, nonce = None):
         difficulty + \
         nonce + \
         num_txs
+    for tx in txs:
+        blob += bytes(tx.blob)
     
     size = len(blob)
     blob = MAGIC + to_bytes(size, 4) + blob
     return deserialize_block(bytearray(blob), height)
 
+def make_tx(inputs, outputs, coinbase_tag = b''):
+    """
+    :param inputs: a list of (spent_txid, spent_output_idx) pairs.  If empty, a
+        coinbase tx is generated.
+    :param outputs: a list of (value, script) pairs.
+    :return: a Tx
+    """
+    return deserialize_tx(bytearray(serialize_tx(inputs, outputs, coinbase_tag)), include_blob = True)
+
+def serialize_tx(inputs, outputs, coinbase_tag = b''):
+    if not inputs:
+        inputs = [ ( COINBASE_SPENT_TXID, COINBASE_SPENT_OUTPUT_INDEX ) ]
+        input_scripts = [ coinbase_tag ]
+    else:
+        input_scripts = [ b'' ] * len(inputs)
+    blob = to_bytes(1, 4)
+    blob += to_varlen(len(inputs))
+    for (spent_txid, spent_output_idx), script in zip(inputs, input_scripts):
+        blob += spent_txid + to_bytes(spent_output_idx, 4) + to_varlen(len(script)) + script + to_bytes(0xffffffff, 4)
+    blob += to_varlen(len(outputs))
+    for value, script in outputs:
+        blob += to_bytes(value, 8) + to_varlen(len(script)) + script
+    blob += to_bytes(0, 4)
+    return blob
+
+def p2pkh_script(h):
+    return b'\x76\xa9\x14' + h + b'\x88\xac'
+
+def p2sh_script(h):
+    return b'\xa9\x14' + h + b'\x87'
+
+def p2wpkh_script(h):
+    return b'\x00\x14' + h
+
 def gen_blocks(next_height, prev_block_hash, num_blocks, **kwargs):
     blocks = []
     while len(blocks) < num_blocks:
@@ -53,12 +92,187 @@ def gen_blocks(next_height, prev_block_hash, num_blocks, **kwargs):
 def to_bytes(x, n):
     return x.to_bytes(n, byteorder='little')
 
+def to_varlen(x):
+    if x < 0xfd:
+        return to_bytes(x, 1)
+    elif x <= 0xffff:
+        return b'\xfd' + to_bytes(x, 2)
+    else:
+        return b'\xfe' + to_bytes(x, 4)
+
 def swap(lst, i, j):
     try:
         lst[i], lst[j] = lst[j], lst[i]
     except IndexError:
         pass
 
+def gen_chain_with_txs(num_blocks, txs_per_block = 3):
+    """
+    Generate a (fork-free) chain of blocks, each including a coinbase tx and txs
+    spending outputs of the previous block, and outputs of other txs from the
+    same block.
+    :return: a list of blocks
+    """
+    blocks = []
+    prev_block_hash = GENESIS_PREV_BLOCK_HASH
+    prev_txs = []
+    for height in range(num_blocks):
+        txs = [ make_tx([], [ (50 * SATOSHIS_IN_ONE, p2pkh_script(to_bytes(height, 20))) ],
+                        coinbase_tag = to_bytes(height, 4)) ]
+        for prev_tx in prev_txs:
+            # spend all outputs of a tx from the previous block
+            value = sum( o.value for o in prev_tx.outputs )
+            inputs = [ (prev_tx.txid, oidx) for oidx in range(len(prev_tx.outputs)) ]
+            tx = make_tx(inputs, [ (value // 2, p2sh_script(prev_tx.txid[:20])), (value - value // 2, b'\x51') ])
+            txs.append(tx)
+            # and a chain of txs within the block
+            for i in range(txs_per_block - 1):
+                tx = make_tx([ (tx.txid, 1) ], [ (tx.outputs[1].value, p2wpkh_script(tx.txid[:20])), (0, b'\x51' * i) ])
+                txs.append(tx)
+        block = make_block(height, prev_block_hash, txs = txs)
+        blocks.append(block)
+        prev_block_hash = block.block_hash
+        prev_txs = txs[:1] + txs[1:][-1:]  # the coinbase and the end of the chain
+    return blocks
+
+def blocks_to_rawdata(blocks):
+    """
+    :return: a blob in the format of a blk.dat file
+    """
+    blob = bytes()
+    for block in blocks:
+        blob += MAGIC
+        blob += len(block.blob).to_bytes(4, 'little')
+        blob += block.blob
+    return blob
+
+def write_raw_files(data_dir, blocks, blocks_per_file = None):
+    """
+    Write the blocks into blk*.dat files in `data_dir`.
+    :return: a list of the filenames written
+    """
+    if blocks_per_file is None:
+        blocks_per_file = len(blocks)
+    filenames = []
+    for i in range(0, len(blocks), blocks_per_file):
+        filename = os.path.join(data_dir, 'blk%05d.dat' % len(filenames))
+        with open(filename, 'wb') as f:
+            f.write(blocks_to_rawdata(blocks[i : i + blocks_per_file]))
+        filenames.append(filename)
+    return filenames
+
+###############################################################################
+# bitcoind's undo files
+
+def get_spent_outputs(blocks):
+    """
+    :return: a list (per block) of lists (per non-coinbase tx) of lists (per input)
+        of the spent outputs, as (txout, height, is_coinbase) tuples.
+    """
+    outputs = {}
+    res = []
+    for block in blocks:
+        block_undo = []
+        for tx_idx, tx in enumerate(block.txs):
+            if tx_idx > 0:
+                block_undo.append([ outputs.pop((txin.spent_txid, txin.spent_output_idx)) for txin in tx.inputs ])
+            for oidx, txout in enumerate(tx.outputs):
+                outputs[(tx.txid, oidx)] = (txout, block.height, tx_idx == 0)
+        res.append(block_undo)
+    return res
+
+def write_undo_files(data_dir, blocks, blocks_per_file = None):
+    """
+    Write the undo data of the blocks into rev*.dat files in `data_dir`, matching
+    the blk*.dat files written by `write_raw_files`.
+    The undo records in each file are written in reverse order.
+    """
+    if blocks_per_file is None:
+        blocks_per_file = len(blocks)
+    all_undo = get_spent_outputs(blocks)
+    for file_idx, i in enumerate(range(0, len(blocks), blocks_per_file)):
+        records = []
+        for block, block_undo in zip(blocks[i : i + blocks_per_file], all_undo[i : i + blocks_per_file]):
+            if block.height == 0:
+                continue  # no undo data for genesis
+            data = serialize_block_undo(block_undo)
+            # like bitcoind, using the hash of the previous block
+            checksum = bytes(doublehash(bytearray(block.prev_block_hash + data)))
+            records.append(MAGIC + to_bytes(len(data), 4) + data + checksum)
+        filename = os.path.join(data_dir, 'rev%05d.dat' % file_idx)
+        with open(filename, 'wb') as f:
+            f.write(b''.join(reversed(records)))
+
+def serialize_block_undo(block_undo):
+    blob = to_varlen(len(block_undo))
+    for tx_undo in block_undo:
+        blob += to_varlen(len(tx_undo))
+        for txout, height, is_coinbase in tx_undo:
+            blob += to_core_varint(height * 2 + int(is_coinbase))
+            if height > 0:
+                blob += to_core_varint(0)  # dummy version
+            blob += to_core_varint(compress_amount(txout.value))
+            blob += compress_script(txout.script)
+    return blob
+
+def to_core_varint(n):
+    tmp = []
+    while True:
+        tmp.append((n & 0x7F) | (0x80 if tmp else 0x00))
+        if n <= 0x7F:
+            break
+        n = (n >> 7) - 1
+    return bytes(reversed(tmp))
+
+def compress_amount(n):
+    if n == 0:
+        return 0
+    e = 0
+    while n % 10 == 0 and e < 9:
+        n //= 10
+        e += 1
+    if e < 9:
+        d = n % 10
+        n //= 10
+        return 1 + (n * 9 + d - 1) * 10 + e
+    else:
+        return 1 + (n - 1) * 10 + 9
+
+def compress_script(script):
+    if len(script) == 25 and script[:3] == b'\x76\xa9\x14' and script[23:] == b'\x88\xac':
+        return b'\x00' + script[3:23]
+    if len(script) == 23 and script[:2] == b'\xa9\x14' and script[22:] == b'\x87':
+        return b'\x01' + script[2:22]
+    return to_core_varint(len(script) + 6) + script
+
+def write_utxo_snapshot(filename, coins, base_block_hash, legacy = False):
+    """
+    Write a UTXO snapshot, like bitcoind's `dumptxoutset`.
+    :param coins: a list of (txid, vout, txout, height, is_coinbase), sorted by
+        (txid, vout)
+    """
+    if legacy:
+        blob = base_block_hash + to_bytes(len(coins), 8)
+        for txid, vout, txout, height, is_coinbase in coins:
+            blob += txid + to_bytes(vout, 4) + serialize_coin(txout, height, is_coinbase)
+    else:
+        blob = b'utxo\xff' + to_bytes(2, 2) + bytes.fromhex('fabfb5da') + base_block_hash + to_bytes(len(coins), 8)
+        groups = {}
+        for coin in coins:
+            groups.setdefault(coin[0], []).append(coin)
+        for txid, group in groups.items():
+            blob += txid + to_varlen(len(group))
+            for _, vout, txout, height, is_coinbase in group:
+                blob += to_varlen(vout) + serialize_coin(txout, height, is_coinbase)
+    with open(filename, 'wb') as f:
+        f.write(blob)
+
+def serialize_coin(txout, height, is_coinbase):
+    return to_core_varint(height * 2 + int(is_coinbase)) + \
+        to_core_varint(compress_amount(txout.value)) + compress_script(txout.script)
+
+###############################################################################
+
 def gen_artificial_block_rawdata_with_forks(num_blocks = 200):
     # generate blocks with forks
     blocks = []
@@ -92,11 +306,6 @@ def gen_artificial_block_rawdata_with_forks(num_blocks = 200):
         swap(blocks, 106+i, 114-i)
     
     # return a single blob
-    blob = bytes()
-    for block in blocks:
-        blob += MAGIC
-        blob += len(block.blob).to_bytes(4, 'little')
-        blob += block.blob
-    return blob
+    return blocks_to_rawdata(blocks)
    
 ###############################################################################
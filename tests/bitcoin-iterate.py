@@ -260,7 +260,7 @@ def main():
     track_spending = fmt_in(all_formats, TRACK_SPENDING_ON_FORMATS)
     
     if track_spending:
-        track = TxSpendingTracker()
+        track = TxSpendingTracker().process_block_txs_gen
     else:
         track = lambda txs: txs  # noop
     
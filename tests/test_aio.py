@@ -0,0 +1,73 @@
+"""
+Unit-testing async iteration, using artificial data.
+"""
+
+import unittest
+import tempfile
+import asyncio
+import os
+
+from chainscan.utils import iter_blocks, iter_txs
+from chainscan.aio import aiter_blocks, aiter_txs
+from tests.artificial import gen_chain_with_txs, write_raw_files, blocks_to_rawdata
+
+################################################################################
+
+class AsyncIterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.data_dir = self.tmpdir.name
+        self.blocks = gen_chain_with_txs(20)
+        self.kwargs = dict(data_dir = self.data_dir, height_safety_margin = 1)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_aiter(self):
+        write_raw_files(self.data_dir, self.blocks, blocks_per_file = 7)
+
+        async def consume(aiter):
+            return [ x async for x in aiter ]
+
+        async def main():
+            # concurrent consumers
+            return await asyncio.gather(
+                consume(aiter_blocks(batch_size = 3, read_ahead = 2, **self.kwargs)),
+                consume(aiter_txs(batch_size = 5, **self.kwargs)),
+            )
+
+        blocks, txs = asyncio.run(main())
+        self.assertEqual([ b.block_hash for b in blocks ], [ b.block_hash for b in iter_blocks(**self.kwargs) ])
+        self.assertEqual([ tx.txid for tx in txs ], [ tx.txid for tx in iter_txs(**self.kwargs) ])
+        self.assertEqual(len(blocks), 20)
+
+    def test_tail(self):
+        write_raw_files(self.data_dir, self.blocks[:10])
+
+        async def main():
+            aiter = aiter_blocks(tail = True, polling_interval = 60, **self.kwargs)
+            heights = []
+            async for block in aiter:
+                heights.append(block.height)
+                if block.height == 9:
+                    # new data arrives
+                    with open(os.path.join(self.data_dir, 'blk00001.dat'), 'wb') as f:
+                        f.write(blocks_to_rawdata(self.blocks[10:]))
+                    aiter.notify()
+                if block.height == 19:
+                    aiter.stop()
+            return heights
+
+        heights = asyncio.run(asyncio.wait_for(main(), timeout = 10))
+        self.assertEqual(heights, list(range(20)))
+
+    def test_timeout(self):
+        write_raw_files(self.data_dir, self.blocks)
+
+        async def main():
+            return [ b async for b in aiter_blocks(tail = True, timeout = 0.1, polling_interval = 0.01, **self.kwargs) ]
+
+        self.assertEqual(len(asyncio.run(main())), 20)
+
+################################################################################
@@ -0,0 +1,160 @@
+"""
+Unit-testing the BlockChain data structure, and its persistence, using artificial data.
+"""
+
+import unittest
+import tempfile
+import pickle
+import datetime
+import os
+import numpy as np
+
+from chainscan.blockchain import BlockInfo, BlockChain, BlockChainIterator
+from chainscan.utils import get_blockchain
+from tests.artificial import gen_chain_with_txs, write_raw_files
+
+################################################################################
+
+class BlockChainTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.data_dir = os.path.join(self.tmpdir.name, 'blocks')
+        self.bc_dir = os.path.join(self.tmpdir.name, 'blockchain')
+        os.mkdir(self.data_dir)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_lookup(self):
+        write_raw_files(self.data_dir, gen_chain_with_txs(30))
+        bciter = BlockChainIterator(data_dir = self.data_dir, height_safety_margin = 1)
+        blocks = list(bciter)
+        bc = bciter.blockchain
+        # force building the index for some of the blocks
+        bc.MIN_PENDING_INDEX_SIZE = 0
+        bc._build_index()
+        self.assertEqual(len(bc), len(blocks))
+        for block in blocks:
+            self._assert_same(bc[block.height], block)
+            self._assert_same(bc[block.block_hash], block)
+            self.assertIn(block, bc)
+        self.assertFalse(bc.contains_hash(bytes(32)))
+        self.assertEqual([ b.block_hash for b in bc ], [ b.block_hash for b in blocks ])
+        self.assertEqual([ b.height for b in reversed(bc) ], list(reversed(range(len(blocks)))))
+        # pop, and re-append
+        last = bc.pop()
+        self._assert_same(last, blocks[-1])
+        self.assertFalse(bc.contains_hash(last.block_hash))
+        bc.append(last)
+        self._assert_same(bc.last_block, blocks[-1])
+        with self.assertRaises(ValueError):
+            bc.append(blocks[-1])
+        # pickling
+        bc2 = pickle.loads(pickle.dumps(bc))
+        self.assertEqual([ b.block_hash for b in bc2 ], [ b.block_hash for b in bc ])
+        self._assert_same(bc2[blocks[5].block_hash], blocks[5])
+
+    def test_persistence(self):
+        all_blocks = gen_chain_with_txs(40)
+        write_raw_files(self.data_dir, all_blocks[:20])
+        kwargs = dict(data_dir = self.data_dir, height_safety_margin = 1)
+        bc = get_blockchain(dirname = self.bc_dir, **kwargs)
+        self.assertEqual(len(bc), 20)
+        bc = BlockChain.load(self.bc_dir)
+        self.assertEqual(len(bc), 20)
+        # extend incrementally
+        write_raw_files(self.data_dir, all_blocks, blocks_per_file = 20)
+        bc = get_blockchain(dirname = self.bc_dir, **kwargs)
+        self.assertEqual(len(bc), 40)
+        expected = list(BlockChainIterator(**kwargs))
+        for block in expected:
+            self._assert_same(bc[block.block_hash], block)
+        bc = BlockChain.load(self.bc_dir)
+        self.assertEqual([ b.block_hash for b in bc ], [ b.block_hash for b in expected ])
+        # reading blocks
+        for block in expected[::7]:
+            self.assertEqual(bc.get_block(block.height).block_hash, block.block_hash)
+            self.assertEqual(bc.get_block(block.block_hash).height, block.height)
+            self.assertEqual(bc.get_block(block.height).num_txs, block.num_txs)
+        self.assertIs(bc.get_block(7), bc.get_block(expected[7].block_hash))
+        heights = [ 30, 2, 25, 2, 11 ]
+        self.assertEqual([ b.block_hash for b in bc.get_blocks(heights) ], [ expected[h].block_hash for h in heights ])
+        self.assertEqual([ tx.txid for tx in bc.get_block(12).txs ], [ tx.txid for tx in expected[12].txs ])
+        with self.assertRaises(KeyError):
+            bc.get_block(40)
+        # pop and save (the files are rewritten, not truncated, as they are mapped)
+        bc2 = BlockChain.load(self.bc_dir)
+        bc.pop()
+        bc.save(self.bc_dir)
+        self._assert_same(bc2.last_block, expected[-1])
+        self._assert_same(bc.last_block, expected[-2])
+        bc = BlockChain.load(self.bc_dir)
+        self.assertEqual(len(bc), 39)
+        self.assertFalse(bc.contains_hash(expected[-1].block_hash))
+        # saving again only appends
+        bc.append(expected[-1])
+        bc.save(self.bc_dir)
+        self.assertEqual([ b.block_hash for b in BlockChain.load(self.bc_dir) ], [ b.block_hash for b in expected ])
+
+    def test_resume(self):
+        all_blocks = gen_chain_with_txs(40)
+        kwargs = dict(data_dir = self.data_dir, height_safety_margin = 1)
+        write_raw_files(self.data_dir, all_blocks[:25], blocks_per_file = 10)
+        bc = get_blockchain(dirname = self.bc_dir, **kwargs)
+        write_raw_files(self.data_dir, all_blocks, blocks_per_file = 10)
+        expected = list(BlockChainIterator(**kwargs))
+        # resuming from the positions of the last blocks: the first file is not read
+        os.remove(os.path.join(self.data_dir, 'blk00000.dat'))
+        class ResumingIterator(BlockChainIterator):
+            RESUME_WINDOW = 3
+        bciter = ResumingIterator(blockchain = BlockChain.load(self.bc_dir), **kwargs)
+        bc = get_blockchain(bciter, dirname = self.bc_dir)
+        self.assertEqual([ b.block_hash for b in bc ], [ b.block_hash for b in expected ])
+        self.assertEqual([ b.block_hash for b in BlockChain.load(self.bc_dir) ], [ b.block_hash for b in expected ])
+
+    def test_append_verifies_prev(self):
+        write_raw_files(self.data_dir, gen_chain_with_txs(10))
+        blocks = list(BlockChainIterator(data_dir = self.data_dir, height_safety_margin = 1))
+        bc = BlockChain(blocks[:5])
+        block = blocks[6]
+        block.height = 5
+        with self.assertRaises(ValueError):
+            bc.append(block)
+        bc.append(blocks[5])
+        self.assertEqual(len(bc), 6)
+
+    def test_time_lookup(self):
+        timestamps = [ 1000, 1010, 1005, 1020, 1020, 1015, 1030 ]
+        bc = BlockChain()
+        for height, t in enumerate(timestamps):
+            bc.append(BlockInfo(height.to_bytes(32, 'little'), height, datetime.datetime.fromtimestamp(t), 1, 100))
+        self.assertEqual(bc.max_timestamps.tolist(), [ 1000, 1010, 1010, 1020, 1020, 1020, 1030 ])
+        self.assertEqual(bc.height_at_or_after(999), 0)
+        self.assertEqual(bc.height_at_or_after(1005), 1)
+        self.assertEqual(bc.height_at_or_after(1011), 3)
+        self.assertEqual(bc.height_at_or_after(datetime.datetime.fromtimestamp(1021)), 6)
+        self.assertEqual(bc.height_at_or_after(2000), 7)
+        self.assertEqual(bc.height_at_or_after(np.array([ 1000, 1020 ])).tolist(), [ 0, 3 ])
+        self.assertEqual(bc.height_range(1001, 1020), range(1, 3))
+        self.assertEqual(bc.height_range(1001), range(1, 7))
+        # consistent with time-based BlockFilters
+        block_filter = bc.get_block_filter(1001, 1020)
+        self.assertEqual(block_filter.block_height, ( 1, 3 ))
+        # updated when blocks are popped and added
+        bc.pop()
+        bc.pop()
+        bc.append(BlockInfo(b'\xff' * 32, 5, datetime.datetime.fromtimestamp(1040), 1, 100))
+        self.assertEqual(bc.max_timestamps.tolist(), [ 1000, 1010, 1010, 1020, 1020, 1040 ])
+
+    def _assert_same(self, block_info, block):
+        self.assertEqual(block_info.block_hash, block.block_hash)
+        self.assertEqual(block_info.height, block.height)
+        self.assertEqual(block_info.timestamp, block.timestamp)
+        self.assertEqual(block_info.num_txs, block.num_txs)
+        self.assertEqual(block_info.rawsize, block.rawsize)
+
+################################################################################
+
+if __name__ == '__main__':
+    unittest.main()
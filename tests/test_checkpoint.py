@@ -0,0 +1,66 @@
+"""
+Unit-testing checkpointing and restoring iterators, using artificial data.
+"""
+
+import unittest
+import tempfile
+import os
+
+from chainscan.scan import LongestChainBlockIterator
+from chainscan.track import TrackedSpendingTxIterator
+from chainscan.checkpoint import Checkpointer
+from tests.artificial import gen_artificial_block_rawdata_with_forks, gen_chain_with_txs, write_raw_files
+
+################################################################################
+
+class CheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.data_dir = os.path.join(self.tmpdir.name, 'blocks')
+        os.mkdir(self.data_dir)
+        self.filename = os.path.join(self.tmpdir.name, 'scan.ckpt')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_blocks_with_forks(self):
+        with open(os.path.join(self.data_dir, 'blk00000.dat'), 'wb') as f:
+            f.write(gen_artificial_block_rawdata_with_forks(200))
+        make_iter = lambda: LongestChainBlockIterator(data_dir = self.data_dir)
+        expected = [ block.block_hash for block in make_iter() ]
+        self.assertGreater(len(expected), 100)
+        self._test_resume(make_iter, expected, lambda block: block.block_hash, every_blocks = 7, resume_every = 23)
+
+    def test_tracked_txs(self):
+        write_raw_files(self.data_dir, gen_chain_with_txs(30), blocks_per_file = 7)
+        make_iter = lambda: TrackedSpendingTxIterator(
+            data_dir = self.data_dir, height_safety_margin = 3, include_block_context = True)
+        get_key = lambda tx: ( tx.txid, tx.block.height, tuple( txin.value for txin in tx.inputs if not txin.is_coinbase ) )
+        expected = [ get_key(tx) for tx in make_iter() ]
+        self._test_resume(make_iter, expected, get_key, every_blocks = 2, resume_every = 11)
+        # the old UTXO snapshots are removed
+        self.assertEqual(len([ fn for fn in os.listdir(self.tmpdir.name) if '.utxo.' in fn ]), 1)
+
+    def _test_resume(self, make_iter, expected, get_key, every_blocks, resume_every):
+        for stop_at in range(resume_every, len(expected), resume_every):
+            for fn in os.listdir(self.tmpdir.name):
+                if fn.startswith('scan.ckpt'):
+                    os.remove(os.path.join(self.tmpdir.name, fn))
+            checkpointer = Checkpointer(self.filename, every_blocks = every_blocks)
+            iterator = make_iter()
+            self.assertFalse(checkpointer.restore(iterator))
+            gen = checkpointer.iter(iterator)
+            for _ in range(stop_at):
+                next(gen)
+            # "crash", and resume from the last checkpoint, in a new iterator
+            iterator = make_iter()
+            self.assertTrue(Checkpointer(self.filename).restore(iterator))
+            rest = [ get_key(x) for x in iterator ]
+            self.assertGreater(len(rest), len(expected) - stop_at)
+            self.assertEqual(rest, expected[len(expected) - len(rest):])
+
+################################################################################
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+"""
+Unit-testing compact block filters, using artificial data.
+"""
+
+import unittest
+import tempfile
+import os
+
+from chainscan import iter_txs
+from chainscan.compactfilter import CompactFilters, FilteredBlockIterator
+from chainscan._gcs_c import siphash24, build_gcs, gcs_match_any
+from tests.artificial import gen_chain_with_txs, write_raw_files, p2pkh_script, to_bytes
+
+################################################################################
+
+class GCSTest(unittest.TestCase):
+
+    def test_siphash(self):
+        # test vectors from the SipHash paper
+        k0 = int.from_bytes(bytes(range(8)), 'little')
+        k1 = int.from_bytes(bytes(range(8, 16)), 'little')
+        self.assertEqual(siphash24(k0, k1, b''), 0x726fdb47dd0e0e31)
+        self.assertEqual(siphash24(k0, k1, bytes(range(15))), 0xa129ca6149be45e5)
+
+    def test_gcs(self):
+        key = bytes(range(16))
+        items = [ b'item%d' % i for i in range(1000) ]
+        gcs = build_gcs(items, key, 19, 784931)
+        self.assertLess(len(gcs), 1000 * 3)
+        for item in items[::10]:
+            self.assertTrue(gcs_match_any(gcs, key, [ item ], 19, 784931))
+        others = [ b'other%d' % i for i in range(1000) ]
+        self.assertFalse(gcs_match_any(gcs, key, others, 19, 784931))
+        self.assertTrue(gcs_match_any(gcs, key, others + items[-1:], 19, 784931))
+        self.assertFalse(gcs_match_any(build_gcs([], key, 19, 784931), key, items, 19, 784931))
+
+
+class CompactFiltersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.data_dir = os.path.join(self.tmpdir.name, 'blocks')
+        self.filters_filename = os.path.join(self.tmpdir.name, 'filters.dat')
+        os.mkdir(self.data_dir)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _build(self, **kwargs):
+        compact_filters = CompactFilters(self.filters_filename)
+        txs = list(iter_txs(track_scripts = True, compact_filters = compact_filters,
+                            block_kwargs = dict(data_dir = self.data_dir, height_safety_margin = 1), **kwargs))
+        compact_filters.close()
+        return txs
+
+    def test_filtered_blocks(self):
+        blocks = gen_chain_with_txs(20)
+        write_raw_files(self.data_dir, blocks[:12])
+        self._build()
+        compact_filters = CompactFilters(self.filters_filename)
+        num_blocks = len(compact_filters)
+        self.assertEqual(compact_filters.height, num_blocks - 1)
+        # the coinbase output of a block is spent by the next block
+        for height in [ 0, 3, 7 ]:
+            script = p2pkh_script(to_bytes(height, 20))
+            matching = list(FilteredBlockIterator(compact_filters, [ script ]))
+            self.assertEqual([ b.height for b in matching ], [ height, height + 1 ])
+            self.assertEqual(matching[0].block_hash, blocks[height].block_hash)
+            self.assertTrue(compact_filters.match_any(blocks[height].block_hash, [ script ]))
+        self.assertEqual(list(FilteredBlockIterator(compact_filters, [ b'\x51\x52' ])), [])
+        compact_filters.close()
+        # extend
+        write_raw_files(self.data_dir, blocks)
+        self._build()
+        compact_filters = CompactFilters(self.filters_filename)
+        self.assertGreater(len(compact_filters), num_blocks)
+        self.assertEqual(len(compact_filters), compact_filters.height + 1)
+        script = p2pkh_script(to_bytes(15, 20))
+        self.assertEqual([ b.height for b in FilteredBlockIterator(compact_filters, [ script ]) ], [ 15, 16 ])
+        compact_filters.close()
+
+################################################################################
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,12 +3,22 @@ Unit-testing longest-chain iterator logic, using artificial forks.
 """
 
 import unittest
+import tempfile
+import os
 import numpy as np
 
-from chainscan.scan import LongestChainBlockIterator
+from chainscan.scan import LongestChainBlockIterator, TxIterator, ReorgEvent
+from chainscan.txindex import TxIndex
+from chainscan.scriptindex import ScriptIndex
+from chainscan.track import TrackedSpendingTxIterator, TxSpendingTracker, UtxoSet
+from chainscan.shard import ShardedUtxoSet
+from chainscan.pipeline import Pipeline
 from chainscan.misc import Bunch
+from chainscan.defs import GENESIS_PREV_BLOCK_HASH
 from tests.test_blockiter import BlockIterTest, TOTAL_NUM_BLOCKS
-from tests.artificial import gen_artificial_block_rawdata_with_forks
+from tests.test_pipeline import Txids
+from tests.artificial import gen_artificial_block_rawdata_with_forks, gen_blocks, gen_chain_with_txs, \
+    write_raw_files, make_block, make_tx, FORKED_NONCE
 
 ################################################################################
 
@@ -39,6 +49,156 @@ class ForkTest(BlockIterTest):
         for blk in LongestChainBlockIterator(raw_data_iter = self._get_raw_data_iter()):
             self.assertEqual(blk.nonce, blk.height)
     
+class CompactStateTest(unittest.TestCase):
+
+    def test_compact_state(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            with open(os.path.join(data_dir, 'blk00000.dat'), 'wb') as f:
+                f.write(gen_artificial_block_rawdata_with_forks(TOTAL_NUM_BLOCKS))
+            expected = list(LongestChainBlockIterator(data_dir = data_dir, height_prune_depth = None))
+            block_iter = LongestChainBlockIterator(data_dir = data_dir, height_prune_depth = 50, orphans_as_positions = True)
+            blocks = list(block_iter)
+        self.assertEqual([ b.block_hash for b in blocks ], [ b.block_hash for b in expected ])
+        self.assertEqual([ b.height for b in blocks ], [ b.height for b in expected ])
+        for blk in blocks:
+            self.assertEqual(blk.nonce, blk.height)
+        # pruned
+        height_by_hash = block_iter.block_iter._height_by_hash
+        self.assertLessEqual(len(height_by_hash), 2 * 50 + 100)
+        self.assertNotIn(blocks[0].block_hash, height_by_hash)
+        self.assertEqual(height_by_hash[blocks[-1].block_hash], blocks[-1].height)
+
+    def test_stale_orphans_dropped(self):
+        chain = gen_blocks(0, GENESIS_PREV_BLOCK_HASH, 200)
+        # stale-fork blocks whose prev block is missing (e.g. pruned), and a block
+        # appearing before its prev block
+        stale1 = gen_blocks(5, bytes(range(32)), 1, nonce = FORKED_NONCE)[0]
+        stale2 = gen_blocks(150, bytes(range(1, 33)), 1, nonce = FORKED_NONCE)[0]
+        blocks = chain[:10] + [ stale1 ] + chain[10:20] + [ chain[21], chain[20] ] + chain[22:160] + [ stale2 ] + chain[160:]
+        with tempfile.TemporaryDirectory() as data_dir:
+            write_raw_files(data_dir, blocks)
+            block_iter = LongestChainBlockIterator(data_dir = data_dir, height_safety_margin = 1, height_prune_depth = 50)
+            self.assertEqual([ b.block_hash for b in block_iter ], [ b.block_hash for b in chain ])
+        # only the recent orphan is kept
+        self.assertEqual(list(block_iter.block_iter._orphans), [ stale2.prev_block_hash ])
+
+class UnsafeTailTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def _apply(self, items, chain = None):
+        # replay the blocks and the reorg events
+        chain = list(chain or [])
+        events = []
+        for x in items:
+            if isinstance(x, ReorgEvent):
+                self.assertEqual([ b.block_hash for b in x.disconnected_blocks ],
+                                 [ b.block_hash for b in reversed(chain[-x.depth:]) ])
+                del chain[-x.depth:]
+                self.assertEqual(chain[-1].block_hash, x.fork_block.block_hash)
+                events.append(x)
+            else:
+                if chain:
+                    self.assertEqual(x.prev_block_hash, chain[-1].block_hash)
+                    self.assertEqual(x.height, chain[-1].height + 1)
+                chain.append(x)
+        return chain, events
+
+    def test_reorg(self):
+        main = gen_blocks(0, GENESIS_PREV_BLOCK_HASH, 10)
+        fork = gen_blocks(6, main[5].block_hash, 8, nonce = FORKED_NONCE)
+        write_raw_files(self.tmpdir.name, main + fork)
+        kwargs = dict(data_dir = self.tmpdir.name, height_safety_margin = 6)
+        items = list(LongestChainBlockIterator(generate_unsafe_tail = True, **kwargs))
+        chain, events = self._apply(items)
+        # the tip is generated, before it is deemed safe
+        self.assertEqual([ b.block_hash for b in chain ], [ b.block_hash for b in main[:6] + fork ])
+        safe = list(LongestChainBlockIterator(**kwargs))
+        self.assertEqual([ b.block_hash for b in safe ], [ b.block_hash for b in chain[:len(safe)] ])
+        self.assertLess(len(safe), len(chain) - 6)
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].fork_block.height, 5)
+        self.assertEqual([ b.height for b in events[0].disconnected_blocks ], [ 9, 8, 7, 6 ])
+        # the new chain is generated as soon as it leads
+        self.assertEqual(items.index(events[0]), 10)
+        self.assertEqual(items[11].block_hash, fork[0].block_hash)
+
+    def test_replay(self):
+        # forks which lead temporarily (blocks are out of order) are disconnected later
+        with open(os.path.join(self.tmpdir.name, 'blk00000.dat'), 'wb') as f:
+            f.write(gen_artificial_block_rawdata_with_forks(200))
+        kwargs = dict(data_dir = self.tmpdir.name, height_safety_margin = 3)
+        chain, events = self._apply(LongestChainBlockIterator(generate_unsafe_tail = True, **kwargs))
+        safe = list(LongestChainBlockIterator(**kwargs))
+        self.assertEqual([ b.block_hash for b in chain[:len(safe)] ], [ b.block_hash for b in safe ])
+        self.assertEqual([ b.height for b in chain ], list(range(200)))
+        self.assertLess(len(safe), len(chain))
+        for blk in chain:
+            self.assertEqual(blk.nonce, blk.height)
+
+    def test_tracked_reorg(self):
+        # the tracking of the txs of the disconnected blocks is undone
+        main = gen_chain_with_txs(10)
+        fork = gen_blocks(6, main[5].block_hash, 8, nonce = FORKED_NONCE)
+        write_raw_files(self.tmpdir.name, main + fork)
+        kwargs = dict(data_dir = self.tmpdir.name, height_safety_margin = 6)
+        tx_iter = TrackedSpendingTxIterator(utxoset = UtxoSet(include_scripts = True), generate_unsafe_tail = True, **kwargs)
+        events = [ x for x in tx_iter if isinstance(x, ReorgEvent) ]
+        self.assertEqual(len(events), 1)
+        write_raw_files(self.tmpdir.name, main[:6])
+        expected_iter = TrackedSpendingTxIterator(utxoset = UtxoSet(include_scripts = True), **dict(kwargs, height_safety_margin = 1))
+        for tx in expected_iter: pass
+        self.assertEqual(_utxos(tx_iter.tracker.utxoset), _utxos(expected_iter.tracker.utxoset))
+
+    def test_tracker_cannot_undo(self):
+        # rejected before the first reorg
+        write_raw_files(self.tmpdir.name, gen_chain_with_txs(10))
+        kwargs = dict(data_dir = self.tmpdir.name, height_safety_margin = 6, generate_unsafe_tail = True)
+        with ShardedUtxoSet(2) as utxoset:
+            for tracker in [ TxSpendingTracker(), TxSpendingTracker(utxoset = utxoset) ]:
+                with self.assertRaises(ValueError):
+                    TrackedSpendingTxIterator(tracker = tracker, **kwargs)
+                with self.assertRaises(ValueError):
+                    Pipeline([ Txids() ], tracker = tracker, **kwargs).run()
+        tx_iter = TrackedSpendingTxIterator(tracker = TxSpendingTracker(undo_depth = 10), **kwargs)
+        self.assertEqual(len(list(tx_iter)), len(list(TxIterator(**kwargs))))
+
+    def test_indexed_reorg(self):
+        # the blocks replacing the disconnected ones are indexed
+        main = gen_chain_with_txs(10)
+        fork = []
+        prev_block_hash = main[5].block_hash
+        for height in range(6, 14):
+            coinbase = make_tx([], [ ( 50, b'\x51' * height ) ], coinbase_tag = b'fork' + bytes([ height ]))
+            fork.append(make_block(height, prev_block_hash, nonce = FORKED_NONCE, txs = [ coinbase ]))
+            prev_block_hash = fork[-1].block_hash
+        write_raw_files(self.tmpdir.name, main + fork)
+        txindex = TxIndex(os.path.join(self.tmpdir.name, 'txindex'))
+        script_index = ScriptIndex(os.path.join(self.tmpdir.name, 'scriptindex'))
+        with txindex, script_index:
+            items = list(TxIterator(data_dir = self.tmpdir.name, height_safety_margin = 6, generate_unsafe_tail = True,
+                                    txindex = txindex, script_index = script_index))
+        self.assertEqual(len([ x for x in items if isinstance(x, ReorgEvent) ]), 1)
+        txindex = TxIndex(os.path.join(self.tmpdir.name, 'txindex'))
+        script_index = ScriptIndex(os.path.join(self.tmpdir.name, 'scriptindex'))
+        self.assertEqual(txindex.height, 13)
+        for block in main[:6] + fork:
+            for tx in block.txs:
+                self.assertEqual(txindex.get_tx(tx.txid).txid, tx.txid)
+        for block in fork:
+            self.assertEqual([ int(p['height']) for p in script_index.get_postings(b'\x51' * block.height) ], [ block.height ])
+        # the disconnected blocks were not flushed yet, so they are forgotten
+        for block in main[6:]:
+            for tx in block.txs:
+                self.assertEqual(txindex.get_locations(tx.txid), [])
+
+def _utxos(utxoset):
+    a = utxoset._export(0, 2**64 - 1, True)
+    scripts = [ bytes(a.script_data[a.script_offset[i] : a.script_offset[i + 1]]) for i in range(len(a.key)) ]
+    return sorted(zip(a.key.tolist(), a.output_idx.tolist(), a.value.tolist(), a.block_height.tolist(), scripts))
+
 ################################################################################
 
 if __name__ == '__main__':
@@ -0,0 +1,58 @@
+"""
+Unit-testing chain_map_reduce, using artificial data.
+"""
+
+import unittest
+import tempfile
+from collections import Counter
+from operator import add
+
+from chainscan.scan import LongestChainBlockIterator
+from chainscan.utils import get_blockchain
+from chainscan.mapreduce import chain_map_reduce, split_heights
+from tests.artificial import gen_chain_with_txs, write_raw_files
+
+################################################################################
+
+def count_outputs(blocks):
+    return Counter( len(tx.outputs) for block in blocks for tx in block.txs )
+
+def get_hashes(blocks):
+    return [ ( block.height, block.block_hash ) for block in blocks ]
+
+class ChainMapReduceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        write_raw_files(self.tmpdir.name, gen_chain_with_txs(25), blocks_per_file = 6)
+        self.kwargs = dict(data_dir = self.tmpdir.name, height_safety_margin = 1)
+        self.blocks = list(LongestChainBlockIterator(**self.kwargs))
+        self.blockchain = get_blockchain(**self.kwargs)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_split_heights(self):
+        n = len(self.blockchain)
+        for num_ranges in [ 1, 3, 7, 100 ]:
+            ranges = split_heights(self.blockchain, num_ranges)
+            self.assertLessEqual(len(ranges), num_ranges)
+            self.assertEqual([ h for r in ranges for h in r ], list(range(n)))
+        ranges = split_heights(self.blockchain, 4, range(5, 12))
+        self.assertEqual([ h for r in ranges for h in r ], list(range(5, 12)))
+        self.assertEqual(split_heights(self.blockchain, 4, range(3, 3)), [])
+
+    def test_map_reduce(self):
+        expected = count_outputs(self.blocks)
+        res = chain_map_reduce(count_outputs, add, workers = 2, blockchain = self.blockchain)
+        self.assertEqual(res, expected)
+        # the blockchain is built from the kwargs
+        res = chain_map_reduce(count_outputs, add, workers = 2, initial = Counter(), **self.kwargs)
+        self.assertEqual(res, expected)
+
+    def test_order(self):
+        res = chain_map_reduce(get_hashes, add, workers = 3, num_ranges = 5, blockchain = self.blockchain, heights = range(4, 20))
+        self.assertEqual(res, [ ( b.height, b.block_hash ) for b in self.blocks[4:20] ])
+        self.assertEqual(chain_map_reduce(get_hashes, add, workers = 2, initial = [], blockchain = self.blockchain, heights = range(0)), [])
+
+################################################################################
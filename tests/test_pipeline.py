@@ -0,0 +1,141 @@
+"""
+Unit-testing the plug-in pipeline, using artificial data.
+"""
+
+import unittest
+import unittest.mock
+import tempfile
+
+from chainscan.utils import iter_blocks
+from chainscan.track import TrackedSpendingTxIterator, TxSpendingTracker, UtxoSet
+from chainscan.shard import ShardedUtxoSet
+from chainscan.pipeline import Pipeline, Plugin, _PluginWorker, NEEDS_TXS, NEEDS_SPENDING, NEEDS_SCRIPTS, NEEDS_BLOCK_CONTEXT
+from tests.artificial import gen_chain_with_txs, write_raw_files
+
+################################################################################
+# Plugins
+
+class NumTxs(Plugin):
+    def begin(self):
+        self.num_txs = 0
+    def process_block(self, block):
+        self.num_txs += block.num_txs
+    def result(self):
+        return self.num_txs
+
+class Fees(Plugin):
+    needs = { NEEDS_SPENDING }
+    def begin(self):
+        self.fees = 0
+    def process_tx(self, tx):
+        if not tx.is_coinbase:
+            self.fees += tx.get_fee_paid()
+    def result(self):
+        return self.fees
+
+class SpentScripts(Plugin):
+    needs = { NEEDS_SCRIPTS }
+    def begin(self):
+        self.scripts = set()
+    def process_tx(self, tx):
+        if not tx.is_coinbase:
+            self.scripts.update( bytes(txin.spent_output.script) for txin in tx.inputs )
+    def result(self):
+        return self.scripts
+
+class OutputsByHeight(Plugin):
+    needs = { NEEDS_BLOCK_CONTEXT }
+    def begin(self):
+        self.counts = {}
+    def process_tx(self, tx):
+        height = tx.block.height
+        self.counts[height] = self.counts.get(height, 0) + len(tx.outputs)
+    def result(self):
+        return self.counts
+
+class Txids(Plugin):
+    needs = { NEEDS_TXS }
+    def begin(self):
+        self.txids = []
+    def process_tx(self, tx):
+        self.txids.append(tx.txid)
+    def result(self):
+        return self.txids
+
+class Failing(Plugin):
+    def process_block(self, block):
+        if block.height == 2:
+            raise ValueError('failing at %d' % block.height)
+
+################################################################################
+
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        write_raw_files(self.tmpdir.name, gen_chain_with_txs(15), blocks_per_file = 4)
+        self.kwargs = dict(data_dir = self.tmpdir.name, height_safety_margin = 1)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _get_expected(self):
+        txs = list(TrackedSpendingTxIterator(utxoset = UtxoSet(include_scripts = True), include_block_context = True, **self.kwargs))
+        counts = {}
+        for tx in txs:
+            counts[tx.block.height] = counts.get(tx.block.height, 0) + len(tx.outputs)
+        return [
+            len(txs),
+            sum( tx.get_fee_paid() for tx in txs if not tx.is_coinbase ),
+            set( bytes(txin.spent_output.script) for tx in txs if not tx.is_coinbase for txin in tx.inputs ),
+            counts,
+            [ tx.txid for tx in txs ],
+        ]
+
+    def test_pipeline(self):
+        pipeline = Pipeline([ NumTxs(), Fees(), SpentScripts(), OutputsByHeight(), Txids() ], **self.kwargs)
+        self.assertEqual(pipeline.needs, { NEEDS_TXS, NEEDS_SPENDING, NEEDS_SCRIPTS, NEEDS_BLOCK_CONTEXT })
+        results = pipeline.run()
+        self.assertEqual(results, self._get_expected())
+        self.assertGreater(results[0], 15)
+
+    def test_sharded(self):
+        with ShardedUtxoSet(2, include_scripts = True) as utxoset:
+            tracker = TxSpendingTracker(utxoset = utxoset)
+            pipeline = Pipeline([ NumTxs(), Fees(), SpentScripts(), OutputsByHeight(), Txids() ], tracker = tracker, **self.kwargs)
+            self.assertEqual(pipeline.run(), self._get_expected())
+            self.assertEqual(tracker.num_pending_blocks, 0)
+
+    def test_blocks_only(self):
+        pipeline = Pipeline([ NumTxs() ], **self.kwargs)
+        self.assertEqual(pipeline.needs, set())
+        self.assertEqual(pipeline.run(), [ sum( b.num_txs for b in iter_blocks(**self.kwargs) ) ])
+
+    def test_workers(self):
+        pipeline = Pipeline(**self.kwargs)
+        pipeline.add(NumTxs(), in_worker = True)
+        pipeline.add(Fees())
+        pipeline.add(SpentScripts())
+        pipeline.add(OutputsByHeight(), in_worker = True)
+        pipeline.add(Txids(), in_worker = True)
+        self.assertEqual(pipeline.needs, { NEEDS_TXS, NEEDS_SPENDING, NEEDS_SCRIPTS })
+        self.assertEqual(pipeline.run(), self._get_expected())
+
+    def test_worker_failure(self):
+        # the worker's error is raised, whether it is detected sending a batch or
+        # waiting for the result
+        for batch_size in [ 1, 100 ]:
+            pipeline = Pipeline(**self.kwargs)
+            pipeline.add(NumTxs(), in_worker = True)
+            pipeline.add(Failing(), in_worker = True)
+            with unittest.mock.patch.object(_PluginWorker, 'BATCH_SIZE', batch_size):
+                with self.assertRaisesRegex(ValueError, 'failing at 2'):
+                    pipeline.run()
+
+    def test_worker_needs_spending(self):
+        pipeline = Pipeline(**self.kwargs)
+        pipeline.add(Fees(), in_worker = True)
+        with self.assertRaises(ValueError):
+            pipeline.run()
+
+################################################################################
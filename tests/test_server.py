@@ -0,0 +1,125 @@
+"""
+Unit-testing the fan-out server, using artificial data.
+"""
+
+import unittest
+import tempfile
+import threading
+import time
+import os
+
+from chainscan.scan import LongestChainBlockIterator, TxIterator, ReorgEvent
+from chainscan.server import ChainServer, ChainClient
+from chainscan.defs import GENESIS_PREV_BLOCK_HASH
+from tests.artificial import gen_chain_with_txs, gen_blocks, write_raw_files, blocks_to_rawdata, FORKED_NONCE
+
+################################################################################
+
+def take(iterator, n):
+    res = []
+    for x in iterator:
+        res.append(x)
+        if len(res) == n:
+            break
+    return res
+
+class SmallChainServer(ChainServer):
+    # older blocks are read from the files
+    NUM_RECENT_BLOCKS = 4
+
+class ChainServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.data_dir = os.path.join(self.tmpdir.name, 'blocks')
+        os.mkdir(self.data_dir)
+        self.socket_path = os.path.join(self.tmpdir.name, 'chainscan.sock')
+        self.kwargs = dict(data_dir = self.data_dir, height_safety_margin = 1)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _start_server(self, **kwargs):
+        server = SmallChainServer(self.socket_path, polling_interval = 0.01, **dict(self.kwargs, **kwargs))
+        server.start()
+        self.addCleanup(server.stop)
+        return server
+
+    def test_clients(self):
+        blocks = gen_chain_with_txs(30)
+        write_raw_files(self.data_dir, blocks, blocks_per_file = 8)
+        expected = list(LongestChainBlockIterator(**self.kwargs))
+        expected_txs = list(TxIterator(**self.kwargs))
+        self._start_server()
+
+        results = {}
+        def consume(name, start_height, n, txs = False):
+            client = ChainClient(self.socket_path, start_height = start_height)
+            results[name] = take(client.iter_txs() if txs else client.iter_blocks(), n)
+        threads = [
+            threading.Thread(target = consume, args = ( 'all', 0, 30 )),
+            threading.Thread(target = consume, args = ( 'resumed', 25, 5 )),
+            threading.Thread(target = consume, args = ( 'txs', 0, len(expected_txs), True )),
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual([ ( b.height, b.block_hash ) for b in results['all'] ], [ ( b.height, b.block_hash ) for b in expected ])
+        self.assertEqual([ b.height for b in results['resumed'] ], list(range(25, 30)))
+        self.assertEqual([ tx.txid for tx in results['txs'] ], [ tx.txid for tx in expected_txs ])
+
+    def test_new_blocks(self):
+        blocks = gen_chain_with_txs(20)
+        write_raw_files(self.data_dir, blocks[:10])
+        self._start_server()
+        client = ChainClient(self.socket_path)
+        heights = [ b.height for b in take(client.iter_blocks(), 10) ]
+        with open(os.path.join(self.data_dir, 'blk00001.dat'), 'wb') as f:
+            f.write(blocks_to_rawdata(blocks[10:]))
+        # resume from the cursor
+        self.assertEqual(client.height, 9)
+        heights += [ b.height for b in take(client.iter_blocks(), 10) ]
+        self.assertEqual(heights, list(range(20)))
+
+    def test_reorg(self):
+        main = gen_blocks(0, GENESIS_PREV_BLOCK_HASH, 10)
+        fork = gen_blocks(6, main[5].block_hash, 8, nonce = FORKED_NONCE)
+        write_raw_files(self.data_dir, main + fork)
+        self._start_server(height_safety_margin = 6, generate_unsafe_tail = True)
+        client = ChainClient(self.socket_path)
+        chain = []
+        for x in client.iter_blocks():
+            if type(x) is ReorgEvent:
+                self.assertEqual([ b.block_hash for b in x.disconnected_blocks ], [ b.block_hash for b in chain[:-x.depth-1:-1] ])
+                del chain[-x.depth:]
+            else:
+                chain.append(x)
+            if len(chain) == 14:
+                break
+        self.assertEqual([ b.block_hash for b in chain ], [ b.block_hash for b in main[:6] + fork ])
+
+    def test_resume_after_reorg(self):
+        main = gen_blocks(0, GENESIS_PREV_BLOCK_HASH, 10)
+        fork = gen_blocks(6, main[5].block_hash, 8, nonce = FORKED_NONCE)
+        write_raw_files(self.data_dir, main)
+        server = self._start_server(height_safety_margin = 6, generate_unsafe_tail = True)
+        client = ChainClient(self.socket_path)
+        chain = take(client.iter_blocks(), 10)
+        self.assertEqual([ b.block_hash for b in chain ], [ b.block_hash for b in main ])
+        server.stop()
+        # the client's last blocks are disconnected while it is away (the server's
+        # blocks at the fork are read from the files)
+        write_raw_files(self.data_dir, main + fork)
+        server = self._start_server(height_safety_margin = 6, generate_unsafe_tail = True)
+        # (the server's reorg happens before the client reconnects)
+        while server.height < 13:
+            time.sleep(0.01)
+        items = take(client.iter_blocks(), 9)
+        event = items[0]
+        self.assertIs(type(event), ReorgEvent)
+        self.assertEqual(event.fork_block.block_hash, main[5].block_hash)
+        self.assertEqual([ b.block_hash for b in event.disconnected_blocks ], [ b.block_hash for b in main[:5:-1] ])
+        self.assertEqual([ b.block_hash for b in items[1:] ], [ b.block_hash for b in fork ])
+
+################################################################################
@@ -0,0 +1,74 @@
+"""
+Unit-testing the shared-memory block transfer, using artificial data.
+"""
+
+import unittest
+import tempfile
+import multiprocessing
+from multiprocessing import resource_tracker
+
+from chainscan.scan import LongestChainBlockIterator
+from chainscan import shm
+from chainscan.shm import SharedBlockRing, read_block_handle, shm_map
+from tests.artificial import gen_chain_with_txs, write_raw_files
+
+################################################################################
+
+def get_attached_segments(block):
+    return tuple(sorted(shm._attached_segments))
+
+def summarize(block):
+    return ( block.height, block.block_hash, [ tx.txid for tx in block.txs ] )
+
+class SharedBlockRingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        write_raw_files(self.tmpdir.name, gen_chain_with_txs(20), blocks_per_file = 8)
+        self.kwargs = dict(data_dir = self.tmpdir.name, height_safety_margin = 1)
+        self.blocks = list(LongestChainBlockIterator(**self.kwargs))
+        self.expected = [ summarize(b) for b in self.blocks ]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_ring(self):
+        max_size = max( len(b.blob) for b in self.blocks )
+        with SharedBlockRing(size = max_size * 3) as ring:
+            pending = []
+            for block, expected in zip(self.blocks, self.expected):
+                handle = ring.put(block)
+                while handle is None:
+                    # wrapping around
+                    ring.release(pending.pop(0))
+                    handle = ring.put(block)
+                self.assertEqual(handle.height, block.height)
+                pending.append(handle)
+                self.assertEqual(summarize(read_block_handle(handle)), expected)
+                self.assertEqual(len(ring), len(pending))
+            with self.assertRaises(ValueError):
+                ring.release(pending[-1])
+        with SharedBlockRing(size = 10) as ring:
+            with self.assertRaises(ValueError):
+                ring.put(self.blocks[-1])
+
+    def test_shm_map(self):
+        max_size = max( len(b.blob) for b in self.blocks )
+        res = list(shm_map(summarize, LongestChainBlockIterator(**self.kwargs), processes = 2, ring_size = max_size * 2))
+        self.assertEqual(res, self.expected)
+
+    def test_detach_closed_rings(self):
+        # the workers of a pool used for several calls keep only the current ring attached
+        # (the workers share the resource tracker of this process, as when the pool
+        # is created by shm_map())
+        resource_tracker.ensure_running()
+        with multiprocessing.Pool(1) as pool:
+            segments = []
+            for _ in range(3):
+                res = list(shm_map(get_attached_segments, self.blocks[:2], pool = pool))
+                self.assertEqual(len(set(res)), 1)
+                segments.append(res[0])
+            self.assertEqual([ len(names) for names in segments ], [ 1, 1, 1 ])
+            self.assertEqual(len(set(segments)), 3)
+
+################################################################################
@@ -0,0 +1,139 @@
+"""
+Unit-testing loading and dumping UTXO snapshots, using artificial txs.
+"""
+
+import unittest
+import tempfile
+import datetime
+import os
+
+from chainscan.track import UtxoSet
+from chainscan.snapshot import load_utxo_snapshot, dump_utxo_snapshot
+from chainscan.blockchain import BlockChain, BlockInfo
+from chainscan._coins_c import serialize_varint, compress_amount, compress_script, decompress_script
+from tests.artificial import make_tx, write_utxo_snapshot, to_core_varint, p2pkh_script, p2sh_script
+from tests.artificial import compress_amount as compress_amount_ref
+from tests.test_utxoset import SCRIPTS
+
+################################################################################
+
+BASE_BLOCK_HASH = bytes(range(32))
+
+################################################################################
+
+class CoinsEncodingTest(unittest.TestCase):
+
+    def test_varint(self):
+        for n in [ 0, 1, 0x7f, 0x80, 0x1234, 2**32, 2**63 ]:
+            self.assertEqual(serialize_varint(n), to_core_varint(n))
+
+    def test_amount(self):
+        for n in [ 0, 1, 546, 5000000000, 2100000000000000, 123456789, 10**9 ]:
+            self.assertEqual(compress_amount(n), compress_amount_ref(n))
+
+    def test_script(self):
+        pubkey = b'\x21\x03' + bytes(range(32)) + b'\xac'
+        self.assertEqual(compress_script(pubkey), b'\x03' + bytes(range(32)))
+        self.assertEqual(compress_script(p2pkh_script(bytes(20)))[:1], b'\x00')
+        self.assertEqual(compress_script(p2sh_script(bytes(20)))[:1], b'\x01')
+        for script in SCRIPTS + [ pubkey ]:
+            compressed = compress_script(script)
+            nsize = compressed[0] if compressed[0] < 0x80 else None
+            if nsize is not None and nsize < 6:
+                self.assertEqual(decompress_script(nsize, bytearray(compressed[1:])), script)
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, 'utxo.dat')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_load(self):
+        for legacy in [ False, True ]:
+            txs, coins = self._make_coins()
+            write_utxo_snapshot(self.filename, coins, BASE_BLOCK_HASH, legacy = legacy)
+            utxoset, meta = load_utxo_snapshot(self.filename, include_scripts = True)
+            self.assertEqual(meta.version, 0 if legacy else 2)
+            self.assertEqual(meta.network, None if legacy else 'regtest')
+            self.assertEqual(meta.base_block_hash, BASE_BLOCK_HASH)
+            self.assertEqual(meta.coins_count, len(coins))
+            self.assertIsNone(meta.block_height)
+            self.assertEqual(utxoset.get_num_unspent_outputs(), len(coins))
+            for txid, vout, txout, height, _ in coins:
+                spending_info = utxoset.spend(bytearray(txid), vout)
+                self.assertEqual(spending_info.spent_output.value, txout.value)
+                self.assertEqual(spending_info.spent_output.script, txout.script)
+                self.assertEqual(spending_info.block_height, height)
+            self.assertEqual(len(utxoset), 0)
+
+    def test_block_height(self):
+        # the base block created no UTXOs (the snapshot's UTXOs are older)
+        _, coins = self._make_coins()
+        write_utxo_snapshot(self.filename, coins, BASE_BLOCK_HASH)
+        self.assertEqual(load_utxo_snapshot(self.filename, block_height = 30)[1].block_height, 30)
+        blocks = [
+            BlockInfo(bytes([ height ]) * 32 if height < 30 else BASE_BLOCK_HASH, height, datetime.datetime(2020, 1, 1), 1, 100)
+            for height in range(31)
+        ]
+        self.assertEqual(load_utxo_snapshot(self.filename, blockchain = BlockChain(blocks))[1].block_height, 30)
+        with self.assertRaises(KeyError):
+            load_utxo_snapshot(self.filename, blockchain = BlockChain(blocks[:30]))
+
+    def test_truncated(self):
+        _, coins = self._make_coins()
+        write_utxo_snapshot(self.filename, coins, BASE_BLOCK_HASH)
+        with open(self.filename, 'rb') as f:
+            blob = f.read()
+        with open(self.filename, 'wb') as f:
+            f.write(blob[:-10])
+        with self.assertRaises(ValueError):
+            load_utxo_snapshot(self.filename)
+
+    def test_dump_and_load(self):
+        for include_scripts in [ False, True ]:
+            utxoset = UtxoSet(include_scripts = include_scripts, check_collisions = True)
+            txs, coins = self._make_coins()
+            for tx in txs:
+                tx_coins = [ coin for coin in coins if coin[0] == tx.txid ]
+                utxoset.add(tx.txid, [ coin[2] for coin in tx_coins ], tx_coins[0][3], [ coin[1] for coin in tx_coins ])
+            # some are in the overflow table, some in the block-local table:
+            utxoset.add(txs[0].txid[:8] + bytes(24), txs[0].outputs, 7)
+            utxoset.begin_block()
+            tx = make_tx([], [ (123, b'\x51') ], coinbase_tag = b'new')
+            utxoset.add(tx.txid, tx.outputs, 20)
+            num_utxos = utxoset.get_num_unspent_outputs()
+            self.assertEqual(dump_utxo_snapshot(utxoset, self.filename, BASE_BLOCK_HASH), num_utxos)
+            utxoset2, meta = load_utxo_snapshot(self.filename, include_scripts = include_scripts, check_collisions = True)
+            self.assertEqual(meta.coins_count, num_utxos)
+            self.assertEqual(utxoset2.num_collisions, 1)
+            self.assertEqual(self._get_utxos(utxoset2), self._get_utxos(utxoset))
+            for txid, vout, txout, _, _ in coins:
+                spent_output = utxoset2.spend(bytearray(txid), vout).spent_output
+                self.assertEqual(spent_output.value, txout.value)
+                self.assertEqual(spent_output.script, txout.script if include_scripts else None)
+
+    def _get_utxos(self, utxoset):
+        arrays = utxoset.to_arrays()
+        return sorted(zip(arrays.key.tolist(), arrays.output_idx.tolist(), arrays.value.tolist(), arrays.block_height.tolist()))
+
+    def _make_coins(self):
+        txs = []
+        coins = []
+        for i in range(20):
+            outputs = [ (1000 * i + oidx, script) for oidx, script in enumerate(SCRIPTS) ]
+            tx = make_tx([], outputs, coinbase_tag = i.to_bytes(4, 'little'))
+            txs.append(tx)
+            for vout, txout in enumerate(tx.outputs):
+                if (i + vout) % 3 != 0:  # some are spent
+                    coins.append(( tx.txid, vout, txout, i, vout == 0 ))
+        coins.sort(key = lambda coin: ( coin[0], coin[1] ))
+        return txs, coins
+
+################################################################################
+
+if __name__ == '__main__':
+    unittest.main()
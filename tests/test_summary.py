@@ -0,0 +1,75 @@
+"""
+Unit-testing skipping of summarized files, using artificial data.
+"""
+
+import unittest
+import tempfile
+import os
+
+from chainscan.scan import LongestChainBlockIterator, BlockFilter
+from chainscan.summary import FileSummaries
+from tests.artificial import gen_chain_with_txs, write_raw_files
+
+################################################################################
+
+class FileSummaryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.data_dir = os.path.join(self.tmpdir.name, 'blocks')
+        self.summaries_dir = os.path.join(self.tmpdir.name, 'summaries')
+        os.mkdir(self.data_dir)
+        self.blocks = gen_chain_with_txs(40)
+        self.filenames = write_raw_files(self.data_dir, self.blocks, blocks_per_file = 10)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _iter_blocks(self, **kwargs):
+        return LongestChainBlockIterator(data_dir = self.data_dir, height_safety_margin = 1, **kwargs)
+
+    def test_summaries(self):
+        block_iter = self._iter_blocks(summaries = FileSummaries(self.summaries_dir))
+        blocks = list(block_iter)
+        # all files but the last are summarized
+        summaries = FileSummaries(self.summaries_dir)
+        for i, filename in enumerate(self.filenames[:-1]):
+            summary = summaries.get(filename)
+            self.assertEqual(summary.num_blocks, 10)
+            self.assertEqual(( summary.min_height, summary.max_height ), ( 10 * i, 10 * i + 9 ))
+            self.assertTrue(summary.contains_hash(blocks[10 * i].block_hash))
+            self.assertFalse(summary.contains_hash(blocks[10 * i + 10].block_hash))
+        self.assertIsNone(summaries.get(self.filenames[-1]))
+
+    def test_skipping(self):
+        list(self._iter_blocks(summaries = FileSummaries(self.summaries_dir)))
+        timestamps = [ block.timestamp for block in self.blocks ]
+        block_filters = [
+            ( dict(start_block_height = 25), 2 ),
+            ( dict(start_block_height = 25, stop_block_height = 28), 2 ),
+            ( dict(start_block_height = 20), 2 ),  # the first block of a file
+            ( dict(stop_block_height = 10), 1 ),  # files after the stop are not reached (but the next one)
+            ( dict(start_block_time = timestamps[21]), 2 ),
+            ( dict(start_block_time = timestamps[15], stop_block_time = timestamps[17]), 1 ),
+        ]
+        for kwargs, num_skipped in block_filters:
+            expected = list(self._iter_blocks(block_filter = BlockFilter(**kwargs)))
+            block_iter = self._iter_blocks(block_filter = BlockFilter(**kwargs), summaries = FileSummaries(self.summaries_dir))
+            blocks = list(block_iter)
+            self.assertEqual([ b.block_hash for b in blocks ], [ b.block_hash for b in expected ], kwargs)
+            self.assertEqual([ b.height for b in blocks ], [ b.height for b in expected ], kwargs)
+            self.assertEqual([ b.num_txs for b in blocks ], [ b.num_txs for b in expected ], kwargs)
+            self.assertEqual(block_iter.block_iter.rawfile_block_iter.num_skipped_files, num_skipped, kwargs)
+
+    def test_modified_file(self):
+        list(self._iter_blocks(summaries = FileSummaries(self.summaries_dir)))
+        # appending to a file invalidates its summary
+        with open(self.filenames[0], 'ab') as f:
+            f.write(b'\0' * 8)
+        self.assertIsNone(FileSummaries(self.summaries_dir).get(self.filenames[0]))
+        self.assertIsNotNone(FileSummaries(self.summaries_dir).get(self.filenames[1]))
+
+################################################################################
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+"""
+Unit-testing TxIndex, using artificial data.
+"""
+
+import unittest
+import tempfile
+import pickle
+import os
+
+from chainscan.scan import TxIterator, BlockFilter
+from chainscan.txindex import TxIndex
+from chainscan.scriptindex import ScriptIndex
+from chainscan.spentbyindex import SpentByIndex
+from chainscan.track import TrackedSpendingTxIterator
+from tests.artificial import gen_chain_with_txs, write_raw_files
+
+################################################################################
+
+class TxIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.data_dir = os.path.join(self.tmpdir.name, 'blocks')
+        self.index_dir = os.path.join(self.tmpdir.name, 'txindex')
+        os.mkdir(self.data_dir)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_build_and_lookup(self):
+        blocks = gen_chain_with_txs(30)
+        write_raw_files(self.data_dir, blocks[:14], blocks_per_file = 7)
+        txindex = TxIndex(self.index_dir, flush_size = 5, max_runs = 4)
+        self._scan(txindex)
+        txindex.close()
+        self.assertEqual(txindex.height, 13)
+        self.assertLessEqual(len(txindex._runs), 4)
+
+        # extend incrementally, in a new TxIndex
+        write_raw_files(self.data_dir, blocks, blocks_per_file = 7)
+        txindex = TxIndex(self.index_dir, flush_size = 5, max_runs = 4)
+        self._scan(txindex, block_filter = BlockFilter(start_block_height = txindex.height + 1))
+        # a rescan from genesis does not add duplicates
+        self._scan(txindex)
+        txindex.close()
+        self.assertEqual(txindex.height, 29)
+
+        txindex = TxIndex(self.index_dir)
+        txs = list(TxIterator(data_dir = self.data_dir, height_safety_margin = 1, include_tx_blob = True))
+        self.assertEqual(len(txindex), len(txs))
+        for tx in txs:
+            tx2 = txindex.get_tx(tx.txid)
+            self.assertEqual(tx2.txid, tx.txid)
+            self.assertEqual(tx2.rawsize, tx.rawsize)
+            self.assertEqual([ o.value for o in tx2.outputs ], [ o.value for o in tx.outputs ])
+        self.assertEqual(txindex.get_tx(txs[5].txid_hex).txid, txs[5].txid)
+        self.assertEqual(txindex.get_locations(txs[-1].txid)[0].height, 29)
+        with self.assertRaises(KeyError):
+            txindex.get_tx(bytes(32))
+        self.assertNotIn(txs[0].txid[:8] + bytes(24), txindex)
+        # pickling
+        self.assertEqual(pickle.loads(pickle.dumps(txindex)).get_tx(txs[3].txid).txid, txs[3].txid)
+
+    def test_script_index(self):
+        blocks = gen_chain_with_txs(30)
+        write_raw_files(self.data_dir, blocks[:20], blocks_per_file = 7)
+        script_index = ScriptIndex(self.index_dir, flush_size = 10, max_runs = 3)
+        script_index.MERGE_CHUNK_SIZE = 16  # merging in several chunks
+        self._scan(script_index = script_index)
+        # more blocks arrive
+        write_raw_files(self.data_dir, blocks, blocks_per_file = 7)
+        self._scan(script_index = script_index, block_filter = BlockFilter(start_block_height = script_index.height + 1))
+        script_index.close()
+
+        expected = {}
+        for tx in TxIterator(data_dir = self.data_dir, height_safety_margin = 1, include_block_context = True):
+            for oidx, txout in enumerate(tx.outputs):
+                expected.setdefault(txout.script, []).append(( tx.block.height, tx.txid, oidx, txout.value ))
+        script_index = ScriptIndex(self.index_dir)
+        self.assertEqual(len(script_index), sum( len(v) for v in expected.values() ))
+        for script, postings in expected.items():
+            self.assertEqual(
+                [ ( int(p['height']), int(p['output_idx']), int(p['value']) ) for p in script_index.get_postings(script) ],
+                [ ( height, oidx, value ) for height, _, oidx, value in postings ])
+            self.assertEqual(
+                [ ( tx.txid, oidx ) for tx, oidx in script_index.get_txs(script) ],
+                [ ( txid, oidx ) for _, txid, oidx, _ in postings ])
+        script = max(expected, key = lambda script: len(expected[script]))
+        self.assertEqual(script_index.get_total_received(script), sum( p[3] for p in expected[script] ))
+        self.assertEqual(len(script_index.get_postings(b'\x6a')), 0)
+
+    def test_spent_by_index(self):
+        write_raw_files(self.data_dir, gen_chain_with_txs(20), blocks_per_file = 7)
+        # built during a tracked scan
+        spent_by_index = SpentByIndex(self.index_dir, flush_size = 10, max_runs = 3)
+        txindex = TxIndex(os.path.join(self.tmpdir.name, 'locations'))
+        txs = list(TrackedSpendingTxIterator(
+            data_dir = self.data_dir, height_safety_margin = 1, spent_by_index = spent_by_index, txindex = txindex))
+        spent_by_index.close()
+        txindex.close()
+
+        spent_by_index = SpentByIndex(self.index_dir)
+        spenders = {}
+        for tx in txs:
+            if not tx.is_coinbase:
+                for input_idx, txin in enumerate(tx.inputs):
+                    spenders[( txin.spent_txid, txin.spent_output_idx )] = ( tx.txid, input_idx )
+        self.assertEqual(len(spent_by_index), len(spenders))
+        num_spent = 0
+        for tx in txs:
+            for oidx in range(len(tx.outputs)):
+                res = spent_by_index.get_spending_tx(tx.txid, oidx)
+                if res is None:
+                    self.assertNotIn(( tx.txid, oidx ), spenders)
+                else:
+                    num_spent += 1
+                    spending_tx, input_idx = res
+                    self.assertEqual(( spending_tx.txid, input_idx ), spenders[( tx.txid, oidx )])
+                    # and back
+                    txin = spending_tx.inputs[input_idx]
+                    self.assertEqual(txindex.get_tx(txin.spent_txid).txid, tx.txid)
+        self.assertEqual(num_spent, len(spenders))
+        self.assertEqual(len(spent_by_index.get_spenders(txs[1].txid)), len(txs[1].outputs))
+
+    def test_buffered(self):
+        write_raw_files(self.data_dir, gen_chain_with_txs(10), blocks_per_file = 7)
+        txs = list(TxIterator(data_dir = self.data_dir, height_safety_margin = 1))
+        # looked up before flushing
+        with TxIndex(self.index_dir) as txindex:
+            self._scan(txindex)
+            self.assertEqual(len(txindex._runs), 0)
+            self.assertEqual(len(txindex), len(txs))
+            for tx in txs:
+                self.assertEqual(txindex.get_tx(tx.txid).txid, tx.txid)
+        # flushed on exiting the block
+        self.assertEqual(len(TxIndex(self.index_dir)), len(txs))
+
+    def test_close_mid_block(self):
+        write_raw_files(self.data_dir, gen_chain_with_txs(20), blocks_per_file = 7)
+        txs = list(TxIterator(data_dir = self.data_dir, height_safety_margin = 1))
+        for index_cls in [ TxIndex, ScriptIndex ]:
+            index_dir = os.path.join(self.tmpdir.name, index_cls.__name__)
+            # stopping in the middle of block #10
+            with index_cls(index_dir, flush_size = 5) as index:
+                for tx in TxIterator(data_dir = self.data_dir, height_safety_margin = 1, include_block_context = True,
+                                     **{ 'txindex' if index_cls is TxIndex else 'script_index': index }):
+                    if tx.block.height == 10 and tx.index == 1:
+                        break
+            index = index_cls(index_dir)
+            self.assertEqual(index.height, 9)
+            # resuming
+            with index:
+                self._scan(**{ 'txindex' if index_cls is TxIndex else 'script_index': index },
+                           block_filter = BlockFilter(start_block_height = index.height + 1))
+            index = index_cls(index_dir)
+            self.assertEqual(index.height, 19)
+            if index_cls is TxIndex:
+                self.assertEqual(len(index), len(txs))
+                for tx in txs:
+                    self.assertEqual(index.get_tx(tx.txid).txid, tx.txid)
+            else:
+                self.assertEqual(len(index), sum( len(tx.outputs) for tx in txs ))
+
+    def test_flush_on_del(self):
+        write_raw_files(self.data_dir, gen_chain_with_txs(10), blocks_per_file = 7)
+        script_index = ScriptIndex(self.index_dir)
+        self._scan(script_index = script_index)
+        num_postings = len(script_index)
+        # an unpickled copy is not flushed
+        copy = pickle.loads(pickle.dumps(script_index))
+        self.assertEqual(len(copy), num_postings)
+        del copy
+        self.assertEqual(len(ScriptIndex(self.index_dir)), 0)
+        # the index itself is
+        del script_index
+        script_index = ScriptIndex(self.index_dir)
+        self.assertEqual(len(script_index._runs), 1)
+        self.assertEqual(len(script_index), num_postings)
+
+    def _scan(self, txindex = None, **kwargs):
+        for _ in TxIterator(data_dir = self.data_dir, height_safety_margin = 1, txindex = txindex, **kwargs):
+            pass
+
+################################################################################
+
+if __name__ == '__main__':
+    unittest.main()
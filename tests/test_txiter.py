@@ -3,9 +3,13 @@ Unit-testing the various tx-iterators, including spending-tracking.
 """
 
 import unittest
+import tempfile
+import pickle
 
 from chainscan.scan import TxIterator
 from chainscan.track import TrackedSpendingTxIterator, UtxoSet
+from chainscan.tx import BlockContext
+from tests.artificial import gen_chain_with_txs, write_raw_files
 
 ################################################################################
 
@@ -94,6 +98,62 @@ class TxIterTest(unittest.TestCase):
             self.assertGreaterEqual(last_block_height, 1000)
         
     
+class BlockContextTest(unittest.TestCase):
+
+    def test_light_block_context(self):
+        blocks = gen_chain_with_txs(10)
+        with tempfile.TemporaryDirectory() as data_dir:
+            write_raw_files(data_dir, blocks)
+            kwargs = dict(data_dir = data_dir, height_safety_margin = 1)
+            txs = list(TxIterator(include_block_context = True, **kwargs))
+            light_txs = list(TrackedSpendingTxIterator(include_block_context = 'light', **kwargs))
+        self.assertEqual([ tx.txid for tx in light_txs ], [ tx.txid for tx in txs ])
+        for tx, light_tx in zip(txs, light_txs):
+            context = light_tx.block
+            self.assertIsInstance(context, BlockContext)
+            self.assertEqual(context.height, tx.block.height)
+            self.assertEqual(context.block_hash, tx.block.block_hash)
+            self.assertEqual(context.timestamp, tx.block.timestamp)
+            self.assertEqual(light_tx.index, tx.index)
+        self.assertIs(light_txs[1].block, light_txs[2].block)  # shared by the txs of a block
+        with self.assertRaises(AttributeError):
+            context.height = 0
+        self.assertEqual(pickle.loads(pickle.dumps(context)), context)
+
+class DetachTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.blocks = gen_chain_with_txs(30)
+        write_raw_files(self.tmpdir.name, self.blocks, blocks_per_file = 10)
+        self.kwargs = dict(data_dir = self.tmpdir.name, height_safety_margin = 1)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_detach(self):
+        txs = list(TxIterator(include_block_context = True, **self.kwargs))
+        tx = txs[-1]
+        block = tx.block
+        state = pickle.dumps(( tx, block ))
+        tx.detach()
+        block.detach()
+        # only copies of the objects' own data are kept
+        self.assertEqual(len(tx.version_bytes.base), 4)
+        self.assertEqual(len(tx.inputs[0].script.base), len(tx.inputs[0].script))
+        self.assertEqual(len(block.blob.base), block.rawsize)
+        self.assertEqual(pickle.dumps(( tx, block )), state)
+        self.assertEqual([ t.txid for t in block.txs ], [ t.txid for t in txs if t.block is block ])
+
+    def test_auto_detach(self):
+        txs = list(TxIterator(auto_detach = True, include_block_context = True, **self.kwargs))
+        self.assertEqual([ tx.txid for tx in txs ], [ tx.txid for tx in TxIterator(**self.kwargs) ])
+        # txs from all files but the last are detached
+        for tx in txs:
+            if tx.block.height < 20:
+                self.assertEqual(len(tx.version_bytes.base), 4)
+                self.assertEqual(len(tx.block.blob.base), tx.block.rawsize)
+
 ################################################################################
 
 if __name__ == '__main__':
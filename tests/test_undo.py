@@ -0,0 +1,130 @@
+"""
+Unit-testing resolving spent outputs from undo files, using artificial data.
+"""
+
+import unittest
+import tempfile
+import pickle
+import os
+import struct
+import hashlib
+
+from chainscan.undo import UndoSpendingTxIterator, UndoIndex
+from chainscan.misc import Bunch, FilePos
+from chainscan.defs import MAGIC
+from chainscan._coins_c import deserialize_varint, decompress_amount, decompress_script
+from tests.artificial import gen_chain_with_txs, write_raw_files, write_undo_files, \
+    get_spent_outputs, to_core_varint, compress_amount
+
+################################################################################
+
+# secp256k1's generator point
+G_X = bytes.fromhex('79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798')
+G_Y = bytes.fromhex('483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8')
+
+################################################################################
+
+class CoinsTest(unittest.TestCase):
+
+    def test_varint(self):
+        for n in [ 0, 1, 0x7f, 0x80, 0x1234, 2**32, 2**63 ]:
+            self.assertEqual(deserialize_varint(bytearray(to_core_varint(n) + b'\xff')), ( n, len(to_core_varint(n)) ))
+
+    def test_amount(self):
+        for n in [ 0, 1, 546, 5000000000, 2100000000000000, 123456789, 10**9 ]:
+            self.assertEqual(decompress_amount(compress_amount(n)), n)
+
+    def test_pubkey_scripts(self):
+        # G.y is even
+        self.assertEqual(decompress_script(2, bytearray(G_X)), b'\x21\x02' + G_X + b'\xac')
+        self.assertEqual(decompress_script(4, bytearray(G_X)), b'\x41\x04' + G_X + G_Y + b'\xac')
+
+
+class UndoTest(unittest.TestCase):
+
+    NUM_BLOCKS = 30
+    BLOCKS_PER_FILE = 7
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.blocks = gen_chain_with_txs(self.NUM_BLOCKS)
+        write_raw_files(self.tmpdir.name, self.blocks, self.BLOCKS_PER_FILE)
+        write_undo_files(self.tmpdir.name, self.blocks, self.BLOCKS_PER_FILE)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_undo_txiter(self):
+        all_undo = get_spent_outputs(self.blocks)
+        num_inputs = 0
+        for tx in self._make_iter():
+            block_undo = all_undo[tx.block.height]
+            if tx.is_coinbase:
+                continue
+            tx_undo = block_undo[tx.index - 1]
+            for txin, ( txout, height, is_coinbase ) in zip(tx.inputs, tx_undo):
+                self.assertEqual(txin.value, txout.value)
+                self.assertEqual(txin.output_script, txout.script)
+                self.assertEqual(txin.spending_info.block_height, height)
+                self.assertEqual(txin.spending_info.is_coinbase, is_coinbase)
+                num_inputs += 1
+        self.assertEqual(num_inputs, sum( len(tx_undo) for block_undo in all_undo for tx_undo in block_undo ))
+
+    def test_resumability(self):
+        txiter = self._make_iter()
+        txids = [ tx.txid for tx in self._make_iter() ]
+        for i, txid in enumerate(txids):
+            tx = next(txiter)
+            self.assertEqual(tx.txid, txid)
+            if not tx.is_coinbase:
+                self.assertIsNotNone(tx.inputs[0].spent_output)
+            if i % 10 == 0:
+                txiter = pickle.loads(pickle.dumps(txiter))
+
+    def test_save_index(self):
+        undo_index = UndoIndex()
+        for tx in self._make_iter(undo_index = undo_index):
+            pass
+        filename = os.path.join(self.tmpdir.name, 'undo.idx')
+        undo_index.save(filename)
+        undo_index2 = UndoIndex.load(filename)
+        block = self.blocks[5]
+        block.filepos = None  # location is known from the index
+        filepos, filepos2 = undo_index.locate(block), undo_index2.locate(block)
+        self.assertEqual(( filepos.filename, filepos.offset ), ( filepos2.filename, filepos2.offset ))
+        self.assertEqual(len(undo_index2.get_block_undo(block)), block.num_txs - 1)
+
+    def test_core_format(self):
+        # The first records of mainnet's rev00000.dat: the (empty) undo data of
+        # blocks #1 and #2.  bitcoind's checksum is SHA256d(prev block hash + data).
+        def sha256d(data):
+            return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+        def header(prev_block_hash, merkle_root_hex, timestamp, nonce):
+            return struct.pack('<I', 1) + prev_block_hash + bytes.fromhex(merkle_root_hex)[::-1] + struct.pack('<III', timestamp, 0x1d00ffff, nonce)
+        genesis_hash = bytes.fromhex('000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26f')[::-1]
+        header1 = header(genesis_hash, '0e3e2357e806b6cdb1f70b54c3a3a17b6714ee1f0e68bebb44a74b1efd512098', 1231469665, 2573394689)
+        header2 = header(sha256d(header1), '9b0fc92260312ce44e74ef369f5c66bbb85848f2eddd5a7a1cde251e54ccfdd5', 1231469744, 1639830024)
+        self.assertEqual(sha256d(header2)[::-1].hex(), '000000006a625f06636b8bb6ac7b960a8d03705d1ace08b1a19da3fdcc99ddbd')
+        raw_filename = os.path.join(self.tmpdir.name, 'blk99999.dat')
+        blocks = [
+            Bunch(block_hash = sha256d(hdr), prev_block_hash = hdr[4:36], num_txs = 1, filepos = FilePos(raw_filename, 0), block_hash_hex = sha256d(hdr)[::-1].hex())
+            for hdr in [ header1, header2 ]
+        ]
+        # records of blocks with the same data, in reverse order
+        records = [ struct.pack('<II', MAGIC, 1) + b'\x00' + sha256d(block.prev_block_hash + b'\x00') for block in reversed(blocks) ]
+        with open(os.path.join(self.tmpdir.name, 'rev99999.dat'), 'wb') as f:
+            f.write(b''.join(records))
+        undo_index = UndoIndex()
+        self.assertEqual(undo_index.locate(blocks[0]).offset, len(records[0]))
+        self.assertEqual(undo_index.locate(blocks[1]).offset, 0)
+
+    def _make_iter(self, **kwargs):
+        return UndoSpendingTxIterator(
+            include_block_context = True, data_dir = self.tmpdir.name, height_safety_margin = 1, **kwargs)
+
+################################################################################
+
+if __name__ == '__main__':
+    unittest.main()
+
+################################################################################
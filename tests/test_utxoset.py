@@ -0,0 +1,317 @@
+"""
+Unit-testing the UtxoSet data structure, using artificial txs.
+"""
+
+import unittest
+import tempfile
+import random
+import numpy as np
+
+from chainscan.track import UtxoSet, TxSpendingTracker, TrackedSpendingTxIterator
+from chainscan.shard import ShardedUtxoSet
+from chainscan.misc import Bunch
+from tests.artificial import make_tx, p2pkh_script, p2sh_script, p2wpkh_script, gen_chain_with_txs, write_raw_files
+
+################################################################################
+
+SCRIPTS = [
+    p2pkh_script(bytes(range(20))),
+    p2sh_script(bytes(range(1, 21))),
+    p2wpkh_script(bytes(range(2, 22))),
+    b'\x6a\x04abcd',  # OP_RETURN
+    b'',
+    b'\x51' * 3000,  # "big" non-standard script
+    p2pkh_script(bytes(20))[:-1],  # almost-P2PKH
+]
+
+################################################################################
+
+class UtxoSetTest(unittest.TestCase):
+
+    def test_spend_values(self):
+        self._test_spend(UtxoSet())
+
+    def test_spend_scripts(self):
+        self._test_spend(UtxoSet(include_scripts = True), check_scripts = True)
+
+    def test_script_arena_reuse(self):
+        utxoset = UtxoSet(include_scripts = True)
+        for i in range(50):
+            tx = self._make_tx(i)
+            utxoset.add_from_tx(tx)
+            for oidx in range(len(tx.outputs)):
+                utxoset.spend(bytearray(tx.txid), oidx)
+        self.assertEqual(len(utxoset), 0)
+        # everything was spent. at most the current chunk is kept.
+        self.assertLessEqual(utxoset.scripts_size, 1 << 20)
+
+    def test_spend_missing(self):
+        utxoset = UtxoSet(include_scripts = True)
+        with self.assertRaises(KeyError):
+            utxoset.spend(bytearray(32), 0)
+        tx = self._make_tx(1)
+        utxoset.add_from_tx(tx)
+        utxoset.spend(bytearray(tx.txid), 0)
+        with self.assertRaises(KeyError):
+            utxoset.spend(bytearray(tx.txid), 0)  # already spent
+        with self.assertRaises(KeyError):
+            utxoset.spend(bytearray(tx.txid), len(tx.outputs))
+
+    def test_in_block_spends(self):
+        for include_scripts in [ False, True ]:
+            utxoset = UtxoSet(include_scripts = include_scripts)
+            tx1 = self._make_tx(1)
+            tx2 = make_tx([ (tx1.txid, 0) ], [ (5, b'\x51'), (6, b'\x52') ])
+            tx3 = make_tx([ (tx2.txid, 1) ], [ (7, b'\x53') ])
+            utxoset.begin_block()
+            for tx in [ tx1, tx2 ]:
+                utxoset.add_from_tx(tx)
+            self.assertEqual(utxoset.spend(bytearray(tx1.txid), 0).spent_output.value, 0 + 1000)
+            utxoset.add_from_tx(tx3)
+            self.assertEqual(utxoset.spend(bytearray(tx2.txid), 1).spent_output.value, 6)
+            self.assertEqual(len(utxoset), 3)
+            utxoset.end_block()
+            # survivors are now in the global set
+            self.assertEqual(len(utxoset), 3)
+            utxoset.begin_block()
+            self.assertEqual(utxoset.spend(bytearray(tx2.txid), 0).spent_output.value, 5)
+            self.assertEqual(utxoset.spend(bytearray(tx3.txid), 0).spent_output.value, 7)
+            utxoset.end_block()
+            self.assertEqual(len(utxoset), 1)
+
+    def test_sharded_in_block_spends(self):
+        with ShardedUtxoSet(2, include_scripts = True) as utxoset:
+            tracker = TxSpendingTracker(utxoset = utxoset)
+            tx1 = self._make_tx(1)
+            tx2 = make_tx([ (tx1.txid, 0) ], [ (5, b'\x51'), (6, b'\x52') ])
+            tx3 = make_tx([ (tx2.txid, 1), (tx1.txid, 1) ], [ (7, b'\x53') ])
+            tracker.process_block_txs([ tx1, tx2 ])
+            self.assertEqual(tx2.inputs[0].spending_info.spent_output.script, tx1.outputs[0].script)
+            self.assertEqual(len(utxoset), 2)
+            tracker.process_block_txs([ tx3 ])
+            self.assertEqual([ txin.spending_info.spent_output.value for txin in tx3.inputs ], [ 6, 1001 ])
+            self.assertEqual(utxoset.get_num_unspent_outputs(), len(SCRIPTS) - 2 + 2)
+            with self.assertRaises(KeyError):
+                tracker.process_tx(make_tx([ (tx1.txid, 1) ], [ (8, b'') ]))
+
+    def test_batch(self):
+        for include_scripts in [ False, True ]:
+            utxoset = UtxoSet(include_scripts = include_scripts)
+            txs = [ self._make_tx(i) for i in range(3) ]
+            # the 2nd tx has only some of its outputs
+            output_idxs = [ list(range(len(SCRIPTS))), [ 1, 4 ], [ 0 ] ]
+            outputs = [ tx.outputs[oidx] for tx, oidxs in zip(txs, output_idxs) for oidx in oidxs ]
+            script_offsets = np.cumsum([ 0 ] + [ len(o.script) for o in outputs ]).astype(np.uint64)
+            utxoset.add_batch(
+                b''.join( tx.txid for tx in txs ),
+                np.array([ 5, 6, 7 ], dtype = np.int32),
+                np.array([ len(oidxs) for oidxs in output_idxs ], dtype = np.uint32),
+                np.array(sum(output_idxs, []), dtype = np.uint32),
+                np.array([ o.value for o in outputs ], dtype = np.uint64),
+                script_offsets, b''.join( o.script for o in outputs ),
+            )
+            self.assertEqual(utxoset.get_num_unspent_outputs(), len(outputs))
+            spends = [ (txs[1], 4), (txs[1], 0), (txs[0], 5), (txs[2], 0), (txs[2], 0) ]
+            res = utxoset.spend_batch(
+                b''.join( tx.txid for tx, _ in spends ),
+                np.array([ oidx for _, oidx in spends ], dtype = np.uint32))
+            self.assertEqual(list(res.found), [ 1, 0, 1, 1, 0 ])
+            self.assertEqual(list(res.value), [ 1004, 0, 5, 2000, 0 ])
+            self.assertEqual(list(res.block_height[res.found == 1]), [ 6, 5, 7 ])
+            if include_scripts:
+                self.assertEqual(res.script_data[res.script_offset[2] : res.script_offset[3]], SCRIPTS[5])
+                self.assertEqual(res.script_offset[4], res.script_offset[5])
+            self.assertEqual(len(utxoset), 2)
+            self.assertEqual(utxoset.spend(bytearray(txs[1].txid), 1).spent_output.value, 1001)
+            with self.assertRaises(KeyError):
+                utxoset.spend(bytearray(txs[1].txid), 2)  # not added
+
+    def test_sharded_pipelined(self):
+        with ShardedUtxoSet(2) as utxoset:
+            tracker = TxSpendingTracker(utxoset = utxoset)
+            tx1 = self._make_tx(1)
+            tx2 = make_tx([ (tx1.txid, 0) ], [ (5, b'\x51') ])
+            tx3 = make_tx([ (tx2.txid, 0), (tx1.txid, 1) ], [ (7, b'\x53') ])
+            tx4 = make_tx([ (tx2.txid, 0) ], [ (8, b'') ])  # double-spend
+            for txs in [ [ tx1 ], [ tx2 ], [ tx3 ], [ tx4 ] ]:
+                tracker.submit_block_txs(txs)
+            self.assertEqual(tracker.num_pending_blocks, 4)
+            for _ in range(3):
+                tracker.collect_block()
+            self.assertEqual([ txin.spending_info.spent_output.value for txin in tx3.inputs ], [ 5, 1001 ])
+            with self.assertRaises(KeyError):
+                tracker.collect_block()
+            self.assertEqual(tracker.num_pending_blocks, 0)
+            self.assertEqual(utxoset.get_num_unspent_outputs(), len(SCRIPTS) - 2 + 2)
+
+    def test_sharded_no_undo(self):
+        with ShardedUtxoSet(1) as utxoset:
+            with self.assertRaises(ValueError):
+                TxSpendingTracker(utxoset = utxoset, undo_depth = 10)
+
+    def test_key_collisions(self):
+        # with key_size=1, many txs share a key
+        for include_scripts in [ False, True ]:
+            for in_block in [ False, True ]:
+                utxoset = UtxoSet(include_scripts = include_scripts, key_size = 1, check_collisions = True)
+                if in_block:
+                    utxoset.begin_block()
+                self._test_spend(utxoset, num_txs = 600, check_scripts = include_scripts, check_collisions = True)
+                self.assertEqual(utxoset.num_collisions, 0)
+
+    def test_overflow_full_txids(self):
+        # txids b and c collide with a (same key), and with each other (same key
+        # and check bytes), but are still told apart
+        utxoset = UtxoSet(key_size = 1, check_collisions = True)
+        a, b, c = b'\x01AAAA' + bytes(27), b'\x01BBBB' + bytes(27), b'\x01BBBB' + b'\x01' * 27
+        for value, txid in enumerate([ a, b, c ]):
+            utxoset.add(txid, [ Bunch(value = value, script = b'') ])
+        self.assertEqual(utxoset.num_collisions, 2)
+        self.assertEqual([ utxoset.spend(bytearray(txid), 0).spent_output.value for txid in [ c, b, a ] ], [ 2, 1, 0 ])
+        self.assertEqual(len(utxoset), 0)
+
+    def test_key_size(self):
+        with self.assertRaises(ValueError):
+            UtxoSet(key_size = 9)
+        self._test_spend(UtxoSet(key_size = 6))
+        # keys are packed: smaller keys take less memory
+        utxosets = [ UtxoSet(key_size = 6), UtxoSet(key_size = 8) ]
+        for i in range(100):
+            for utxoset in utxosets:
+                utxoset.add_from_tx(self._make_tx(i))
+        self.assertLess(utxosets[0].table_size, utxosets[1].table_size)
+        with self.assertRaises(ValueError):
+            utxosets[0].spend(bytearray(self._make_tx(0).txid[:8]), 0)
+
+    def test_table(self):
+        # many adds and spends, in random order, with colliding keys
+        rng = random.Random(0)
+        utxoset = UtxoSet(key_size = 2, check_collisions = True)
+        txs = [ make_tx([], [ (i, b''), (i + 1, b'') ], coinbase_tag = i.to_bytes(4, 'little')) for i in range(3000) ]
+        outpoints = []
+        for tx in txs:
+            utxoset.add_from_tx(tx)
+            outpoints += [ ( tx, 0 ), ( tx, 1 ) ]
+        self.assertEqual(len(utxoset), len(txs))
+        rng.shuffle(outpoints)
+        for tx, oidx in outpoints:
+            self.assertEqual(utxoset.spend(bytearray(tx.txid), oidx).spent_output.value, tx.outputs[oidx].value)
+        self.assertEqual(len(utxoset), 0)
+
+    def test_to_arrays(self):
+        utxoset = UtxoSet()
+        self.assertEqual(len(utxoset.to_arrays().value), 0)
+        self.assertEqual(len(utxoset.count_by_height()), 0)
+        txs = [ self._make_tx(i) for i in range(5) ]
+        for tx in txs:
+            utxoset.add_from_tx(tx)
+        utxoset.spend(bytearray(txs[0].txid), 1)
+        utxoset.begin_block()
+        tx = make_tx([ (txs[1].txid, 0) ], [ (10, b'') ])
+        utxoset.spend(bytearray(txs[1].txid), 0)
+        utxoset.add_from_tx(tx)
+        expected = {
+            ( int.from_bytes(t.txid[:8], 'little'), oidx ): txout.value
+            for t in txs + [ tx ] for oidx, txout in enumerate(t.outputs)
+        }
+        del expected[( int.from_bytes(txs[0].txid[:8], 'little'), 1 )]
+        del expected[( int.from_bytes(txs[1].txid[:8], 'little'), 0 )]
+        arrays = utxoset.to_arrays()
+        self.assertEqual(utxoset.get_num_unspent_outputs(), len(expected))
+        self.assertEqual(
+            { ( int(k), int(i) ): int(v) for k, i, v in zip(arrays.key, arrays.output_idx, arrays.value) },
+            expected)
+        self.assertTrue((arrays.block_height == -1).all())
+        self.assertEqual(utxoset.get_total_value(), sum(expected.values()))
+        self.assertEqual(utxoset.count_dust(), sum( 1 for v in expected.values() if v < 546 ))
+        self.assertEqual(utxoset.count_dust(1001), sum( 1 for v in expected.values() if v < 1001 ))
+
+    def _test_spend(self, utxoset, num_txs = 10, check_scripts = False, check_collisions = False):
+        txs = [ self._make_tx(i) for i in range(num_txs) ]
+        for tx in txs:
+            utxoset.add_from_tx(tx)
+        if check_collisions:
+            utxoset.end_block()
+            self.assertGreater(utxoset.num_collisions, 0)
+        self.assertEqual(len(utxoset), len(txs))
+        for tx in txs:
+            for oidx, txout in enumerate(tx.outputs):
+                spending_info = utxoset.spend(bytearray(tx.txid), oidx)
+                spent_output = spending_info.spent_output
+                self.assertEqual(spent_output.value, txout.value)
+                self.assertEqual(spending_info.block_height, -1)
+                if check_scripts:
+                    self.assertEqual(spent_output.script, txout.script)
+                else:
+                    self.assertIsNone(spent_output.script)
+        self.assertEqual(len(utxoset), 0)
+
+    def _make_tx(self, i):
+        outputs = [ (1000 * i + oidx, script) for oidx, script in enumerate(SCRIPTS) ]
+        return make_tx([], outputs, coinbase_tag = i.to_bytes(4, 'little'))
+
+class TrackedArtificialTest(unittest.TestCase):
+
+    NUM_BLOCKS = 30
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.blocks = gen_chain_with_txs(self.NUM_BLOCKS)
+        write_raw_files(self.tmpdir.name, self.blocks)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_tracked(self):
+        for include_scripts in [ False, True ]:
+            self._test_tracked(UtxoSet(include_scripts = include_scripts))
+
+    def test_tracked_sharded(self):
+        for include_scripts in [ False, True ]:
+            with ShardedUtxoSet(3, include_scripts = include_scripts) as utxoset:
+                self._test_tracked(utxoset)
+
+    def _test_tracked(self, utxoset):
+        include_scripts = utxoset.include_scripts
+        outputs = {}  # (txid, oidx) -> (output, height)
+        for block in self.blocks:
+            for tx in block.txs:
+                for oidx, txout in enumerate(tx.outputs):
+                    outputs[(tx.txid, oidx)] = (txout, block.height)
+        txiter = TrackedSpendingTxIterator(
+            utxoset = utxoset, include_block_context = True, data_dir = self.tmpdir.name,
+            height_safety_margin = 1)
+        num_inputs = 0
+        for tx in txiter:
+            if tx.is_coinbase:
+                continue
+            for txin in tx.inputs:
+                txout, height = outputs.pop((txin.spent_txid, txin.spent_output_idx))
+                self.assertEqual(txin.value, txout.value)
+                self.assertEqual(txin.spending_info.block_height, height)
+                if include_scripts:
+                    self.assertEqual(txin.output_script, txout.script)
+                num_inputs += 1
+        expected_num_inputs = sum(
+            len(tx.inputs)
+            for block in self.blocks
+            for tx in block.txs if not tx.is_coinbase
+        )
+        self.assertGreater(num_inputs, 0)
+        self.assertEqual(num_inputs, expected_num_inputs)
+        self.assertEqual(utxoset.get_num_unspent_outputs(), len(outputs))
+        self.assertEqual(utxoset.get_total_value(), sum( txout.value for txout, height in outputs.values() ))
+        if isinstance(utxoset, ShardedUtxoSet):
+            return
+        # UTXOs by height
+        heights = utxoset.to_arrays().block_height
+        counts = utxoset.count_by_height(bucket_size = 7)
+        self.assertEqual(counts.sum(), len(outputs))
+        self.assertEqual(counts[0], ((heights >= 0) & (heights < 7)).sum())
+
+################################################################################
+
+if __name__ == '__main__':
+    unittest.main()
+
+################################################################################